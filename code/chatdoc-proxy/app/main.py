@@ -2,13 +2,13 @@
 Author: longsion<xianglong_chen@intsig.net>
 Date: 2024-05-09 20:18:27
 LastEditors: longsion
-LastEditTime: 2025-03-09 09:31:28
+LastEditTime: 2026-10-18 15:22:40
 '''
 from fastapi import FastAPI, Request
 from app.controller.embedding_and_upload import embedding_and_upload, embedding_and_upload_personal
 from app.services.pdf_to_word import pdf_to_word
 from app.services.embedding import parallel_query
-from app.services.es import global_es
+from app.services.es import async_es
 from app.services.retrieve import Context, retrieve_small_by_document
 from app.services.analyst import analyst_query
 from app.services.backup_images import backup_file_images, BackupImageObject
@@ -118,7 +118,17 @@ async def html_list_to_markdown(html_list: list[str]):
 @app.post("/es_proxy/search")
 async def es_proxy_search(body: dict):
     index, search_body = body.get("index"), body.get("search_body")
-    return global_es.search(index, search_body)
+    return await async_es.search(index, search_body)
+
+
+@app.post("/es_proxy/msearch")
+async def es_proxy_msearch(body: dict):
+    return await async_es.msearch(body.get("searches") or [])
+
+
+@app.on_event("shutdown")
+async def close_async_es():
+    await async_es.close()
 
 
 @app.post("/retrieve/small")
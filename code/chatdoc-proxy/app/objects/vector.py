@@ -2,7 +2,7 @@
 Author: longsion<xianglong_chen@intsig.net>
 Date: 2024-07-14 17:54:10
 LastEditors: longsion
-LastEditTime: 2025-03-05 17:31:48
+LastEditTime: 2026-10-18 18:40:26
 '''
 
 from enum import Enum
@@ -19,6 +19,8 @@ class VectorEntity(BaseModel):
     uuid: str
     file_uuid: str
     vector: list[float]
+    # 两阶段召回的粗排向量（截断维度后归一化），未开启时为 None
+    coarse_vector: list[float] = None
 
 
 class TextWithoutVecEntity(BaseModel):
@@ -32,6 +34,7 @@ class PersonalVectorEntity(BaseModel):
     file_uuid: str
     user_id: str
     vector: list[float]
+    coarse_vector: list[float] = None
 
 
 class PersonalTextWithoutVecEntity(BaseModel):
@@ -2,7 +2,7 @@
 Author: longsion<xianglong_chen@intsig.net>
 Date: 2024-07-14 16:04:07
 LastEditors: longsion
-LastEditTime: 2025-03-09 08:14:40
+LastEditTime: 2026-10-18 18:40:26
 '''
 
 import heapq
@@ -21,6 +21,21 @@ from app.config import config
 EMBEDDING_URL = config["textin"]["embedding_url"]
 BATCH_SIZE = int(config["embedding"]["batch_size"])
 PARALLELS = int(config["embedding"]["parallels"])
+# 两阶段召回粗排向量维度，0 则不生成
+COARSE_DIMS = int(config["embedding"].get("coarse_dims") or 0)
+
+
+def matryoshka_truncate(vector, dimension: int) -> list[float]:
+    '''
+    Matryoshka embedding 取前 dimension 维并重新归一化，与 chatdoc 查询侧 pkg.embedding.matryoshka_truncate 一致
+    '''
+    head = np.asarray(vector[:dimension], dtype=np.float32)
+    norm = float(np.linalg.norm(head)) or 1.0
+    return (head / norm).tolist()
+
+
+def coarse_vector(vector):
+    return matryoshka_truncate(vector, COARSE_DIMS) if COARSE_DIMS else None
 
 
 @retry_exponential_backoff()
@@ -89,7 +104,7 @@ def acge_embedding_multi_by_entities(text_entity_list: list[TextWithoutVecEntity
     et = time.time()
     logger.info(f"acge_embedding_multi 请求成功，耗时{et - st:.2f}s")
     return [
-        VectorEntity(file_uuid=text_entity.file_uuid, uuid=text_entity.uuid, vector=embedding)
+        VectorEntity(file_uuid=text_entity.file_uuid, uuid=text_entity.uuid, vector=embedding, coarse_vector=coarse_vector(embedding))
         for embedding, text_entity in zip(completion.json()["result"]["embedding"], text_entity_list)
     ]
 
@@ -121,6 +136,7 @@ def acge_embedding_multi_by_personal_entities(text_entity_list: list[PersonalTex
             file_uuid=text_entity.file_uuid,
             uuid=text_entity.uuid,
             vector=embedding,
+            coarse_vector=coarse_vector(embedding),
             user_id=text_entity.user_id
         )
         for embedding, text_entity in zip(completion.json()["result"]["embedding"], text_entity_list)
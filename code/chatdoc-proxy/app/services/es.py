@@ -2,7 +2,7 @@
 Author: longsion<xianglong_chen@intsig.net>
 Date: 2024-07-15 15:12:21
 LastEditors: longsion
-LastEditTime: 2025-03-07 14:53:58
+LastEditTime: 2026-10-18 18:40:26
 '''
 import json
 from pydantic import BaseModel
@@ -124,10 +124,14 @@ class ES:
                     "_id": doc_id
                 }
             }))
+            doc = {
+                "acge_embedding": item["embedding"]
+            }
+            # 两阶段召回的粗排向量，字段名如 acge_embedding_256
+            if item.get("coarse_embedding"):
+                doc[f"acge_embedding_{len(item['coarse_embedding'])}"] = item["coarse_embedding"]
             bulk_data.append(json.dumps({
-                "doc": {
-                    "acge_embedding": item["embedding"]
-                }
+                "doc": doc
             }))
 
         if not bulk_data:
@@ -210,4 +214,67 @@ class ES:
             raise e
 
 
+class AsyncES:
+    """
+    基于 AsyncElasticsearch（aiohttp）的异步客户端，供 FastAPI 路由直接 await，
+    连接池常驻，多节点故障切换与重试由 transport 负责
+    """
+
+    def __init__(self):
+        self.hosts = config["es"]["hosts"].split("|")
+        self.username = config["es"].get("username")
+        self.password = config["es"].get("password")
+        self._conn = None
+
+    @property
+    def conn(self):
+        # 延迟创建：AsyncElasticsearch 需要在事件循环中初始化
+        if self._conn is None:
+            from elasticsearch import AsyncElasticsearch
+
+            options = dict(
+                connections_per_node=int(config["es"].get("connections_per_node") or 32),
+                request_timeout=float(config["es"].get("request_timeout") or 30),
+                max_retries=int(config["es"].get("max_retries") or 2),
+                retry_on_timeout=True,
+            )
+            if self.username:
+                options.update(basic_auth=(self.username, self.password), verify_certs=False)
+            self._conn = AsyncElasticsearch(self.hosts, **options)
+        return self._conn
+
+    async def search(self, index, search_body):
+        try:
+            st = time.time()
+            resp = await self.conn.search(index=index, body=search_body)
+            et = time.time()
+            if et - st > 0.5:
+                logger.warning(f"ES search too slow: {et - st}s, index: {index}, search_body: {json.dumps(search_body, ensure_ascii=False)}")
+            return resp.body
+        except Exception as e:
+            logger.error(f"ES Error: search_body: {json.dumps(search_body, ensure_ascii=False)}")
+            raise e
+
+    async def msearch(self, searches: list[dict]):
+        """
+        searches: [{"index": index, "search_body": search_body}, ...]
+        """
+        body = []
+        for item in searches:
+            body.append({"index": item["index"]})
+            body.append(item["search_body"])
+        try:
+            resp = await self.conn.msearch(searches=body)
+            return resp.body
+        except Exception as e:
+            logger.error(f"ES Error: msearch indexes: {[item['index'] for item in searches]}")
+            raise e
+
+    async def close(self):
+        if self._conn is not None:
+            await self._conn.close()
+            self._conn = None
+
+
 global_es = ES()
+async_es = AsyncES()
@@ -9,7 +9,8 @@ def insert_entities(ins_entities: list[VectorEntity]):
         items=[
             {
                 "uuid": entity.uuid,
-                "embedding": entity.vector
+                "embedding": entity.vector,
+                "coarse_embedding": entity.coarse_vector,
             }
             for entity in ins_entities
         ]
@@ -22,7 +23,8 @@ def insert_personal_entities(ins_entities: list[PersonalVectorEntity]):
         items=[
             {
                 "uuid": entity.uuid,
-                "embedding": entity.vector
+                "embedding": entity.vector,
+                "coarse_embedding": entity.coarse_vector,
             }
             for entity in ins_entities
         ]
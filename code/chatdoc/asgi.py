@@ -0,0 +1,88 @@
+'''
+Author: longsion<xianglong_chen@intsig.net>
+Date: 2026-10-18 16:20:37
+LastEditors: longsion
+LastEditTime: 2026-10-19 09:20:11
+'''
+
+# asyncio 模式入口
+# /api/v1/*/infer 走异步链路：召回等同步阶段提交到有界的请求线程池（threadpool.request_worker），LLM 流式输出与 SSE 推送在事件循环中完成，不再占用线程
+# 其余接口挂载原 Flask 应用
+# 启动: gunicorn -w 4 -k uvicorn.workers.UvicornWorker -b 0.0.0.0:5000 asgi:app
+
+import json
+
+from fastapi import FastAPI, Request
+from fastapi.middleware.wsgi import WSGIMiddleware
+from fastapi.responses import JSONResponse, StreamingResponse
+
+from main import app as flask_app
+from pkg.utils.aio import close_async_http_client, run_sync, set_request_thread_context
+from pkg.utils.jaeger import tracer
+from pkg.utils.logger import logger
+from pkg.utils.thread_with_return_value import ThreadContext
+
+
+app = FastAPI()
+
+
+def return_data(code, data):
+    if code == 500:
+        data = {
+            "err": data
+        }
+    return JSONResponse({"code": code, "data": data})
+
+
+async def _infer(name: str, request: Request):
+    if name == "analyst":
+        from pkg.analyst import process, Params
+    elif name == "personal":
+        from pkg.personal import process, Params
+    else:
+        from pkg.global_ import process, Params
+
+    params = Params(**json.loads(await request.body()))
+    params.compliance_check = False
+
+    with tracer.start_as_current_span(f"infer_{name}") as span:
+        set_request_thread_context(ThreadContext(trace_id=f"{span.get_span_context().trace_id:0x}"))
+        logger.info(f"{name} infer params: {params.model_dump_json()}")
+        result = await run_sync(process, params)
+
+    logger.info(f"resp trace_id: {result.trace_id}")
+    if result.answer_response_aiter:
+        return StreamingResponse(result.answer_response_aiter, status_code=200, media_type="text/event-stream", headers={"Connection": "keep-alive", "Cache-Control": "no-cache"})
+
+    else:
+        return return_data(200, result.answer_response.model_dump())
+
+
+@app.api_route("/api/v1/analyst/infer", methods=["POST", "GET"])
+async def infer_analyst(request: Request):
+    return await _infer("analyst", request)
+
+
+@app.api_route("/api/v1/personal/infer", methods=["POST", "GET"])
+async def infer_personal(request: Request):
+    return await _infer("personal", request)
+
+
+@app.post("/api/v1/global/infer")
+async def infer_global(request: Request):
+    return await _infer("global", request)
+
+
+@app.on_event("startup")
+async def startup():
+    # 直接用 uvicorn 启动时没有 gunicorn.conf.py 的 post_worker_init，重复调用无影响
+    from pkg.doc_worker import local_doc_worker
+    local_doc_worker.start()
+
+
+@app.on_event("shutdown")
+async def shutdown():
+    await close_async_http_client()
+
+
+app.mount("/", WSGIMiddleware(flask_app))
@@ -0,0 +1,14 @@
+'''
+Author: longsion<xianglong_chen@intsig.net>
+Date: 2026-10-19 09:20:11
+LastEditors: longsion
+LastEditTime: 2026-10-19 09:20:11
+'''
+
+# gunicorn 默认读取工作目录下的 gunicorn.conf.py，main:app / asgi:app 均适用
+
+
+def post_worker_init(worker):
+    # 每个 worker 进程 fork 后启动进程内的文档处理 worker，doc_queue.local_workers 为 0 时只入队
+    from pkg.doc_worker import local_doc_worker
+    local_doc_worker.start()
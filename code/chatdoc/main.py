@@ -46,6 +46,15 @@ def parse_analyst_file():
     return return_data(200, result.answer_response.model_dump())
 
 
+@app.route("/api/v1/analyst/parse/status", methods=["GET"])
+def parse_analyst_file_status():
+    from pkg.doc import process_status
+    job = process_status(request.args.get("uuid", ""))
+    if job is None:
+        return return_data(404, {"msg": "处理任务不存在"})
+    return return_data(200, job)
+
+
 @app.route("/api/v1/analyst/delete", methods=["POST"])
 def delete_analyst_file():
     from pkg.doc import delete_process, DeleteParams
@@ -77,6 +86,15 @@ def parse_personal_file():
     return return_data(200, result.answer_response.model_dump())
 
 
+@app.route("/api/v1/personal/parse/status", methods=["GET"])
+def parse_personal_file_status():
+    from pkg.personal_doc import process_status
+    job = process_status(request.args.get("user_id", ""), request.args.get("uuid", ""))
+    if job is None:
+        return return_data(404, {"msg": "处理任务不存在"})
+    return return_data(200, job)
+
+
 @app.route("/api/v1/personal/delete", methods=["POST"])
 def delete_personal_file():
     from pkg.personal_doc import delete_process, DeleteParams
@@ -141,5 +159,13 @@ def infer_global():
         return return_data(200, result.answer_response.model_dump())
 
 
+@app.route("/metrics", methods=["GET"])
+def metrics():
+    from pkg.utils.metrics import global_metrics
+    return Response(global_metrics.render(), status=200, mimetype="text/plain; version=0.0.4")
+
+
 if __name__ == '__main__':
+    from pkg.doc_worker import local_doc_worker
+    local_doc_worker.start()
     app.run(host="0.0.0.0", port=5000)
@@ -2,7 +2,7 @@
 Author: longsion<xianglong_chen@intsig.net>
 Date: 2024-05-06 15:12:45
 LastEditors: longsion
-LastEditTime: 2024-10-16 14:16:13
+LastEditTime: 2026-10-18 16:20:37
 '''
 from pkg.exceptions import LLMComplianceError
 from pkg.utils import group_by_func
@@ -12,6 +12,7 @@ from pkg.es.es_file import ESFileObject
 from pkg.llm.llm import LLM
 from pkg.llm.template_manager import TemplateManager
 from pkg.utils.decorators import register_span_func
+from pkg.utils.jaeger import tracer
 from pkg.config import config
 from pkg.utils.logger import logger
 
@@ -59,6 +60,31 @@ def generation(context: Context) -> Context:
     return context
 
 
+async def agenerate(context: Context) -> Context:
+    """
+    生成（asyncio 模式），流式结果写入 context.stream_aiter
+    """
+    # 生成context
+    _context = generate_context(context)
+
+    prompt_temp = TemplateManager().get_template("qa_input")
+    context.llm_question = prompt_temp.format(question=context.question_analysis.rewrite_question, context=_context)
+
+    with tracer.start_as_current_span("LLM问答"):
+        try:
+            answer_or_iterator = await llm.achat(context.llm_question, stream=context.params.stream)
+        except LLMComplianceError:
+            answer_or_iterator = config["compliance"]["warning_text"]
+            context.answer_compliance = False
+
+    if isinstance(answer_or_iterator, str):
+        context.llm_answer = answer_or_iterator
+    else:
+        context.stream_aiter = answer_or_iterator
+
+    return context
+
+
 def generate_context(context: Context):
     """
     生成prompt
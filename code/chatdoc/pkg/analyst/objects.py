@@ -2,16 +2,17 @@
 Author: longsion<xianglong_chen@intsig.net>
 Date: 2024-05-27 14:32:49
 LastEditors: longsion
-LastEditTime: 2024-10-22 11:05:25
+LastEditTime: 2026-10-18 23:34:20
 '''
 from pkg.es.es_file import ESFileObject
 from pkg.es.es_company import ESCompanyObject
 from pkg.es.es_doc_table import DocTableModel
 from pkg.es.es_doc_fragment import DocFragmentModel
 from pkg.es.es_doc_item import DocItemModel
+from pkg.es.fragment_tree import FragmentCache
 
 from enum import Enum
-from pydantic import BaseModel
+from pydantic import BaseModel, Field
 import typing
 
 
@@ -188,11 +189,13 @@ class Context(BaseModel):
 
     # 原文Cache [文件uuid|文件ori_id, DocItemModel]
     doc_items_cache: dict[str, DocItemModel] = {}
-    # 片段Cache [片段uuid, DocFragmentModel]
-    fragment_cache: dict[str, DocFragmentModel] = {}
+    # 片段Cache [片段uuid, DocFragmentModel]，已加载片段树的文件按需构造片段对象
+    fragment_cache: FragmentCache = Field(default_factory=FragmentCache)
 
     # 问题 rerank之后结果
     rerank_retrieve_before_qa: list[RetrieveContext] = []
+    # 超时降级返回默认结果的阶段（TaskGroup 记录），非空时召回结果不写入阶段缓存
+    degraded_stages: list[str] = []
 
     # 问题 qa 结果
     llm_question: str = None
@@ -206,6 +209,8 @@ class Context(BaseModel):
 
     # 回答相关
     stream_iter: typing.Iterator = None
+    # asyncio 模式下的异步生成器
+    stream_aiter: typing.Any = None
 
     # 耗时相关
     durations: dict = {}
@@ -213,4 +218,5 @@ class Context(BaseModel):
 
     # 返回回答的内容
     answer_response_iter: typing.Iterator = None
+    answer_response_aiter: typing.Any = None
     answer_response: Response = None
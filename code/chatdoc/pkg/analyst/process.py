@@ -2,7 +2,7 @@
 Author: longsion<xianglong_chen@intsig.net>
 Date: 2024-05-27 14:34:25
 LastEditors: longsion
-LastEditTime: 2024-10-22 11:24:45
+LastEditTime: 2026-10-18 23:41:52
 '''
 import datetime
 import time
@@ -10,8 +10,10 @@ from pkg.analyst.objects import Params, Context, Response
 from pkg.utils.decorators import register_span_func
 from pkg.config import config
 from pkg.utils.logger import logger
-from pkg.utils.thread_with_return_value import ThreadWithReturnValue
-from pkg.llm.util import check_repetition, get_stream_json, remove_repetition, set_stream_json, stream_fixes_suffix
+from pkg.utils.task_group import TaskGroup
+from pkg.llm.util import async_answer_stream, check_repetition, get_stream_json, remove_repetition, set_stream_json, stream_fixes_suffix
+from pkg.utils.aio import run_sync
+from pkg.redis.stage_cache import ANALYST_LIBRARY, stage_cache
 
 from opentelemetry import context as otel_context
 from opentelemetry.trace import get_current_span
@@ -20,12 +22,12 @@ from opentelemetry.trace import get_current_span
 def process(params: Params) -> Context:
 
     from .compliance_question import func as compliance_question
-    from .preprocess_question import preprocess_question
+    from .preprocess_question import preprocess_question, replace_query
     # from .retrieve_parallel import retrieve_parallel
     from .rerank_by_question import rerank_by_question
     from .small2big import small2big
     from .truncation import truncation
-    from .generation import generation
+    from .generation import agenerate, generation
     from .compliance_answer import func as compliance_answer
     from .rerank_by_answer import func as rerank_by_answer
     from .retrieve_small import retrieve_small
@@ -39,15 +41,20 @@ def process(params: Params) -> Context:
     # 赋予trace_id
     context.trace_id = f"{get_current_span().context.trace_id:0x}"
 
-    # 并行合规检测
-    compliance_t = ThreadWithReturnValue(target=compliance_question, args=(context,), parent_span_context=span_ctx)
-    compliance_t.start()
+    task_group = TaskGroup("process")
+    # 并行合规检测；超时按未检测处理（question_compliance 为 None），生成的答案仍会经过 compliance_answer
+    compliance_t = task_group.spawn(compliance_question, context, stage="compliance_question", default=context)
+
+    # 阶段缓存：归一化问题 + 文件范围 + 索引版本，命中时跳过问题分析/召回/rerank/small2big
+    cache_scope = stage_cache.scope(replace_query(params.question), params.document_uuids, [ANALYST_LIBRARY])
 
     # 预处理问题，分析问题，确定AgentType
-    context = preprocess_question(context)
+    if not stage_cache.load(context, cache_scope, "question_analysis"):
+        context = preprocess_question(context)
+        stage_cache.save(context, cache_scope, "question_analysis", ["question_analysis", "files", "locationfiles", "company_mapper"])
 
     # 预处理与合并检测并行
-    context = compliance_t.join()
+    context = compliance_t.result()
     if context.question_compliance is False:
         context.answer_response = Response(answer=config["compliance"]["warning_text"], question_compliance=False, trace_id=context.trace_id, durations=context.durations)
         return context
@@ -62,13 +69,17 @@ def process(params: Params) -> Context:
     # else:
     #     # 召回small片段
     #     context = retrieve_small(context)
-    context = retrieve_small(context)
+    if not stage_cache.load(context, cache_scope, "rerank_candidates"):
+        context = retrieve_small(context)
 
-    # 问题与召回rerank
-    context = rerank_by_question(context)
+        # 问题与召回rerank
+        context = rerank_by_question(context)
 
-    # small2big
-    context = small2big(context)
+        # small2big
+        context = small2big(context)
+        # 召回为空或有召回阶段超时降级（部分结果）时不缓存
+        if context.rerank_retrieve_before_qa and not context.degraded_stages:
+            stage_cache.save(context, cache_scope, "rerank_candidates", ["files", "rerank_retrieve_before_qa"])
 
     # 组合&&截断
     context = truncation(context)
@@ -100,9 +111,8 @@ def process(params: Params) -> Context:
 
         return gen_response_by_context(context)
 
-    def _after_trunction():
-        nonlocal context
-        # yield 召回结果
+    def _retrieve_result():
+        # 召回结果
         ori = [
             dict(
                 ori_id=ori_id,
@@ -111,7 +121,7 @@ def process(params: Params) -> Context:
             )
             for i, r in enumerate(context.rerank_retrieve_before_qa) for ori_id in r.ori_ids
         ]
-        yield set_stream_json(
+        result = set_stream_json(
             {
                 "status": "DOING",
                 "content": "",
@@ -123,10 +133,28 @@ def process(params: Params) -> Context:
             推送召回结果=f"{(time.time() - context.start_ts) * 1000:.1f}ms"
         )
         logger.info(f"推送召回结果 duration: {context.durations['推送召回结果']}")
+        return result
+
+    def _after_trunction():
+        nonlocal context
+        # yield 召回结果
+        yield _retrieve_result()
         # 生成
         context = generation(context)
         yield from _after_generation()
 
+    async def _aon_done(context) -> Response:
+        return await run_sync(_on_done, context)
+
+    async def _aafter_trunction():
+        nonlocal context
+        # yield 召回结果
+        yield _retrieve_result()
+        # 生成
+        context = await agenerate(context)
+        async for x in async_answer_stream(context, _aon_done):
+            yield x
+
     def _after_generation():
         nonlocal context
         answer_text = ""
@@ -173,6 +201,7 @@ def process(params: Params) -> Context:
 
     if context.params.stream:
         context.answer_response_iter = _after_trunction()
+        context.answer_response_aiter = _aafter_trunction()
     else:
         # 生成
         context = generation(context)
@@ -2,20 +2,20 @@
 Author: longsion<xianglong_chen@intsig.net>
 Date: 2024-05-27 17:50:27
 LastEditors: longsion
-LastEditTime: 2024-10-16 14:16:58
+LastEditTime: 2026-10-18 23:34:20
 '''
-import json
 
 import requests
 from pkg.analyst.common import fillin_doc_items_cache, fillin_fragment_children_cache
 from pkg.analyst.objects import Context
-from pkg.embedding.acge_embedding import get_similar_top_n
+from pkg.embedding.keyword_matrix import three_table_key_matrix
+from pkg.es.fragment_tree import fragment_tree_cache
 from pkg.es.es_doc_table import DocTableES, DocTableModel
 from pkg.es.es_doc_fragment import DocFragmentES, DocFragmentModel
 from pkg.utils import edit_distance
 from pkg.utils.decorators import register_span_func
-from pkg.utils.thread_with_return_value import ThreadWithReturnValue
-from pkg.structure_static import match_fixed_tables, three_table_key_list
+from pkg.utils.task_group import TaskGroup
+from pkg.structure_static import match_fixed_tables
 from pkg.config import config
 from pkg.utils.logger import logger
 
@@ -101,16 +101,18 @@ def retrieve_parallel(context: Context) -> Context:
 
 
 def fill_fragments_cache(context: Context):
-    # 从doc_fragments_json中更新 context.fragment_cache
+    # 从片段 blob（或doc_fragments_json）中加载文件片段树（进程级缓存共享），片段对象按需构造
+    missing = []
     for file in context.files:
-        if file.doc_fragments_json:
-            doc_fragments = json.loads(file.doc_fragments_json)
-            if isinstance(doc_fragments, list):
-                # without embeddings
-                doc_fragments = [
-                    DocFragmentModel(**fragment, file_uuid=file.uuid) for fragment in doc_fragments
-                ]
-                context.fragment_cache.update({doc_fragment.uuid: doc_fragment for doc_fragment in doc_fragments})
+        tree = fragment_tree_cache.get(file.uuid, file.fragments_source)
+        if tree is not None:
+            context.fragment_cache.add_tree(tree)
+        elif not file.fragments_source:
+            missing.append(file.uuid)
+    # 阶段缓存命中的文件不带片段来源，按 uuid 批量加载
+    if missing:
+        for tree in fragment_tree_cache.load(missing).values():
+            context.fragment_cache.add_tree(tree)
 
 
 def retrieve_small_by_document(context: Context, uuid: str):
@@ -123,14 +125,12 @@ def retrieve_small_by_document(context: Context, uuid: str):
     # 文件三大表召回到了之后之后其他的召回就省略掉
     document_uuids = list(set(document_uuids) - set(fixed_table_file_uuids))
     if document_uuids:
-        _normal_table_retrieve_t = ThreadWithReturnValue(target=retrieve_by_table, args=(context, document_uuids))
-        _normal_table_retrieve_t.start()
+        with TaskGroup("retrieve_parallel", context=context) as task_group:
+            _normal_table_retrieve_t = task_group.spawn(retrieve_by_table, context, document_uuids, stage="retrieve_table", default=[])
+            _paragraph_retrieve_t = task_group.spawn(retrieve_by_paragraph, context, document_uuids, stage="retrieve_paragraph", default=[])
 
-        _paragraph_retrieve_t = ThreadWithReturnValue(target=retrieve_by_paragraph, args=(context, document_uuids))
-        _paragraph_retrieve_t.start()
-
-        normal_table_retrieve_small = _normal_table_retrieve_t.join()
-        fragment_retrieve_small = _paragraph_retrieve_t.join()
+        normal_table_retrieve_small = _normal_table_retrieve_t.result()
+        fragment_retrieve_small = _paragraph_retrieve_t.result()
 
     else:
         normal_table_retrieve_small = []
@@ -153,7 +153,7 @@ def retrieve_by_fixed_table(context: Context, document_uuids: list[str]) -> list
 
     keyword = context.question_analysis.keywords[0]
     # """语义匹配top1"""
-    top1 = get_similar_top_n(three_table_key_list, keyword)
+    top1 = three_table_key_matrix.top_n(keyword)
     if not top1:
         logger.warning(f"Fixed Table Agent 匹配不到关键词对应的表格，keyword: {keyword}")
         return empty_list
@@ -178,12 +178,8 @@ def retrieve_by_fixed_table(context: Context, document_uuids: list[str]) -> list
 
 def retrieve_by_table(context: Context, document_uuids: list[str]) -> list[DocTableModel]:
     # 表格召回
-    doc_table_items: list[DocTableModel] = []
-
-    for keyword in context.question_analysis.keywords:
-        doc_table_items.extend(
-            DocTableES().search_table(bm25_text=keyword, ebd_text=context.question_analysis.retrieve_question, document_uuids=document_uuids)
-        )
+    # 所有关键词合并为一次 _msearch
+    doc_table_items: list[DocTableModel] = DocTableES().search_tables(bm25_texts=context.question_analysis.keywords, ebd_text=context.question_analysis.retrieve_question, document_uuids=document_uuids)
 
     return doc_table_items
 
@@ -0,0 +1,152 @@
+'''
+Author: longsion<xianglong_chen@intsig.net>
+Date: 2026-10-18 22:50:26
+LastEditors: longsion
+LastEditTime: 2026-10-19 09:20:11
+'''
+
+# 入库后的缓存预热：切片成功回调后执行，使新文件的首个问题与稳态延迟一致
+# - 片段 blob 已由 upload_doc_fragments_json 在回调前写入 Redis，这里只预建问答侧的按文件结构
+# - 片段树 / 原文段是进程内缓存，通过 invalidation_bus 广播 warm 消息，每个问答 worker（含本进程）收到后在后台预建；
+#   同一频道消息有序，预建一定在本文件的失效消息之后，不会被随后到达的失效消息淘汰
+# - 文件向量矩阵需要从 ES 取回全部片段向量，默认不预建；vectors 开启时每个节点只有一个 worker 预建（Redis SET NX 按主机名 + 文件抢占）
+# - probe_embedding 开启时对探测问题（probe_templates 按三表指标展开）预先 embedding，结果写入 L1/L2 embedding 缓存，只需在入库进程执行一次
+# - 总线未订阅时进程缓存本身不可用，跳过结构预建；预热失败只记录日志，不影响入库结果
+
+import socket
+import time
+from typing import Optional
+
+from pkg.config import config
+from pkg.embedding.acge_embedding import acg_embedding_multi_batch_with_cache
+from pkg.es.es_doc_fragment import DocFragmentES
+from pkg.es.es_file_vectors import file_vector_cache, use_scoped_vector
+from pkg.es.es_p_doc_fragment import PDocFragmentES
+from pkg.es.fragment_tree import fragment_tree_cache
+from pkg.ori_segment import ori_segment_cache
+from pkg.redis.invalidation_bus import InvalidationBus, invalidation_bus
+from pkg.structure_static import three_table_key_list
+from pkg.utils import global_thread_pool
+from pkg.utils.logger import logger
+from pkg.utils.metrics import global_metrics
+
+
+cache_warmup_requests = global_metrics.counter("cache_warmup_total", "Post-ingest cache warmup runs by stage and outcome")
+
+WARM_NAMESPACE = "warm"
+# 与 search_fragment 的向量召回字段一致
+WARM_EMBEDDING_FIELD = "acge_embedding"
+
+
+class CacheWarmer:
+
+    def __init__(self, bus: InvalidationBus, enable: bool = False, structures: bool = True, vectors: bool = False,
+                 probe_embedding: bool = False, probe_templates: Optional[list[str]] = None, redis_client=None):
+        self.enable = enable
+        self.structures = structures
+        self.vectors = vectors
+        self.probe_embedding = probe_embedding
+        self.probe_templates = probe_templates or ["{metric}"]
+        self._bus = bus
+        self._redis = redis_client
+        self._node = socket.gethostname()
+
+    def subscribe(self):
+        '''
+        提供问答的进程（pre_import）订阅 warm 消息，独立的文档处理 worker 不预建
+        '''
+        if self.enable and self.structures:
+            self._bus.subscribe(WARM_NAMESPACE, self._on_warm)
+
+    def warm(self, file_uuid: str, user_id: Optional[str] = None, file_meta=None):
+        '''
+        入库完成（es_file 已写入、文件版本号已更新）后调用
+        '''
+        if not self.enable:
+            return
+
+        if self.probe_embedding:
+            self._warm_probes(file_uuid, file_meta)
+        if self.structures:
+            # 本进程也等订阅线程收到消息后再预建
+            self._bus.publish(WARM_NAMESPACE, [f"{user_id or ''}:{file_uuid}"], local=False)
+
+    def probe_texts(self, file_meta=None) -> list[str]:
+        fields = dict(title=getattr(file_meta, "file_title", None) or "",
+                      company=getattr(file_meta, "extract_company_str", None) or "")
+        texts = []
+        for template in self.probe_templates:
+            # 模板引用的文件信息为空时跳过，避免与其他模板重复
+            if any(f"{{{name}}}" in template and not value for name, value in fields.items()):
+                continue
+            if "{metric}" in template:
+                texts.extend(template.format(metric=metric, **fields) for metric in three_table_key_list)
+            else:
+                texts.append(template.format(**fields))
+        return list(dict.fromkeys(text for text in texts if text))
+
+    def _warm_probes(self, file_uuid: str, file_meta):
+        start_time = time.time()
+        texts = self.probe_texts(file_meta)
+        try:
+            acg_embedding_multi_batch_with_cache(texts, dimension=1024)
+        except Exception as e:
+            cache_warmup_requests.inc(stage="probes", outcome="error")
+            logger.warning(f"CacheWarmer probes {file_uuid} failed: {e}")
+            return
+        cache_warmup_requests.inc(stage="probes", outcome="success")
+        logger.info(f"CacheWarmer probes {file_uuid}, texts: {len(texts)}, cost: {1000*(time.time() - start_time):.1f}ms")
+
+    def _on_warm(self, keys: Optional[list[str]]):
+        # 订阅线程中回调，预建放到线程池；换代（keys 为 None）无需处理
+        for key in keys or []:
+            user_id, file_uuid = key.rsplit(":", 1)
+            global_thread_pool.submit(self.warm_structures, file_uuid, user_id or None)
+
+    def warm_structures(self, file_uuid: str, user_id: Optional[str] = None):
+        start_time = time.time()
+        try:
+            fragment_tree_cache.load([file_uuid], user_id)
+            if ori_segment_cache.enable:
+                ori_segment_cache.get_segments([file_uuid], user_id)
+            if self.vectors and use_scoped_vector([file_uuid]) and self._claim_node(file_uuid, user_id):
+                index = PDocFragmentES().index_name if user_id else DocFragmentES().index_name
+                file_vector_cache.get_matrices(index, WARM_EMBEDDING_FIELD, [file_uuid], user_id)
+        except Exception as e:
+            cache_warmup_requests.inc(stage="structures", outcome="error")
+            logger.warning(f"CacheWarmer structures {file_uuid} failed: {e}")
+            return
+        cache_warmup_requests.inc(stage="structures", outcome="success")
+        logger.info(f"CacheWarmer structures {file_uuid}, cost: {1000*(time.time() - start_time):.1f}ms")
+
+    def _claim_node(self, file_uuid: str, user_id: Optional[str] = None) -> bool:
+        '''
+        同一节点的多个 worker 中只有一个预建文件向量矩阵，Redis 不可用时不预建
+        '''
+        if self._redis is None:
+            return False
+        try:
+            return bool(self._redis.set(f"warm:vectors:{self._node}:{user_id or ''}:{file_uuid}", 1, nx=True, ex=600))
+        except Exception as e:
+            logger.warning(f"CacheWarmer claim vectors {file_uuid} failed: {e}")
+            return False
+
+
+def _build_cache_warmer():
+    warmup_config = config.get("cache_warmup") or {}
+
+    redis_client = None
+    if warmup_config.get("vectors", False):
+        from pkg.redis.redis import redis_store
+        redis_client = redis_store
+
+    return CacheWarmer(invalidation_bus,
+                       enable=warmup_config.get("enable", False),
+                       structures=warmup_config.get("structures", True),
+                       vectors=warmup_config.get("vectors", False),
+                       probe_embedding=warmup_config.get("probe_embedding", False),
+                       probe_templates=warmup_config.get("probe_templates"),
+                       redis_client=redis_client)
+
+
+cache_warmer = _build_cache_warmer()
@@ -0,0 +1,236 @@
+'''
+Author: longsion<xianglong_chen@intsig.net>
+Date: 2026-10-18 13:12:26
+LastEditors: longsion
+LastEditTime: 2026-10-19 00:03:27
+'''
+
+# 共享的 HTTP 客户端
+# - 每个 endpoint 一个 Session，urllib3 按 host 维护连接池并保持长连接，池大小与 threadpool 配置对齐
+# - 每个 endpoint 独立的超时、重试次数，按 host 熔断
+# - 可选 HTTP/2（需安装 httpx[http2]）
+# - 导出请求耗时、并发数、连接池饱和度等指标
+
+import random
+import threading
+import time
+from urllib.parse import urlsplit
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from pkg.config import config
+from pkg.exceptions import CircuitOpenError
+from pkg.utils.logger import logger
+from pkg.utils.metrics import global_metrics
+
+try:
+    import httpx
+except ImportError:  # pragma: no cover
+    httpx = None
+
+
+http_requests_total = global_metrics.counter("http_client_requests_total", "HTTP client requests by endpoint and status")
+http_request_seconds = global_metrics.histogram("http_client_request_seconds", "HTTP client request latency")
+http_inflight = global_metrics.gauge("http_client_inflight", "HTTP client in-flight requests")
+http_pool_size = global_metrics.gauge("http_client_pool_maxsize", "HTTP client per-host connection pool size")
+http_pool_saturation = global_metrics.gauge("http_client_pool_saturation", "HTTP client in-flight / pool size")
+http_circuit_open = global_metrics.gauge("http_client_circuit_open", "HTTP client circuit breaker state, 1 for open")
+
+DEFAULT_ENDPOINT_CONFIG = dict(
+    connect_timeout=3,
+    read_timeout=30,
+    retries=2,
+    backoff=0.2,
+    failure_threshold=5,
+    recovery_timeout=10,
+)
+
+RETRY_STATUS = {429, 500, 502, 503, 504}
+
+
+class CircuitBreaker:
+    '''
+    连续失败 failure_threshold 次后熔断，recovery_timeout 秒后放行一个探测请求（half-open），成功则恢复
+    '''
+
+    def __init__(self, failure_threshold=5, recovery_timeout=10):
+        self.failure_threshold = failure_threshold
+        self.recovery_timeout = recovery_timeout
+        self._lock = threading.Lock()
+        self._failures = 0
+        self._opened_at = None
+        self._probing = False
+
+    @property
+    def is_open(self):
+        return self._opened_at is not None
+
+    def allow(self) -> bool:
+        with self._lock:
+            if self._opened_at is None:
+                return True
+            if not self._probing and time.monotonic() - self._opened_at >= self.recovery_timeout:
+                self._probing = True
+                return True
+            return False
+
+    def on_success(self):
+        with self._lock:
+            self._failures = 0
+            self._opened_at = None
+            self._probing = False
+
+    def on_failure(self):
+        with self._lock:
+            self._failures += 1
+            if self._probing or self._failures >= self.failure_threshold:
+                self._opened_at = time.monotonic()
+            self._probing = False
+
+
+class HttpClient:
+
+    def __init__(self, name: str, pool_maxsize: int, http2: bool = False, **endpoint_config):
+        self.name = name
+        self.pool_maxsize = pool_maxsize
+        self._config = {**DEFAULT_ENDPOINT_CONFIG, **endpoint_config}
+        self.timeout = (float(self._config["connect_timeout"]), float(self._config["read_timeout"]))
+        self.retries = int(self._config["retries"])
+        self.backoff = float(self._config["backoff"])
+
+        self._breakers = {}
+        self._breakers_lock = threading.Lock()
+        self._inflight = 0
+        self._inflight_lock = threading.Lock()
+
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=16, pool_maxsize=pool_maxsize, pool_block=False)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+
+        self._h2_client = None
+        if http2:
+            if httpx is None:
+                logger.warning(f"http client {name}: http2 enabled but httpx is not installed, fallback to http/1.1")
+            else:
+                self._h2_client = httpx.Client(
+                    http2=True,
+                    timeout=httpx.Timeout(self.timeout[1], connect=self.timeout[0]),
+                    limits=httpx.Limits(max_connections=pool_maxsize, max_keepalive_connections=pool_maxsize),
+                    verify=False,
+                )
+
+        http_pool_size.set(pool_maxsize, client=name)
+
+    def _breaker(self, host) -> CircuitBreaker:
+        breaker = self._breakers.get(host)
+        if breaker is None:
+            with self._breakers_lock:
+                breaker = self._breakers.setdefault(host, CircuitBreaker(
+                    failure_threshold=int(self._config["failure_threshold"]),
+                    recovery_timeout=float(self._config["recovery_timeout"]),
+                ))
+        return breaker
+
+    def _track_inflight(self, delta):
+        with self._inflight_lock:
+            self._inflight += delta
+            inflight = self._inflight
+        http_inflight.set(inflight, client=self.name)
+        http_pool_saturation.set(round(inflight / max(1, self.pool_maxsize), 3), client=self.name)
+
+    def _send(self, method, url, stream=False, **kwargs):
+        # 流式请求仍走 requests，调用方依赖 iter_lines 等接口
+        if self._h2_client is not None and not stream:
+            kwargs.pop("verify", None)
+            auth = kwargs.pop("auth", None)
+            if auth is not None:
+                kwargs["auth"] = (auth.username, auth.password) if hasattr(auth, "username") else auth
+            try:
+                return self._h2_client.request(method, url, **kwargs)
+            except httpx.TimeoutException as e:
+                raise requests.exceptions.Timeout(str(e))
+            except httpx.TransportError as e:
+                raise requests.exceptions.ConnectionError(str(e))
+
+        return self.session.request(method, url, stream=stream, **kwargs)
+
+    def request(self, method: str, url: str, **kwargs):
+        '''
+        与 requests.request 参数一致；连接错误、超时与 429/5xx 会按 retries 重试，
+        重试耗尽后抛出最后一次异常或返回最后一次的响应，由调用方 raise_for_status
+        '''
+        kwargs.setdefault("timeout", self.timeout)
+        host = urlsplit(url).netloc
+        breaker = self._breaker(host)
+
+        attempt = 0
+        while True:
+            if not breaker.allow():
+                http_circuit_open.set(1, client=self.name, host=host)
+                raise CircuitOpenError(f"{self.name} circuit open, host: {host}")
+
+            st = time.time()
+            self._track_inflight(1)
+            resp, error = None, None
+            try:
+                resp = self._send(method, url, **kwargs)
+            except requests.exceptions.RequestException as e:
+                error = e
+            except Exception as e:
+                # 其他异常不重试，同样计为一次失败；half-open 探测请求由此重新熔断，不会一直停在探测中
+                breaker.on_failure()
+                http_requests_total.inc(client=self.name, status=type(e).__name__)
+                raise
+            finally:
+                self._track_inflight(-1)
+                http_request_seconds.observe(time.time() - st, client=self.name)
+
+            status = resp.status_code if resp is not None else type(error).__name__
+            http_requests_total.inc(client=self.name, status=status)
+
+            if error is None and resp.status_code not in RETRY_STATUS:
+                breaker.on_success()
+                http_circuit_open.set(0, client=self.name, host=host)
+                return resp
+
+            breaker.on_failure()
+            if attempt >= self.retries:
+                if error is not None:
+                    raise error
+                return resp
+
+            # 指数退避 + 随机抖动
+            wait_time = self.backoff * (2 ** attempt) * (0.5 + random.random())
+            logger.warning(f"{self.name} request failed: {error or status}, retry {attempt + 1}/{self.retries} in {wait_time:.2f}s")
+            time.sleep(wait_time)
+            attempt += 1
+
+    def get(self, url, **kwargs):
+        return self.request("GET", url, **kwargs)
+
+    def post(self, url, **kwargs):
+        return self.request("POST", url, **kwargs)
+
+
+_clients = {}
+_clients_lock = threading.Lock()
+
+
+def get_http_client(name: str) -> HttpClient:
+    '''
+    按 endpoint 名称获取共享客户端，超时等参数见 config.yaml http.endpoints
+    '''
+    client = _clients.get(name)
+    if client is not None:
+        return client
+
+    with _clients_lock:
+        client = _clients.get(name)
+        if client is None:
+            http_config = config.get("http") or {}
+            pool_maxsize = int(http_config.get("pool_maxsize") or config["threadpool"]["global_worker"])
+            endpoint_config = (http_config.get("endpoints") or {}).get(name) or {}
+            client = _clients[name] = HttpClient(name, pool_maxsize=pool_maxsize, http2=bool(http_config.get("http2")), **endpoint_config)
+        return client
@@ -2,16 +2,16 @@
 Author: longsion<xianglong_chen@intsig.net>
 Date: 2024-03-25 16:19:13
 LastEditors: longsion
-LastEditTime: 2025-03-09 07:34:54
+LastEditTime: 2026-10-19 09:41:20
 '''
 
 from pkg.config import config
 from pkg.utils.logger import logger
 
-from tenacity import retry, stop_after_attempt, stop_after_delay
-import requests
 import uuid
 
+from pkg.clients.http_client import get_http_client
+
 
 class TextCompliance(object):
     """
@@ -36,8 +36,15 @@ class TextCompliance(object):
     check_types	string	检查类型；可以选择多个类型，类型名之间以,分隔；详情见下方检查类型check_types取值列表；默认值目前为全部类型
     """
 
-    @retry(stop=(stop_after_attempt(3) | stop_after_delay(5)), retry_error_callback=lambda x: True)
     def is_text_valid(self, text: str, request_id: str = None):
+        # 重试由 http.endpoints.compliance 统一控制，调用失败时按合规处理
+        try:
+            return self._check_text(text, request_id)
+        except Exception as e:
+            logger.warning(f"text compliance failed, treat as valid: {e}")
+            return True
+
+    def _check_text(self, text: str, request_id: str = None):
 
         request_id = request_id or str(uuid.uuid4())
 
@@ -51,7 +58,7 @@ class TextCompliance(object):
             requestid=request_id,
         )
         ip_data = dict(data=text)
-        op_data = requests.post(self.url, params=params, json=ip_data, timeout=self.timeout)
+        op_data = get_http_client("compliance").post(self.url, params=params, json=ip_data, timeout=self.timeout)
         if op_data.status_code != 200:
             msg = f"text compliance call error, p1, status_code:{op_data.status_code}, msg: {op_data.json()}"
             logger.error(msg)
@@ -2,11 +2,11 @@
 Author: longsion<xianglong_chen@intsig.net>
 Date: 2024-05-14 11:28:54
 LastEditors: longsion
-LastEditTime: 2024-09-20 19:20:24
+LastEditTime: 2026-10-18 23:12:40
 '''
 
 from .objects import Context, Params, FileProcessException, DeleteParams
-from .process import process
+from .process import process, process_status
 from .delete_process import process as delete_process
 
 
@@ -2,12 +2,13 @@
 Author: longsion<xianglong_chen@intsig.net>
 Date: 2024-05-16 14:42:21
 LastEditors: longsion
-LastEditTime: 2024-07-16 23:18:55
+LastEditTime: 2026-10-18 20:58:40
 '''
 
+from pkg.config import config
 from pkg.utils.decorators import register_span_func
-from pkg.utils.transform import is_financial_string, markdown2list, uneven_list_to_markdown_table
-from .objects import Context, DocTreeNode, Fragment
+from pkg.utils.transform import html2markdown, is_financial_string, markdown2list, uneven_list_to_markdown_table
+from .objects import Context, DocOriItem, DocTreeNode, Fragment
 import uuid
 from langchain.text_splitter import RecursiveCharacterTextSplitter
 
@@ -24,6 +25,9 @@ def cut_paragraph_fragment(context: Context) -> Context:
     row_texts: 段落切片逻辑
     """
     context.doc_fragments = create_fragments(context.doc_tree.tree[0])
+    # 非叶子切片物化子树原文与ori_id，问答时直接使用，不再递归拼接
+    materialize_subtree_texts(context.doc_fragments, context.doc_ori_items,
+                              max_length=config["parse"].get("materialize_max_length", 20000))
 
     return context
 
@@ -119,6 +123,62 @@ def create_fragments(node: DocTreeNode, parent_uuid: str = "", level: int = 1, t
     return fragments
 
 
+def materialize_subtree_texts(fragments: list[Fragment], doc_ori_items: list[DocOriItem], max_length: int = 20000):
+    """
+    计算非叶子切片的 tree_ori_ids / tree_text / tree_all_texts，结果与问答时 get_fragment_ori_ids / get_fragment_ori_text / get_fragment_all_texts 一致
+
+    :param fragments: create_fragments 的结果，子节点在父节点之前
+    :param doc_ori_items: 目录树预处理后的原文（表格已转为markdown），即写入 doc_item 索引的内容
+    :param max_length: 子树原文超过该长度时不物化文本，问答时回退到递归拼接
+    """
+    contents = {}
+    for doc_ori_item in doc_ori_items:
+        content = doc_ori_item.content if isinstance(doc_ori_item.content, str) else "\n".join(doc_ori_item.content)
+        for ori_id in doc_ori_item.ori_id:
+            contents.setdefault(ori_id, content)
+
+    def leaf_text(content):
+        return html2markdown(content) if content.startswith("<table border=") else content
+
+    fragment_map = {fragment.uuid: fragment for fragment in fragments}
+    # uuid => (ori_ids, text, all_texts)，text 为 None 表示超长或原文缺失
+    results = {}
+    for fragment in fragments:
+        content = contents.get(fragment.ori_id[0]) if fragment.ori_id else ""
+        if fragment.leaf:
+            if content is None:
+                results[fragment.uuid] = (fragment.ori_id, None, None)
+            else:
+                results[fragment.uuid] = (fragment.ori_id, leaf_text(content), [leaf_text(content)] if fragment.ori_id else [])
+            continue
+
+        children = [results[child_uuid] for child_uuid in fragment.children_fragment_uuids
+                    if child_uuid in results and fragment_map[child_uuid].parent_frament_uuid == fragment.uuid]
+
+        ori_ids = set(fragment.ori_id)
+        for child_ori_ids, _, _ in children:
+            ori_ids.update(child_ori_ids)
+        try:
+            fragment.tree_ori_ids = sorted(ori_ids, key=lambda x: tuple([int(_x) for _x in x.split(",")]))
+        except ValueError:
+            fragment.tree_ori_ids = sorted(ori_ids)
+
+        text = all_texts = None
+        if not fragment.ori_id:
+            text, all_texts = "", []
+        elif content is not None and all(child_text is not None for _, child_text, _ in children):
+            child_texts = list(dict.fromkeys(child_text for _, child_text, _ in children))
+            text = "#" * (fragment.level + 1) + " " + content + "\n" + "\n".join(child_texts)
+            all_texts = [content] + list(dict.fromkeys(t for _, _, child_all_texts in children for t in child_all_texts))
+            if len(text) > max_length or sum(len(t) for t in all_texts) > max_length:
+                text = all_texts = None
+
+        results[fragment.uuid] = (fragment.tree_ori_ids, text, all_texts)
+        if text:
+            fragment.tree_text = text
+            fragment.tree_all_texts = all_texts
+
+
 def split_with_offsets(text, chunk_size, chunk_overlap):
     text_splitter = RecursiveCharacterTextSplitter(chunk_size=chunk_size, chunk_overlap=chunk_overlap)
     chunks = text_splitter.split_text(text)
@@ -2,12 +2,13 @@
 Author: longsion<xianglong_chen@intsig.net>
 Date: 2024-09-20 19:13:01
 LastEditors: longsion
-LastEditTime: 2024-09-27 18:18:27
+LastEditTime: 2026-10-18 17:32:40
 '''
 
 
 from pkg.utils.thread_with_return_value import ThreadWithReturnValue
 from .objects import DeleteParams
+from pkg.redis.stage_cache import ANALYST_LIBRARY, stage_cache
 
 
 def process(params: DeleteParams) -> bool:
@@ -34,6 +35,9 @@ def process(params: DeleteParams) -> bool:
     for t in es_threads:
         result = result and (t.join() is None)
 
+    # 失效问答阶段缓存
+    stage_cache.invalidate(params.uuids, [ANALYST_LIBRARY])
+
     # TODO: 删除AWS源文件【暂时先不删除了】
 
     return result
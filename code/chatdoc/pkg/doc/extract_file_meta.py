@@ -2,17 +2,18 @@
 Author: longsion<xianglong_chen@intsig.net>
 Date: 2024-06-20 20:06:00
 LastEditors: longsion
-LastEditTime: 2024-10-23 18:18:12
+LastEditTime: 2026-10-18 21:58:12
 '''
 
 from datetime import datetime
 import re
 from pkg.storage import Storage
-from pkg.utils import compress, ensure_list, xjson
+from pkg.utils import ensure_list, xjson
 from pkg.utils.thread_with_return_value import ThreadWithReturnValue
 from .objects import Context, FileOriEnum, FileTypeEnum
 from pkg.utils.decorators import register_span_func
 from pkg.es.es_company import ESCompanyObject, CompanyES
+from pkg.es.fragment_blob import encode_fragments_blob
 from pkg.es.es_file import ESFileObject, FileES
 from pkg.openkie import ie_vllm
 from pkg.config import config
@@ -67,6 +68,7 @@ def extract_file_meta(context: Context) -> Context:
 
     FileES().delete_by_file_uuid(context.params.uuid, wait_delete=True)
 
+    doc_fragments = gen_doc_fragments_json(context)
     context.es_file_entity = ESFileObject(
         uuid=context.params.uuid,
         ori_type=context.file_meta.ori_type,
@@ -82,19 +84,20 @@ def extract_file_meta(context: Context) -> Context:
         extract_company_str=context.file_meta.extract_company_str,
         keywords=context.file_meta.keywords,
         summary=context.file_meta.summary,
-        doc_fragments_json=xjson.dumps(gen_doc_fragments_json(context)),  # , ensure_ascii=False
+        doc_fragments_json=xjson.dumps(doc_fragments),  # , ensure_ascii=False
         tree_summaries=context.file_meta.tree_summaries,
     )
 
-    upload_doc_parse_thread = ThreadWithReturnValue(target=upload_doc_fragments_json, args=(context.es_file_entity.doc_fragments_json, context.params.uuid))
+    upload_doc_parse_thread = ThreadWithReturnValue(target=upload_doc_fragments_json, args=(doc_fragments, context.params.uuid))
     upload_doc_parse_thread.start()
     context.threads.append(upload_doc_parse_thread)
 
     return context
 
 
-def upload_doc_fragments_json(doc_fragments_json: str, uuid: str):
-    stream = compress(doc_fragments_json)
+def upload_doc_fragments_json(doc_fragments: list[dict], uuid: str):
+    # 片段 blob（fragment_blob），ES 中仍保存 doc_fragments_json
+    stream = encode_fragments_blob(doc_fragments)
     redis_store.set(f"fragment-{uuid}", stream)
     Storage.upload(f"fragments-{uuid}.gz", stream)
 
@@ -156,7 +159,11 @@ def gen_doc_fragments_json(context: Context):
 
     return [
         fragment.model_dump(exclude=[
-            "ebed_text"
+            "ebed_text",
+            # 物化的子树结果只存片段索引，问答时按需取回
+            "tree_ori_ids",
+            "tree_text",
+            "tree_all_texts",
         ])
         for fragment in context.doc_fragments
     ]
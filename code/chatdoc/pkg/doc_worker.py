@@ -0,0 +1,120 @@
+'''
+Author: longsion<xianglong_chen@intsig.net>
+Date: 2026-10-18 23:12:40
+LastEditors: longsion
+LastEditTime: 2026-10-18 23:31:08
+'''
+
+# 文档处理队列的 worker：每个线程循环领取任务并执行对应的 run_job，处理期间心跳续期可见性超时
+# - Web 进程内启动 doc_queue.local_workers 个线程（为 0 时只入队），独立节点运行 python -m scripts.doc_worker
+# - 维护线程定期把到期的重试任务放回就绪队列、回收超时任务、上报队列深度，多个节点同时执行也是安全的
+
+import importlib
+import os
+import socket
+import threading
+import time
+
+from pkg.config import config
+from pkg.redis.doc_queue import DocJob, DocQueue, doc_queue
+from pkg.utils.logger import logger
+
+
+# 任务类型 -> 处理模块（run_job 处理任务，report_job_failed 回调最终失败），处理模块较重，按需导入
+JOB_HANDLERS = {
+    "analyst": "pkg.doc.process",
+    "personal": "pkg.personal_doc.process",
+}
+
+
+def get_job_handler(kind: str, func_name: str = "run_job"):
+    return getattr(importlib.import_module(JOB_HANDLERS[kind]), func_name)
+
+
+def report_job_failed(job: DocJob):
+    get_job_handler(job.kind, "report_job_failed")(job)
+
+
+class DocWorker:
+
+    def __init__(self, queue: DocQueue, workers: int = 4, poll_interval: float = 1.0):
+        self._queue = queue
+        self._workers = workers
+        self._poll_interval = poll_interval
+        self._stopped = threading.Event()
+        self._threads = []
+        self.name = f"{socket.gethostname()}:{os.getpid()}"
+
+    def start(self):
+        if self._threads or self._workers <= 0:
+            return
+        self._threads.append(threading.Thread(target=self._maintain_loop, name="doc-queue-maintain", daemon=True))
+        for idx in range(self._workers):
+            self._threads.append(threading.Thread(target=self._work_loop, name=f"doc-worker-{idx}", daemon=True))
+        for thread in self._threads:
+            thread.start()
+        logger.info(f"DocWorker {self.name} started, workers: {self._workers}")
+
+    def stop(self):
+        self._stopped.set()
+
+    def join(self):
+        for thread in self._threads:
+            thread.join()
+
+    def _maintain_loop(self):
+        while not self._stopped.wait(self._poll_interval):
+            try:
+                self._queue.maintain(on_failed=report_job_failed)
+            except Exception as e:
+                logger.warning(f"DocWorker maintain failed: {e}")
+
+    def _work_loop(self):
+        while not self._stopped.is_set():
+            try:
+                job = self._queue.claim(self.name)
+            except Exception as e:
+                logger.warning(f"DocWorker claim failed: {e}")
+                job = None
+            if job is None:
+                self._stopped.wait(self._poll_interval)
+                continue
+            try:
+                self.run(job)
+            except Exception as e:
+                # 完成 / 失败状态未写入时，任务超时后由维护线程回收
+                logger.error(f"DocWorker job {job.job_id} finish failed: {e}")
+
+    def _heartbeat(self, job: DocJob, done: threading.Event):
+        while not done.wait(self._queue.visibility_timeout / 3):
+            try:
+                if not self._queue.heartbeat(job):
+                    logger.warning(f"DocWorker job {job.job_id} lease lost")
+                    return
+            except Exception as e:
+                logger.warning(f"DocWorker heartbeat {job.job_id} failed: {e}")
+
+    def run(self, job: DocJob):
+        start_time = time.time()
+        logger.info(f"DocWorker run job {job.job_id}, kind: {job.kind}, attempts: {job.attempts}")
+        done = threading.Event()
+        threading.Thread(target=self._heartbeat, args=(job, done), name=f"doc-heartbeat-{job.job_id}", daemon=True).start()
+        try:
+            get_job_handler(job.kind)(job)
+        except Exception as e:
+            self._queue.fail(job, f"{type(e).__name__}: {e}", on_failed=report_job_failed)
+        else:
+            self._queue.complete(job)
+            logger.info(f"DocWorker job {job.job_id} success, elapsed: {1000*(time.time() - start_time):.1f}ms")
+        finally:
+            done.set()
+
+
+def _build_local_worker():
+    queue_config = config.get("doc_queue") or {}
+    return DocWorker(doc_queue,
+                     workers=int(queue_config.get("local_workers", 4)),
+                     poll_interval=float(queue_config.get("poll_interval", 1)))
+
+
+local_doc_worker = _build_local_worker()
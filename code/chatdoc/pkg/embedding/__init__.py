@@ -2,10 +2,10 @@
 Author: longsion<xianglong_chen@intsig.net>
 Date: 2024-04-17 10:57:45
 LastEditors: longsion
-LastEditTime: 2024-05-28 19:05:30
+LastEditTime: 2026-10-18 23:59:10
 '''
 from enum import Enum
-from .acge_embedding import acge_embedding, acge_embedding_with_cache, acge_embedding_multi, acg_embedding_multi_batch_with_cache
+from .acge_embedding import acge_embedding, acge_embedding_with_cache, acge_embedding_multi, acg_embedding_multi_batch_with_cache, matryoshka_truncate
 from .peg_embedding import peg_embedding, peg_embedding_with_cache, peg_embedding_multi, peg_embedding_multi_batch_with_cache
 
 
@@ -21,3 +21,15 @@ def embedding_text_by_type(text, type: EmbeddingType = EmbeddingType.acge, dimen
         return peg_embedding_with_cache(text) if use_cache else peg_embedding(text)
     else:
         raise ValueError(f"{type} is not a valid embedding type")
+
+
+def embedding_texts_by_type(texts: list[str], type: EmbeddingType = EmbeddingType.acge, dimension: int = 1024) -> list:
+    '''
+    批量 embedding（带缓存），未命中的文本合并请求
+    '''
+    if type == EmbeddingType.acge:
+        return acg_embedding_multi_batch_with_cache(texts, dimension=dimension)
+    elif type == EmbeddingType.peg:
+        return peg_embedding_multi_batch_with_cache(texts)
+    else:
+        raise ValueError(f"{type} is not a valid embedding type")
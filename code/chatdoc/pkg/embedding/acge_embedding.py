@@ -2,20 +2,20 @@
 Author: longsion<xianglong_chen@intsig.net>
 Date: 2024-04-17 10:56:43
 LastEditors: longsion
-LastEditTime: 2025-03-09 08:13:25
+LastEditTime: 2026-10-19 10:11:26
 '''
 
+import hashlib
 import numpy as np
 import heapq
-from pkg.utils.lru_cache import LRUCacheDict, LRUCachedFunction, BatchCacheManager
+from pkg.utils.lru_cache import ShardedLRUCacheDict, TieredCacheDict, LRUCachedFunction, BatchCacheManager
+from pkg.utils.single_flight import SingleFlight
 from pkg.config import config
-from pkg.utils import global_thread_pool, retry_exponential_backoff
+from pkg.utils import global_thread_pool
+from pkg.clients.http_client import get_http_client
 
 
-@retry_exponential_backoff()
 def acge_embedding(text, dimension=1024, digit=8):
-    import requests
-
     json_text = {
         "input": [text],
         "matryoshka_dim": dimension,
@@ -27,19 +27,48 @@ def acge_embedding(text, dimension=1024, digit=8):
         "x-ti-secret-code": config["textin"]["app_secret"],
     }
 
-    completion = requests.post(url=url, headers=headers, json=json_text)
+    completion = get_http_client("embedding").post(url=url, headers=headers, json=json_text)
     completion.raise_for_status()
     return completion.json()["result"]["embedding"][0]
 
 
-acg_lru_cache = LRUCacheDict(max_size=5000, expiration=60 * 60)
-acge_embedding_with_cache = LRUCachedFunction(acge_embedding, acg_lru_cache, cache_key_suffix="acge_embedding")
+def matryoshka_truncate(vector, dimension: int) -> list[float]:
+    '''
+    Matryoshka embedding 取前 dimension 维并重新归一化，用于两阶段召回的粗排向量
+    '''
+    head = np.asarray(vector[:dimension], dtype=np.float32)
+    norm = float(np.linalg.norm(head)) or 1.0
+    return (head / norm).tolist()
+
+
+def acge_cache_key(text, dimension=1024, digit=8, headers=None, url=None, **kwargs):
+    # 单条与批量 embedding 共用同一个 key，共享 L1/L2 缓存；key 包含服务地址的摘要，不同模型 / 服务的向量不会混用
+    endpoint = hashlib.md5((url or config["textin"]["embedding_url"]).encode('utf-8')).hexdigest()[:8]
+    return f"acge_embedding:{endpoint}:{dimension}:{digit}:{hashlib.md5(text.encode('utf-8')).hexdigest()}"
 
 
-@retry_exponential_backoff()
-def acge_embedding_multi(text_list, dimension=1024, digit=8, headers=None, url=None):
-    import requests
+def _build_acge_cache():
+    cache_config = config.get("embedding_cache") or {}
+    l1 = ShardedLRUCacheDict(max_size=cache_config.get("l1_max_size", 5000), expiration=cache_config.get("l1_expiration", 60 * 60))
+    if not cache_config.get("redis_enable"):
+        return l1
 
+    from pkg.redis.redis import redis_store
+    from pkg.redis.vector_store import RedisVectorStore
+    l2 = RedisVectorStore(redis_store,
+                          prefix=cache_config.get("redis_prefix", "emb"),
+                          dtype=cache_config.get("redis_dtype", "float16"),
+                          expiration=cache_config.get("redis_expiration"))
+    return TieredCacheDict(l1, l2)
+
+
+acg_lru_cache = _build_acge_cache()
+# 单条与批量共用缓存 key，请求合并也共用，同一文本并发未命中时只请求一次
+acge_single_flight = SingleFlight("acge_embedding")
+acge_embedding_with_cache = LRUCachedFunction(acge_embedding, acg_lru_cache, cache_key_suffix="acge_embedding", key_func=acge_cache_key, single_flight=acge_single_flight)
+
+
+def acge_embedding_multi(text_list, dimension=1024, digit=8, headers=None, url=None):
     json_text = {
         "input": text_list,
         "matryoshka_dim": dimension,
@@ -50,14 +79,15 @@ def acge_embedding_multi(text_list, dimension=1024, digit=8, headers=None, url=N
         "x-ti-app-id": config["textin"]["app_id"],
         "x-ti-secret-code": config["textin"]["app_secret"],
     })
-    completion = requests.post(url=url or config["textin"]["embedding_url"],
-                               headers=headers or None,
-                               json=json_text)
+    completion = get_http_client("embedding").post(url=url or config["textin"]["embedding_url"],
+                                                   headers=headers or None,
+                                                   json=json_text)
     completion.raise_for_status()
     return completion.json()["result"]["embedding"]
 
 
-acg_embedding_multi_batch_with_cache = BatchCacheManager(acge_embedding_multi, cache=acg_lru_cache, batch_size=16, cache_key_suffix="acge_embedding", thread_pool=global_thread_pool)
+acg_embedding_multi_batch_with_cache = BatchCacheManager(acge_embedding_multi, cache=acg_lru_cache, batch_size=16, cache_key_suffix="acge_embedding", thread_pool=global_thread_pool, key_func=acge_cache_key,
+                                                         single_flight=acge_single_flight)
 
 
 def get_similar_top_n(texts: list[str], sentence: str, dimension=1024, top_n=1):
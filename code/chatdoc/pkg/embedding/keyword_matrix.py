@@ -0,0 +1,113 @@
+'''
+Author: longsion<xianglong_chen@intsig.net>
+Date: 2026-10-18 12:14:50
+LastEditors: longsion
+LastEditTime: 2026-10-19 00:08:14
+'''
+
+import hashlib
+import os
+import threading
+
+import numpy as np
+
+from pkg.config import BASE_DIR, config
+from pkg.embedding.acge_embedding import acg_embedding_multi_batch_with_cache, acge_embedding_with_cache
+from pkg.utils.logger import logger
+
+
+class KeywordMatrix:
+    '''
+    静态关键词列表的 embedding 矩阵
+    - 首次使用时构建（优先读取 .npy 缓存文件，文件名包含关键词、embedding 模型与服务地址的摘要），之后常驻内存
+    - 行向量归一化，连续 float32 存储，查询时一次 matmul + argpartition 取 top-k
+    '''
+
+    def __init__(self, keys: list[str], dimension: int = 1024, cache_dir: str = None, model: str = "acge_embedding", endpoint: str = None):
+        self.keys = list(keys)
+        self.dimension = dimension
+        self.model = model
+        self.endpoint = endpoint or config["textin"]["embedding_url"]
+        self._cache_dir = cache_dir
+        self._matrix = None
+        self._lock = threading.Lock()
+
+    @property
+    def cache_path(self):
+        if not self._cache_dir:
+            return None
+        digest = hashlib.md5("\n".join([self.model, self.endpoint] + self.keys).encode("utf-8")).hexdigest()
+        return os.path.join(self._cache_dir, f"keyword-matrix-{digest}-{self.dimension}.npy")
+
+    @staticmethod
+    def _normalize(matrix: np.ndarray) -> np.ndarray:
+        norms = np.linalg.norm(matrix, axis=-1, keepdims=True)
+        norms[norms == 0] = 1
+        return np.ascontiguousarray(matrix / norms, dtype=np.float32)
+
+    def _load(self):
+        path = self.cache_path
+        if path and os.path.exists(path):
+            try:
+                matrix = np.load(path)
+                if matrix.shape == (len(self.keys), self.dimension):
+                    return matrix
+            except Exception as e:
+                logger.warning(f"KeywordMatrix load {path} failed: {e}")
+
+        vectors = acg_embedding_multi_batch_with_cache(self.keys, dimension=self.dimension)
+        matrix = self._normalize(np.asarray(vectors, dtype=np.float32))
+        if path:
+            try:
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                np.save(path, matrix)
+            except Exception as e:
+                logger.warning(f"KeywordMatrix save {path} failed: {e}")
+        return matrix
+
+    @property
+    def matrix(self) -> np.ndarray:
+        if self._matrix is None:
+            with self._lock:
+                if self._matrix is None:
+                    self._matrix = self._load()
+        return self._matrix
+
+    def warmup(self):
+        try:
+            self.matrix
+        except Exception as e:
+            logger.warning(f"KeywordMatrix warmup failed: {e}")
+
+    def top_n(self, sentence: str, top_n=1) -> list[tuple[str, float]]:
+        '''
+        与 get_similar_top_n(self.keys, sentence, top_n=top_n) 返回格式一致
+        '''
+        if not self.keys:
+            return []
+        query = self._normalize(np.asarray(acge_embedding_with_cache(sentence, dimension=self.dimension), dtype=np.float32))
+        scores = self.matrix @ query
+
+        top_n = min(top_n, len(self.keys))
+        if top_n < len(self.keys):
+            index = np.argpartition(-scores, top_n - 1)[:top_n]
+        else:
+            index = np.arange(len(self.keys))
+        index = index[np.argsort(-scores[index], kind="stable")]
+
+        return [
+            (self.keys[i], np.round(float(scores[i]), 4)) for i in index
+        ]
+
+
+def _keyword_matrix_cache_dir():
+    cache_dir = (config.get("embedding_cache") or {}).get("keyword_matrix_dir")
+    return cache_dir.format(BASE_DIR=BASE_DIR) if cache_dir else None
+
+
+def _build_three_table_key_matrix():
+    from pkg.structure_static import three_table_key_list
+    return KeywordMatrix(three_table_key_list, cache_dir=_keyword_matrix_cache_dir())
+
+
+three_table_key_matrix = _build_three_table_key_matrix()
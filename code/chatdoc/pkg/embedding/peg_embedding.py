@@ -2,11 +2,11 @@
 Author: longsion<xianglong_chen@intsig.net>
 Date: 2024-04-17 11:00:09
 LastEditors: longsion
-LastEditTime: 2024-04-26 10:58:28
+LastEditTime: 2026-10-18 10:36:12
 '''
 
 
-from pkg.utils.lru_cache import LRUCacheDict, LRUCachedFunction, BatchCacheManager
+from pkg.utils.lru_cache import ShardedLRUCacheDict, LRUCachedFunction, BatchCacheManager
 from pkg.config import config
 from pkg.utils import global_thread_pool, retry_exponential_backoff
 
@@ -25,7 +25,7 @@ def peg_embedding(text):
     return completion.json()["result"]["embedding"][0]
 
 
-peg_lru_cache = LRUCacheDict(max_size=5000, expiration=60 * 60)
+peg_lru_cache = ShardedLRUCacheDict(max_size=5000, expiration=60 * 60)
 peg_embedding_with_cache = LRUCachedFunction(peg_embedding, cache=peg_lru_cache)
 
 
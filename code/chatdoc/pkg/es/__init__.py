@@ -2,11 +2,12 @@
 Author: longsion<xianglong_chen@intsig.net>
 Date: 2024-04-24 15:25:44
 LastEditors: longsion
-LastEditTime: 2025-03-07 16:15:11
+LastEditTime: 2026-10-18 21:24:05
 '''
 from pkg.config import config
 from pkg.utils import ensure_list
 from pkg.utils.logger import logger
+from pkg.utils.metrics import global_metrics
 from functools import cache
 
 import time
@@ -16,7 +17,9 @@ from datetime import datetime
 from elasticsearch import ConflictError, TransportError, helpers
 from elasticsearch import Elasticsearch
 from pkg.utils.objects import IFBaseModel
-from requests.auth import HTTPBasicAuth
+
+
+es_search_seconds = global_metrics.histogram("es_search_seconds", "ES search latency by index")
 
 
 @cache
@@ -49,6 +52,13 @@ class ES:
         self.default_host = hosts[0]
         self.username = config["es"].get("username")
         self.password = config["es"].get("password")
+        # 连接池与查询线程数对齐，节点故障时由 transport 自动切换并重试
+        transport_options = dict(
+            connections_per_node=int(config["es"].get("connections_per_node") or config["threadpool"]["global_worker"]),
+            request_timeout=float(config["es"].get("request_timeout") or 30),
+            max_retries=int(config["es"].get("max_retries") or 2),
+            retry_on_timeout=True,
+        )
         if config["es"].get("username"):
             # deprecated
             # self.conn = Elasticsearch(hosts, http_auth=(config["es"]["username"], config["es"]["password"]))
@@ -57,10 +67,11 @@ class ES:
                 basic_auth=(config["es"]["username"], config["es"]["password"]),
                 verify_certs=False,     # 验证证书
                 # ca_certs="/path/to/ca.crt"  # CA证书的路径，如果自签名的话需要这个
+                **transport_options,
             )
 
         else:
-            self.conn = Elasticsearch(hosts)
+            self.conn = Elasticsearch(hosts, **transport_options)
 
     @staticmethod
     def analyze(text):
@@ -113,8 +124,9 @@ class ES:
 
         # 使用helpers.bulk方法插入，为每个操作指定op_type为'create'
         # 确保了如果尝试插入的文档ID已经在索引中存在，则该操作会被忽略
+        # 指定了确定性 _id 的文档使用 'index' 覆盖写入，重试与重新入库都是幂等的
         for doc in docs:
-            doc["_op_type"] = "create"
+            doc["_op_type"] = "index" if "_id" in doc else "create"
             doc["_source"]["created_at"] = datetime.strftime(datetime.now(), "%Y-%m-%d %H:%M:%S")
 
         for attempt in range(max_retries + 1):  # 加1是因为range不包含结束值
@@ -229,34 +241,75 @@ class ES:
     def search(self, index, search_body):
         try:
             st = time.time()
-            body_str = json.dumps(search_body, ensure_ascii=False)
-            for host in [self.default_host] + self.hosts:
-                url = f"{host}/{index}/_search"
-                if self.username:
-                    resp = requests.get(url, json=search_body, auth=HTTPBasicAuth(self.username, self.password), verify=False)
-                else:
-                    resp = requests.get(url, json=search_body, verify=False)
-
-                if resp.status_code == 200:
-                    resp = resp.json()
-                    self.default_host = host
-                    break
-                else:
-                    print(f"search error, search_body: {search_body},resp: {resp.text}")
-
+            resp = self.conn.search(index=index, body=search_body)
             hits = resp["hits"]["hits"]
             et = time.time()
 
+            es_search_seconds.observe(et - st, index=index, op="search")
             logger.info(f"searching ES: {index}, duration: {(et-st) * 1000:.1f}ms")
-
-            if et - st > 0.5:
-                logger.warning(f"ES search too slow: {1000*(et - st):.1f}ms, index: {index}, search_body: {body_str}")
             # return [hit["_source"][field] for hit in hits]
             return hits
         except Exception as e:
             logger.error(f"ES Error: search_body: {search_body}", )
             raise e
 
+    def msearch(self, searches: list[tuple[str, dict]]) -> list[list[dict]]:
+        """
+        多个查询合并为一次 _msearch 请求
+        Args:
+            searches: [(index, search_body), ...]
+        Returns:
+            与 searches 一一对应的 hits 列表
+        """
+        if not searches:
+            return []
+
+        body = []
+        for index, search_body in searches:
+            body.append({"index": index})
+            body.append(search_body)
+
+        try:
+            st = time.time()
+            resp = self.conn.msearch(searches=body)
+            et = time.time()
+        except Exception as e:
+            logger.error(f"ES Error: msearch indexes: {[index for index, _ in searches]}")
+            raise e
+
+        indexes = ",".join(sorted({index for index, _ in searches}))
+        es_search_seconds.observe(et - st, index=indexes, op="msearch")
+        logger.info(f"msearching ES: {indexes}, size: {len(searches)}, duration: {(et-st) * 1000:.1f}ms")
+
+        results = []
+        for (index, search_body), item in zip(searches, resp["responses"]):
+            if "error" in item:
+                logger.error(f"ES Error: msearch index: {index}, error: {item['error']}, search_body: {search_body}")
+                raise Exception(f"ES msearch error, index: {index}, error: {item['error']}")
+            results.append(item["hits"]["hits"])
+        return results
+
+    def mget(self, index, ids: list[str], source: list[str] = None) -> dict[str, dict]:
+        """
+        按确定性 _id 批量取文档（realtime GET，写入后无需等待 refresh）
+        Returns:
+            {_id: _source}，不存在的 _id 不返回
+        """
+        if not ids:
+            return {}
+
+        try:
+            st = time.time()
+            resp = self.conn.mget(index=index, ids=list(ids), source=source, realtime=True)
+            et = time.time()
+        except Exception as e:
+            logger.error(f"ES Error: mget index: {index}, ids: {len(ids)}")
+            raise e
+
+        es_search_seconds.observe(et - st, index=index, op="mget")
+        logger.info(f"mget ES: {index}, size: {len(ids)}, duration: {(et-st) * 1000:.1f}ms")
+        return {doc["_id"]: doc["_source"] for doc in resp["docs"] if doc.get("found")}
+
     def search_local(self, index, search_body):
         try:
             st = time.time()
@@ -279,6 +332,25 @@ class ES:
             raise e
 
 
+def keyed_docs(index: str, sources: list[dict], doc_ids) -> list[dict]:
+    '''
+    生成带确定性 _id 的 bulk 文档，doc_ids(source) 返回该文档的全部 _id（同一份 source 可写入多个 _id），返回空时使用自动 _id
+    '''
+    docs = []
+    for source in sources:
+        ids = doc_ids(source)
+        if not ids:
+            docs.append({"_index": index, "_source": source})
+        for doc_id in ids:
+            docs.append({"_index": index, "_id": doc_id, "_source": source})
+    return docs
+
+
+def keyed_lookup_fallback() -> bool:
+    # 历史数据为自动 _id，mget 未命中时回退到 terms 查询；执行 scripts/es/construct_v5_keyed_index.py 迁移后可关闭
+    return bool(config["es"].get("keyed_lookup_fallback", True))
+
+
 def generate_es_mapping(model_class):
     # model_class: pydantic class
     properties = {}
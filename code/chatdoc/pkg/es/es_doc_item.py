@@ -2,23 +2,29 @@
 Author: longsion<xianglong_chen@intsig.net>
 Date: 2024-05-15 14:08:26
 LastEditors: longsion
-LastEditTime: 2024-10-16 10:57:40
+LastEditTime: 2026-10-18 21:24:05
 '''
 
 
 import time
 from pkg.config import config
-from pkg.es import global_es, EsBaseItem
+from pkg.es import global_es, EsBaseItem, keyed_docs, keyed_lookup_fallback
 import requests
 from pkg.utils import ensure_list
 from pkg.utils.logger import logger
+from pkg.utils.metrics import global_metrics
+
+
+# 表格入库时已转换为markdown，content 仍为html的是历史数据，需执行 scripts.es.backfill_doc_item_markdown
+legacy_html_tables = global_metrics.counter("doc_item_legacy_html_tables_total", "Doc items whose table content is still html, pending markdown backfill")
 
 
 class DocItemModel(EsBaseItem):
     uuid: str = None        # 文件的uuid
     titles: list[str] = []
     ori_id: list[str] = []
-    content: str = None
+    content: str = None             # 段落内容 | 表格入库时转换好的markdown
+    content_html: str = ""          # 表格原始html，只存储不检索，问答链路不读取
     type: str = None
 
 
@@ -59,6 +65,10 @@ class DocItemES(object):
             "content": {
                 "type": "text"
             },
+            "content_html": {
+                "type": "text",
+                "index": False
+            },
             "created_at": {
                 "type": "date",  # 字段类型为日期
                 "format": "yyyy-MM-dd HH:mm:ss"  # 日期格式示例，根据实际需求调整
@@ -120,12 +130,7 @@ class DocItemES(object):
         :param data:
         :return:
         """
-        global_es.insert(self.index_name, docs=[
-            {
-                "_index": self.index_name,
-                "_source": doc_item.model_dump()
-            }
-        ])
+        global_es.insert(self.index_name, docs=keyed_docs(self.index_name, [doc_item.model_dump()], self.doc_ids))
 
     def insert_doc_items(self, doc_items: list[DocItemModel]) -> bool:
         """
@@ -133,12 +138,7 @@ class DocItemES(object):
         :param data:
         :return:
         """
-        global_es.insert(self.index_name, docs=[
-            {
-                "_index": self.index_name,
-                "_source": doc_item.model_dump()
-            } for doc_item in doc_items
-        ])
+        global_es.insert(self.index_name, docs=keyed_docs(self.index_name, [doc_item.model_dump() for doc_item in doc_items], self.doc_ids))
 
     def delete_by_file_uuid(self, uuid, wait_delete=True):
         start_time = time.time()
@@ -150,7 +150,32 @@ class DocItemES(object):
         global_es.delete_document_by_query(index=self.index_name, query=dict(terms=dict(uuid=uuids)), wait_delete=wait_delete)
         logger.info(f"DocItemES delete_by_file_uuids: {uuids}, cost: {1000*(time.time() - start_time):.1f}ms")
 
+    @staticmethod
+    def doc_ids(source: dict) -> list[str]:
+        # 每个 ori_id 一个 _id（跨页的段落 / 表格写入多份），按任意 ori_id 都能直接 mget
+        return [f"{source['uuid']}|{ori_id}" for ori_id in dict.fromkeys(source.get("ori_id") or [])]
+
     def get_by_uuid_ori_tuples(self, pairs: list[tuple[str, str]], fillup=True) -> list[DocItemModel]:
+        '''
+        按确定性 _id（{uuid}|{ori_id}）mget，只取请求的原文；未命中的（历史自动 _id 数据）回退到 terms 查询
+        '''
+        pairs = list(set(pairs))
+        ids = {f"{uuid}|{ori_id}": (uuid, ori_id) for uuid, ori_id in pairs}
+        sources = global_es.mget(self.index_name, list(ids), source=DocItemModel.keys(exclude=["content_html"]))
+
+        doc_items = [DocItemModel(**source) for source in sources.values()]
+        missing_pairs = [pair for doc_id, pair in ids.items() if doc_id not in sources]
+        if missing_pairs and keyed_lookup_fallback():
+            doc_items.extend(self.search_by_uuid_ori_tuples(missing_pairs, fillup=fillup))
+
+        legacy_count = sum(1 for doc_item in doc_items if doc_item.content and doc_item.content.startswith("<table border="))
+        if legacy_count:
+            legacy_html_tables.inc(legacy_count, index=self.index_name)
+        doc_items = {f"{doc_item.uuid}|{doc_item.ori_id}": doc_item for doc_item in doc_items}.values()
+
+        return doc_items
+
+    def search_by_uuid_ori_tuples(self, pairs: list[tuple[str, str]], fillup=True) -> list[DocItemModel]:
         pairs = list(set(pairs))
         uuid_groups = {}
         for uuid, ori_id in pairs:
@@ -171,7 +196,7 @@ class DocItemES(object):
                 }
             })
         search_body = {
-            "_source": DocItemModel.keys(),
+            "_source": DocItemModel.keys(exclude=["content_html"]),
             "query": {
                 "bool": {
                     "should": should_condition,
@@ -186,7 +211,7 @@ class DocItemES(object):
         uncached_pairs = set(pairs) - set([(doc_item.uuid, ori_id) for doc_item in doc_items for ori_id in doc_item.ori_id])
         if fillup and len(doc_items) >= len(pairs) and uncached_pairs:
             # 再重新补全一遍, 确保找到
-            fillup_doc_items = self.get_by_uuid_ori_tuples(uncached_pairs, fillup=False)
+            fillup_doc_items = self.search_by_uuid_ori_tuples(uncached_pairs, fillup=False)
             doc_items.extend(fillup_doc_items)
 
         doc_items = {f"{doc_item.uuid}|{doc_item.ori_id}": doc_item for doc_item in doc_items}.values()
@@ -0,0 +1,168 @@
+'''
+Author: longsion<xianglong_chen@intsig.net>
+Date: 2026-10-18 19:40:18
+LastEditors: longsion
+LastEditTime: 2026-10-19 10:03:47
+'''
+
+# 限定少量文件的向量召回：按文件缓存片段向量矩阵（float32 连续内存）与片段字段，
+# 问题向量在本地一次 matmul + argpartition 取 top-k，不再发送 ES painless 向量查询
+# - 缓存 key: 索引 + file_uuid + user_id + 文件版本号（stage_cache.file_versions，文件重新解析或删除时 +1），收到失效消息时立即淘汰
+# - 片段尚未全部写入向量（解析中）或超过 max_fragments_per_file 时不缓存，仍按本次加载结果打分
+# - 得分与 script_score 一致：max(dotProduct, 0)
+# - 缓存中不保留物化的子树原文（tree_text / tree_all_texts），只对返回的 top-k 按 _id mget 补齐
+
+import time
+from typing import Optional
+
+import numpy as np
+
+from pkg.config import config
+from pkg.es import global_es
+from pkg.redis.invalidation_bus import FileKeyIndex, invalidation_bus
+from pkg.redis.stage_cache import stage_cache
+from pkg.utils.logger import logger
+from pkg.utils.lru_cache import ShardedLRUCacheDict, estimate_nbytes
+from pkg.utils.metrics import global_metrics
+
+
+file_vector_cache_requests = global_metrics.counter("file_vector_cache_requests_total", "Per-file embedding matrix cache lookups by outcome")
+
+EMBEDDING_FIELDS = ["acge_embedding", "acge_embedding_256", "peg_embedding"]
+# 不放入缓存的大字段，命中后再取
+LARGE_FIELDS = ["tree_text", "tree_all_texts"]
+
+
+def get_scoped_vector_config() -> dict:
+    return config["retrieve"].get("scoped_vector") or {}
+
+
+def use_scoped_vector(file_uuids: list[str]) -> bool:
+    # 只有向量存储在 ES 中时才能从片段索引加载向量
+    from pkg.vdb import get_vector_db_model
+
+    scoped_config = get_scoped_vector_config()
+    return bool(scoped_config.get("enable")) and get_vector_db_model() == "es" \
+        and 0 < len(file_uuids) <= int(scoped_config.get("max_files", 5))
+
+
+class FileEmbeddingMatrix:
+    '''
+    单个文件的片段向量矩阵，ids / items 与 vectors 的行一一对应
+    '''
+
+    def __init__(self, ids: list[str], vectors: np.ndarray, items: list[dict], complete: bool):
+        self.ids = ids
+        self.vectors = vectors
+        self.items = items
+        self.complete = complete
+        self.nbytes = vectors.nbytes + estimate_nbytes(items)
+
+
+class FileVectorCache:
+
+    def __init__(self, max_bytes: int = 1 << 30, expiration: int = 3600, max_fragments_per_file: int = 10000):
+        self._cache = ShardedLRUCacheDict(max_size=100000, expiration=expiration, max_bytes=max_bytes)
+        self._max_fragments_per_file = max_fragments_per_file
+        self._file_keys = FileKeyIndex(self._cache, invalidation_bus)
+
+    def _load(self, index: str, field: str, file_uuids: list[str], user_id: Optional[str]) -> dict[str, FileEmbeddingMatrix]:
+        searches = []
+        for file_uuid in file_uuids:
+            filters = [dict(term=dict(file_uuid=file_uuid))]
+            if user_id:
+                filters.append(dict(term=dict(user_id=user_id)))
+            searches.append((index, {
+                "_source": {"excludes": [name for name in EMBEDDING_FIELDS if name != field] + LARGE_FIELDS},
+                "size": self._max_fragments_per_file,
+                "query": {"bool": {"filter": filters}},
+            }))
+
+        matrices = {}
+        for file_uuid, hits in zip(file_uuids, global_es.msearch(searches)):
+            ids, vectors, items = [], [], []
+            for hit in hits:
+                vector = hit["_source"].pop(field, None)
+                if not vector:
+                    continue
+                ids.append(hit["_id"])
+                vectors.append(vector)
+                items.append(hit["_source"])
+
+            # 命中数达到上限时可能未取全
+            complete = len(hits) < self._max_fragments_per_file and len(ids) == len(hits)
+            matrix = np.asarray(vectors, dtype=np.float32) if vectors else np.zeros((0, 1), dtype=np.float32)
+            matrices[file_uuid] = FileEmbeddingMatrix(ids, np.ascontiguousarray(matrix), items, complete)
+        return matrices
+
+    def get_matrices(self, index: str, field: str, file_uuids: list[str], user_id: Optional[str] = None) -> Optional[list[FileEmbeddingMatrix]]:
+        versions = stage_cache.file_versions(file_uuids)
+        if versions is None:
+            return None
+
+        keys = {file_uuid: f"{index}:{field}:{user_id or ''}:{file_uuid}:{version}" for file_uuid, version in zip(file_uuids, versions)}
+        matrices = {file_uuid: self._cache.get(key) for file_uuid, key in keys.items()}
+        missing = [file_uuid for file_uuid, matrix in matrices.items() if matrix is None]
+        file_vector_cache_requests.inc(len(file_uuids) - len(missing), outcome="hit")
+        file_vector_cache_requests.inc(len(missing), outcome="miss")
+
+        if missing:
+            for file_uuid, matrix in self._load(index, field, missing, user_id).items():
+                matrices[file_uuid] = matrix
+                if matrix.complete:
+                    self._cache[keys[file_uuid]] = matrix
+                    self._file_keys.add(file_uuid, keys[file_uuid])
+
+        return [matrices[file_uuid] for file_uuid in file_uuids]
+
+    def search(self, index: str, field: str, question_embedding: list[float], file_uuids: list[str], size: int,
+               op_fields: list = [], user_id: Optional[str] = None) -> Optional[list[dict]]:
+        '''
+        返回与 hits_to_items 相同结构的结果，缓存不可用时返回 None，由调用方回退到 ES 向量查询
+        '''
+        start_time = time.time()
+        matrices = self.get_matrices(index, field, file_uuids, user_id)
+        if matrices is None:
+            return None
+
+        query = np.asarray(question_embedding, dtype=np.float32)
+        candidates = []
+        for matrix in matrices:
+            if not matrix.ids:
+                continue
+            scores = matrix.vectors @ query
+            top = np.argpartition(-scores, size)[:size] if len(scores) > size else np.arange(len(scores))
+            candidates.extend((float(scores[i]), matrix, int(i)) for i in top)
+
+        candidates.sort(key=lambda x: x[0], reverse=True)
+        op_fields = set(op_fields)
+        items = [
+            {
+                "score": max(score, 0.0),
+                "_id": matrix.ids[i],
+                **{key: value for key, value in matrix.items[i].items() if key in op_fields},
+            }
+            for score, matrix, i in candidates[:size]
+        ]
+
+        large_fields = [name for name in LARGE_FIELDS if name in op_fields]
+        if large_fields and items:
+            try:
+                sources = global_es.mget(index, [item["_id"] for item in items], source=large_fields)
+            except Exception as e:
+                logger.warning(f"FileVectorCache mget {index} failed: {e}")
+                return None
+            for item in items:
+                item.update(sources.get(item["_id"]) or {})
+        logger.info(f"FileVectorCache search {index}, files: {len(file_uuids)}, size: {size}, cost: {1000*(time.time() - start_time):.1f}ms")
+        return items
+
+
+def _build_file_vector_cache():
+    scoped_config = get_scoped_vector_config()
+    return FileVectorCache(max_bytes=int(scoped_config.get("cache_max_bytes") or (1 << 30)),
+                           expiration=scoped_config.get("expiration", 3600),
+                           max_fragments_per_file=scoped_config.get("max_fragments_per_file", 10000))
+
+
+file_vector_cache = _build_file_vector_cache()
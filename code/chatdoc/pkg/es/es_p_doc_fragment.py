@@ -2,18 +2,22 @@
 Author: longsion<xianglong_chen@intsig.net>
 Date: 2024-09-13 14:20:04
 LastEditors: longsion
-LastEditTime: 2025-03-06 22:14:35
+LastEditTime: 2026-10-19 09:55:30
 '''
 
 
 import time
 from pkg.config import config
 from pkg.embedding import EmbeddingType
-from pkg.es import global_es, EsBaseItem
+from pkg.es import global_es, EsBaseItem, keyed_docs, keyed_lookup_fallback
 from pkg.utils.logger import logger
 import requests
 
 
+# 构建片段树不需要的大字段
+TREE_SOURCE_EXCLUDES = ("ebed_text", "tree_text", "tree_all_texts")
+
+
 class PDocFragmentModel(EsBaseItem):
     user_id: str = ""               # 用户id
     uuid: str = ""                  # 切片唯一标识uuid
@@ -40,6 +44,11 @@ class PDocFragmentModel(EsBaseItem):
     table_start_row_idx: int = 0    # 表格起始行
     table_end_row_idx: int = 0      # 表格结束行
 
+    # ---- 非叶子切片入库时物化的子树结果，超过长度限制时为空，查询时回退到递归拼接 ----
+    tree_ori_ids: list[str] = []    # 子树ori_id去重后按(页, 序号)排序
+    tree_text: str = ""             # 子树markdown原文，同get_fragment_ori_text
+    tree_all_texts: list[str] = []  # 子树原文列表，同get_fragment_all_texts
+
 
 class PDocFragmentES(object):
 
@@ -119,6 +128,20 @@ class PDocFragmentES(object):
             "table_end_row_idx": {
                 "type": "integer"
             },
+            # 物化的子树结果只存储不检索
+            "tree_ori_ids": {
+                "type": "keyword",
+                "index": False,
+                "doc_values": False
+            },
+            "tree_text": {
+                "type": "text",
+                "index": False
+            },
+            "tree_all_texts": {
+                "type": "text",
+                "index": False
+            },
             "created_at": {
                 "type": "date",  # 字段类型为日期
                 "format": "yyyy-MM-dd HH:mm:ss"  # 日期格式示例，根据实际需求调整
@@ -126,6 +149,26 @@ class PDocFragmentES(object):
             "acge_embedding": {
                 "type": "dense_vector",
                 "dims": 1024,
+                # HNSW 索引，供 es.vector_search=knn 使用
+                "index": True,
+                "similarity": "cosine",
+                "index_options": {
+                    "type": "hnsw",
+                    "m": 16,
+                    "ef_construction": 100
+                }
+            },
+            # 两阶段召回的粗排向量：acge_embedding 前 256 维归一化，int8 量化 HNSW（es.vector_search=two_stage）
+            "acge_embedding_256": {
+                "type": "dense_vector",
+                "dims": 256,
+                "index": True,
+                "similarity": "cosine",
+                "index_options": {
+                    "type": "int8_hnsw",
+                    "m": 16,
+                    "ef_construction": 100
+                }
             }
         }
 
@@ -165,12 +208,7 @@ class PDocFragmentES(object):
         :param data:
         :return:
         """
-        return global_es.insert(self.index_name, docs=[
-            {
-                "_index": self.index_name,
-                "_source": doc_fragment.model_dump()
-            }
-        ])
+        return global_es.insert(self.index_name, docs=keyed_docs(self.index_name, [doc_fragment.model_dump()], self.doc_ids))
 
     def insert_doc_fragments(self, doc_fragments: list[PDocFragmentModel]) -> bool:
         """
@@ -178,12 +216,7 @@ class PDocFragmentES(object):
         :param data:
         :return:
         """
-        return global_es.insert(self.index_name, docs=[
-            {
-                "_index": self.index_name,
-                "_source": doc_fragment.model_dump()
-            } for doc_fragment in doc_fragments
-        ])
+        return global_es.insert(self.index_name, docs=keyed_docs(self.index_name, [doc_fragment.model_dump() for doc_fragment in doc_fragments], self.doc_ids))
 
     def delete_by_file_uuid(self, file_uuid, wait_delete=True):
         start_time = time.time()
@@ -203,7 +236,26 @@ class PDocFragmentES(object):
         global_es.delete_document_by_query(index=self.index_name, query=query, wait_delete=wait_delete)
         logger.info(f"PDocFragmentES delete_by_user_and_file_uuid, user_id: {user_id}, uuids: {uuids}, cost: {1000*(time.time() - start_time):.1}ms")
 
+    @staticmethod
+    def doc_ids(source: dict) -> list[str]:
+        # 片段 uuid 即 _id
+        return [source["uuid"]] if source.get("uuid") else []
+
     def get_by_uuids(self, uuids, fillup=True) -> list[PDocFragmentModel]:
+        '''
+        按片段 uuid（即 _id）mget；未命中的（历史自动 _id 数据）回退到 terms 查询
+        '''
+        uuids = list(set(uuids))
+        sources = global_es.mget(self.index_name, uuids, source=self.keys)
+
+        doc_fragments = [PDocFragmentModel(**source) for source in sources.values()]
+        missing_uuids = [uuid for uuid in uuids if uuid not in sources]
+        if missing_uuids and keyed_lookup_fallback():
+            doc_fragments.extend(self.search_by_uuids(missing_uuids, fillup=fillup))
+
+        return doc_fragments
+
+    def search_by_uuids(self, uuids, fillup=True) -> list[PDocFragmentModel]:
         uuids = list(set(uuids))
         hits = global_es.search(index=self.index_name, search_body=dict(
             _source=self.keys,
@@ -221,7 +273,7 @@ class PDocFragmentES(object):
         uncached_uuids = set(uuids) - set([doc_fragment.uuid for doc_fragment in doc_fragments])
         if fillup and len(doc_fragments) >= len(uuids) and uncached_uuids:
             # 再重新补全一遍, 确保找到
-            fillup_doc_fragments = self.get_by_uuids(uncached_uuids, fillup=False)
+            fillup_doc_fragments = self.search_by_uuids(uncached_uuids, fillup=False)
             doc_fragments.extend(fillup_doc_fragments)
 
         # 根据uuid去重
@@ -229,7 +281,25 @@ class PDocFragmentES(object):
 
         return doc_fragments
 
-    def search_fragment(self, bm25_text, ebd_text, user_id, document_uuids, size=10) -> list[PDocFragmentModel]:
+    def get_tree_sources_by_file_uuids(self, file_uuids, user_id, size=10000) -> dict[str, list[dict]]:
+        """
+        按文件取全部片段（不含 ebed_text、物化的子树原文与向量），每个文件一个查询，合并为一次 msearch
+        用于构建整棵片段树，代替按层级逐次 get_by_uuids；命中数达到 size 时可能未取全，由调用方判断
+        """
+        start_time = time.time()
+        source = [key for key in self.keys if key not in TREE_SOURCE_EXCLUDES]
+        searches = []
+        for file_uuid in file_uuids:
+            filters = [dict(term=dict(file_uuid=file_uuid))]
+            if user_id:
+                filters.append(dict(term=dict(user_id=user_id)))
+            searches.append((self.index_name, dict(_source=source, query={"bool": {"filter": filters}}, size=size)))
+
+        results = {file_uuid: [hit["_source"] for hit in hits] for file_uuid, hits in zip(file_uuids, global_es.msearch(searches))}
+        logger.info(f"PDocFragmentES get_tree_sources_by_file_uuids: {len(file_uuids)}, cost: {1000*(time.time() - start_time):.1f}ms")
+        return results
+
+    def search_fragment(self, bm25_text, ebd_text, user_id, document_uuids, size=10, num_candidates=0) -> list[PDocFragmentModel]:
         from pkg.es.es_p_retrieval import EmbeddingArgs, es_retrieve
 
         hits = es_retrieve(index=self.index_name,
@@ -239,7 +309,7 @@ class PDocFragmentES(object):
                            bm25_size=size,
                            op_fields=self.keys,
                            embedding_args=[
-                               EmbeddingArgs(type=EmbeddingType.acge, field="acge_embedding", size=size, dimension=1024),
+                               EmbeddingArgs(type=EmbeddingType.acge, field="acge_embedding", size=size, dimension=1024, num_candidates=num_candidates),
                                #    EmbeddingArgs(type=EmbeddingType.peg, field="peg_embedding", size=size),
                            ],
                            must_conditions=[
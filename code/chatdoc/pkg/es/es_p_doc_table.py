@@ -2,17 +2,17 @@
 Author: longsion<xianglong_chen@intsig.net>
 Date: 2024-05-15 19:54:42
 LastEditors: longsion
-LastEditTime: 2024-10-17 14:48:23
+LastEditTime: 2026-10-18 23:59:10
 '''
 
 
 import time
 from pkg.config import config
-from pkg.es import global_es, EsBaseItem
+from pkg.es import global_es, EsBaseItem, keyed_docs
 from pkg.utils.logger import logger
 import requests
 
-from pkg.es.es_p_retrieval import es_retrieve
+from pkg.es.es_p_retrieval import es_retrieve, es_retrieve_batch
 from pkg.embedding.acge_embedding import get_similar_top_n
 
 
@@ -105,18 +105,20 @@ class PDocTableES(object):
         if retry_times == 0:
             raise Exception("wait_delete_done timeout")
 
+    @staticmethod
+    def doc_ids(source: dict) -> list[str]:
+        # 文件 + 表格首个 ori_id + 行号唯一确定一行，重新入库覆盖写入
+        if not source.get("ori_id"):
+            return []
+        return [f"{source['user_id']}|{source['uuid']}|{source['ori_id'][0]}|{source['row_id']}"]
+
     def insert_doc_table(self, doc_table: PDocTableModel) -> bool:
         """
         插入数据
         :param data:
         :return:
         """
-        return global_es.insert(self.index_name, docs=[
-            {
-                "_index": self.index_name,
-                "_source": doc_table.model_dump()
-            }
-        ])
+        return global_es.insert(self.index_name, docs=keyed_docs(self.index_name, [doc_table.model_dump()], self.doc_ids))
 
     def insert_doc_tables(self, doc_tables: list[PDocTableModel]) -> bool:
         """
@@ -124,12 +126,7 @@ class PDocTableES(object):
         :param data:
         :return:
         """
-        return global_es.insert(self.index_name, docs=[
-            {
-                "_index": self.index_name,
-                "_source": doc_table.model_dump()
-            } for doc_table in doc_tables
-        ])
+        return global_es.insert(self.index_name, docs=keyed_docs(self.index_name, [doc_table.model_dump() for doc_table in doc_tables], self.doc_ids))
 
     def delete_by_file_uuid(self, uuid, wait_delete=True):
         start_time = time.time()
@@ -172,6 +169,28 @@ class PDocTableES(object):
         hits = self.filter_by_embedding(hits, ebd_text, match_score=0.5)
         return [PDocTableModel.from_hit(hit) for hit in hits]
 
+    def search_tables(self, bm25_texts: list[str], ebd_text, user_id, document_uuids, size=20) -> list[PDocTableModel]:
+        """
+        多个关键词的表格召回，一次 _msearch 完成，结果按关键词顺序拼接
+        """
+        op_fields = PDocTableModel.keys(exclude=["acge_embedding", "peg_embedding"])
+
+        hits_list = es_retrieve_batch(index=self.index_name,
+                                      texts=bm25_texts,
+                                      text_for_embedding=ebd_text,
+                                      text_field="keywords",
+                                      bm25_size=size,
+                                      op_fields=op_fields,
+                                      must_conditions=[
+                                          dict(terms=dict(uuid=document_uuids)),
+                                          dict(term=dict(user_id=user_id))
+                                      ],
+                                      )
+
+        # 所有关键词的召回结果一起做 embedding 过滤（一次批量请求），顺序不变
+        hits = [hit for hits in hits_list for hit in hits]
+        return [PDocTableModel.from_hit(hit) for hit in self.filter_by_embedding(hits, ebd_text, match_score=0.5)]
+
     def search_fixed_tables(self, titles, user_id, document_uuids, keyword) -> list[PDocTableModel]:
         '''
         description: 寻找三大表内容
@@ -2,11 +2,13 @@
 Author: longsion<xianglong_chen@intsig.net>
 Date: 2024-05-11 18:08:16
 LastEditors: longsion
-LastEditTime: 2024-10-16 11:00:51
+LastEditTime: 2026-10-18 21:58:12
 '''
 
 
 import time
+from typing import Optional, Union
+from pydantic import PrivateAttr
 from pkg.config import config
 from pkg.utils.logger import logger
 from pkg.es import global_es, EsBaseItem, es_index_default_settings
@@ -36,6 +38,12 @@ class PESFileObject(EsBaseItem):
     summary: str
     doc_fragments_json: str = ""
     tree_summaries: list[str] = []
+    # Redis / Storage 中的片段 blob（不写入 ES），构建片段树时优先使用
+    _fragments_blob: Optional[bytes] = PrivateAttr(default=None)
+
+    @property
+    def fragments_source(self) -> Union[str, bytes]:
+        return (self.__pydantic_private__ or {}).get("_fragments_blob") or self.doc_fragments_json
 
     def get_file_desc_md(self, company_mapper: dict):
         """
@@ -2,10 +2,11 @@
 Author: longsion<xianglong_chen@intsig.net>
 Date: 2024-04-17 09:59:37
 LastEditors: longsion
-LastEditTime: 2025-03-08 23:51:04
+LastEditTime: 2026-10-18 23:59:10
 '''
 
-from pkg.embedding import embedding_text_by_type, EmbeddingType
+from pkg.config import config
+from pkg.embedding import embedding_text_by_type, embedding_texts_by_type, matryoshka_truncate, EmbeddingType
 from pkg.utils.decorators import register_span_func
 from pkg.utils.rrf import RRF
 from pkg.utils.logger import logger
@@ -20,17 +21,26 @@ class EmbeddingArgs(BaseModel):
     field: str
     size: int = 10
     dimension: int = 1024
+    # knn 模式的候选数，0 则取 size * es.knn_num_candidates_factor
+    num_candidates: int = 0
 
 
-def retrieval_embeddings_by_es(index, embedding_field_name, question_embedding: list[float], size: int, op_fields: list = [], must_conditions: list = []):
-    """
-    稠密检索，如向量匹配.
-    Args:
-        question_embedding: 查询问题的索引
-        size: 返回的top-k的个数
-        embedding_name: 查询问题匹配的ES数据库的表名的索引
-    Returns:
-    """
+def use_knn() -> bool:
+    # script_score: 对过滤后的所有文档暴力打分；knn: 使用 HNSW 近似检索，过滤条件下推到 knn.filter
+    # two_stage: 先在截断维度的 int8 HNSW 粗排向量上 knn，再用完整向量对候选 rescore，得分与 script_score 一致
+    return config["es"].get("vector_search", "script_score") == "knn"
+
+
+def use_two_stage() -> bool:
+    return config["es"].get("vector_search", "script_score") == "two_stage"
+
+
+def coarse_embedding_field(embedding_field_name) -> str:
+    # 粗排向量字段，如 acge_embedding_256
+    return f"{embedding_field_name}_{int(config['es'].get('coarse_embedding_dims') or 256)}"
+
+
+def build_dot_product_script(embedding_field_name, question_embedding: list[float]):
     source_string = f"""
                     if (!doc.containsKey('{embedding_field_name}') || doc['{embedding_field_name}'].empty) {{
                         return 0; 
@@ -41,45 +51,119 @@ def retrieval_embeddings_by_es(index, embedding_field_name, question_embedding:
                     }}
                     return dp;
                     """
+    return {
+        "source": source_string,
+        "params": {
+            "queryVector": question_embedding
+        }
+    }
 
-    must_conditions.append(
-        {
-            "script_score": {
-                "query": {
-                    "match_all": {}
-                },
-                "script": {
-                    "source": source_string,
-                    "params": {
-                        "queryVector": question_embedding
-                    }
-                }
-            }
 
+def build_knn_search_body(embedding_field_name, question_embedding: list[float], size: int, num_candidates: int = 0, op_fields: list = [], must_conditions: list = []):
+    if not num_candidates:
+        num_candidates = size * int(config["es"].get("knn_num_candidates_factor") or 10)
+    knn = {
+        "field": embedding_field_name,
+        "query_vector": question_embedding,
+        "k": size,
+        # ES 要求 k <= num_candidates <= 10000
+        "num_candidates": min(max(num_candidates, size), 10000),
+    }
+    if must_conditions:
+        knn["filter"] = list(must_conditions)
+
+    return {
+        "_source": op_fields,
+        "size": size,
+        "knn": knn,
+    }
+
+
+def build_two_stage_search_body(embedding_field_name, question_embedding: list[float], size: int, num_candidates: int = 0, op_fields: list = [], must_conditions: list = []):
+    # 第一阶段：粗排向量 knn 取 size * oversample 个候选
+    window = size * int(config["es"].get("two_stage_oversample") or 4)
+    coarse_embedding = matryoshka_truncate(question_embedding, int(config["es"].get("coarse_embedding_dims") or 256))
+    body = build_knn_search_body(coarse_embedding_field(embedding_field_name), coarse_embedding, window, num_candidates, op_fields, must_conditions)
+    body["size"] = size
+    # 第二阶段：候选用完整向量 dotProduct 重新打分
+    body["rescore"] = {
+        "window_size": window,
+        "query": {
+            "rescore_query": {
+                "script_score": {
+                    "query": {
+                        "match_all": {}
+                    },
+                    "script": build_dot_product_script(embedding_field_name, question_embedding)
+                }
+            },
+            "query_weight": 0,
+            "rescore_query_weight": 1
         }
-    )
-    query = {
+    }
+    return body
+
+
+def build_vector_search_body(embedding_field_name, question_embedding: list[float], size: int, num_candidates: int = 0, op_fields: list = [], must_conditions: list = []):
+    if use_two_stage():
+        return build_two_stage_search_body(embedding_field_name, question_embedding, size, num_candidates, op_fields, must_conditions)
+    if use_knn():
+        return build_knn_search_body(embedding_field_name, question_embedding, size, num_candidates, op_fields, must_conditions)
+    return build_embedding_search_body(embedding_field_name, question_embedding, size, op_fields, must_conditions)
+
+
+def build_embedding_search_body(embedding_field_name, question_embedding: list[float], size: int, op_fields: list = [], must_conditions: list = []):
+    # 不修改调用方传入的 must_conditions，BM25 与向量查询共用同一份条件
+    return {
         "_source": op_fields,
         "size": size,
         "query": {
             "bool": {
-                "must": must_conditions,
+                "must": [
+                    *must_conditions,
+                    {
+                        "script_score": {
+                            "query": {
+                                "match_all": {}
+                            },
+                            "script": build_dot_product_script(embedding_field_name, question_embedding)
+                        }
+
+                    }
+                ],
                 "filter": [
                 ]
             },
         }
     }
 
+
+def hits_to_items(hits: list[dict], knn: bool = False) -> list[dict]:
     return [
         {
-            "score": hit["_score"],
+            # cosine 的 knn 得分为 (1 + cos) / 2，换算回与 script_score 一致的 max(dotProduct, 0)
+            "score": max(2 * hit["_score"] - 1, 0) if knn else hit["_score"],
             "_id": hit["_id"],
             **hit["_source"]
         }
-        for hit in global_es.search(index, query)
+        for hit in hits
     ]
 
 
+def retrieval_embeddings_by_es(index, embedding_field_name, question_embedding: list[float], size: int, op_fields: list = [], must_conditions: list = [], num_candidates: int = 0):
+    """
+    稠密检索，如向量匹配.
+    Args:
+        question_embedding: 查询问题的索引
+        size: 返回的top-k的个数
+        embedding_name: 查询问题匹配的ES数据库的表名的索引
+        num_candidates: knn 模式每个分片的候选数
+    Returns:
+    """
+    query = build_vector_search_body(embedding_field_name, question_embedding, size, num_candidates, op_fields, must_conditions)
+    return hits_to_items(global_es.search(index, query), knn=use_knn())
+
+
 def retrieval_embeddings_by_tencent(index, embedding_field_name, question_embedding: list[float], size: int, op_fields: list = [], must_conditions: list = []):
     """
     使用腾讯VDB向量去召回，然后从es中加载详情数据
@@ -252,15 +336,40 @@ def retrieval_embeddings_by_zilliz(index, embedding_field_name, question_embeddi
     return result
 
 
-@register_span_func()
-def retrieve_bm25(index, text, text_field, size: int, op_fields: list = [], must_conditions: list = []):
+def retrieval_embeddings_by_local(index, embedding_field_name, question_embedding: list[float], size: int, op_fields: list = [], must_conditions: list = []):
     """
-    稀疏检索,如bm25算法等.
-    Args:
-        size: 检索返回的个数
-    Returns:
+    使用本地向量库召回，切片字段直接取自本地向量库的 payload，不再回 ES 加载
     """
-    search_body = {
+    from pkg.vdb.local import search_personal
+
+    document_uuids = []
+    user_id = ""
+
+    for condition in must_conditions:
+        if "terms" in condition and "file_uuid" in condition["terms"]:
+            document_uuids = condition["terms"]["file_uuid"]
+
+        elif "terms" in condition and "uuid" in condition["terms"]:
+            document_uuids = condition["terms"]["uuid"]
+
+        if "term" in condition and "user_id" in condition["term"]:
+            user_id = condition["term"]["user_id"]
+
+    hits = search_personal(size=size, file_uuids=document_uuids, question_embedding=question_embedding, user_id=user_id)
+
+    return [
+        {
+            "score": hit["score"],
+            # 本地向量库没有 ES _id，使用切片 uuid，RRF 按 uuid 融合
+            "_id": hit["uuid"],
+            **{key: value for key, value in hit["payload"].items() if key in op_fields},
+        }
+        for hit in hits
+    ]
+
+
+def build_bm25_search_body(text, text_field, size: int, op_fields: list = [], must_conditions: list = []):
+    return {
         "_source": op_fields,
         "size": size,
         "query": {
@@ -282,14 +391,17 @@ def retrieve_bm25(index, text, text_field, size: int, op_fields: list = [], must
         }
     }
 
-    return [
-        {
-            "score": hit["_score"],
-            "_id": hit["_id"],
-            **hit["_source"]
-        }
-        for hit in global_es.search(index, search_body=search_body)
-    ]
+
+@register_span_func()
+def retrieve_bm25(index, text, text_field, size: int, op_fields: list = [], must_conditions: list = []):
+    """
+    稀疏检索,如bm25算法等.
+    Args:
+        size: 检索返回的个数
+    Returns:
+    """
+    search_body = build_bm25_search_body(text, text_field, size, op_fields, must_conditions)
+    return hits_to_items(global_es.search(index, search_body=search_body))
 
 
 def get_retrieval_embeddings_handler():
@@ -297,17 +409,93 @@ def get_retrieval_embeddings_handler():
     vector_model_map = dict(
         es=retrieval_embeddings_by_es,
         zilliz=retrieval_embeddings_by_zilliz,
-        tencent=retrieval_embeddings_by_tencent
+        tencent=retrieval_embeddings_by_tencent,
+        local=retrieval_embeddings_by_local,
     )
     func = vector_model_map.get(current_vector_model, retrieval_embeddings_by_es)
     return register_span_func()(func)
 
 
+def _is_valid_hit(hit: dict) -> bool:
+    return hit["ebed_text"] != "ROOT" and "......." not in hit['ebed_text']
+
+
+def _fuse_hits(hits: list[dict], identity_key: str = "_id") -> list[dict]:
+    # k = 1 for test
+    rerank_list = RRF().reciprocal_rank_fusion(hits, group_key="retrieval_type", identity_key=identity_key, k=1)
+
+    return [
+        {
+            "rrf_score": hit["score"],
+            "id": hit["id"],
+            **max(hit["results"], key=lambda x: x["score"]),
+            "score": {cur['retrieval_type']: cur['score'] for cur in hit["results"]},
+        }
+        for hit in rerank_list
+    ]
+
+
+def _scoped_file_uuids(must_conditions: list) -> tuple[list[str], str]:
+    """
+    条件只包含 file_uuid 与 user_id 过滤时返回 (file_uuids, user_id)，否则返回空列表，本地打分无法表达其他过滤条件
+    """
+    file_uuids, user_id = [], None
+    for condition in must_conditions:
+        if "terms" in condition and list(condition["terms"]) == ["file_uuid"]:
+            file_uuids = condition["terms"]["file_uuid"]
+        elif "term" in condition and list(condition["term"]) == ["user_id"]:
+            user_id = condition["term"]["user_id"]
+        else:
+            return [], None
+    return file_uuids, user_id
+
+
+def es_retrieve_scoped(index, text, text_field, file_uuids: list[str], bm25_size=10, text_for_embedding="", op_fields=[], embedding_args: list[EmbeddingArgs] = [], must_conditions: list = [], user_id=None):
+    """
+    限定少量文件时的召回：BM25 走 ES，向量在本地按文件缓存的向量矩阵上打分，同样经 RRF 融合
+    向量矩阵不可用时返回 None，由调用方走 ES 向量查询
+    """
+    from pkg.es.es_file_vectors import file_vector_cache
+
+    op_fields = list(set(op_fields) | {"_id"})
+    bm25_t = ThreadWithReturnValue(target=retrieve_bm25, args=(index, text, text_field, bm25_size, op_fields, must_conditions))
+    bm25_t.start()
+
+    embedding_hits = []
+    for embedding_arg in embedding_args:
+        question_embedding = embedding_text_by_type(text_for_embedding or text, embedding_arg.type, dimension=embedding_arg.dimension, use_cache=True)
+        _hits = file_vector_cache.search(index, embedding_arg.field, question_embedding, file_uuids, embedding_arg.size, op_fields, user_id=user_id)
+        if _hits is None:
+            bm25_t.join()
+            return None
+        embedding_hits.append((embedding_arg, _hits))
+
+    hits = [dict(**_hit, retrieval_type="bm25") for _hit in bm25_t.join() if _is_valid_hit(_hit)]
+    for embedding_arg, _hits in embedding_hits:
+        hits.extend(
+            [dict(**_hit, retrieval_type=embedding_arg.type.value) for _hit in _hits if _is_valid_hit(_hit)]
+        )
+    return _fuse_hits(hits)
+
+
 def es_retrieve(index, text, text_field, bm25_size=10, text_for_embedding="", op_fields=[], embedding_args: list[EmbeddingArgs] = [], must_conditions: list = []):
     """
     ES 召回方式
     如果传入embedding_args表明需要附加上 embedding的得分，使用rrf进行排名
     """
+    from pkg.es.es_file_vectors import use_scoped_vector
+
+    file_uuids, user_id = _scoped_file_uuids(must_conditions)
+    if embedding_args and use_scoped_vector(file_uuids):
+        hits = es_retrieve_scoped(index, text, text_field, file_uuids, bm25_size=bm25_size, text_for_embedding=text_for_embedding,
+                                  op_fields=op_fields, embedding_args=embedding_args, must_conditions=must_conditions, user_id=user_id)
+        if hits is not None:
+            return hits
+
+    if get_vector_db_model() == "es":
+        # 向量也在 ES 中时，BM25 与各路向量召回合并为一次 _msearch
+        return es_retrieve_batch(index, [text], text_field, bm25_size=bm25_size, text_for_embedding=text_for_embedding,
+                                 op_fields=op_fields, embedding_args=embedding_args, must_conditions=must_conditions)[0]
 
     # Embedding Recall
     hits = []
@@ -324,28 +512,75 @@ def es_retrieve(index, text, text_field, bm25_size=10, text_for_embedding="", op
     # BM25 Recall
     _hits = retrieve_bm25(index, text, text_field, size=bm25_size, op_fields=op_fields, must_conditions=must_conditions)
     hits.extend(
-        [dict(**_hit, retrieval_type="bm25") for _hit in _hits if _hit["ebed_text"] != "ROOT" and "......." not in _hit['ebed_text']]
+        [dict(**_hit, retrieval_type="bm25") for _hit in _hits if _is_valid_hit(_hit)]
     )
 
     for _t, embedding_arg in zip(_retrieve_threads, embedding_args):
         _hits = _t.join()
         hits.extend(
-            [dict(**_hit, retrieval_type=embedding_arg.type.value) for _hit in _hits if _hit["ebed_text"] != "ROOT" and "......." not in _hit['ebed_text']]
+            [dict(**_hit, retrieval_type=embedding_arg.type.value) for _hit in _hits if _is_valid_hit(_hit)]
         )
 
-    # k = 1 for test
-    rerank_list = RRF().reciprocal_rank_fusion(hits, group_key="retrieval_type", k=1)
+    # 本地向量库的召回结果没有 ES _id，与 BM25 结果按切片 uuid 融合
+    return _fuse_hits(hits, identity_key="uuid" if get_vector_db_model() == "local" else "_id")
 
-    results = [
-        {
-            "rrf_score": hit["score"],
-            "id": hit["id"],
-            **max(hit["results"], key=lambda x: x["score"]),
-            "score": {cur['retrieval_type']: cur['score'] for cur in hit["results"]},
-        }
-        for hit in rerank_list
-    ]
 
+def es_retrieve_batch(index, texts: list[str], text_field, bm25_size=10, text_for_embedding="", op_fields=[], embedding_args: list[EmbeddingArgs] = [], must_conditions: list = []) -> list[list[dict]]:
+    """
+    多个召回文本（如多个关键词）的 es_retrieve，结果与 texts 一一对应
+    向量存储在 ES 时，所有 BM25 与向量查询合并为一次 _msearch，相同的向量查询只发送一次
+    """
+    if not texts:
+        return []
+
+    if get_vector_db_model() != "es":
+        threads = [
+            ThreadWithReturnValue(target=es_retrieve, kwargs=dict(index=index, text=text, text_field=text_field, bm25_size=bm25_size, text_for_embedding=text_for_embedding,
+                                                                  op_fields=op_fields, embedding_args=embedding_args, must_conditions=must_conditions))
+            for text in texts
+        ]
+        for t in threads:
+            t.start()
+        return [t.join() for t in threads]
+
+    op_fields = list(set(op_fields) | {"_id"})
+
+    # 召回文本的 embedding 按 (类型, 维度) 各批量请求一次
+    embedding_texts = list(dict.fromkeys(text_for_embedding or text for text in texts))
+    embeddings = {}
+    for embedding_type, dimension in dict.fromkeys((embedding_arg.type, embedding_arg.dimension) for embedding_arg in embedding_args):
+        vectors = embedding_texts_by_type(embedding_texts, embedding_type, dimension=dimension)
+        embeddings.update(((embedding_text, embedding_type.value, dimension), vector) for embedding_text, vector in zip(embedding_texts, vectors))
+
+    searches = []
+    # 每个 text 对应的 [(retrieval_type, searches 下标)]
+    text_searches = [[] for _ in texts]
+    embedding_search_index = {}
+    for i, text in enumerate(texts):
+        searches.append((index, build_bm25_search_body(text, text_field, bm25_size, op_fields, must_conditions)))
+        text_searches[i].append(("bm25", len(searches) - 1))
+
+        for embedding_arg in embedding_args:
+            embedding_text = text_for_embedding or text
+            key = (embedding_text, embedding_arg.type.value, embedding_arg.field, embedding_arg.size, embedding_arg.dimension, embedding_arg.num_candidates)
+            if key not in embedding_search_index:
+                question_embedding = embeddings[(embedding_text, embedding_arg.type.value, embedding_arg.dimension)]
+                searches.append((index, build_vector_search_body(embedding_arg.field, question_embedding, embedding_arg.size, embedding_arg.num_candidates, op_fields, must_conditions)))
+                embedding_search_index[key] = len(searches) - 1
+            text_searches[i].append((embedding_arg.type.value, embedding_search_index[key]))
+
+    # 向量查询的下标，knn 得分需要换算
+    embedding_search_indexes = set(embedding_search_index.values())
+    knn = use_knn()
+    responses = [hits_to_items(hits, knn=knn and i in embedding_search_indexes) for i, hits in enumerate(global_es.msearch(searches))]
+
+    results = []
+    for pairs in text_searches:
+        hits = [
+            dict(**_hit, retrieval_type=retrieval_type)
+            for retrieval_type, search_index in pairs for _hit in responses[search_index] if _is_valid_hit(_hit)
+        ]
+        results.append(_fuse_hits(hits))
     return results
 
 
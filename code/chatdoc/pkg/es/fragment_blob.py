@@ -0,0 +1,306 @@
+'''
+Author: longsion<xianglong_chen@intsig.net>
+Date: 2026-10-18 21:58:12
+LastEditors: longsion
+LastEditTime: 2026-10-18 22:12:30
+'''
+
+# 片段缓存（Redis: fragment-{uuid} / Storage: fragments-{uuid}.gz）的二进制格式，替代 gzip 压缩的 doc_fragments_json
+# - 容器: magic "CDFB" | version u8 | codec u8（0 不压缩 / 1 zstd / 2 zlib）| dict_id u32（zstd 字典，0 为不使用）| body 长度 u32 | body
+# - body（解压后）: json 头长度 u32 | json 头 {count, types, attr_fields, columns: {列名: [偏移, dtype, 元素数]}} | 8 字节对齐的列
+#   uuid_offsets int32[n+1] + uuid_bytes          片段 uuid（utf-8 拼接）
+#   uuid_order int32[n]                           按 uuid 排序的行号，按 uuid 二分查找，不需要构建 dict
+#   parent int32[n]                               父片段行号，-1 为根（父片段不在本文件）
+#   child_offsets int32[n+1] + child_rows int32   children_fragment_uuids 对应的行号（不在本文件的丢弃）
+#   ori_offsets int32[n+1] + ori_str_offsets int32 + ori_bytes   每个片段的 ori_id
+#   type_codes uint8[n]                           片段类型在 types 中的下标
+#   attrs int32[n, len(attr_fields)]              数值字段
+# - 读取时各列 np.frombuffer 直接引用 body（不压缩时即 Redis 返回的 bytes），uuid / ori_id 只解码访问到的片段
+# - 不是该格式的（无 magic）按历史 gzip json 读取
+# - zstd 为可选依赖（zstandard），未安装时写入 zlib；字典由 scripts/es/train_fragment_blob_dict.py 训练，
+#   config fragment_blob.zstd_dict_path 指定，更换字典后旧字典写入的缓存无法解码，会回退到片段索引重新加载
+
+import json
+import struct
+import zlib
+from typing import Optional, Union
+
+import numpy as np
+
+from pkg.config import config
+from pkg.es.es_doc_fragment import DocFragmentModel
+from pkg.utils import decompress, xjson
+from pkg.utils.logger import logger
+from pkg.utils.metrics import global_metrics
+from pkg.utils.single_flight import SingleFlight
+
+try:
+    import zstandard
+except ImportError:  # pragma: no cover
+    zstandard = None
+
+
+fragment_blob_reads = global_metrics.counter("fragment_blob_reads_total", "Fragment cache blobs read by format")
+# Redis（fragment-*）/ Storage（fragments-*.gz）片段缓存的请求合并，key 即缓存 key / 文件名
+fragment_blob_flight = SingleFlight("fragment_blob")
+
+MAGIC = b"CDFB"
+VERSION = 1
+CODEC_NONE, CODEC_ZSTD, CODEC_ZLIB = 0, 1, 2
+CONTAINER = struct.Struct("<4sBBII")
+
+# 数值字段统一存到 attrs[row, i]
+ATTR_FIELDS = [
+    "tree_token_length", "token_length", "level", "leaf",
+    "leaf_split_idx", "leaf_split_num", "leaf_start_offset", "leaf_end_offset",
+    "table_title_row_idx", "table_start_row_idx", "table_end_row_idx",
+]
+ATTR_DEFAULTS = [DocFragmentModel.model_fields[name].default for name in ATTR_FIELDS]
+
+
+def is_fragment_blob(data) -> bool:
+    return bool(data) and bytes(data[:len(MAGIC)]) == MAGIC
+
+
+def _string_column(values: list[str]) -> tuple[np.ndarray, bytes]:
+    encoded = [value.encode("utf-8") for value in values]
+    offsets = np.zeros(len(encoded) + 1, dtype=np.int32)
+    if encoded:
+        offsets[1:] = np.cumsum([len(value) for value in encoded])
+    return offsets, b"".join(encoded)
+
+
+class _Codec:
+    '''
+    按 config fragment_blob 选择压缩方式，zstd 字典与压缩器延迟加载
+    '''
+
+    def __init__(self, blob_config: dict):
+        self.codec = blob_config.get("codec", "zstd")
+        self.level = int(blob_config.get("level", 3))
+        self.min_compress_bytes = int(blob_config.get("min_compress_bytes", 1024))
+        self.dict_path = blob_config.get("zstd_dict_path") or ""
+        self._dict = None
+        self._dict_loaded = False
+
+    def zstd_dict(self):
+        if not self._dict_loaded:
+            self._dict_loaded = True
+            if zstandard is not None and self.dict_path:
+                try:
+                    with open(self.dict_path, "rb") as f:
+                        self._dict = zstandard.ZstdCompressionDict(f.read())
+                except Exception as e:
+                    logger.warning(f"load fragment blob zstd dict {self.dict_path} failed: {e}")
+        return self._dict
+
+    def compress(self, body: bytes) -> tuple[int, int, bytes]:
+        if len(body) < self.min_compress_bytes or self.codec == "none":
+            return CODEC_NONE, 0, body
+        if self.codec == "zstd" and zstandard is not None:
+            zstd_dict = self.zstd_dict()
+            compressor = zstandard.ZstdCompressor(level=self.level, dict_data=zstd_dict) if zstd_dict else zstandard.ZstdCompressor(level=self.level)
+            return CODEC_ZSTD, zstd_dict.dict_id() if zstd_dict else 0, compressor.compress(body)
+        return CODEC_ZLIB, 0, zlib.compress(body, 6)
+
+    def decompress(self, codec: int, dict_id: int, payload, length: int) -> bytes:
+        if codec == CODEC_NONE:
+            return payload
+        if codec == CODEC_ZLIB:
+            return zlib.decompress(payload)
+        if codec == CODEC_ZSTD:
+            if zstandard is None:
+                raise ValueError("zstandard is not installed")
+            zstd_dict = None
+            if dict_id:
+                zstd_dict = self.zstd_dict()
+                if zstd_dict is None or zstd_dict.dict_id() != dict_id:
+                    raise ValueError(f"zstd dict {dict_id} not loaded")
+            decompressor = zstandard.ZstdDecompressor(dict_data=zstd_dict) if zstd_dict else zstandard.ZstdDecompressor()
+            return decompressor.decompress(payload, max_output_size=length)
+        raise ValueError(f"unknown fragment blob codec {codec}")
+
+
+_codec = _Codec(config.get("fragment_blob") or {})
+
+
+def encode_fragments_body(fragments: list[dict]) -> bytes:
+    '''
+    fragments 为 doc_fragments_json 中的片段（dict），返回未压缩的 body，训练 zstd 字典时作为样本
+    '''
+    n = len(fragments)
+    uuids = [fragment.get("uuid", "") for fragment in fragments]
+    rows = {}
+    for row, uuid in enumerate(uuids):
+        rows.setdefault(uuid, row)
+
+    uuid_offsets, uuid_bytes = _string_column(uuids)
+    uuid_order = np.array(sorted(range(n), key=lambda row: uuids[row].encode("utf-8")), dtype=np.int32)
+    parent = np.array([rows.get(fragment.get("parent_frament_uuid") or "", -1) for fragment in fragments], dtype=np.int32)
+
+    child_offsets = np.zeros(n + 1, dtype=np.int32)
+    child_rows, ori_counts, ori_ids, type_codes, types = [], [], [], [], {}
+    attrs = np.empty((n, len(ATTR_FIELDS)), dtype=np.int32)
+    for row, fragment in enumerate(fragments):
+        child_rows.extend(rows[uuid] for uuid in fragment.get("children_fragment_uuids") or [] if uuid in rows)
+        child_offsets[row + 1] = len(child_rows)
+        node_ori_ids = fragment.get("ori_id") or []
+        ori_ids.extend(node_ori_ids)
+        ori_counts.append(len(node_ori_ids))
+        type_codes.append(types.setdefault(fragment.get("type") or "text", len(types)))
+        attrs[row] = [int(fragment.get(name, default) or 0) for name, default in zip(ATTR_FIELDS, ATTR_DEFAULTS)]
+
+    ori_offsets = np.zeros(n + 1, dtype=np.int32)
+    if n:
+        ori_offsets[1:] = np.cumsum(ori_counts)
+    ori_str_offsets, ori_bytes = _string_column(ori_ids)
+
+    columns = [
+        ("uuid_offsets", uuid_offsets), ("uuid_bytes", np.frombuffer(uuid_bytes, dtype=np.uint8)),
+        ("uuid_order", uuid_order), ("parent", parent),
+        ("child_offsets", child_offsets), ("child_rows", np.array(child_rows, dtype=np.int32)),
+        ("ori_offsets", ori_offsets), ("ori_str_offsets", ori_str_offsets), ("ori_bytes", np.frombuffer(ori_bytes, dtype=np.uint8)),
+        ("type_codes", np.array(type_codes, dtype=np.uint8)), ("attrs", attrs),
+    ]
+    layout, offset = {}, 0
+    for name, array in columns:
+        layout[name] = [offset, array.dtype.str, int(array.size)]
+        offset += (array.nbytes + 7) & ~7
+    header = json.dumps(dict(count=n, types=list(types), attr_fields=ATTR_FIELDS, columns=layout)).encode("utf-8")
+    head = struct.pack("<I", len(header)) + header
+    head += b" " * (-len(head) % 8)
+
+    parts = [head]
+    for name, array in columns:
+        data = array.tobytes()
+        parts.append(data + b"\0" * (-len(data) % 8))
+    return b"".join(parts)
+
+
+def encode_fragments_blob(fragments: list[dict]) -> bytes:
+    body = encode_fragments_body(fragments)
+    codec, dict_id, payload = _codec.compress(body)
+    return CONTAINER.pack(MAGIC, VERSION, codec, dict_id, len(body)) + payload
+
+
+class FragmentBlob:
+    '''
+    只读的片段 blob，列为 body 上的 numpy 视图，片段按需解码
+    '''
+
+    def __init__(self, data: Union[bytes, memoryview]):
+        view = memoryview(data)
+        magic, version, codec, dict_id, length = CONTAINER.unpack_from(view)
+        if magic != MAGIC or version != VERSION:
+            raise ValueError(f"unsupported fragment blob version {version}")
+        body = _codec.decompress(codec, dict_id, view[CONTAINER.size:], length)
+        self._body = body
+
+        header_length = struct.unpack_from("<I", body)[0]
+        header = json.loads(bytes(body[4:4 + header_length]))
+        base = (4 + header_length + 7) & ~7
+        self.count = header["count"]
+        self.types = header["types"]
+        self.attr_fields = header["attr_fields"]
+
+        columns = {}
+        for name, (offset, dtype, size) in header["columns"].items():
+            columns[name] = np.frombuffer(body, dtype=np.dtype(dtype), count=size, offset=base + offset)
+        self.uuid_offsets = columns["uuid_offsets"]
+        self.uuid_bytes = columns["uuid_bytes"]
+        self.uuid_order = columns["uuid_order"]
+        self.parent = columns["parent"]
+        self.child_offsets = columns["child_offsets"]
+        self.child_rows = columns["child_rows"]
+        self.ori_offsets = columns["ori_offsets"]
+        self.ori_str_offsets = columns["ori_str_offsets"]
+        self.ori_bytes = columns["ori_bytes"]
+        self.type_codes = columns["type_codes"]
+        self.attrs = columns["attrs"].reshape(self.count, len(self.attr_fields))
+
+    def __len__(self):
+        return self.count
+
+    def uuid(self, row: int) -> str:
+        return self.uuid_bytes[self.uuid_offsets[row]:self.uuid_offsets[row + 1]].tobytes().decode("utf-8")
+
+    def uuids(self) -> list[str]:
+        data = self.uuid_bytes.tobytes()
+        offsets = self.uuid_offsets.tolist()
+        return [data[offsets[row]:offsets[row + 1]].decode("utf-8") for row in range(self.count)]
+
+    def row(self, uuid: str) -> Optional[int]:
+        # uuid_order 按 utf-8 字节序排列，二分查找
+        target = uuid.encode("utf-8")
+        low, high = 0, self.count
+        while low < high:
+            mid = (low + high) // 2
+            row = int(self.uuid_order[mid])
+            value = self.uuid_bytes[self.uuid_offsets[row]:self.uuid_offsets[row + 1]].tobytes()
+            if value < target:
+                low = mid + 1
+            elif value > target:
+                high = mid
+            else:
+                return row
+        return None
+
+    def children(self, row: int) -> list[int]:
+        return self.child_rows[self.child_offsets[row]:self.child_offsets[row + 1]].tolist()
+
+    def ori_ids(self, row: int) -> list[str]:
+        start, end = int(self.ori_offsets[row]), int(self.ori_offsets[row + 1])
+        offsets = self.ori_str_offsets[start:end + 1].tolist()
+        data = self.ori_bytes[offsets[0]:offsets[-1]].tobytes() if offsets else b""
+        return [data[begin - offsets[0]:stop - offsets[0]].decode("utf-8") for begin, stop in zip(offsets, offsets[1:])]
+
+    def all_ori_ids(self) -> list[str]:
+        data = self.ori_bytes.tobytes()
+        offsets = self.ori_str_offsets.tolist()
+        return [data[begin:stop].decode("utf-8") for begin, stop in zip(offsets, offsets[1:])]
+
+    def fragment(self, row: int) -> dict:
+        '''
+        解码单个片段，字段与 doc_fragments_json 中的片段一致（不含 file_uuid 等文件级字段）
+        '''
+        values = dict(zip(self.attr_fields, self.attrs[row].tolist()))
+        if "leaf" in values:
+            values["leaf"] = bool(values["leaf"])
+        parent = int(self.parent[row])
+        values.update(
+            uuid=self.uuid(row),
+            ori_id=self.ori_ids(row),
+            type=self.types[self.type_codes[row]],
+            parent_frament_uuid=self.uuid(parent) if parent >= 0 else "",
+            children_fragment_uuids=[self.uuid(child) for child in self.children(row)],
+        )
+        return values
+
+    def get(self, uuid: str) -> Optional[dict]:
+        row = self.row(uuid)
+        return None if row is None else self.fragment(row)
+
+    def fragments(self) -> list[dict]:
+        return [self.fragment(row) for row in range(self.count)]
+
+
+def load_fragments_blob(data) -> Optional[Union[FragmentBlob, list[dict]]]:
+    '''
+    读取 Redis / Storage 中的片段缓存：二进制格式返回 FragmentBlob，历史 gzip json 返回片段列表，无法解析返回 None
+    '''
+    if not data:
+        return None
+    try:
+        if is_fragment_blob(data):
+            fragment_blob_reads.inc(format="blob")
+            return FragmentBlob(data)
+        fragment_blob_reads.inc(format="legacy_json")
+        fragments = xjson.loads(decompress(data))
+        return fragments if isinstance(fragments, list) else None
+    except Exception as e:
+        logger.warning(f"load fragments blob failed: {e}")
+        return None
+
+
+def fragments_blob_from_json(doc_fragments_json: str) -> bytes:
+    return encode_fragments_blob(xjson.loads(doc_fragments_json or "[]"))
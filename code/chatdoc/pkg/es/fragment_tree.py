@@ -0,0 +1,492 @@
+'''
+Author: longsion<xianglong_chen@intsig.net>
+Date: 2026-10-18 20:10:36
+LastEditors: longsion
+LastEditTime: 2026-10-18 22:31:05
+'''
+
+# 按文件构建的只读片段树（数组存储），替代每次问答从 doc_fragments_json 构造上千个 pydantic 片段对象
+# - 节点按先序遍历编号：子树 = 连续区间 [node, node + subtree_size[node])，子树遍历 / ori_id 合并都是数组切片
+# - parent / first_child / next_sibling 为 int32 数组，子节点只认 children_fragment_uuids 中且 parent 指回本节点的片段
+# - ori_id 按节点打包：ori_offsets[node]:ori_offsets[node + 1] 为该节点的 ori_id，ori_keys 为 (页, 序号) 编码后的 int64，用于排序去重
+# - uuid / type / ori_id 字符串 intern 后复用
+# - 进程级缓存，key: 文件 uuid + 文件版本号（stage_cache.file_versions，重新解析或删除时 +1），各请求只读共享；收到失效消息时立即淘汰
+# - 来源为 Redis / Storage 中的片段 blob（fragment_blob，历史 gzip json 兼容）或 ES 中的 doc_fragments_json；blob 直接按列构建，不解析 json
+# - 召回片段所在文件未随 files 加载片段 blob 时，整文件批量加载：Redis 中的片段 blob -> 片段索引 msearch（每个文件一个查询），
+#   父节点 / 子树都从片段树取，不再按层级逐次请求 ES
+
+import sys
+import time
+from typing import Optional, Union
+
+import numpy as np
+
+from pkg.config import config
+from pkg.es.es_doc_fragment import DocFragmentES, DocFragmentModel
+from pkg.es.es_p_doc_fragment import PDocFragmentES, PDocFragmentModel
+from pkg.es.fragment_blob import ATTR_DEFAULTS, ATTR_FIELDS, FragmentBlob, fragment_blob_flight, load_fragments_blob
+from pkg.redis.invalidation_bus import FileKeyIndex, invalidation_bus
+from pkg.redis.stage_cache import stage_cache
+from pkg.utils import xjson
+from pkg.utils.logger import logger
+from pkg.utils.lru_cache import ShardedLRUCacheDict
+from pkg.utils.metrics import global_metrics
+
+
+fragment_tree_requests = global_metrics.counter("fragment_tree_requests_total", "Per-file fragment tree cache lookups by outcome")
+
+# 数值字段统一存到 attrs[node, i]，字段顺序与片段 blob 一致
+LEVEL, LEAF = ATTR_FIELDS.index("level"), ATTR_FIELDS.index("leaf")
+
+
+def ori_id_key(ori_id: str) -> int:
+    # "页,序号" => 可排序的 int64，与 tuple(int(x) for x in ori_id.split(",")) 的顺序一致
+    try:
+        page, _, idx = ori_id.partition(",")
+        return (int(page) << 32) | int(idx or 0)
+    except ValueError:
+        return -1
+
+
+class FragmentTree:
+    '''
+    单个文件的片段树，构建后只读，可在多个请求间共享
+    '''
+
+    def __init__(self, file_uuid: str, fragments: list[dict], user_id: Optional[str] = None, source_length: Optional[int] = None):
+        raw_index = {}
+        for i, fragment in enumerate(fragments):
+            raw_index.setdefault(fragment.get("uuid", ""), i)
+
+        ori_offsets = np.zeros(len(fragments) + 1, dtype=np.int32)
+        ori_ids = []
+        for i, fragment in enumerate(fragments):
+            ori_ids.extend(fragment.get("ori_id") or [])
+            ori_offsets[i + 1] = len(ori_ids)
+
+        self._build(
+            file_uuid, user_id, source_length,
+            uuids=[fragment.get("uuid", "") for fragment in fragments],
+            types=[fragment.get("type") or "text" for fragment in fragments],
+            parent_uuids=[fragment.get("parent_frament_uuid") or "" for fragment in fragments],
+            raw_parent=[raw_index.get(fragment.get("parent_frament_uuid", ""), -1) for fragment in fragments],
+            raw_children=lambda i: [raw_index[uuid] for uuid in fragments[i].get("children_fragment_uuids") or [] if uuid in raw_index],
+            attrs=np.array([[int(fragment.get(name, default) or 0) for name, default in zip(ATTR_FIELDS, ATTR_DEFAULTS)] for fragment in fragments],
+                           dtype=np.int32).reshape(len(fragments), len(ATTR_FIELDS)),
+            ori_offsets=ori_offsets,
+            ori_ids=ori_ids,
+        )
+
+    @classmethod
+    def from_blob(cls, file_uuid: str, blob: FragmentBlob, user_id: Optional[str] = None, source_length: Optional[int] = None) -> "FragmentTree":
+        '''
+        从二进制片段 blob 构建，父子关系 / 数值字段直接取列，不再解析 json
+        '''
+        tree = cls.__new__(cls)
+        uuids = blob.uuids()
+        raw_index = {}
+        for i, uuid in enumerate(uuids):
+            raw_index.setdefault(uuid, i)
+
+        parent = blob.parent.tolist()
+        attrs = np.zeros((len(blob), len(ATTR_FIELDS)), dtype=np.int32)
+        for i, name in enumerate(ATTR_FIELDS):
+            if name in blob.attr_fields:
+                attrs[:, i] = blob.attrs[:, blob.attr_fields.index(name)]
+            else:
+                attrs[:, i] = int(ATTR_DEFAULTS[i] or 0)
+
+        tree._build(
+            file_uuid, user_id, source_length,
+            uuids=uuids,
+            types=[blob.types[code] for code in blob.type_codes.tolist()],
+            parent_uuids=[uuids[row] if row >= 0 else "" for row in parent],
+            raw_parent=[raw_index[uuids[row]] if row >= 0 else -1 for row in parent],
+            raw_children=blob.children,
+            attrs=attrs,
+            ori_offsets=blob.ori_offsets,
+            ori_ids=blob.all_ori_ids(),
+        )
+        return tree
+
+    def _build(self, file_uuid: str, user_id: Optional[str], source_length: Optional[int], uuids: list[str], types: list[str],
+               parent_uuids: list[str], raw_parent: list[int], raw_children, attrs: np.ndarray, ori_offsets: np.ndarray, ori_ids: list[str]):
+        '''
+        按原始顺序的列构建：raw_parent 为父节点 uuid 首次出现的行号（不在本文件为 -1），raw_children(i) 为子节点 uuid 首次出现的行号
+        '''
+        self.file_uuid = file_uuid
+        self.user_id = user_id
+        # 构建来源（doc_fragments_json / 片段 blob）的长度，来自片段索引时为 None
+        self.source_length = source_length
+
+        intern = sys.intern
+        canonical = {}
+        for i, uuid in enumerate(uuids):
+            canonical.setdefault(uuid, i)
+
+        # 先序遍历：子节点必须出现在父节点的 children_fragment_uuids 中且 parent 指回父节点
+        def valid_children(i):
+            return [j for j in raw_children(i) if raw_parent[j] == canonical[uuids[i]]]
+
+        order, visited = [], set()
+        roots = [i for i in range(len(uuids)) if raw_parent[i] < 0]
+        for root in roots + list(range(len(uuids))):
+            if root in visited:
+                continue
+            stack = [root]
+            while stack:
+                i = stack.pop()
+                if i in visited:
+                    continue
+                visited.add(i)
+                order.append(i)
+                stack.extend(reversed([j for j in valid_children(i) if j not in visited]))
+
+        n = len(order)
+        position = {raw: node for node, raw in enumerate(order)}
+        self.uuids = [intern(uuids[raw]) for raw in order]
+        self.index = {uuid: node for node, uuid in enumerate(self.uuids)}
+        self.types = [intern(types[raw]) for raw in order]
+        # 原始 parent uuid，父节点不在本文件时保留
+        self.parent_uuids = [intern(parent_uuids[raw]) for raw in order]
+
+        parent = np.full(n, -1, dtype=np.int32)
+        first_child = np.full(n, -1, dtype=np.int32)
+        next_sibling = np.full(n, -1, dtype=np.int32)
+        for node, raw in enumerate(order):
+            prev = -1
+            for child_raw in valid_children(raw):
+                child = position[child_raw]
+                if child <= node or parent[child] != -1:
+                    continue
+                parent[child] = node
+                if prev == -1:
+                    first_child[node] = child
+                else:
+                    next_sibling[prev] = child
+                prev = child
+
+        # 先序编号下，子树大小可逆序累加得到
+        subtree_size = np.ones(n, dtype=np.int32)
+        for node in range(n - 1, 0, -1):
+            if parent[node] >= 0:
+                subtree_size[parent[node]] += subtree_size[node]
+
+        order_array = np.array(order, dtype=np.int64)
+        node_ori_offsets = np.zeros(n + 1, dtype=np.int32)
+        node_ori_ids = []
+        raw_ori_offsets = ori_offsets.tolist()
+        for node, raw in enumerate(order):
+            node_ori_ids.extend(intern(ori_id) for ori_id in ori_ids[raw_ori_offsets[raw]:raw_ori_offsets[raw + 1]])
+            node_ori_offsets[node + 1] = len(node_ori_ids)
+
+        self.parent = parent
+        self.first_child = first_child
+        self.next_sibling = next_sibling
+        self.subtree_size = subtree_size
+        self.attrs = np.ascontiguousarray(attrs[order_array]) if n else np.empty((0, len(ATTR_FIELDS)), dtype=np.int32)
+        self.ori_offsets = node_ori_offsets
+        self.ori_ids = node_ori_ids
+        self.ori_keys = np.fromiter((ori_id_key(ori_id) for ori_id in node_ori_ids), dtype=np.int64, count=len(node_ori_ids))
+
+        self.nbytes = sum(array.nbytes for array in [parent, first_child, next_sibling, subtree_size, self.attrs, node_ori_offsets, self.ori_keys]) \
+            + sum(sys.getsizeof(uuid) for uuid in self.uuids) + sys.getsizeof(self.index) \
+            + sys.getsizeof(node_ori_ids) + sum(sys.getsizeof(ori_id) for ori_id in set(node_ori_ids))
+
+    def __len__(self):
+        return len(self.uuids)
+
+    def __contains__(self, uuid: str):
+        return uuid in self.index
+
+    def node(self, uuid: str) -> Optional[int]:
+        return self.index.get(uuid)
+
+    def level(self, node: int) -> int:
+        return int(self.attrs[node, LEVEL])
+
+    def is_leaf(self, node: int) -> bool:
+        return bool(self.attrs[node, LEAF])
+
+    def children(self, node: int) -> list[int]:
+        children = []
+        child = self.first_child[node]
+        while child >= 0:
+            children.append(int(child))
+            child = self.next_sibling[child]
+        return children
+
+    def subtree(self, node: int) -> range:
+        return range(node, node + int(self.subtree_size[node]))
+
+    def ancestors(self, node: int, level: int = None) -> list[int]:
+        '''
+        由近到远的祖先节点，level 限制向上的层数
+        '''
+        ancestors = []
+        current = self.parent[node]
+        while current >= 0 and not (level and len(ancestors) >= level):
+            ancestors.append(int(current))
+            current = self.parent[current]
+        return ancestors
+
+    def node_ori_ids(self, node: int) -> list[str]:
+        return self.ori_ids[self.ori_offsets[node]:self.ori_offsets[node + 1]]
+
+    def subtree_ori_ids(self, node: int) -> list[str]:
+        '''
+        子树内全部节点的 ori_id（未去重，按先序）
+        '''
+        return self.ori_ids[self.ori_offsets[node]:self.ori_offsets[node + int(self.subtree_size[node])]]
+
+    def tree_ori_ids(self, node: int) -> list[str]:
+        '''
+        与 get_fragment_ori_ids 一致：叶子返回自身 ori_id，否则子树 ori_id 去重后按 (页, 序号) 排序
+        '''
+        if self.is_leaf(node):
+            return self.node_ori_ids(node)
+
+        start, end = self.ori_offsets[node], self.ori_offsets[node + int(self.subtree_size[node])]
+        keys = self.ori_keys[start:end]
+        if len(keys) and keys.min() < 0:
+            # 非 "页,序号" 格式的 ori_id 退化为字符串排序
+            return sorted(set(self.ori_ids[start:end]))
+        _, first = np.unique(keys, return_index=True)
+        return [self.ori_ids[start + i] for i in first]
+
+    def ori_text(self, node: int, doc_items_cache: dict) -> str:
+        '''
+        与 get_fragment_ori_text 一致：非叶子节点以 markdown 标题拼接子树原文
+        '''
+        ori_ids = self.node_ori_ids(node)
+        if not ori_ids:
+            return ""
+
+        content = doc_items_cache[f"{self.file_uuid}|{ori_ids[0]}"].content
+        if self.is_leaf(node):
+            return content
+
+        child_texts = []
+        seen = set()
+        for child in self.children(node):
+            text = self.ori_text(child, doc_items_cache)
+            if text not in seen:
+                seen.add(text)
+                child_texts.append(text)
+        return "#" * (self.level(node) + 1) + " " + content + "\n" + "\n".join(child_texts)
+
+    def all_texts(self, node: int, doc_items_cache: dict) -> list[str]:
+        '''
+        与 get_fragment_all_texts 一致
+        '''
+        ori_ids = self.node_ori_ids(node)
+        if not ori_ids:
+            return []
+
+        content = doc_items_cache[f"{self.file_uuid}|{ori_ids[0]}"].content
+        if self.is_leaf(node):
+            return [content]
+
+        children_texts = []
+        for child in self.children(node):
+            children_texts.extend(self.all_texts(child, doc_items_cache))
+
+        texts = [content]
+        seen = set()
+        for text in children_texts:
+            if text not in seen:
+                seen.add(text)
+                texts.append(text)
+        return texts
+
+    def model(self, node: int) -> Union[DocFragmentModel, PDocFragmentModel]:
+        '''
+        按需构造单个节点的片段对象（不含 ebed_text）
+        '''
+        values = dict(zip(ATTR_FIELDS, self.attrs[node].tolist()))
+        values["leaf"] = bool(values["leaf"])
+        values.update(
+            uuid=self.uuids[node],
+            file_uuid=self.file_uuid,
+            ori_id=list(self.node_ori_ids(node)),
+            type=self.types[node],
+            parent_frament_uuid=self.parent_uuids[node],
+            children_fragment_uuids=[self.uuids[child] for child in self.children(node)],
+        )
+        if self.user_id is not None:
+            return PDocFragmentModel.if_model_construct(user_id=self.user_id, **values)
+        return DocFragmentModel.if_model_construct(**values)
+
+
+class FragmentCache(dict):
+    '''
+    请求内的片段缓存 [片段uuid, 片段对象]，兼容原 dict 用法
+    已加载片段树的文件不再逐个构造片段对象，只有被访问到的节点才按需构造
+    '''
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.trees: dict[str, FragmentTree] = {}
+        self._uuid_trees: list[FragmentTree] = []
+
+    def add_tree(self, tree: FragmentTree):
+        if tree.file_uuid not in self.trees:
+            self.trees[tree.file_uuid] = tree
+            self._uuid_trees.append(tree)
+
+    def load_trees(self, fragments: list[Union[DocFragmentModel, PDocFragmentModel]]):
+        '''
+        补齐片段所在文件的片段树，整文件一次加载，之后父节点 / 子树都不再请求 ES
+        '''
+        file_uuids = {}
+        for fragment in fragments:
+            if fragment.file_uuid and fragment.file_uuid not in self.trees:
+                file_uuids.setdefault(getattr(fragment, "user_id", None) or None, set()).add(fragment.file_uuid)
+
+        for user_id, uuids in file_uuids.items():
+            try:
+                trees = fragment_tree_cache.load(sorted(uuids), user_id)
+            except Exception as e:
+                logger.warning(f"FragmentTree load failed: {e}, file_uuids: {uuids}")
+                continue
+            for tree in trees.values():
+                self.add_tree(tree)
+
+    def _find_tree(self, uuid: str) -> Optional[FragmentTree]:
+        for tree in self._uuid_trees:
+            if uuid in tree.index:
+                return tree
+        return None
+
+    def locate(self, fragment: Union[DocFragmentModel, PDocFragmentModel]) -> Optional[tuple[FragmentTree, int]]:
+        tree = self.trees.get(fragment.file_uuid)
+        node = tree.node(fragment.uuid) if tree is not None else None
+        return None if node is None else (tree, node)
+
+    def __contains__(self, uuid):
+        return super().__contains__(uuid) or self._find_tree(uuid) is not None
+
+    def __missing__(self, uuid):
+        tree = self._find_tree(uuid)
+        if tree is None:
+            raise KeyError(uuid)
+        fragment = tree.model(tree.index[uuid])
+        self[uuid] = fragment
+        return fragment
+
+    def get(self, uuid, default=None):
+        try:
+            return self[uuid]
+        except KeyError:
+            return default
+
+    def __deepcopy__(self, memo):
+        # 片段树只读共享
+        cache = FragmentCache(self)
+        for tree in self._uuid_trees:
+            cache.add_tree(tree)
+        return cache
+
+
+class FragmentTreeCache:
+
+    def __init__(self, max_bytes: int = 512 << 20, expiration: int = 3600, max_fragments_per_file: int = 10000):
+        self._cache = ShardedLRUCacheDict(max_size=100000, expiration=expiration, max_bytes=max_bytes)
+        self._max_fragments_per_file = max_fragments_per_file
+        self._file_keys = FileKeyIndex(self._cache, invalidation_bus)
+
+    def _keys(self, file_uuids: list[str], user_id: Optional[str]) -> list[Optional[str]]:
+        versions = stage_cache.file_versions(file_uuids)
+        if versions is None:
+            return [None] * len(file_uuids)
+        return [f"{user_id or ''}:{file_uuid}:{version}" for file_uuid, version in zip(file_uuids, versions)]
+
+    def _build(self, key: Optional[str], file_uuid: str, fragments: Union[list[dict], FragmentBlob], user_id: Optional[str], source_length: Optional[int] = None) -> FragmentTree:
+        start_time = time.time()
+        if isinstance(fragments, FragmentBlob):
+            tree = FragmentTree.from_blob(file_uuid, fragments, user_id, source_length=source_length)
+        else:
+            tree = FragmentTree(file_uuid, fragments, user_id, source_length=source_length)
+        if key:
+            self._cache[key] = tree
+            self._file_keys.add(file_uuid, key)
+        logger.info(f"FragmentTree build {file_uuid}, nodes: {len(tree)}, cost: {1000*(time.time() - start_time):.1f}ms")
+        return tree
+
+    def _build_from_source(self, key: Optional[str], file_uuid: str, source: Union[str, bytes], user_id: Optional[str]) -> Optional[FragmentTree]:
+        # str 为 doc_fragments_json，bytes 为 Redis / Storage 中的片段 blob（含历史 gzip json）
+        fragments = xjson.loads(source) if isinstance(source, str) else load_fragments_blob(source)
+        if not isinstance(fragments, (list, FragmentBlob)):
+            return None
+        return self._build(key, file_uuid, fragments, user_id, source_length=len(source))
+
+    def get(self, file_uuid: str, source: Union[str, bytes], user_id: Optional[str] = None) -> Optional[FragmentTree]:
+        if not source:
+            return None
+
+        key = self._keys([file_uuid], user_id)[0]
+        tree = self._cache.get(key) if key else None
+        if tree is not None and tree.source_length in (None, len(source)):
+            fragment_tree_requests.inc(outcome="hit")
+            return tree
+
+        fragment_tree_requests.inc(outcome="miss")
+        return self._build_from_source(key, file_uuid, source, user_id)
+
+    def load(self, file_uuids: list[str], user_id: Optional[str] = None) -> dict[str, FragmentTree]:
+        '''
+        批量加载文件片段树：进程缓存 -> Redis 中的片段 blob（一次 mget）-> 片段索引（一次 msearch）
+        片段数达到 max_fragments_per_file 的文件可能未取全，不返回，由调用方回退到逐层请求
+        '''
+        keys = dict(zip(file_uuids, self._keys(file_uuids, user_id)))
+        trees = {}
+        for file_uuid, key in keys.items():
+            tree = self._cache.get(key) if key else None
+            if tree is not None:
+                trees[file_uuid] = tree
+
+        missing = [file_uuid for file_uuid in file_uuids if file_uuid not in trees]
+        fragment_tree_requests.inc(len(trees), outcome="hit")
+        fragment_tree_requests.inc(len(missing), outcome="miss")
+        if not missing:
+            return trees
+
+        for file_uuid, blob in _get_cached_fragments_blobs(missing, user_id).items():
+            tree = self._build_from_source(keys[file_uuid], file_uuid, blob, user_id)
+            if tree is not None:
+                trees[file_uuid] = tree
+
+        missing = [file_uuid for file_uuid in missing if file_uuid not in trees]
+        if missing:
+            if user_id:
+                sources = PDocFragmentES().get_tree_sources_by_file_uuids(missing, user_id, size=self._max_fragments_per_file)
+            else:
+                sources = DocFragmentES().get_tree_sources_by_file_uuids(missing, size=self._max_fragments_per_file)
+            for file_uuid, fragments in sources.items():
+                if fragments and len(fragments) < self._max_fragments_per_file:
+                    trees[file_uuid] = self._build(keys[file_uuid], file_uuid, fragments, user_id)
+
+        return trees
+
+
+def _get_cached_fragments_blobs(file_uuids: list[str], user_id: Optional[str]) -> dict[str, bytes]:
+    # 与 attach_file_fragments_json 使用同一份 Redis 缓存，解码由 _build_from_source 按格式处理
+    from pkg.redis.redis import redis_store
+
+    cache_keys = [f"fragment-{user_id}-{file_uuid}" if user_id else f"fragment-{file_uuid}" for file_uuid in file_uuids]
+    try:
+        cached_results = fragment_blob_flight.do_many(cache_keys, redis_store.mget)
+    except Exception as e:
+        logger.warning(f"FragmentTree get cached fragments blob failed: {e}")
+        return {}
+    return {file_uuid: value for file_uuid, value in zip(file_uuids, cached_results) if value}
+
+
+def _build_fragment_tree_cache():
+    tree_config = config.get("fragment_tree") or {}
+    return FragmentTreeCache(max_bytes=int(tree_config.get("cache_max_bytes") or (512 << 20)),
+                             expiration=tree_config.get("expiration", 3600),
+                             max_fragments_per_file=tree_config.get("max_fragments_per_file", 10000))
+
+
+fragment_tree_cache = _build_fragment_tree_cache()
@@ -2,7 +2,7 @@
 Author: longsion<xianglong_chen@intsig.net>
 Date: 2024-06-04 16:57:16
 LastEditors: longsion
-LastEditTime: 2024-06-04 16:58:25
+LastEditTime: 2026-10-18 15:41:05
 '''
 
 
@@ -12,3 +12,11 @@ class LLMException(Exception):
 
 class LLMComplianceError(LLMException):
     pass
+
+
+class CircuitOpenError(Exception):
+    pass
+
+
+class StageTimeoutError(Exception):
+    pass
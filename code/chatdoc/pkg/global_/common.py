@@ -2,7 +2,7 @@
 Author: longsion<xianglong_chen@intsig.net>
 Date: 2024-05-30 15:55:24
 LastEditors: longsion
-LastEditTime: 2024-10-08 18:40:58
+LastEditTime: 2026-10-18 21:41:37
 '''
 
 
@@ -14,8 +14,8 @@ from pkg.es.es_doc_table import DocTableModel
 from pkg.es.es_p_doc_fragment import PDocFragmentES, PDocFragmentModel
 from pkg.es.es_p_doc_item import PDocItemES, PDocItemModel
 from pkg.es.es_p_doc_table import PDocTableModel
-from pkg.utils.thread_with_return_value import ThreadWithReturnValue
-from pkg.utils.transform import html2markdown
+from pkg.ori_segment import ori_segment_cache
+from pkg.utils.task_group import TaskGroup
 from pkg.utils import duplicates_list
 
 
@@ -32,17 +32,18 @@ def fillin_doc_items_cache(doc_item_cache, uuid_ori_id_tuples: list[tuple[str, s
         if hashkey not in doc_item_cache:
             to_request_dict[uuid_ori_id_tuple] = idx
 
-    if to_request_dict:
+    # 优先从入库时写入的原文段取原文，原文段中没有的再查 ES
+    to_request_list = ori_segment_cache.fillin(doc_item_cache, list(to_request_dict.keys()), DocItemModel)
+    if to_request_list:
         max_batch_size = 1000
-        to_request_list = list(to_request_dict.keys())
-        threads = []
-        for i in range(0, len(to_request_list), max_batch_size):
-            t = ThreadWithReturnValue(target=DocItemES().get_by_uuid_ori_tuples, kwargs=dict(pairs=to_request_list[i:i + max_batch_size]))
-            t.start()
-            threads.append(t)
-
-        for t in threads:
-            doc_items = t.join()
+        with TaskGroup("fillin_doc_items") as task_group:
+            tasks = [
+                task_group.spawn(DocItemES().get_by_uuid_ori_tuples, pairs=to_request_list[i:i + max_batch_size], stage="fillin_doc_items")
+                for i in range(0, len(to_request_list), max_batch_size)
+            ]
+
+        for t in tasks:
+            doc_items = t.result()
             for doc_item in doc_items:
                 for ori_id in doc_item.ori_id:
                     hashkey = f"{doc_item.uuid}|{ori_id}"
@@ -62,17 +63,18 @@ def fillin_personal_doc_items_cache(doc_item_cache, user_id: str, uuid_ori_id_tu
         if hashkey not in doc_item_cache:
             to_request_dict[uuid_ori_id_tuple] = idx
 
-    if to_request_dict:
+    # 优先从入库时写入的原文段取原文，原文段中没有的再查 ES
+    to_request_list = ori_segment_cache.fillin(doc_item_cache, list(to_request_dict.keys()), PDocItemModel, user_id=user_id)
+    if to_request_list:
         max_batch_size = 1000
-        to_request_list = list(to_request_dict.keys())
-        threads = []
-        for i in range(0, len(to_request_list), max_batch_size):
-            t = ThreadWithReturnValue(target=PDocItemES().get_by_uuid_ori_tuples, kwargs=dict(pairs=to_request_list[i:i + max_batch_size], user_id=user_id))
-            t.start()
-            threads.append(t)
-
-        for t in threads:
-            doc_items = t.join()
+        with TaskGroup("fillin_doc_items") as task_group:
+            tasks = [
+                task_group.spawn(PDocItemES().get_by_uuid_ori_tuples, pairs=to_request_list[i:i + max_batch_size], user_id=user_id, stage="fillin_doc_items")
+                for i in range(0, len(to_request_list), max_batch_size)
+            ]
+
+        for t in tasks:
+            doc_items = t.result()
             for doc_item in doc_items:
                 for ori_id in doc_item.ori_id:
                     hashkey = f"{doc_item.uuid}|{ori_id}"
@@ -84,6 +86,8 @@ def fillin_fragment_parent_cache(fragment_cache: dict[str, Union[PDocFragmentMod
     description: 填充节点的父节点的fragment_cache
     return {*}
     '''
+    # 整文件加载片段树后父节点都在缓存中，不再逐层请求ES
+    fragment_cache.load_trees(fragments)
     _fragments = fragments
     level_cnt = 0
     while _fragments:
@@ -102,6 +106,8 @@ def fillin_personal_fragment_parent_cache(fragment_cache: dict[str, Union[PDocFr
     description: 填充节点的父节点的fragment_cache
     return {*}
     '''
+    # 整文件加载片段树后父节点都在缓存中，不再逐层请求ES
+    fragment_cache.load_trees(fragments)
     _fragments = fragments
     level_cnt = 0
     while _fragments:
@@ -120,8 +126,20 @@ def fillin_fragment_children_cache(fragment_cache: dict[str, Union[PDocFragmentM
     description: 填充节点的子节点的fragment_cache，并返回相应的ori_id列表，用做uuid_ori_id缓存
     return {*}
     '''
-    _fragments = fragments
+    # 入库时已物化子树原文的片段不需要子节点与原文
+    fragments = [fragment for fragment in fragments if not fragment.tree_text]
+    fragment_cache.load_trees(fragments)
+    _fragments = []
     uuid_ori_tuple_list = list()
+    for fragment in fragments:
+        located = fragment_cache.locate(fragment)
+        if located:
+            # 已加载片段树的文件直接按先序区间取整棵子树的ori_id
+            tree, node = located
+            uuid_ori_tuple_list.extend([(tree.file_uuid, ori_id) for ori_id in tree.subtree_ori_ids(node)])
+        else:
+            _fragments.append(fragment)
+
     while _fragments:
         uuid_ori_tuple_list.extend([(fragment.file_uuid, ori_id) for fragment in _fragments for ori_id in fragment.ori_id])
         children_uuids = [uuid for item in _fragments for uuid in item.children_fragment_uuids]
@@ -142,8 +160,20 @@ def fillin_personal_fragment_children_cache(fragment_cache: dict[str, Union[PDoc
     description: 填充节点的子节点的fragment_cache，并返回相应的ori_id列表，用做uuid_ori_id缓存
     return {*}
     '''
-    _fragments = fragments
+    # 入库时已物化子树原文的片段不需要子节点与原文
+    fragments = [fragment for fragment in fragments if not fragment.tree_text]
+    fragment_cache.load_trees(fragments)
+    _fragments = []
     uuid_ori_tuple_list = list()
+    for fragment in fragments:
+        located = fragment_cache.locate(fragment)
+        if located:
+            # 已加载片段树的文件直接按先序区间取整棵子树的ori_id
+            tree, node = located
+            uuid_ori_tuple_list.extend([(tree.file_uuid, ori_id) for ori_id in tree.subtree_ori_ids(node)])
+        else:
+            _fragments.append(fragment)
+
     while _fragments:
         uuid_ori_tuple_list.extend([(fragment.file_uuid, ori_id) for fragment in _fragments for ori_id in fragment.ori_id])
         children_uuids = [uuid for item in _fragments for uuid in item.children_fragment_uuids]
@@ -159,11 +189,51 @@ def fillin_personal_fragment_children_cache(fragment_cache: dict[str, Union[PDoc
     return uuid_ori_tuple_list
 
 
+def fillin_materialized_fragments(fragment_cache: dict[str, Union[PDocFragmentModel, DocFragmentModel]], fragments: list[DocFragmentModel]) -> list[DocFragmentModel]:
+    '''
+    description: 物化的子树原文不在doc_fragments_json中，未带物化结果的非叶子节点一次按uuid取回并替换fragment_cache中的片段；超长未物化的仍走子节点与原文补齐
+    return {*}
+    '''
+    materialized = {}
+    uuids = list(set([fragment.uuid for fragment in fragments if not fragment.leaf and not fragment.tree_text]))
+    if uuids:
+        for fragment in DocFragmentES().get_by_uuids(uuids):
+            if fragment.tree_text:
+                materialized[fragment.uuid] = fragment
+                fragment_cache[fragment.uuid] = fragment
+
+    return [materialized.get(fragment.uuid, fragment) for fragment in fragments]
+
+
+def fillin_personal_materialized_fragments(fragment_cache: dict[str, Union[PDocFragmentModel, DocFragmentModel]], fragments: list[PDocFragmentModel]) -> list[PDocFragmentModel]:
+    '''
+    description: 物化的子树原文不在doc_fragments_json中，未带物化结果的非叶子节点一次按uuid取回并替换fragment_cache中的片段；超长未物化的仍走子节点与原文补齐
+    return {*}
+    '''
+    materialized = {}
+    uuids = list(set([fragment.uuid for fragment in fragments if not fragment.leaf and not fragment.tree_text]))
+    if uuids:
+        for fragment in PDocFragmentES().get_by_uuids(uuids):
+            if fragment.tree_text:
+                materialized[fragment.uuid] = fragment
+                fragment_cache[fragment.uuid] = fragment
+
+    return [materialized.get(fragment.uuid, fragment) for fragment in fragments]
+
+
 def get_fragment_ori_ids(fragment: Union[DocFragmentModel, PDocFragmentModel], fragment_cache: dict[str, Union[DocFragmentModel, PDocFragmentModel]]):
     '''
     description: 通过缓存获取 fragment的ori_ids， 补充填满【fragment_cache中包含该节点的所有子孙节点的Fragment】
     return {*}
     '''
+    if fragment.tree_ori_ids:
+        return list(fragment.tree_ori_ids)
+
+    located = fragment_cache.locate(fragment)
+    if located:
+        tree, node = located
+        return tree.tree_ori_ids(node)
+
     if fragment.leaf:
         return fragment.ori_id
 
@@ -194,18 +264,24 @@ def get_fragment_ori_text(fragment: Union[DocFragmentModel, PDocFragmentModel],
     description: 通过缓存获取 fragment的text， 补充填满【fragment_cache中包含该节点的所有子孙节点的Fragment】，doc_items_cache中也包含了【ori_id的缓存】
     return {*}
     '''
+    if fragment.tree_text:
+        return fragment.tree_text
+
     if isinstance(fragment, PDocFragmentModel):
         doc_items_cache = p_doc_items_cache
 
+    located = fragment_cache.locate(fragment)
+    if located:
+        tree, node = located
+        return tree.ori_text(node, doc_items_cache)
+
     if not fragment.ori_id:
         return ""
 
     fragment_content = doc_items_cache[f"{fragment.file_uuid}|{fragment.ori_id[0]}"].content
+    # 表格入库时已转换为markdown
     if fragment.leaf:
-        if fragment_content.startswith("<table border="):
-            return html2markdown(fragment_content)
-        else:
-            return fragment_content
+        return fragment_content
 
     # 先直接去全部的
     # 后续： 如果不超过字数限制，则取全部的，否则按照层级去获取，依次扩充到总数超过2000为止
@@ -224,18 +300,23 @@ def get_fragment_all_texts(fragment: Union[DocFragmentModel, PDocFragmentModel],
     description: 通过缓存获取 fragment的text列表， 补充填满【fragment_cache中包含该节点的所有子孙节点的Fragment】，doc_items_cache中也包含了【ori_id的缓存】
     return {*}
     '''
+    if fragment.tree_all_texts:
+        return list(fragment.tree_all_texts)
+
     if isinstance(fragment, PDocFragmentModel):
         doc_items_cache = p_doc_items_cache
 
+    located = fragment_cache.locate(fragment)
+    if located:
+        tree, node = located
+        return tree.all_texts(node, doc_items_cache)
+
     if not fragment.ori_id:
         return []
 
     fragment_content = doc_items_cache[f"{fragment.file_uuid}|{fragment.ori_id[0]}"].content
     if fragment.leaf:
-        if fragment_content.startswith("<table border="):
-            return [html2markdown(fragment_content)]
-        else:
-            return [fragment_content]
+        return [fragment_content]
 
     # 先直接去全部的
     # 后续： 如果不超过字数限制，则取全部的，否则按照层级去获取，依次扩充到总数超过2000为止
@@ -264,9 +345,5 @@ def get_table_ori_text(doc_table: Union[DocTableModel, PDocTableModel] , doc_ori
     if not doc_table.ori_id:
         return ""
 
-    fragment_content = doc_ori_cache[f"{doc_table.uuid}|{doc_table.ori_id[0]}"].content
-    if fragment_content.startswith("<table border="):
-        return html2markdown(fragment_content)
-
-    else:
-        return fragment_content
+    # 表格入库时已转换为markdown
+    return doc_ori_cache[f"{doc_table.uuid}|{doc_table.ori_id[0]}"].content
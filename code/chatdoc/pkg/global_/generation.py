@@ -2,12 +2,13 @@
 Author: longsion<xianglong_chen@intsig.net>
 Date: 2024-05-06 15:12:45
 LastEditors: longsion
-LastEditTime: 2024-10-15 17:54:34
+LastEditTime: 2026-10-18 16:20:37
 '''
 from pkg.exceptions import LLMComplianceError
 from pkg.global_.objects import Context
 from pkg.llm.llm import LLM
 from pkg.utils.decorators import register_span_func
+from pkg.utils.jaeger import tracer
 from pkg.config import config
 from pkg.utils.logger import logger
 
@@ -47,3 +48,22 @@ def generation(context: Context) -> Context:
     logger.info(f"Statistics , question_len: {len(context.llm_question)}, answer_len: {len(context.llm_answer or '')}")
 
     return context
+
+
+async def agenerate(context: Context) -> Context:
+    """
+    生成（asyncio 模式），流式结果写入 context.stream_aiter
+    """
+    with tracer.start_as_current_span("LLM问答"):
+        try:
+            answer_or_iterator = await llm.achat(context.llm_question, stream=context.params.stream)
+        except LLMComplianceError:
+            answer_or_iterator = config["compliance"]["warning_text"]
+            context.answer_compliance = False
+
+    if isinstance(answer_or_iterator, str):
+        context.llm_answer = answer_or_iterator
+    else:
+        context.stream_aiter = answer_or_iterator
+
+    return context
@@ -2,7 +2,7 @@
 Author: longsion<xianglong_chen@intsig.net>
 Date: 2024-05-27 15:23:01
 LastEditors: longsion
-LastEditTime: 2024-10-08 16:50:58
+LastEditTime: 2026-10-18 15:41:05
 '''
 import os.path
 
@@ -13,7 +13,7 @@ from pkg.es.es_company import CompanyES
 from pkg.query_analysis import query_extract_uie
 from pkg.utils import ensure_list
 from pkg.utils.decorators import register_span_func
-from pkg.utils.thread_with_return_value import ThreadWithReturnValue
+from pkg.utils.task_group import TaskGroup
 from pkg.config import config
 from difflib import get_close_matches, SequenceMatcher
 
@@ -81,22 +81,20 @@ def preprocess_question(context: Context) -> Context:
     # question 校验
     question = replace_query(ori_question)
     if question:
+        task_group = TaskGroup("preprocess_question")
         if context.params.qa_type == GlobalQAType.ANALYST.value:
-            _files_brief_t = ThreadWithReturnValue(target=FileES().search_file_brief_by_query, args=(gen_query(replace_query(context.params.question), filter_words),))
+            _files_brief_t = task_group.spawn(FileES().search_file_brief_by_query, gen_query(replace_query(context.params.question), filter_words), stage="file_lookup")
 
         elif context.params.qa_type == GlobalQAType.PERSONAL.value:
-            _files_brief_t = ThreadWithReturnValue(target=PFileES().search_file_brief_by_query, args=(context.params.user_id, gen_query(replace_query(context.params.question), filter_words),))
+            _files_brief_t = task_group.spawn(PFileES().search_file_brief_by_query, context.params.user_id, gen_query(replace_query(context.params.question), filter_words), stage="file_lookup")
 
         else:
-            _files_brief_t = ThreadWithReturnValue(target=search_both_file_brief, args=(context.params.user_id, gen_query(replace_query(context.params.question), filter_words),))
+            _files_brief_t = task_group.spawn(search_both_file_brief, context.params.user_id, gen_query(replace_query(context.params.question), filter_words), stage="file_lookup")
 
-        _files_brief_t.start()
+        _extract_info_t = task_group.spawn(get_extract_info, question)
 
-        _extract_info_t = ThreadWithReturnValue(target=get_extract_info, args=(question,))
-        _extract_info_t.start()
-
-        files_brief = _files_brief_t.join()
-        extract_info = _extract_info_t.join()
+        files_brief = _files_brief_t.result()
+        extract_info = _extract_info_t.result()
     else:
         files_brief = []
         extract_info = {}
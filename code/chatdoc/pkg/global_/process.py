@@ -2,16 +2,18 @@
 Author: longsion<xianglong_chen@intsig.net>
 Date: 2024-05-27 14:34:25
 LastEditors: longsion
-LastEditTime: 2024-10-22 11:10:52
+LastEditTime: 2026-10-18 23:41:52
 '''
 import datetime
 import time
-from pkg.global_.objects import Params, Context, Response
+from pkg.global_.objects import GlobalQAType, Params, Context, Response
 from pkg.utils.logger import logger
 from pkg.utils.decorators import register_span_func
 from pkg.config import config
-from pkg.utils.thread_with_return_value import ThreadWithReturnValue
-from pkg.llm.util import check_repetition, get_stream_json, remove_repetition, set_stream_json, stream_fixes_suffix
+from pkg.utils.task_group import TaskGroup
+from pkg.llm.util import async_answer_stream, check_repetition, get_stream_json, remove_repetition, set_stream_json, stream_fixes_suffix
+from pkg.utils.aio import run_sync
+from pkg.redis.stage_cache import ANALYST_LIBRARY, personal_library, stage_cache
 
 from opentelemetry import context as otel_context
 from opentelemetry.trace import get_current_span
@@ -20,15 +22,15 @@ from opentelemetry.trace import get_current_span
 def process(params: Params) -> Context:
 
     from .compliance_question import compliance_question
-    from .preprocess_question import preprocess_question
+    from .preprocess_question import preprocess_question, replace_query
     from .rerank_by_question import rerank_by_question
     from .small2big import small2big
     from .truncation import truncation
-    from .generation import generation
+    from .generation import agenerate, generation
     from .compliance_answer import func as compliance_answer
     from .rerank_by_answer import func as rerank_by_answer
     from .retrieve_small import retrieve_small
-    from .retrieve_small_full import retrieve_small_full
+    from .retrieve_small_full import retrieve_small_full, speculate_retrieve_small_full
 
     context = Context(params=params)
     context.start_ts = time.time()
@@ -38,32 +40,56 @@ def process(params: Params) -> Context:
     # 赋予trace_id
     context.trace_id = f"{get_current_span().context.trace_id:0x}"
 
-    # 并行合规检测
-    compliance_t = ThreadWithReturnValue(target=compliance_question, args=(context,), parent_span_context=span_ctx)
-    compliance_t.start()
+    task_group = TaskGroup("process", context=context)
+    # 并行合规检测；超时按未检测处理（question_compliance 为 None），生成的答案仍会经过 compliance_answer
+    compliance_t = task_group.spawn(compliance_question, context, stage="compliance_question", default=context)
 
-    # 预处理问题，分析问题，确定AgentType
-    context = preprocess_question(context)
+    # 阶段缓存：归一化问题 + 检索的文件库 + 索引版本，命中时跳过问题分析/召回/rerank/small2big
+    libraries = []
+    if params.qa_type != GlobalQAType.PERSONAL.value:
+        libraries.append(ANALYST_LIBRARY)
+    if params.qa_type != GlobalQAType.ANALYST.value:
+        libraries.append(personal_library(params.user_id))
+    cache_scope = stage_cache.scope(replace_query(params.question), [], libraries)
+    cached_analysis = stage_cache.load(context, cache_scope, "question_analysis")
+    cached_candidates = cached_analysis and stage_cache.load(context, cache_scope, "rerank_candidates")
 
-    # 并行全局搜索
-    retrieve_all_t = ThreadWithReturnValue(target=retrieve_small_full, args=(context,))
-    retrieve_all_t.start()
+    if not cached_candidates:
+        # 推测召回：原始问题的全局段落召回与问题预处理并行
+        speculate_retrieve_small_full(context, task_group)
+
+        # 预处理问题，分析问题，确定AgentType
+        if not cached_analysis:
+            context = preprocess_question(context)
+            stage_cache.save(context, cache_scope, "question_analysis", ["question_analysis", "files", "locationfiles", "company_mapper"])
+
+        # 并行全局搜索
+        retrieve_all_t = task_group.spawn(retrieve_small_full, context)
 
     # 预处理与合并检测并行
-    context = compliance_t.join()
+    context = compliance_t.result()
     if context.question_compliance is False:
+        task_group.cancel()
         context.answer_response = Response(answer=config["compliance"]["warning_text"], question_compliance=False, trace_id=context.trace_id)
         return context
 
-    # 数据并行检索，定位文件检索 + 全局检索
-    context = retrieve_small(context)
-    context = retrieve_all_t.join()
+    if not cached_candidates:
+        # 数据并行检索，定位文件检索 + 全局检索
+        context = retrieve_small(context)
+        context = retrieve_all_t.result()
+        # 未被复用的推测召回
+        for _, speculative_t in context.speculative_retrieve.values():
+            speculative_t.cancel()
+        context.speculative_retrieve.clear()
 
-    # 问题与召回rerank
-    context = rerank_by_question(context)
+        # 问题与召回rerank
+        context = rerank_by_question(context)
 
-    # small2big
-    context = small2big(context)
+        # small2big
+        context = small2big(context)
+        # 召回为空或有召回阶段超时降级（部分结果）时不缓存
+        if context.rerank_retrieve_before_qa and not context.degraded_stages:
+            stage_cache.save(context, cache_scope, "rerank_candidates", ["files", "rerank_retrieve_before_qa"])
 
     # 组合&&截断
     context = truncation(context)
@@ -95,10 +121,8 @@ def process(params: Params) -> Context:
 
         return gen_response_by_context(context)
 
-    def _after_trunction():
-        nonlocal context
-
-        # yield 召回结果
+    def _retrieve_result():
+        # 召回结果
         ori = [
             dict(
                 ori_id=ori_id,
@@ -113,7 +137,7 @@ def process(params: Params) -> Context:
             推送召回结果=f"{(time.time() - context.start_ts) * 1000:.1f}ms"
         )
         logger.info(f"推送召回结果 duration: {context.durations['推送召回结果']}")
-        yield set_stream_json(
+        result = set_stream_json(
             {
                 "status": "DOING",
                 "content": "",
@@ -121,11 +145,28 @@ def process(params: Params) -> Context:
                 "data": dict(source=ori)
             }
         )
+        return result
+
+    def _after_trunction():
+        nonlocal context
+        # yield 召回结果
+        yield _retrieve_result()
         # 生成
         context = generation(context)
-
         yield from _after_generation()
 
+    async def _aon_done(context) -> Response:
+        return await run_sync(_on_done, context)
+
+    async def _aafter_trunction():
+        nonlocal context
+        # yield 召回结果
+        yield _retrieve_result()
+        # 生成
+        context = await agenerate(context)
+        async for x in async_answer_stream(context, _aon_done):
+            yield x
+
     def _after_generation():
         nonlocal context
         answer_text = ""
@@ -174,6 +215,7 @@ def process(params: Params) -> Context:
 
     if context.params.stream:
         context.answer_response_iter = _after_trunction()
+        context.answer_response_aiter = _aafter_trunction()
     else:
         # 生成
         context = generation(context)
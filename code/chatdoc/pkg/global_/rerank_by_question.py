@@ -2,32 +2,31 @@
 Author: longsion<xianglong_chen@intsig.net>
 Date: 2024-05-06 14:57:34
 LastEditors: longsion
-LastEditTime: 2024-10-23 17:01:05
+LastEditTime: 2026-10-18 23:34:20
 '''
 
-from collections import OrderedDict
 from pkg.es.es_file import ESFileObject, FileES
+from pkg.es.fragment_tree import fragment_tree_cache
 from pkg.es.es_p_doc_fragment import PDocFragmentModel
 from pkg.es.es_p_doc_table import PDocTableModel
 from pkg.es.es_p_file import PESFileObject, PFileES
 from pkg.global_.common import fillin_doc_items_cache, fillin_fragment_children_cache, fillin_personal_doc_items_cache, fillin_personal_fragment_children_cache, get_fragment_all_texts, get_fragment_ori_ids, get_fragment_ori_text, get_table_ori_text
 from pkg.global_.objects import Context, RetrieveContext, RetrieveType, GlobalQAType
-from pkg.config import config
 from pkg.es.es_doc_fragment import DocFragmentModel
 from pkg.es.es_doc_table import DocTableModel
+from pkg.es.fragment_blob import fragment_blob_flight, fragments_blob_from_json
 from pkg.storage import Storage
 from pkg.utils.jaeger import TracedThreadPoolExecutor
 from .preprocess_question import file_filter
-from pkg.rerank import rerank_api_by_cache
-from pkg.utils import compress, decompress, log_msg, split_list, sigmoid, xjson
+from pkg.rerank.batcher import rerank_batcher
+from pkg.utils import log_msg, sigmoid
 from pkg.utils.decorators import register_span_func
 from pkg.utils.logger import logger
-from pkg.utils.thread_with_return_value import ThreadWithReturnValue
+from pkg.utils.task_group import TaskGroup
 from pkg.redis.redis import redis_store
 
 import re
 import numpy as np
-import concurrent.futures
 
 
 def lambda_func(context: Context):
@@ -78,24 +77,23 @@ def rerank_by_question(context: Context) -> Context:
         # 召回为空，直接返回
         return context
 
+    task_group = TaskGroup("rerank_by_question")
     if context.params.qa_type == GlobalQAType.ANALYST.value:
-        retrieve_files_t = ThreadWithReturnValue(target=get_files_by_uuid, args=(uuids,))
+        retrieve_files_t = task_group.spawn(get_files_by_uuid, uuids, stage="file_lookup")
 
     elif context.params.qa_type == GlobalQAType.PERSONAL.value:
-        retrieve_files_t = ThreadWithReturnValue(target=get_personal_files_by_uuid, args=(context.params.user_id, uuids,))
+        retrieve_files_t = task_group.spawn(get_personal_files_by_uuid, context.params.user_id, uuids, stage="file_lookup")
 
     else:
-        retrieve_files_t = ThreadWithReturnValue(target=get_both_files_by_uuid, args=(context,))
+        retrieve_files_t = task_group.spawn(get_both_files_by_uuid, context, stage="file_lookup")
 
-    retrieve_files_t.start()
     rerank_scores = rerank_max_score(context.question_analysis.retrieve_question, rerank_texts)
-    context.files = retrieve_files_t.join()
+    context.files = retrieve_files_t.result()
     context = file_filter(context)
     # 对切片进行cache填充
-    process_cache_t = ThreadWithReturnValue(target=process_cache, args=(context,))
-    process_cache_t.start()
+    process_cache_t = task_group.spawn(process_cache, context)
     uuid_rerank_scores = rerank_score_by_filename(context)
-    process_cache_t.join()
+    process_cache_t.result()
     # 重排去重后去计算 repeat score
     r_contexts = generate_retieval_contexts(context, rerank_scores, uuid_rerank_scores)
 
@@ -188,24 +186,8 @@ def rerank_max_score(txt1: str, txt2s) -> list[float]:
             # 表格线替换为空
             txt2 = txt2.replace('|', ' ')
             clean_txt2s.append(txt2)
-        concurrent_split_txts = split_list(txt2_combines_all, chunk_size=16)
-        pairs = [[[txt1], concurrent_split_txt] for concurrent_split_txt in concurrent_split_txts]
-        tasks_with_index = [
-            (i, txt2) for i, txt2 in enumerate(pairs)
-        ]
-        with TracedThreadPoolExecutor(max_workers=8) as executor:
-            futures = {executor.submit(rerank_api_by_cache, txt2, headers=None, url=config["textin"]["rerank_url"], if_softmax=0): idx for idx, txt2 in tasks_with_index}
-
-            # 使用OrderedDict来保证按原顺序收集结果
-            ordered_results = OrderedDict()
-            for future in concurrent.futures.as_completed(futures):
-                idx = futures[future]
-                result = future.result()
-                ordered_results[idx] = result
-
-            # 提取并排序结果
-            ress = [ordered_results[i] for i in range(len(ordered_results))]
-        text_span_scores = [sigmoid(score) for text_span_score in ress for score in text_span_score]
+        # 由进程级 rerank_batcher 跨请求合批
+        text_span_scores = [sigmoid(score) for score in rerank_batcher.score(txt1, txt2_combines_all)]
         # text_span_scores = [round(score, 4) for score in softmax(text_span_scores)]
 
         # pairs = [[txt1], clean_txt2s]
@@ -232,24 +214,8 @@ def rerank_score_by_filename(context):
     query = context.params.question
     name_uuid_dic = {c.filename: c.uuid for c in context.files}
     file_names = list(name_uuid_dic.keys())
-    concurrent_split_txts = split_list(file_names, chunk_size=16)
-    pairs = [[[query], concurrent_split_txt] for concurrent_split_txt in concurrent_split_txts]
-    tasks_with_index = [
-        (i, txt2) for i, txt2 in enumerate(pairs)
-    ]
-    with TracedThreadPoolExecutor(max_workers=8) as executor:
-        futures = {executor.submit(rerank_api_by_cache, txt2, headers=None, url=config["textin"]["rerank_url"], if_softmax=0): idx for idx, txt2 in tasks_with_index}
-
-        # 使用OrderedDict来保证按原顺序收集结果
-        ordered_results = OrderedDict()
-        for future in concurrent.futures.as_completed(futures):
-            idx = futures[future]
-            result = future.result()
-            ordered_results[idx] = result
-
-        # 提取并排序结果
-        ress = [ordered_results[i] for i in range(len(ordered_results))]
-    text_span_scores = [sigmoid(score) for text_span_score in ress for score in text_span_score]
+    # 由进程级 rerank_batcher 跨请求合批
+    text_span_scores = [sigmoid(score) for score in rerank_batcher.score(query, file_names)]
     # hard_code
     max_score = max(text_span_scores) if text_span_scores else 0
     if 0.1 <= max_score * 10 < 1:
@@ -325,22 +291,19 @@ def replace_duplicate_context(contexts: list[RetrieveContext]) -> list[RetrieveC
 
 
 def fill_fragments_cache(context: Context):
-    # 从doc_fragments_json中更新 context.fragment_cache
+    # 从片段 blob（或doc_fragments_json）中加载文件片段树（进程级缓存共享），片段对象按需构造
+    missing = {}
     for file in context.files:
-        if file.doc_fragments_json:
-            doc_fragments = xjson.loads(file.doc_fragments_json)
-            if isinstance(doc_fragments, list):
-                # without embeddings
-                if isinstance(file, ESFileObject):
-                    doc_fragments = [
-                        DocFragmentModel.if_model_construct(**fragment, file_uuid=file.uuid) for fragment in doc_fragments
-                    ]
-                else:
-                    doc_fragments = [
-                        PDocFragmentModel.if_model_construct(**fragment, file_uuid=file.uuid) for fragment in doc_fragments
-                    ]
-
-                context.fragment_cache.update({doc_fragment.uuid: doc_fragment for doc_fragment in doc_fragments})
+        user_id = file.user_id if isinstance(file, PESFileObject) else None
+        tree = fragment_tree_cache.get(file.uuid, file.fragments_source, user_id=user_id)
+        if tree is not None:
+            context.fragment_cache.add_tree(tree)
+        elif not file.fragments_source:
+            missing.setdefault(user_id, []).append(file.uuid)
+    # 阶段缓存命中的文件不带片段来源，按 uuid 批量加载
+    for user_id, file_uuids in missing.items():
+        for tree in fragment_tree_cache.load(file_uuids, user_id).values():
+            context.fragment_cache.add_tree(tree)
 
 
 def process_cache(context: Context):
@@ -398,10 +361,10 @@ def get_both_files_by_uuid(context: Context):
                               + [c.file_uuid for c in context.fragment_retrieve_small if isinstance(c, PDocFragmentModel)]
                               + [f.uuid for f in context.locationfiles if context.locationfiles if isinstance(f, PESFileObject)]))
 
-    personal_t = ThreadWithReturnValue(target=get_personal_files_by_uuid, args=(context.params.user_id, personal_uuids))
-    personal_t.start()
+    task_group = TaskGroup("get_both_files_by_uuid")
+    personal_t = task_group.spawn(get_personal_files_by_uuid, context.params.user_id, personal_uuids, stage="file_lookup")
 
-    all_files = get_files_by_uuid(analyst_uuids) + personal_t.join()
+    all_files = get_files_by_uuid(analyst_uuids) + personal_t.result()
 
     return all_files
 
@@ -409,27 +372,34 @@ def get_both_files_by_uuid(context: Context):
 def attach_file_fragments_json(files: list[ESFileObject]):
     uuids = [file.uuid for file in files]
     cache_keys = [f"fragment-{u}" for u in uuids]
-    cached_results = redis_store.mget(cache_keys)
+    cached_results = fragment_blob_flight.do_many(cache_keys, redis_store.mget)
 
     uncached_files = []
     for i, _file in enumerate(files):
         if cached_results[i]:
-            _file.doc_fragments_json = decompress(cached_results[i])
+            _file._fragments_blob = cached_results[i]
 
         else:
             uncached_files.append(_file)
 
-    def _attach_file_fragments_json(_file):
-        fragment_gz, err = Storage.download_content(f"fragments-{_file.uuid}.gz")
+    def _load_file_fragments_blob(_file):
+        fragment_blob, err = Storage.download_content(f"fragments-{_file.uuid}.gz")
         if err:
+            # 没有缓存文件时从 ES 的 doc_fragments_json 生成片段 blob 并回写
             fragment_json = FileES().search_file_fragment_json(_file.uuid)
-            _file.doc_fragments_json = fragment_json
-            if fragment_json:
-                Storage.upload(f"fragments-{_file.uuid}.gz", compress(fragment_json))
-                redis_store.set(f"fragment-{_file.uuid}", compress(fragment_json))
+            if not fragment_json:
+                return None
+            fragment_blob = fragments_blob_from_json(fragment_json)
+            Storage.upload(f"fragments-{_file.uuid}.gz", fragment_blob)
+            redis_store.set(f"fragment-{_file.uuid}", fragment_blob)
         else:
-            _file.doc_fragments_json = decompress(fragment_gz)
-            redis_store.set(f"fragment-{_file.uuid}", fragment_gz)
+            # 片段 blob 或历史 gzip json，构建片段树时按格式读取
+            redis_store.set(f"fragment-{_file.uuid}", fragment_blob)
+        return fragment_blob
+
+    def _attach_file_fragments_json(_file):
+        # 并发请求同一文件时只下载 / 回写一次
+        _file._fragments_blob = fragment_blob_flight.do(f"fragments-{_file.uuid}.gz", lambda: _load_file_fragments_blob(_file))
 
     with TracedThreadPoolExecutor(max_workers=10) as executor:
         futures = [executor.submit(_attach_file_fragments_json, _file) for _file in uncached_files]
@@ -440,27 +410,34 @@ def attach_file_fragments_json(files: list[ESFileObject]):
 def attach_p_file_fragments_json(user_id: str, files: list[PESFileObject]):
     uuids = [file.uuid for file in files]
     cache_keys = [f"fragment-{user_id}-{u}" for u in uuids]
-    cached_results = redis_store.mget(cache_keys)
+    cached_results = fragment_blob_flight.do_many(cache_keys, redis_store.mget)
 
     uncached_files = []
     for i, _file in enumerate(files):
         if cached_results[i]:
-            _file.doc_fragments_json = decompress(cached_results[i])
+            _file._fragments_blob = cached_results[i]
 
         else:
             uncached_files.append(_file)
 
-    def _attach_p_file_fragments_json(_file):
-        fragment_gz, err = Storage.download_content(f"User_{user_id}/fragments-{_file.uuid}.gz")
+    def _load_p_file_fragments_blob(_file):
+        fragment_blob, err = Storage.download_content(f"User_{user_id}/fragments-{_file.uuid}.gz")
         if err:
+            # 没有缓存文件时从 ES 的 doc_fragments_json 生成片段 blob 并回写
             fragment_json = PFileES().search_file_fragment_json(user_id, _file.uuid)
-            _file.doc_fragments_json = fragment_json
-            if fragment_json:
-                Storage.upload(f"User_{user_id}/fragments-{_file.uuid}.gz", compress(fragment_json))
-                redis_store.set(f"fragment-{user_id}-{_file.uuid}", compress(fragment_json), ex=86400 * 30)  # 缓存过期时间为 30天
+            if not fragment_json:
+                return None
+            fragment_blob = fragments_blob_from_json(fragment_json)
+            Storage.upload(f"User_{user_id}/fragments-{_file.uuid}.gz", fragment_blob)
+            redis_store.set(f"fragment-{user_id}-{_file.uuid}", fragment_blob, ex=86400 * 30)  # 缓存过期时间为 30天
         else:
-            _file.doc_fragments_json = decompress(fragment_gz)
-            redis_store.set(f"fragment-{user_id}-{_file.uuid}", fragment_gz, ex=86400 * 30)  # 缓存过期时间为 30天
+            # 片段 blob 或历史 gzip json，构建片段树时按格式读取
+            redis_store.set(f"fragment-{user_id}-{_file.uuid}", fragment_blob, ex=86400 * 30)  # 缓存过期时间为 30天
+        return fragment_blob
+
+    def _attach_p_file_fragments_json(_file):
+        # 并发请求同一文件时只下载 / 回写一次
+        _file._fragments_blob = fragment_blob_flight.do(f"User_{user_id}/fragments-{_file.uuid}.gz", lambda: _load_p_file_fragments_blob(_file))
 
     with TracedThreadPoolExecutor(max_workers=10) as executor:
         futures = [executor.submit(_attach_p_file_fragments_json, _file) for _file in uncached_files]
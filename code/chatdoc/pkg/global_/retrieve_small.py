@@ -2,11 +2,11 @@
 Author: longsion<xianglong_chen@intsig.net>
 Date: 2024-05-23 23:22:47
 LastEditors: longsion
-LastEditTime: 2024-10-14 15:43:33
+LastEditTime: 2026-10-18 23:34:20
 '''
 from pkg.es.es_doc_table import DocTableES, DocTableModel
 from pkg.es.es_doc_fragment import DocFragmentES, DocFragmentModel
-from pkg.embedding.acge_embedding import get_similar_top_n
+from pkg.embedding.keyword_matrix import three_table_key_matrix
 from pkg.es.es_file import ESFileObject
 from pkg.es.es_p_doc_fragment import PDocFragmentES, PDocFragmentModel
 from pkg.es.es_p_doc_table import PDocTableES, PDocTableModel
@@ -14,10 +14,10 @@ from pkg.es.es_p_file import PESFileObject
 from pkg.utils import edit_distance
 from pkg.utils.logger import logger
 from pkg.utils.decorators import register_span_func
-from pkg.structure_static import match_fixed_tables, three_table_key_list
+from pkg.structure_static import match_fixed_tables
 from pkg.config import config
 from pkg.global_.objects import Context, GlobalQAType
-from pkg.utils.thread_with_return_value import ThreadWithReturnValue
+from pkg.utils.task_group import TaskGroup
 
 
 def lambda_func(context: Context):
@@ -45,16 +45,14 @@ def retrieve_small_by_analyst(context: Context) -> Context:
     # 文件三大表召回到了之后之后其他的召回就省略掉
     document_uuids = list(set(document_uuids) - set(fixed_table_file_uuids))
 
-    _normal_table_retrieve_t, _paragraph_retrieve_t = None, None
     if document_uuids:
-        _normal_table_retrieve_t = ThreadWithReturnValue(target=retrieve_by_table, args=(context, document_uuids))
-        _normal_table_retrieve_t.start()
+        # 单路召回超时按空结果降级
+        with TaskGroup("retrieve_small", context=context) as task_group:
+            _normal_table_retrieve_t = task_group.spawn(retrieve_by_table, context, document_uuids, stage="retrieve_table", default=[])
+            _paragraph_retrieve_t = task_group.spawn(retrieve_by_paragraph, context, document_uuids, stage="retrieve_paragraph", default=[])
 
-        _paragraph_retrieve_t = ThreadWithReturnValue(target=retrieve_by_paragraph, args=(context, document_uuids))
-        _paragraph_retrieve_t.start()
-
-        context.normal_table_retrieve_small += _normal_table_retrieve_t.join()
-        context.fragment_retrieve_small += _paragraph_retrieve_t.join()
+        context.normal_table_retrieve_small += _normal_table_retrieve_t.result()
+        context.fragment_retrieve_small += _paragraph_retrieve_t.result()
 
     return context
 
@@ -65,16 +63,14 @@ def retrieve_small_by_personal(context: Context) -> Context:
     if not document_uuids:
         document_uuids = list(set([file.uuid for file in context.files if isinstance(file, PESFileObject)]))
 
-    _normal_table_retrieve_t, _paragraph_retrieve_t = None, None
     if document_uuids:
-        _normal_table_retrieve_t = ThreadWithReturnValue(target=retrieve_by_personal_table, args=(context, document_uuids))
-        _normal_table_retrieve_t.start()
-
-        _paragraph_retrieve_t = ThreadWithReturnValue(target=retrieve_by_personal_paragraph, args=(context, document_uuids))
-        _paragraph_retrieve_t.start()
+        # 单路召回超时按空结果降级
+        with TaskGroup("retrieve_small", context=context) as task_group:
+            _normal_table_retrieve_t = task_group.spawn(retrieve_by_personal_table, context, document_uuids, stage="retrieve_table", default=[])
+            _paragraph_retrieve_t = task_group.spawn(retrieve_by_personal_paragraph, context, document_uuids, stage="retrieve_paragraph", default=[])
 
-        context.normal_table_retrieve_small += _normal_table_retrieve_t.join()
-        context.fragment_retrieve_small += _paragraph_retrieve_t.join()
+        context.normal_table_retrieve_small += _normal_table_retrieve_t.result()
+        context.fragment_retrieve_small += _paragraph_retrieve_t.result()
 
     return context
 
@@ -87,10 +83,10 @@ def retrieve_small(context: Context) -> Context:
     elif context.params.qa_type == GlobalQAType.PERSONAL.value:
         context = retrieve_small_by_personal(context)
     else:
-        personal_t = ThreadWithReturnValue(target=retrieve_small_by_personal, args=(context,))
-        personal_t.start()
-        context = retrieve_small_by_analyst(context)
-        context = personal_t.join()
+        with TaskGroup("retrieve_small", context=context) as task_group:
+            personal_t = task_group.spawn(retrieve_small_by_personal, context)
+            context = retrieve_small_by_analyst(context)
+            context = personal_t.result()
 
     return context
 
@@ -103,7 +99,7 @@ def retrieve_by_fixed_table(context: Context, document_uuids: list[str]) -> list
 
     keyword = context.question_analysis.keywords[0]
     # """语义匹配top1"""
-    top1 = get_similar_top_n(three_table_key_list, keyword)
+    top1 = three_table_key_matrix.top_n(keyword)
     if not top1:
         logger.warning(f"Fixed Table Agent 匹配不到关键词对应的表格，keyword: {keyword}")
         return empty_list
@@ -138,18 +134,11 @@ def retrieve_by_table(context: Context, document_uuids: list[str]) -> list[DocTa
         size = min(4 * len(files), 10)
     else:
         size = 10
-    doc_table_items: list[DocTableModel] = []
-    threads = []
-    for keyword in context.question_analysis.keywords:
-        t = ThreadWithReturnValue(target=DocTableES().search_table, kwargs=dict(bm25_text=keyword,
-                                                                                ebd_text=context.question_analysis.retrieve_question if document_uuids != [] else context.params.question,
-                                                                                document_uuids=document_uuids,
-                                                                                size=size))
-        t.start()
-        threads.append(t)
-
-    for t in threads:
-        doc_table_items.extend(t.join())
+    # 所有关键词合并为一次 _msearch
+    doc_table_items: list[DocTableModel] = DocTableES().search_tables(bm25_texts=context.question_analysis.keywords,
+                                                                      ebd_text=context.question_analysis.retrieve_question if document_uuids != [] else context.params.question,
+                                                                      document_uuids=document_uuids,
+                                                                      size=size)
     return doc_table_items
 
 
@@ -179,20 +168,12 @@ def retrieve_by_personal_table(context: Context, document_uuids: list[str]) -> l
     else:
         size = 10
 
-    doc_table_items: list[PDocTableModel] = []
-    threads = []
-    for keyword in context.question_analysis.keywords:
-        t = ThreadWithReturnValue(target=PDocTableES().search_table, kwargs=dict(bm25_text=keyword,
-                                                                                 ebd_text=context.question_analysis.retrieve_question if document_uuids != [] else context.params.question,
-                                                                                 document_uuids=document_uuids,
-                                                                                 user_id=context.params.user_id,
-                                                                                 size=size,
-                                                                                 ))
-        t.start()
-        threads.append(t)
-
-    for t in threads:
-        doc_table_items.extend(t.join())
+    # 所有关键词合并为一次 _msearch
+    doc_table_items: list[PDocTableModel] = PDocTableES().search_tables(bm25_texts=context.question_analysis.keywords,
+                                                                        ebd_text=context.question_analysis.retrieve_question if document_uuids != [] else context.params.question,
+                                                                        document_uuids=document_uuids,
+                                                                        user_id=context.params.user_id,
+                                                                        size=size)
     return doc_table_items
 
 
@@ -2,7 +2,7 @@
 Author: longsion<xianglong_chen@intsig.net>
 Date: 2024-10-08 16:11:24
 LastEditors: longsion
-LastEditTime: 2024-10-08 19:17:02
+LastEditTime: 2026-10-18 23:34:20
 '''
 
 import re
@@ -15,7 +15,13 @@ from pkg.es.es_p_doc_table import PDocTableES, PDocTableModel
 from pkg.es.es_p_file import PESFileObject
 from pkg.utils.decorators import register_span_func
 from pkg.global_.objects import Context, GlobalQAType
-from pkg.utils.thread_with_return_value import ThreadWithReturnValue
+from pkg.config import config
+from pkg.utils.logger import logger
+from pkg.utils.metrics import global_metrics
+from pkg.utils.task_group import TaskGroup
+
+
+speculative_retrieve_total = global_metrics.counter("speculative_retrieve_total", "Speculative paragraph retrieval outcome (hit/miss)")
 
 
 def lambda_func(context: Context):
@@ -33,14 +39,13 @@ def lambda_func(context: Context):
 def retrieve_small_full_by_analyst(context: Context) -> Context:
     document_uuids = []
     # 没有选中文件时，进行全局检索，只使用段落召回与表格召回
-    _normal_table_retrieve_l = ThreadWithReturnValue(target=retrieve_by_table, args=(context, document_uuids))
-    _normal_table_retrieve_l.start()
-
-    _paragraph_retrieve_l = ThreadWithReturnValue(target=retrieve_by_paragraph, args=(context, document_uuids))
-    _paragraph_retrieve_l.start()
+    # 单路召回超时按空结果降级
+    with TaskGroup("retrieve_small_full", context=context) as task_group:
+        _normal_table_retrieve_l = task_group.spawn(retrieve_by_table, context, document_uuids, stage="retrieve_table", default=[])
+        _paragraph_retrieve_l = task_group.spawn(retrieve_by_paragraph, context, document_uuids, stage="retrieve_paragraph", default=[])
 
-    normal_table_retrieve_small = _normal_table_retrieve_l.join()
-    fragment_retrieve_small = _paragraph_retrieve_l.join()
+    normal_table_retrieve_small = _normal_table_retrieve_l.result()
+    fragment_retrieve_small = _paragraph_retrieve_l.result()
 
     # 过滤召回内容
     files = [file for file in context.locationfiles]
@@ -70,14 +75,13 @@ def retrieve_small_full_by_personal(context: Context) -> Context:
     # 如果文件存在
     document_uuids = []
     # 没有选中文件时，进行全局检索，只使用段落召回与表格召回
-    _normal_table_retrieve_l = ThreadWithReturnValue(target=retrieve_by_personal_table, args=(context, document_uuids))
-    _normal_table_retrieve_l.start()
+    # 单路召回超时按空结果降级
+    with TaskGroup("retrieve_small_full", context=context) as task_group:
+        _normal_table_retrieve_l = task_group.spawn(retrieve_by_personal_table, context, document_uuids, stage="retrieve_table", default=[])
+        _paragraph_retrieve_l = task_group.spawn(retrieve_by_personal_paragraph, context, document_uuids, stage="retrieve_paragraph", default=[])
 
-    _paragraph_retrieve_l = ThreadWithReturnValue(target=retrieve_by_personal_paragraph, args=(context, document_uuids))
-    _paragraph_retrieve_l.start()
-
-    normal_table_retrieve_small = _normal_table_retrieve_l.join()
-    fragment_retrieve_small = _paragraph_retrieve_l.join()
+    normal_table_retrieve_small = _normal_table_retrieve_l.result()
+    fragment_retrieve_small = _paragraph_retrieve_l.result()
 
     # 过滤召回内容
     files = [file for file in context.locationfiles]
@@ -103,6 +107,48 @@ def retrieve_small_full_by_personal(context: Context) -> Context:
     return context
 
 
+def speculate_retrieve_small_full(context: Context, task_group: TaskGroup):
+    '''
+    推测召回：preprocess_question 之前用原始问题提前发起全局段落召回（BM25 + 向量）
+    未定位到文件时全局段落召回的参数与原始问题一致，预处理结束后直接复用；参数不一致则取消并按分析结果重新召回
+    表格召回依赖 UIE 抽取的关键词，不参与推测
+    '''
+    if not config["retrieve"].get("speculative", True):
+        return
+
+    document_uuids, size = [], 25
+    question = context.params.question
+    if context.params.qa_type != GlobalQAType.PERSONAL.value:
+        context.speculative_retrieve["paragraph"] = (
+            (question, document_uuids, size),
+            task_group.spawn(search_paragraph, question, document_uuids, size, stage="retrieve_paragraph", default=[]),
+        )
+    if context.params.qa_type != GlobalQAType.ANALYST.value:
+        context.speculative_retrieve["personal_paragraph"] = (
+            (question, document_uuids, size),
+            task_group.spawn(search_personal_paragraph, question, document_uuids, size, context.params.user_id, stage="retrieve_paragraph", default=[]),
+        )
+
+
+def take_speculative_retrieve(context: Context, name: str, key: tuple):
+    '''
+    取出推测召回结果，参数与实际召回一致时返回结果，否则取消推测任务并返回 None
+    '''
+    speculative = context.speculative_retrieve.pop(name, None)
+    if speculative is None:
+        return None
+
+    speculative_key, task = speculative
+    if speculative_key != key:
+        task.cancel()
+        speculative_retrieve_total.inc(name=name, outcome="miss")
+        logger.info(f"speculative retrieve {name} miss, refine with question analysis")
+        return None
+
+    speculative_retrieve_total.inc(name=name, outcome="hit")
+    return task.result()
+
+
 @register_span_func(func_name="多路召回Full", span_export_func=lambda context: lambda_func(context))
 def retrieve_small_full(context: Context) -> Context:
     if context.params.qa_type == GlobalQAType.ANALYST.value:
@@ -110,10 +156,10 @@ def retrieve_small_full(context: Context) -> Context:
     elif context.params.qa_type == GlobalQAType.PERSONAL.value:
         context = retrieve_small_full_by_personal(context)
     else:
-        personal_t = ThreadWithReturnValue(target=retrieve_small_full_by_personal, args=(context,))
-        personal_t.start()
-        context = retrieve_small_full_by_analyst(context)
-        context = personal_t.join()
+        with TaskGroup("retrieve_small_full", context=context) as task_group:
+            personal_t = task_group.spawn(retrieve_small_full_by_personal, context)
+            context = retrieve_small_full_by_analyst(context)
+            context = personal_t.result()
 
     return context
 
@@ -127,18 +173,11 @@ def retrieve_by_table(context: Context, document_uuids: list[str]) -> list[DocTa
         size = min(4 * len(files), 10)
     else:
         size = 10
-    doc_table_items: list[DocTableModel] = []
-    threads = []
-    for keyword in context.question_analysis.keywords:
-        t = ThreadWithReturnValue(target=DocTableES().search_table, kwargs=dict(bm25_text=keyword,
-                                                                                ebd_text=context.question_analysis.retrieve_question if document_uuids != [] else context.params.question,
-                                                                                document_uuids=document_uuids,
-                                                                                size=size))
-        t.start()
-        threads.append(t)
-
-    for t in threads:
-        doc_table_items.extend(t.join())
+    # 所有关键词合并为一次 _msearch
+    doc_table_items: list[DocTableModel] = DocTableES().search_tables(bm25_texts=context.question_analysis.keywords,
+                                                                      ebd_text=context.question_analysis.retrieve_question if document_uuids != [] else context.params.question,
+                                                                      document_uuids=document_uuids,
+                                                                      size=size)
     return doc_table_items
 
 
@@ -151,10 +190,20 @@ def retrieve_by_paragraph(context: Context, document_uuids: list[str]) -> list[D
         size = min(20 * len(files), 25)
     else:
         size = 25
-    doc_fragment_items: list[DocFragmentModel] = DocFragmentES().search_fragment(bm25_text=context.question_analysis.retrieve_question if document_uuids != [] else context.params.question,
-                                                                                 ebd_text=context.question_analysis.retrieve_question if document_uuids != [] else context.params.question,
+    question = context.question_analysis.retrieve_question if document_uuids != [] else context.params.question
+    # 与推测召回参数一致时直接复用
+    doc_fragment_items = take_speculative_retrieve(context, "paragraph", (question, document_uuids, size))
+    if doc_fragment_items is None:
+        doc_fragment_items = search_paragraph(question, document_uuids, size)
+    return doc_fragment_items
+
+
+def search_paragraph(question: str, document_uuids: list[str], size: int) -> list[DocFragmentModel]:
+    doc_fragment_items: list[DocFragmentModel] = DocFragmentES().search_fragment(bm25_text=question,
+                                                                                 ebd_text=question,
                                                                                  document_uuids=document_uuids,
-                                                                                 size=size)
+                                                                                 size=size,
+                                                                                 num_candidates=int(config["retrieve"].get("global_knn_num_candidates") or 0))
     return doc_fragment_items
 
 
@@ -168,19 +217,12 @@ def retrieve_by_personal_table(context: Context, document_uuids: list[str]) -> l
     else:
         size = 10
 
-    doc_table_items: list[PDocTableModel] = []
-    threads = []
-    for keyword in context.question_analysis.keywords:
-        t = ThreadWithReturnValue(target=PDocTableES().search_table, kwargs=dict(bm25_text=keyword,
-                                                                                 ebd_text=context.question_analysis.retrieve_question if document_uuids != [] else context.params.question,
-                                                                                 document_uuids=document_uuids,
-                                                                                 size=size,
-                                                                                 user_id=context.params.user_id))
-        t.start()
-        threads.append(t)
-
-    for t in threads:
-        doc_table_items.extend(t.join())
+    # 所有关键词合并为一次 _msearch
+    doc_table_items: list[PDocTableModel] = PDocTableES().search_tables(bm25_texts=context.question_analysis.keywords,
+                                                                        ebd_text=context.question_analysis.retrieve_question if document_uuids != [] else context.params.question,
+                                                                        document_uuids=document_uuids,
+                                                                        size=size,
+                                                                        user_id=context.params.user_id)
     return doc_table_items
 
 
@@ -193,11 +235,21 @@ def retrieve_by_personal_paragraph(context: Context, document_uuids: list[str])
         size = min(20 * len(files), 25)
     else:
         size = 25
-    doc_fragment_items: list[PDocFragmentModel] = PDocFragmentES().search_fragment(bm25_text=context.question_analysis.retrieve_question if document_uuids != [] else context.params.question,
-                                                                                   ebd_text=context.question_analysis.retrieve_question if document_uuids != [] else context.params.question,
+    question = context.question_analysis.retrieve_question if document_uuids != [] else context.params.question
+    # 与推测召回参数一致时直接复用
+    doc_fragment_items = take_speculative_retrieve(context, "personal_paragraph", (question, document_uuids, size))
+    if doc_fragment_items is None:
+        doc_fragment_items = search_personal_paragraph(question, document_uuids, size, context.params.user_id)
+    return doc_fragment_items
+
+
+def search_personal_paragraph(question: str, document_uuids: list[str], size: int, user_id: str) -> list[PDocFragmentModel]:
+    doc_fragment_items: list[PDocFragmentModel] = PDocFragmentES().search_fragment(bm25_text=question,
+                                                                                   ebd_text=question,
                                                                                    document_uuids=document_uuids,
                                                                                    size=size,
-                                                                                   user_id=context.params.user_id)
+                                                                                   user_id=user_id,
+                                                                                   num_candidates=int(config["retrieve"].get("global_knn_num_candidates") or 0))
     return doc_fragment_items
 
 
@@ -2,13 +2,13 @@
 Author: longsion<xianglong_chen@intsig.net>
 Date: 2024-05-30 17:03:20
 LastEditors: longsion
-LastEditTime: 2024-10-14 15:43:40
+LastEditTime: 2026-10-18 20:58:40
 '''
 
 
 from pkg.es.es_doc_fragment import DocFragmentModel
 from pkg.es.es_p_doc_fragment import PDocFragmentModel
-from pkg.global_.common import fillin_doc_items_cache, fillin_fragment_children_cache, fillin_fragment_parent_cache, fillin_personal_doc_items_cache, fillin_personal_fragment_children_cache, fillin_personal_fragment_parent_cache, get_fragment_all_texts, get_fragment_ori_ids, get_fragment_ori_text
+from pkg.global_.common import fillin_doc_items_cache, fillin_fragment_children_cache, fillin_fragment_parent_cache, fillin_materialized_fragments, fillin_personal_doc_items_cache, fillin_personal_fragment_children_cache, fillin_personal_fragment_parent_cache, fillin_personal_materialized_fragments, get_fragment_all_texts, get_fragment_ori_ids, get_fragment_ori_text
 from pkg.global_.objects import Context, RetrieveContext, RetrieveType
 from pkg.utils.decorators import register_span_func
 from pkg.utils import group_by_func
@@ -42,12 +42,15 @@ def small2big(context: Context) -> Context:
     if analyst_fragments:
         fillin_fragment_parent_cache(context.fragment_cache, analyst_fragments, level=1)
         parent_fragments = [context.fragment_cache[para_fragment.parent_frament_uuid] for para_fragment in analyst_fragments if para_fragment.parent_frament_uuid]
+        # 父节点优先使用入库时物化的子树原文，未物化的再补齐子节点与原文
+        parent_fragments = fillin_materialized_fragments(context.fragment_cache, parent_fragments)
         uuid_ori_tuple_list = fillin_fragment_children_cache(context.fragment_cache, parent_fragments)
         fillin_doc_items_cache(context.doc_items_cache, uuid_ori_tuple_list)
 
     if personal_fragments:
         fillin_personal_fragment_parent_cache(context.fragment_cache, personal_fragments, level=1)
         parent_fragments = [context.fragment_cache[para_fragment.parent_frament_uuid] for para_fragment in personal_fragments if para_fragment.parent_frament_uuid]
+        parent_fragments = fillin_personal_materialized_fragments(context.fragment_cache, parent_fragments)
         uuid_ori_tuple_list = fillin_personal_fragment_children_cache(context.fragment_cache, parent_fragments)
         fillin_personal_doc_items_cache(context.p_doc_items_cache, context.params.user_id, uuid_ori_tuple_list)
 
@@ -2,8 +2,9 @@ import time
 import requests
 from pkg.config import config
 from pkg.llm.template_manager import TemplateManager
-from pkg.llm.util import result_generator
+from pkg.llm.util import async_result_generator, result_generator
 from pkg.utils import retry_exponential_backoff
+from pkg.utils.aio import get_async_http_client
 from pkg.utils.logger import logger
 
 
@@ -17,8 +18,7 @@ class DeepseekAPIInterface(object):
         self.model = config["deepseek"]["model"]
         self.api_key = config["deepseek"]["api_key"]
 
-    @retry_exponential_backoff()
-    def server_request(self, prompt, system_message=None, stream=False):
+    def _build_request(self, prompt, system_message=None, stream=False):
         headers = {
             "Content-Type": "application/json",
             "Authorization": f"Bearer {self.api_key}",
@@ -37,6 +37,22 @@ class DeepseekAPIInterface(object):
             ],
             "stream": stream
         }
+        return headers, ip_data
+
+    def _get_chunk_data_func(self):
+        print_request_id = False
+
+        def get_chunk_data(chunk_json):
+            nonlocal print_request_id
+            if not print_request_id:
+                logger.info(f'deepseek request_id: {chunk_json["id"]}')
+                print_request_id = True
+            return chunk_json
+        return get_chunk_data
+
+    @retry_exponential_backoff()
+    def server_request(self, prompt, system_message=None, stream=False):
+        headers, ip_data = self._build_request(prompt, system_message=system_message, stream=stream)
 
         start_time = time.time()
         op_data = requests.post(self.url, json=ip_data, headers=headers, stream=stream)
@@ -46,15 +62,31 @@ class DeepseekAPIInterface(object):
             choices = op_data.json().get("choices", [])
             return choices[0]["message"]["content"]
         else:
-            print_request_id = False
-
-            def get_chunk_data(chunk_json):
-                nonlocal print_request_id
-                if not print_request_id:
-                    logger.info(f'deepseek request_id: {chunk_json["id"]}')
-                    print_request_id = True
-                return chunk_json
-            return result_generator(start_time, op_data, get_chunk_data=get_chunk_data)
+            return result_generator(start_time, op_data, get_chunk_data=self._get_chunk_data_func())
+
+    @retry_exponential_backoff()
+    async def async_server_request(self, prompt, system_message=None):
+        """
+        流式请求的异步版本，返回异步生成器
+        """
+        headers, ip_data = self._build_request(prompt, system_message=system_message, stream=True)
+        client = get_async_http_client()
+
+        start_time = time.time()
+        request = client.build_request("POST", self.url, json=ip_data, headers=headers)
+        op_data = await client.send(request, stream=True)
+        if op_data.status_code != 200:
+            await op_data.aread()
+            await op_data.aclose()
+            raise Exception(f"Deepseek API call error, status_code:{op_data.status_code}, msg: {op_data.text}")
+
+        async def _iter():
+            try:
+                async for x in async_result_generator(start_time, op_data.aiter_bytes(), get_chunk_data=self._get_chunk_data_func()):
+                    yield x
+            finally:
+                await op_data.aclose()
+        return _iter()
 
 
 if __name__ == '__main__':
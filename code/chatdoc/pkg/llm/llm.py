@@ -2,7 +2,7 @@
 Author: longsion<xianglong_chen@intsig.net>
 Date: 2024-02-27 15:18:43
 LastEditors: longsion
-LastEditTime: 2024-10-14 18:07:49
+LastEditTime: 2026-10-18 16:20:37
 '''
 
 from pkg.config import config
@@ -18,6 +18,7 @@ from pkg.llm.gpt import GPT
 from pkg.llm.tyqw_api import tyqwAPIInterface
 from pkg.llm.chat_glm import ChatGlmInterface
 from pkg.utils import log_msg
+from pkg.utils.aio import aiter_sync, run_sync
 
 
 class LLM:
@@ -63,6 +64,26 @@ class LLM:
         else:
             return self._gpt(prompt, system_message=system_message, stream=stream)
 
+    async def achat(self, prompt, system_message=TemplateManager().get_template('qa_system').format(), stream=None):
+        """
+        chat 的异步版本：流式返回异步生成器
+        支持异步请求的模型直接在事件循环中读取流；其余模型在任务线程池中请求，再逐块转为异步迭代
+        """
+        model = self.get_model()
+        async_backend = {
+            "tyqw": self._tyqw,
+            "deepseek": self._deepseek_api,
+        }.get(model)
+
+        if stream and async_backend is not None:
+            logger.info(f"llm_model: {model}, model: {config.get(model, {}).get('model')}, prompt len: {len(prompt)}, async stream")
+            return await async_backend.async_server_request(prompt, system_message=system_message)
+
+        answer_or_iterator = await run_sync(self.chat, prompt, system_message=system_message, stream=stream)
+        if isinstance(answer_or_iterator, str):
+            return answer_or_iterator
+        return aiter_sync(iter(answer_or_iterator))
+
 
 if __name__ == '__main__':
     prompt = """
@@ -2,7 +2,7 @@
 Author: longsion<xianglong_chen@intsig.net>
 Date: 2024-02-27 14:14:11
 LastEditors: longsion
-LastEditTime: 2024-02-27 15:56:31
+LastEditTime: 2026-10-18 16:20:37
 '''
 
 import time
@@ -10,7 +10,8 @@ import tenacity
 import requests
 from pkg.config import config
 from pkg.llm.template_manager import TemplateManager
-from pkg.llm.util import result_generator
+from pkg.llm.util import async_result_generator, result_generator
+from pkg.utils.aio import get_async_http_client
 
 
 class tyqwInterface(object):
@@ -22,11 +23,8 @@ class tyqwInterface(object):
         self.url = config["tyqw"]["url"]
         self.model = config["tyqw"]["model"]
 
-    @tenacity.retry(wait=tenacity.wait_exponential(multiplier=1, min=5, max=15),
-                    stop=tenacity.stop_after_attempt(max_attempt_number=5),
-                    reraise=True)
-    def server_request(self, prompt, system_message=None, stream=False):
-        ip_data = {
+    def _build_request(self, prompt, system_message=None, stream=False):
+        return {
             "model": self.model,
             "stream": stream,
             "messages": [
@@ -34,6 +32,12 @@ class tyqwInterface(object):
                 {"role": "user", "content": prompt}
             ]
         }
+
+    @tenacity.retry(wait=tenacity.wait_exponential(multiplier=1, min=5, max=15),
+                    stop=tenacity.stop_after_attempt(max_attempt_number=5),
+                    reraise=True)
+    def server_request(self, prompt, system_message=None, stream=False):
+        ip_data = self._build_request(prompt, system_message=system_message, stream=stream)
         start_time = time.time()
         op_data = requests.post(self.url, json=ip_data, stream=stream)
         if op_data.status_code != 200:
@@ -46,6 +50,29 @@ class tyqwInterface(object):
         else :
             return result_generator(start_time, op_data)
 
+    async def async_server_request(self, prompt, system_message=None):
+        """
+        流式请求的异步版本，返回异步生成器
+        """
+        ip_data = self._build_request(prompt, system_message=system_message, stream=True)
+        client = get_async_http_client()
+
+        start_time = time.time()
+        request = client.build_request("POST", self.url, json=ip_data)
+        op_data = await client.send(request, stream=True)
+        if op_data.status_code != 200:
+            await op_data.aread()
+            await op_data.aclose()
+            raise Exception(f"Tyqw call error, status_code:{op_data.status_code}, msg: {op_data.text}")
+
+        async def _iter():
+            try:
+                async for x in async_result_generator(start_time, op_data.aiter_bytes()):
+                    yield x
+            finally:
+                await op_data.aclose()
+        return _iter()
+
 
 if __name__ == '__main__':
     tyqw = tyqwInterface()
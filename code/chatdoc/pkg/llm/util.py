@@ -28,20 +28,26 @@ def set_stream_json(json_data):
     return set_stream_data(json.dumps(json_data, ensure_ascii=False))
 
 
-def result_generator(start_time, result, format_func=None, get_chunk_data=None):
-    chunk_bytes = b''
-    chunk_str = ''
-    pre_message = ''
-    stream_contents = []
-    first_input_time: int = None
-
-    def handle_chunk(chunk_one_str):
-        nonlocal pre_message
-        nonlocal stream_contents
+class StreamParser:
+    '''
+    按 SSE 分隔解析 LLM 流式返回的字节块，同步与异步生成器共用
+    '''
+
+    def __init__(self, start_time, format_func=None, get_chunk_data=None):
+        self.start_time = start_time
+        self.format_func = format_func
+        self.get_chunk_data = get_chunk_data
+        self.chunk_bytes = b''
+        self.chunk_str = ''
+        self.pre_message = ''
+        self.stream_contents = []
+        self.first_input_time: int = None
+
+    def handle_chunk(self, chunk_one_str):
         try:
             chunk_json = json.loads(chunk_one_str)  # parse the chunk
-            if get_chunk_data:
-                chunk_json = get_chunk_data(chunk_json)
+            if self.get_chunk_data:
+                chunk_json = self.get_chunk_data(chunk_json)
         except Exception:
             return None
         data = None
@@ -55,60 +61,84 @@ def result_generator(start_time, result, format_func=None, get_chunk_data=None):
                 delta_message = chunk_json["choices"][0]["delta"].get("content", "")
             else:
                 total_message = chunk_json["choices"][0].get("message", {}).get("content", "")
-                delta_message = re.sub(fr"^{pre_message}", "", total_message)
-                pre_message = total_message
+                delta_message = re.sub(fr"^{self.pre_message}", "", total_message)
+                self.pre_message = total_message
 
             data = {"content": delta_message, "status": "DOING"}
 
-        chunk_time = time.time() - start_time
-        stream_contents.append((delta_message, f"{1000*chunk_time:.1f}ms"))
+        chunk_time = time.time() - self.start_time
+        self.stream_contents.append((delta_message, f"{1000*chunk_time:.1f}ms"))
         # logger.info(f"Stream message received {chunk_time:.3f} seconds after request: {json.dumps(data, ensure_ascii=False)}")
         return data
 
-    fixed_prefix = stream_fixed_prefix.strip()
+    def feed(self, chunk) -> list[str]:
+        fixed_prefix = stream_fixed_prefix.strip()
+        outputs = []
 
-    for chunk in result:
         if type(chunk) is str:
             chunk = chunk.encode("utf-8")
-        chunk_bytes += chunk
+        self.chunk_bytes += chunk
         try:
             # errors='ignore' 忽略解码错误，解决乱码问题
-            chunk_str = chunk_bytes.decode('utf-8', errors='ignore')
-            if format_func:
-                chunk_str = format_func(chunk_str)
+            self.chunk_str = self.chunk_bytes.decode('utf-8', errors='ignore')
+            if self.format_func:
+                self.chunk_str = self.format_func(self.chunk_str)
         except Exception as e:
             logger.error(f"Decode chunk error: {e}")
             # chunk_bytes 为json一部分，可能会出现解码错误，发生错误后继续拼接，可以忽略
-            continue
-        while fixed_prefix in chunk_str:
-            temp_list = chunk_str.split(fixed_prefix)
+            return outputs
+        while fixed_prefix in self.chunk_str:
+            temp_list = self.chunk_str.split(fixed_prefix)
             if temp_list[0]:
-                data = handle_chunk(temp_list[0])
-                if not first_input_time:
-                    first_input_time = time.time()
+                data = self.handle_chunk(temp_list[0])
+                if not self.first_input_time:
+                    self.first_input_time = time.time()
                 if data:
                     data["status"] = "DOING"
-                    yield set_stream_json(data)
-            chunk_str = ''.join(temp_list[1:])
-            chunk_bytes = chunk_str.encode("utf-8")
+                    outputs.append(set_stream_json(data))
+            self.chunk_str = ''.join(temp_list[1:])
+            self.chunk_bytes = self.chunk_str.encode("utf-8")
+        return outputs
+
+    def finish(self) -> list[str]:
+        outputs = []
+        if self.chunk_str:
+            data = self.handle_chunk(self.chunk_str)
+            if data:
+                data["status"] = "DOING"
+                outputs.append(set_stream_json(data))
+
+        chunk_time = time.time() - self.start_time
+        logger.info(f"Stream messages received: {self.stream_contents}")
+        logger.info(f"Finally Stream message received {chunk_time*1000:.1f}ms after request, answer_len: {sum([len(x[0]) for x in self.stream_contents])}")
+        if not self.first_input_time:
+            self.first_input_time = time.time()
+        logger.info(f"Stream message Total time: {1000*(time.time() - self.first_input_time):.1f}ms")
+
+        # 手动触发停止
+        data = {"content": "", "status": "DONE"}
+        outputs.append(set_stream_json(data))
+        outputs.append(stream_fixes_suffix)
+        return outputs
 
-    if chunk_str:
-        data = handle_chunk(chunk_str)
-        if data:
-            data["status"] = "DOING"
-            yield set_stream_json(data)
 
-    chunk_time = time.time() - start_time
-    logger.info(f"Stream messages received: {stream_contents}")
-    logger.info(f"Finally Stream message received {chunk_time*1000:.1f}ms after request, answer_len: {sum([len(x[0]) for x in stream_contents])}")
-    if not first_input_time:
-        first_input_time = time.time()
-    logger.info(f"Stream message Total time: {1000*(time.time() - first_input_time):.1f}ms")
+def result_generator(start_time, result, format_func=None, get_chunk_data=None):
+    parser = StreamParser(start_time, format_func=format_func, get_chunk_data=get_chunk_data)
+    for chunk in result:
+        yield from parser.feed(chunk)
+    yield from parser.finish()
+
 
-    # 手动触发停止
-    data = {"content": "", "status": "DONE"}
-    yield set_stream_json(data)
-    yield stream_fixes_suffix
+async def async_result_generator(start_time, result, format_func=None, get_chunk_data=None):
+    '''
+    result: 异步字节流，如 httpx.Response.aiter_bytes()
+    '''
+    parser = StreamParser(start_time, format_func=format_func, get_chunk_data=get_chunk_data)
+    async for chunk in result:
+        for x in parser.feed(chunk):
+            yield x
+    for x in parser.finish():
+        yield x
 
 
 def check_repetition(text, delta_text):
@@ -189,3 +219,52 @@ def remove_repetition(text, delta_text):
 #     "2023年，公司实现营业收入195,163.02万元，同比增长14.95%。其中，汽车流体管路及总成营业收入129,331.39万元，同比增长6.53%；汽车密封部件及总成营业收入63,656.19万元，同比增长36.99%。公司营业收入的增长主要得益于汽车流体管路及总成和汽车密封部件及总成营业收入的增长。公司营业收入的增长主要得益于汽车流体管路及总成和汽车密封部件及总成营业收入的增长。公司营业收入的增长主要得益于汽车流体管路及总成和汽车密封部件及总成营业收入的增长。公司营业收入的增长主要得益于汽车流体管路及总成和汽车密封部件及总成营业收入的增长。公司营业收入的增长主要得益于汽车流体管路及总成和汽车密封部件及总成营业收入的增长。",
 #     "公司营业收入的增长主要"
 # ))
+
+
+async def async_answer_stream(context, on_done):
+    '''
+    asyncio 模式下处理 LLM 流式输出，与各 process 中 _after_generation 逻辑一致
+    on_done: async (context) -> Response
+    '''
+    answer_text = ""
+    first_ts, last_ts = -1, -1
+    async for x in context.stream_aiter:
+        if not answer_text:
+            first_ts = time.time()
+            context.durations.update(
+                首token=f"{(first_ts - context.start_ts) * 1000:.1f}ms"
+            )
+            logger.info(f"首token duration: {context.durations['首token']}")
+
+        if x == stream_fixes_suffix:
+            last_ts = time.time()
+            context.durations.update(
+                尾token=f"{(last_ts - context.start_ts) * 1000:.1f}ms",
+                token速率=f"{len(answer_text)/(last_ts-first_ts):.1f} token/s"
+            )
+            logger.info(f"尾token duration: {context.durations['尾token']}, token速率: {context.durations['token速率']}, ")
+
+            yield x
+            break
+        x_json = get_stream_json(x)
+        if x_json["status"] == "DONE":
+            context.llm_answer = answer_text
+            response = await on_done(context)
+            x_json.update(data=response.model_dump_json())
+            yield set_stream_json(x_json)
+        elif x != stream_fixes_suffix and check_repetition(answer_text, x_json["content"]):
+            context.llm_answer = remove_repetition(answer_text, x_json["content"])
+            response = await on_done(context)
+            x_json.update(data=response.model_dump_json(), status="DONE")
+            yield set_stream_json(x_json)
+            last_ts = time.time()
+            context.durations.update(
+                尾token=f"{(last_ts - context.start_ts) * 1000:.1f}ms",
+                token速率=f"{len(answer_text)/(last_ts-first_ts):.1f} token/s"
+            )
+            logger.info(f"尾token duration: {context.durations['尾token']}, token速率: {context.durations['token速率']}, ")
+            yield stream_fixes_suffix
+            break
+        else:
+            answer_text += x_json["content"] if x != stream_fixes_suffix else ""
+            yield x
@@ -0,0 +1,268 @@
+'''
+Author: longsion<xianglong_chen@intsig.net>
+Date: 2026-10-18 21:41:37
+LastEditors: longsion
+LastEditTime: 2026-10-18 22:31:05
+'''
+
+# 按文件的原文段（ori item segment）：入库时把 doc_ori_items 按顺序写成一个二进制文件存入 Storage，
+# 问答时按 ori_id 直接切片取原文，不再逐条请求 ES 原文索引
+# - 文件名: ori-{file_uuid}.seg，个人库 User_{user_id}/ori-{file_uuid}.seg
+# - 布局: 4096 字节文件头（magic + 头长度 + json 头）| keys int64[k] | items int64[n, 4] | rows int32[k] | data
+#   keys 为 ori_id 按 (页, 序号) 编码的 int64（同片段树 ori_id_key），升序排列，rows[i] 为 keys[i] 所在原文的行号，跨页原文每个 ori_id 各一条
+#   items 每行为 (meta 偏移, meta 长度, content 偏移, content 长度)，偏移相对 data 起始；meta 为 {"titles", "ori_id", "type"} 的 json
+# - 本地存储 mmap 后在 memoryview 上切片解码；远程存储用 Range 请求读取索引与所需片段（相邻片段合并为一次请求）
+# - 进程内按 文件 + 文件版本号（stage_cache.file_versions）缓存打开的段，LRU 淘汰或收到失效消息后由 GC 释放 mmap；不存在的段同样缓存，历史文件回退到 ES 原文索引
+
+import json
+import mmap
+import os
+import struct
+from typing import Optional
+
+import numpy as np
+
+from pkg.config import config
+from pkg.es.fragment_tree import ori_id_key
+from pkg.redis.invalidation_bus import FileKeyIndex, invalidation_bus
+from pkg.redis.stage_cache import stage_cache
+from pkg.storage import Storage
+from pkg.utils.logger import logger
+from pkg.utils.lru_cache import ShardedLRUCacheDict
+from pkg.utils.metrics import global_metrics
+
+
+ori_segment_items = global_metrics.counter("ori_segment_items_total", "Doc item lookups served by ori item segments or falling back to ES")
+
+MAGIC = b"CDORI001"
+HEADER_SIZE = 4096
+# 远程读取时间隔小于该值的片段合并为一次 Range 请求
+RANGE_MERGE_GAP = 64 * 1024
+
+
+def segment_filename(file_uuid: str, user_id: Optional[str] = None) -> str:
+    if user_id:
+        return f"User_{user_id}/ori-{file_uuid}.seg"
+    return f"ori-{file_uuid}.seg"
+
+
+def build_segment(items: list[dict]) -> bytes:
+    '''
+    items: 按文档顺序的 [{"titles", "ori_id", "content", "type"}]
+    '''
+    data = bytearray()
+    records = np.zeros((len(items), 4), dtype=np.int64)
+    key_rows = {}
+    for row, item in enumerate(items):
+        meta = json.dumps(dict(titles=item["titles"], ori_id=item["ori_id"], type=item["type"]), ensure_ascii=False).encode("utf-8")
+        content = (item["content"] or "").encode("utf-8")
+        records[row] = (len(data), len(meta), len(data) + len(meta), len(content))
+        data += meta
+        data += content
+        for ori_id in item["ori_id"]:
+            key = ori_id_key(ori_id)
+            if key >= 0:
+                key_rows[key] = row
+
+    sorted_keys = sorted(key_rows)
+    keys = np.array(sorted_keys, dtype=np.int64)
+    rows = np.array([key_rows[key] for key in sorted_keys], dtype=np.int32)
+
+    items_offset = HEADER_SIZE + keys.nbytes
+    rows_offset = items_offset + records.nbytes
+    data_offset = rows_offset + rows.nbytes
+    header = json.dumps(dict(count=len(items), key_count=len(keys), items_offset=items_offset, rows_offset=rows_offset,
+                             data_offset=data_offset, data_length=len(data))).encode("utf-8")
+    head = MAGIC + struct.pack("<I", len(header)) + header
+    if len(head) > HEADER_SIZE:
+        raise ValueError(f"ori segment header too large: {len(head)}")
+
+    return b"".join([head.ljust(HEADER_SIZE, b" "), keys.tobytes(), records.tobytes(), rows.tobytes(), bytes(data)])
+
+
+def _parse_header(head: bytes) -> dict:
+    if head[:len(MAGIC)] != MAGIC:
+        raise ValueError("invalid ori segment")
+    header_length = struct.unpack("<I", head[len(MAGIC):len(MAGIC) + 4])[0]
+    return json.loads(bytes(head[len(MAGIC) + 4:len(MAGIC) + 4 + header_length]))
+
+
+class OriSegment:
+    '''
+    单个文件的原文段，只读，可在多个请求间共享
+    buffer 为 mmap（本地存储）或 None（远程存储，按 Range 读取）
+    '''
+
+    def __init__(self, filename: str, header: dict, index_bytes, buffer: Optional[mmap.mmap] = None):
+        self.filename = filename
+        self.count = header["count"]
+        self._data_offset = header["data_offset"]
+        self._buffer = buffer
+        self._view = memoryview(buffer) if buffer is not None else None
+
+        key_count = header["key_count"]
+        # index_bytes 从 HEADER_SIZE 开始
+        base = HEADER_SIZE
+        self.keys = np.frombuffer(index_bytes, dtype=np.int64, count=key_count, offset=0)
+        self.items = np.frombuffer(index_bytes, dtype=np.int64, count=self.count * 4, offset=header["items_offset"] - base).reshape(self.count, 4)
+        self.rows = np.frombuffer(index_bytes, dtype=np.int32, count=key_count, offset=header["rows_offset"] - base)
+
+    def _read_ranges(self, ranges: list[tuple[int, int]]) -> list:
+        '''
+        ranges: [(data 内偏移, 长度)]，返回对应的 bytes-like
+        '''
+        if self._view is not None:
+            start = self._data_offset
+            return [self._view[start + offset:start + offset + length] for offset, length in ranges]
+
+        # 远程：按偏移排序后合并相邻区间
+        order = sorted(range(len(ranges)), key=lambda i: ranges[i][0])
+        results = [None] * len(ranges)
+        group, group_start, group_end = [], 0, 0
+        for i in order + [None]:
+            if i is not None and group and ranges[i][0] - group_end <= RANGE_MERGE_GAP:
+                group.append(i)
+                group_end = max(group_end, ranges[i][0] + ranges[i][1])
+                continue
+            if group:
+                content, err = Storage.download_range(self.filename, self._data_offset + group_start, group_end - group_start)
+                if err or content is None:
+                    raise IOError(f"read ori segment {self.filename} failed: {err}")
+                view = memoryview(content)
+                for j in group:
+                    offset = ranges[j][0] - group_start
+                    results[j] = view[offset:offset + ranges[j][1]]
+            if i is not None:
+                group, group_start, group_end = [i], ranges[i][0], ranges[i][0] + ranges[i][1]
+        return results
+
+    def get_items(self, ori_ids: list[str]) -> dict[str, dict]:
+        '''
+        返回 {ori_id: {"titles", "ori_id", "content", "type"}}，段内不存在的 ori_id 不返回；同一原文的多个 ori_id 共用一个 dict
+        '''
+        if not len(self.keys):
+            return {}
+
+        ori_rows = {}
+        for ori_id in ori_ids:
+            key = ori_id_key(ori_id)
+            if key < 0:
+                continue
+            idx = int(np.searchsorted(self.keys, key))
+            if idx < len(self.keys) and self.keys[idx] == key:
+                ori_rows[ori_id] = int(self.rows[idx])
+
+        rows = list(dict.fromkeys(ori_rows.values()))
+        ranges = []
+        for row in rows:
+            meta_offset, meta_length, _, content_length = self.items[row]
+            ranges.append((int(meta_offset), int(meta_length + content_length)))
+
+        row_items = {}
+        for row, chunk in zip(rows, self._read_ranges(ranges)):
+            meta_length = int(self.items[row][1])
+            item = json.loads(str(chunk[:meta_length], "utf-8"))
+            item["content"] = str(chunk[meta_length:], "utf-8")
+            row_items[row] = item
+
+        return {ori_id: row_items[row] for ori_id, row in ori_rows.items()}
+
+
+def open_segment(file_uuid: str, user_id: Optional[str] = None) -> Optional[OriSegment]:
+    filename = segment_filename(file_uuid, user_id)
+    try:
+        path = Storage.local_path(filename)
+        if path is not None:
+            if not os.path.exists(path):
+                return None
+            with open(path, "rb") as f:
+                buffer = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            header = _parse_header(buffer[:HEADER_SIZE])
+            index_bytes = memoryview(buffer)[HEADER_SIZE:header["data_offset"]]
+            return OriSegment(filename, header, index_bytes, buffer)
+
+        head, err = Storage.download_range(filename, 0, HEADER_SIZE)
+        if err or not head:
+            return None
+        header = _parse_header(head)
+        index_bytes, err = Storage.download_range(filename, HEADER_SIZE, header["data_offset"] - HEADER_SIZE)
+        if err:
+            return None
+        return OriSegment(filename, header, index_bytes)
+    except Exception as e:
+        logger.warning(f"open ori segment {filename} failed: {e}")
+        return None
+
+
+class OriSegmentCache:
+
+    def __init__(self, enable: bool = True, max_open_files: int = 2000, expiration: int = 3600):
+        self.enable = enable
+        # 不存在的段缓存为 False，避免重复访问存储
+        self._cache = ShardedLRUCacheDict(max_size=max_open_files, expiration=expiration)
+        self._file_keys = FileKeyIndex(self._cache, invalidation_bus)
+
+    def get_segments(self, file_uuids: list[str], user_id: Optional[str] = None) -> dict[str, OriSegment]:
+        versions = stage_cache.file_versions(file_uuids)
+        segments = {}
+        for idx, file_uuid in enumerate(file_uuids):
+            if versions is None:
+                segment = open_segment(file_uuid, user_id)
+            else:
+                key = f"{user_id or ''}:{file_uuid}:{versions[idx]}"
+                segment = self._cache.get(key)
+                if segment is None:
+                    segment = open_segment(file_uuid, user_id) or False
+                    self._cache[key] = segment
+                    self._file_keys.add(file_uuid, key)
+            if segment:
+                segments[file_uuid] = segment
+        return segments
+
+    def fillin(self, doc_item_cache: dict, pairs: list[tuple[str, str]], model_cls, user_id: Optional[str] = None) -> list[tuple[str, str]]:
+        '''
+        先从原文段取原文写入 doc_item_cache（key: {uuid}|{ori_id}），返回原文段中没有的 (uuid, ori_id)，由调用方继续查 ES
+        '''
+        if not self.enable or not pairs:
+            return pairs
+
+        file_ori_ids = {}
+        for uuid, ori_id in pairs:
+            file_ori_ids.setdefault(uuid, []).append(ori_id)
+
+        try:
+            segments = self.get_segments(list(file_ori_ids), user_id)
+        except Exception as e:
+            logger.warning(f"OriSegmentCache get segments failed: {e}")
+            return pairs
+
+        extra = dict(user_id=user_id) if user_id else {}
+        for file_uuid, segment in segments.items():
+            try:
+                items = segment.get_items(file_ori_ids[file_uuid])
+            except Exception as e:
+                logger.warning(f"OriSegmentCache read {segment.filename} failed: {e}")
+                continue
+
+            models = {}
+            for item in items.values():
+                if id(item) not in models:
+                    models[id(item)] = model_cls(uuid=file_uuid, **item, **extra)
+            for model in models.values():
+                for ori_id in model.ori_id:
+                    doc_item_cache[f"{file_uuid}|{ori_id}"] = model
+
+        remaining = [(uuid, ori_id) for uuid, ori_id in pairs if f"{uuid}|{ori_id}" not in doc_item_cache]
+        ori_segment_items.inc(len(pairs) - len(remaining), outcome="segment")
+        ori_segment_items.inc(len(remaining), outcome="fallback")
+        return remaining
+
+
+def _build_ori_segment_cache():
+    segment_config = config.get("ori_segment") or {}
+    return OriSegmentCache(enable=segment_config.get("enable", True),
+                           max_open_files=segment_config.get("max_open_files", 2000),
+                           expiration=segment_config.get("expiration", 3600))
+
+
+ori_segment_cache = _build_ori_segment_cache()
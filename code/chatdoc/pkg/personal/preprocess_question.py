@@ -2,18 +2,19 @@
 Author: longsion<xianglong_chen@intsig.net>
 Date: 2024-05-27 15:23:01
 LastEditors: longsion
-LastEditTime: 2024-10-23 14:19:48
+LastEditTime: 2026-10-18 22:12:30
 '''
 import os.path
 from pkg.personal.objects import Context, QuestionAnalysisResult
 from pkg.es.es_p_file import PESFileObject, PFileES
 from pkg.es.es_company import CompanyES
 from pkg.query_analysis import query_extract_uie
+from pkg.es.fragment_blob import fragment_blob_flight, fragments_blob_from_json
 from pkg.storage import Storage
-from pkg.utils import compress, decompress, ensure_list, has_intersection_list
+from pkg.utils import ensure_list, has_intersection_list
 from pkg.utils.decorators import register_span_func
 from pkg.utils.jaeger import TracedThreadPoolExecutor
-from pkg.utils.thread_with_return_value import ThreadWithReturnValue
+from pkg.utils.task_group import TaskGroup
 from pkg.config import config
 from difflib import get_close_matches, SequenceMatcher
 from pkg.redis.redis import redis_store
@@ -65,11 +66,11 @@ def preprocess_question(context: Context) -> Context:
     # question 校验
     question = replace_query(ori_question)
     if question:
-        _extract_info_t = ThreadWithReturnValue(target=get_extract_info, args=(question,))
-        _extract_info_t.start()
+        task_group = TaskGroup("preprocess_question")
+        _extract_info_t = task_group.spawn(get_extract_info, question)
 
         all_files = get_personal_files_by_uuid(context.params.user_id, context.params.document_uuids)
-        extract_info = _extract_info_t.join()
+        extract_info = _extract_info_t.result()
     else:
         all_files = []
         extract_info = {}
@@ -273,13 +274,9 @@ def file_match(question, file_metas: list[PESFileObject], question_years, regula
             _extract_infos = [company + year for company in question_companys for year in regular_question_years]
         else:
             _extract_infos = question_companys
-        # 构建线程列表
-        threads = []
-        for _extract_info in _extract_infos:
-            t = ThreadWithReturnValue(target=search_engine, args=(_extract_info, matches, 0.4, ))
-            t.start()
-            threads.append(t)
-        results = [t.join() for t in threads]
+        with TaskGroup("file_match") as task_group:
+            tasks = [task_group.spawn(search_engine, _extract_info, matches, 0.4) for _extract_info in _extract_infos]
+        results = [t.result() for t in tasks]
         for result in results:
             file_matches.extend(result)
 
@@ -422,27 +419,34 @@ def get_personal_files_by_uuid(user_id, uuids, with_doc_fragments_json=True):
 def attach_p_file_fragments_json(user_id: str, files: list[PESFileObject]):
     uuids = [file.uuid for file in files]
     cache_keys = [f"fragment-{user_id}-{u}" for u in uuids]
-    cached_results = redis_store.mget(cache_keys)
+    cached_results = fragment_blob_flight.do_many(cache_keys, redis_store.mget)
 
     uncached_files = []
     for i, _file in enumerate(files):
         if cached_results[i]:
-            _file.doc_fragments_json = decompress(cached_results[i])
+            _file._fragments_blob = cached_results[i]
 
         else:
             uncached_files.append(_file)
 
-    def _attach_p_file_fragments_json(_file):
-        fragment_gz, err = Storage.download_content(f"User_{user_id}/fragments-{_file.uuid}.gz")
+    def _load_p_file_fragments_blob(_file):
+        fragment_blob, err = Storage.download_content(f"User_{user_id}/fragments-{_file.uuid}.gz")
         if err:
+            # 没有缓存文件时从 ES 的 doc_fragments_json 生成片段 blob 并回写
             fragment_json = PFileES().search_file_fragment_json(user_id, _file.uuid)
-            _file.doc_fragments_json = fragment_json
-            if fragment_json:
-                Storage.upload(f"User_{user_id}/fragments-{_file.uuid}.gz", compress(fragment_json))
-                redis_store.set(f"fragment-{user_id}-{_file.uuid}", compress(fragment_json), ex=86400 * 30)  # 缓存过期时间为 30天
+            if not fragment_json:
+                return None
+            fragment_blob = fragments_blob_from_json(fragment_json)
+            Storage.upload(f"User_{user_id}/fragments-{_file.uuid}.gz", fragment_blob)
+            redis_store.set(f"fragment-{user_id}-{_file.uuid}", fragment_blob, ex=86400 * 30)  # 缓存过期时间为 30天
         else:
-            _file.doc_fragments_json = decompress(fragment_gz)
-            redis_store.set(f"fragment-{user_id}-{_file.uuid}", fragment_gz, ex=86400 * 30)  # 缓存过期时间为 30天
+            # 片段 blob 或历史 gzip json，构建片段树时按格式读取
+            redis_store.set(f"fragment-{user_id}-{_file.uuid}", fragment_blob, ex=86400 * 30)  # 缓存过期时间为 30天
+        return fragment_blob
+
+    def _attach_p_file_fragments_json(_file):
+        # 并发请求同一文件时只下载 / 回写一次
+        _file._fragments_blob = fragment_blob_flight.do(f"User_{user_id}/fragments-{_file.uuid}.gz", lambda: _load_p_file_fragments_blob(_file))
 
     with TracedThreadPoolExecutor(max_workers=10) as executor:
         futures = [executor.submit(_attach_p_file_fragments_json, _file) for _file in uncached_files]
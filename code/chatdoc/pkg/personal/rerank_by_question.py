@@ -2,22 +2,20 @@
 Author: longsion<xianglong_chen@intsig.net>
 Date: 2024-05-06 14:57:34
 LastEditors: longsion
-LastEditTime: 2024-09-13 14:51:21
+LastEditTime: 2026-10-18 14:20:51
 '''
 
-from collections import Counter, OrderedDict
+from collections import Counter
 from pkg.personal.common import get_fragment_all_texts, get_fragment_ori_ids, get_fragment_ori_text, get_table_ori_text
 from pkg.personal.objects import Context, RetrieveContext, RetrieveType
-from pkg.config import config
 from pkg.es.es_p_doc_fragment import PDocFragmentModel
 from pkg.es.es_p_doc_table import PDocTableModel
-from pkg.rerank import rerank_api_by_cache
-from pkg.utils import duplicates_list, softmax, split_list
+from pkg.rerank.batcher import rerank_batcher
+from pkg.utils import duplicates_list, softmax
 from pkg.utils.decorators import register_span_func
 
 import re
 import numpy as np
-import concurrent.futures
 
 
 def lambda_func(context: Context):
@@ -161,24 +159,8 @@ def rerank_max_score(txt1: str, txt2s) -> list[float]:
             # 表格线替换为空
             txt2 = txt2.replace('|', ' ')
             clean_txt2s.append(txt2)
-        concurrent_split_txts = split_list(txt2_combines_all, chunk_size=16)
-        pairs = [[[txt1], concurrent_split_txt] for concurrent_split_txt in concurrent_split_txts]
-        tasks_with_index = [
-            (i, txt2) for i, txt2 in enumerate(pairs)
-        ]
-        with concurrent.futures.ThreadPoolExecutor(max_workers=8) as executor:
-            futures = {executor.submit(rerank_api_by_cache, txt2, headers=None, url=config["textin"]["rerank_url"], if_softmax=0): idx for idx, txt2 in tasks_with_index}
-
-            # 使用OrderedDict来保证按原顺序收集结果
-            ordered_results = OrderedDict()
-            for future in concurrent.futures.as_completed(futures):
-                idx = futures[future]
-                result = future.result()
-                ordered_results[idx] = result
-
-            # 提取并排序结果
-            ress = [ordered_results[i] for i in range(len(ordered_results))]
-        text_span_scores = [score for text_span_score in ress for score in text_span_score]
+        # 由进程级 rerank_batcher 跨请求合批
+        text_span_scores = rerank_batcher.score(txt1, txt2_combines_all)
         text_span_scores = [round(score, 4) for score in softmax(text_span_scores)]
 
         # pairs = [[txt1], clean_txt2s]
@@ -2,19 +2,19 @@
 Author: longsion<xianglong_chen@intsig.net>
 Date: 2024-05-23 23:22:47
 LastEditors: longsion
-LastEditTime: 2024-10-16 14:13:33
+LastEditTime: 2026-10-18 23:34:20
 '''
-import json
+from pkg.es.fragment_tree import fragment_tree_cache
 from pkg.es.es_p_doc_table import PDocTableES, PDocTableModel
 from pkg.es.es_p_doc_fragment import PDocFragmentES, PDocFragmentModel
-from pkg.embedding.acge_embedding import get_similar_top_n
+from pkg.embedding.keyword_matrix import three_table_key_matrix
 from pkg.utils import edit_distance
 from pkg.utils.decorators import register_span_func
-from pkg.structure_static import match_fixed_tables, three_table_key_list
+from pkg.structure_static import match_fixed_tables
 from pkg.config import config
 from pkg.personal.objects import Context
 from pkg.personal.common import fillin_fragment_children_cache, fillin_doc_items_cache
-from pkg.utils.thread_with_return_value import ThreadWithReturnValue
+from pkg.utils.task_group import TaskGroup
 from pkg.utils.logger import logger
 
 
@@ -35,30 +35,27 @@ def retrieve_small(context: Context) -> Context:
 
     document_uuids = list(set([file.uuid for file in context.files]))
 
+    task_group = TaskGroup("retrieve_small", context=context)
     # 三大表召回
-    _fixed_table_retrieve_t = ThreadWithReturnValue(target=retrieve_by_fixed_table, args=(context, document_uuids,))
-    _fixed_table_retrieve_t.start()
+    _fixed_table_retrieve_t = task_group.spawn(retrieve_by_fixed_table, context, document_uuids, stage="retrieve_table", default=[])
 
     # 更新 fragment cache 以及 doc item cache
     fill_fragments_cache(context)
 
-    context.fixed_table_retrieve_small = _fixed_table_retrieve_t.join()
+    context.fixed_table_retrieve_small = _fixed_table_retrieve_t.result()
 
     fixed_table_file_uuids = [cur.uuid for cur in context.fixed_table_retrieve_small]
 
     # 文件三大表召回到了之后之后其他的召回就省略掉
     document_uuids = list(set(document_uuids) - set(fixed_table_file_uuids))
 
-    _normal_table_retrieve_t, _paragraph_retrieve_t = None, None
     if document_uuids:
-        _normal_table_retrieve_t = ThreadWithReturnValue(target=retrieve_by_table, args=(context, document_uuids))
-        _normal_table_retrieve_t.start()
+        # 单路召回超时按空结果降级
+        _normal_table_retrieve_t = task_group.spawn(retrieve_by_table, context, document_uuids, stage="retrieve_table", default=[])
+        _paragraph_retrieve_t = task_group.spawn(retrieve_by_paragraph, context, document_uuids, stage="retrieve_paragraph", default=[])
 
-        _paragraph_retrieve_t = ThreadWithReturnValue(target=retrieve_by_paragraph, args=(context, document_uuids))
-        _paragraph_retrieve_t.start()
-
-        context.normal_table_retrieve_small = _normal_table_retrieve_t.join()
-        context.fragment_retrieve_small = _paragraph_retrieve_t.join()
+        context.normal_table_retrieve_small = _normal_table_retrieve_t.result()
+        context.fragment_retrieve_small = _paragraph_retrieve_t.result()
 
     # 填充子切片cache及ori_item的cache，方便后续步骤使用
     table_ori_ids = [
@@ -71,16 +68,18 @@ def retrieve_small(context: Context) -> Context:
 
 
 def fill_fragments_cache(context: Context):
-    # 从doc_fragments_json中更新 context.fragment_cache
+    # 从片段 blob（或doc_fragments_json）中加载文件片段树（进程级缓存共享），片段对象按需构造
+    missing = []
     for file in context.files:
-        if file.doc_fragments_json:
-            doc_fragments = json.loads(file.doc_fragments_json)
-            if isinstance(doc_fragments, list):
-                # without embeddings
-                doc_fragments = [
-                    PDocFragmentModel(**fragment, file_uuid=file.uuid) for fragment in doc_fragments
-                ]
-                context.fragment_cache.update({doc_fragment.uuid: doc_fragment for doc_fragment in doc_fragments})
+        tree = fragment_tree_cache.get(file.uuid, file.fragments_source, user_id=file.user_id)
+        if tree is not None:
+            context.fragment_cache.add_tree(tree)
+        elif not file.fragments_source:
+            missing.append(file.uuid)
+    # 阶段缓存命中的文件不带片段来源，按 uuid 批量加载
+    if missing:
+        for tree in fragment_tree_cache.load(missing, context.params.user_id).values():
+            context.fragment_cache.add_tree(tree)
 
 
 def retrieve_by_fixed_table(context: Context, document_uuids: list[str]) -> list[PDocTableModel]:
@@ -91,7 +90,7 @@ def retrieve_by_fixed_table(context: Context, document_uuids: list[str]) -> list
 
     keyword = context.question_analysis.keywords[0]
     # """语义匹配top1"""
-    top1 = get_similar_top_n(three_table_key_list, keyword)
+    top1 = three_table_key_matrix.top_n(keyword)
     if not top1:
         logger.info(f"Fixed Table Agent 匹配不到关键词对应的表格，keyword: {keyword}")
         return empty_list
@@ -119,16 +118,8 @@ def retrieve_by_fixed_table(context: Context, document_uuids: list[str]) -> list
 
 def retrieve_by_table(context: Context, document_uuids: list[str]) -> list[PDocTableModel]:
     # 表格召回
-    doc_table_items: list[PDocTableModel] = []
-
-    threads = []
-    for keyword in context.question_analysis.keywords:
-        t = ThreadWithReturnValue(target=PDocTableES().search_table, kwargs=dict(bm25_text=keyword, ebd_text=context.question_analysis.retrieve_question, user_id=context.params.user_id, document_uuids=document_uuids, size=min(5 * len(context.files), 200)))
-        t.start()
-        threads.append(t)
-
-    for t in threads:
-        doc_table_items.extend(t.join())
+    # 所有关键词合并为一次 _msearch
+    doc_table_items: list[PDocTableModel] = PDocTableES().search_tables(bm25_texts=context.question_analysis.keywords, ebd_text=context.question_analysis.retrieve_question, user_id=context.params.user_id, document_uuids=document_uuids, size=min(5 * len(context.files), 200))
     # 表格召回过滤
     if len(context.locationfiles) < 4:
         doc_table_items = [doc_table_item
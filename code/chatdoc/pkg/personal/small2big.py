@@ -2,11 +2,11 @@
 Author: longsion<xianglong_chen@intsig.net>
 Date: 2024-05-30 17:03:20
 LastEditors: longsion
-LastEditTime: 2024-09-20 16:41:12
+LastEditTime: 2026-10-18 20:58:40
 '''
 
 
-from pkg.personal.common import fillin_doc_items_cache, fillin_fragment_children_cache, fillin_fragment_parent_cache, get_fragment_all_texts, get_fragment_ori_ids, get_fragment_ori_text
+from pkg.personal.common import fillin_doc_items_cache, fillin_fragment_children_cache, fillin_fragment_parent_cache, fillin_materialized_fragments, get_fragment_all_texts, get_fragment_ori_ids, get_fragment_ori_text
 from pkg.personal.objects import Context, RetrieveContext, RetrieveType
 from pkg.utils.decorators import register_span_func
 from pkg.utils import group_by_func
@@ -34,6 +34,8 @@ def small2big(context: Context) -> Context:
     # 补齐Cache
     fillin_fragment_parent_cache(context.fragment_cache, para_fragments, level=1)
     parent_fragments = [context.fragment_cache[para_fragment.parent_frament_uuid] for para_fragment in para_fragments if para_fragment.parent_frament_uuid]
+    # 父节点优先使用入库时物化的子树原文，未物化的再补齐子节点与原文
+    parent_fragments = fillin_materialized_fragments(context.fragment_cache, parent_fragments)
     uuid_ori_tuple_list = fillin_fragment_children_cache(context.fragment_cache, parent_fragments)
     fillin_doc_items_cache(context.doc_items_cache, context.params.user_id, uuid_ori_tuple_list)
 
@@ -2,13 +2,14 @@
 Author: longsion<xianglong_chen@intsig.net>
 Date: 2024-09-20 15:22:49
 LastEditors: longsion
-LastEditTime: 2024-09-27 18:18:12
+LastEditTime: 2026-10-18 17:32:40
 '''
 
 
 from pkg.utils.thread_with_return_value import ThreadWithReturnValue
 from pkg.vdb import delete_personal_vdb
 from .objects import DeleteParams
+from pkg.redis.stage_cache import personal_library, stage_cache
 from pkg.es.es_p_doc_fragment import PDocFragmentES
 from pkg.es.es_p_doc_table import PDocTableES
 from pkg.es.es_p_doc_item import PDocItemES
@@ -34,6 +35,9 @@ def process(params: DeleteParams) -> bool:
     for t in es_threads:
         result = result and (t.join() is None)
 
+    # 失效问答阶段缓存
+    stage_cache.invalidate(params.uuids, [personal_library(params.user_id)])
+
     # TODO: 删除AWS源文件【暂时先不删除了】
 
     return True
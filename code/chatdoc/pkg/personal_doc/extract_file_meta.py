@@ -2,17 +2,18 @@
 Author: longsion<xianglong_chen@intsig.net>
 Date: 2024-06-20 20:06:00
 LastEditors: longsion
-LastEditTime: 2024-10-23 19:10:55
+LastEditTime: 2026-10-18 21:58:12
 '''
 
 from datetime import datetime
 import re
 from pkg.storage import Storage
-from pkg.utils import compress, ensure_list, xjson
+from pkg.utils import ensure_list, xjson
 from pkg.utils.thread_with_return_value import ThreadWithReturnValue
 from .objects import Context, FileOriEnum, FileTypeEnum
 from pkg.utils.decorators import register_span_func
 from pkg.es.es_company import ESCompanyObject, CompanyES
+from pkg.es.fragment_blob import encode_fragments_blob
 from pkg.es.es_p_file import PESFileObject, PFileES
 from pkg.openkie import ie_vllm
 from pkg.config import config
@@ -69,6 +70,7 @@ def extract_file_meta(context: Context) -> Context:
     delete_file_uuid_thread.start()
     context.threads.append(delete_file_uuid_thread)
 
+    doc_fragments = gen_doc_fragments_json(context)
     context.es_file_entity = PESFileObject(
         user_id=context.params.user_id,
         uuid=context.params.uuid,
@@ -85,19 +87,20 @@ def extract_file_meta(context: Context) -> Context:
         extract_company_str=context.file_meta.extract_company_str,
         keywords=context.file_meta.keywords,
         summary=context.file_meta.summary,
-        doc_fragments_json=xjson.dumps(gen_doc_fragments_json(context)),  # , ensure_ascii=False
+        doc_fragments_json=xjson.dumps(doc_fragments),  # , ensure_ascii=False
         tree_summaries=context.file_meta.tree_summaries,
     )
 
-    upload_doc_fragments_thread = ThreadWithReturnValue(target=upload_doc_fragments_json, args=(context.es_file_entity.doc_fragments_json, context.params.user_id, context.params.uuid))
+    upload_doc_fragments_thread = ThreadWithReturnValue(target=upload_doc_fragments_json, args=(doc_fragments, context.params.user_id, context.params.uuid))
     upload_doc_fragments_thread.start()
     context.threads.append(upload_doc_fragments_thread)
 
     return context
 
 
-def upload_doc_fragments_json(doc_fragments_json: str, user_id: str, uuid: str):
-    stream = compress(doc_fragments_json)
+def upload_doc_fragments_json(doc_fragments: list[dict], user_id: str, uuid: str):
+    # 片段 blob（fragment_blob），ES 中仍保存 doc_fragments_json
+    stream = encode_fragments_blob(doc_fragments)
     # 个人库的过期时间设为30天
     redis_store.set(f"fragment-{user_id}-{uuid}", stream, ex=86400 * 30)
     Storage.upload(f"User_{user_id}/fragments-{uuid}.gz", stream)
@@ -161,7 +164,11 @@ def gen_doc_fragments_json(context: Context):
 
     return [
         fragment.model_dump(exclude=[
-            "ebed_text"
+            "ebed_text",
+            # 物化的子树结果只存片段索引，问答时按需取回
+            "tree_ori_ids",
+            "tree_text",
+            "tree_all_texts",
         ])
         for fragment in context.doc_fragments
     ]
@@ -2,7 +2,7 @@
 Author: longsion<xianglong_chen@intsig.net>
 Date: 2024-05-14 11:32:10
 LastEditors: longsion
-LastEditTime: 2024-10-17 15:10:46
+LastEditTime: 2026-10-18 23:12:40
 '''
 
 from typing import Optional, Union
@@ -10,6 +10,7 @@ from pydantic import BaseModel
 from pkg.es.es_company import ESCompanyObject
 from pkg.es.es_p_file import PESFileObject
 from pkg.utils.thread_with_return_value import ThreadWithReturnValue
+from pkg.redis.doc_queue import DocJob
 from enum import Enum, IntEnum
 from opentelemetry import context as otel_context
 
@@ -254,6 +255,11 @@ class Fragment(BaseModel):
     table_start_row_idx: int = 0    # 表格起始行
     table_end_row_idx: int = 0      # 表格结束行
 
+    # ---- 非叶子切片入库时物化的子树结果，超过长度限制时为空，查询时回退到递归拼接 ----
+    tree_ori_ids: list[str] = []    # 子树ori_id去重后按(页, 序号)排序
+    tree_text: str = ""             # 子树markdown原文，同get_fragment_ori_text
+    tree_all_texts: list[str] = []  # 子树原文列表，同get_fragment_all_texts
+
 
 # -------------
 
@@ -320,6 +326,10 @@ class Context(BaseModel):
     trace_id: str = None
     span_ctx: otel_context.Context = None
 
+    # 文档处理队列任务，同步处理时为空；stage: 当前处理阶段，失败时按阶段计重试次数
+    job: DocJob = None
+    stage: str = None
+
     # org_file_path
     org_file_path: str = None
 
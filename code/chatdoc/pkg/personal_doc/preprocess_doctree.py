@@ -2,7 +2,7 @@
 Author: longsion<xianglong_chen@intsig.net>
 Date: 2024-05-15 11:02:22
 LastEditors: longsion
-LastEditTime: 2024-09-20 16:22:09
+LastEditTime: 2026-10-18 21:41:37
 '''
 
 
@@ -11,6 +11,7 @@ import pypeln as pl
 import requests
 
 from pkg.storage import Storage
+from pkg.ori_segment import build_segment, segment_filename
 from .objects import Context, DocTreeNode, DocOriItem, DocOriItemType
 from pkg.utils.decorators import register_span_func
 from pkg.utils.thread_with_return_value import ThreadWithReturnValue
@@ -53,6 +54,9 @@ def preprocess_doctree(context: Context) -> Context:
     thread = ThreadWithReturnValue(target=upload_ori_items_to_es, args=(context.doc_ori_items, context.params.user_id, context.params.uuid))
     thread.start()
     context.threads.append(thread)
+    segment_thread = ThreadWithReturnValue(target=upload_ori_segment, args=(context.doc_ori_items, context.params.user_id, context.params.uuid))
+    segment_thread.start()
+    context.threads.append(segment_thread)
 
     return context
 
@@ -124,6 +128,8 @@ def upload_ori_items_to_es(doc_ori_items: list[DocOriItem], user_id: str, file_u
                 titles=doc_ori_item.titles,
                 ori_id=doc_ori_item.ori_id,
                 content=doc_ori_item.content,
+                # 表格 content 已是markdown，原始html并排存储，问答链路不再解析html
+                content_html="\n".join(merge_table(doc_ori_item.content_html)) if doc_ori_item.type == DocOriItemType.TABLE else "",
                 type=doc_ori_item.type.value,
             )
             for doc_ori_item in doc_ori_items[i:i + batch_size]
@@ -132,6 +138,15 @@ def upload_ori_items_to_es(doc_ori_items: list[DocOriItem], user_id: str, file_u
         PDocItemES().insert_doc_items(batch_items)
 
 
+def upload_ori_segment(doc_ori_items: list[DocOriItem], user_id: str, file_uuid: str):
+    # 按文件的原文段，问答时 mmap 后按 ori_id 直接取原文
+    segment = build_segment([
+        dict(titles=doc_ori_item.titles, ori_id=doc_ori_item.ori_id, content=doc_ori_item.content, type=doc_ori_item.type.value)
+        for doc_ori_item in doc_ori_items
+    ])
+    Storage.upload(segment_filename(file_uuid, user_id), segment)
+
+
 def upload_merge_file(doc_ori_items: list[DocOriItem], user_id: str, file_uuid: str):
 
     def gen_merge_map(doc_items: list[DocOriItem]) -> list[DocOriItem]:
@@ -2,10 +2,11 @@
 Author: longsion<xianglong_chen@intsig.net>
 Date: 2024-05-14 11:33:12
 LastEditors: longsion
-LastEditTime: 2024-10-16 14:26:03
+LastEditTime: 2026-10-18 23:31:08
 '''
 
 import time
+from typing import Optional
 
 from pkg.personal_doc.pdf2md import parse_document_new
 from .objects import FileProcessStatus, Params, Context, FileProcessException, Response
@@ -18,21 +19,22 @@ from .upload_paragraph import upload_paragragh_fragment
 from .extract_file_meta import extract_file_meta
 
 from pkg.utils.decorators import register_span_func
-from pkg.utils import global_file_thread_pool
 from pkg.es.es_p_file import PFileES, PESFileObject
-from pkg.config import config
+from pkg.cache_warmup import cache_warmer
+from pkg.redis.doc_queue import DocJob, doc_queue
+from pkg.redis.stage_cache import personal_library, stage_cache
 
 from pkg.utils.thread_with_return_value import ThreadWithReturnValue
 
 from opentelemetry.trace import get_current_span
-from opentelemetry import context as otel_context
+from opentelemetry import context as otel_context, propagate
 import traceback
 from pkg.utils.logger import logger
 
 
 def thread_process(context: Context) -> Context:
     '''
-    description: 文档处理，后台线程池处理
+    description: 文档处理，由文档处理队列的 worker 执行（run_job），或 process_sync 同步执行
     return {*}
     '''
 
@@ -42,6 +44,11 @@ def thread_process(context: Context) -> Context:
     otel_context.attach(context.span_ctx)
 
     try:
+        # worker 可能与接收请求的不是同一个节点，处理时再下载文件
+        doc_queue.enter_stage(context, "download")
+        context = download_file(context)
+
+        doc_queue.enter_stage(context, "parse")
         # 文档解析: 个人知识库仅调用pdf2md, TODO: 需要调用doc_parser的话再看，
         # Cover是否也需要更新？
         # 个人知识库只调用PDF2MD？防止Cover及Page图片可能会冲突！！！可以暂时这么去使用！后面需要加的话再添加相应的逻辑处理！
@@ -52,17 +59,20 @@ def thread_process(context: Context) -> Context:
         _t.start()
         context.threads.append(_t)
 
+        doc_queue.enter_stage(context, "preprocess")
         # 目录树预处理
         # 1. 生成ori_id对于原文的映射，存入到es中
         # 2. 方便切片逻辑的数据获取，以及存储
         context = preprocess_doctree(context)
 
+        doc_queue.enter_stage(context, "cut")
         # 表格切片处理
         context = cut_table_fragment(context)
 
         # 段落切片处理
         context = cut_paragraph_fragment(context)
 
+        doc_queue.enter_stage(context, "upload")
         # 异步进行文件基础信息提取
         _t_extract_file_meta = ThreadWithReturnValue(target=extract_file_meta, args=(context,))
         _t_extract_file_meta.start()
@@ -75,9 +85,15 @@ def thread_process(context: Context) -> Context:
 
     except Exception as e:
         logger.error(f"Doc Process Failed, trace_id: {context.trace_id}, exception: {e}, traceback: {traceback.format_exc()}")
-        callback(context.params.callback_url, context.params.uuid, FileProcessStatus.file_process_error.value, params=context.params)
+        # 切片可能已部分写入，失效问答阶段缓存
+        stage_cache.invalidate([context.params.uuid], [personal_library(context.params.user_id)])
+        # 队列任务的失败回调在重试次数用完后由队列发送（含 worker 失联超时回收）
+        if context.job is None:
+            callback(context.params.callback_url, context.params.uuid, FileProcessStatus.file_process_error.value, params=context.params)
         raise e
 
+    doc_queue.enter_stage(context, "finalize")
+
     # 等待后台线程执行完成
     thread_rets = []
     for thread in context.threads:
@@ -89,14 +105,20 @@ def thread_process(context: Context) -> Context:
 
     # 更新 es_file
     insert_file_bool = PFileES().insert_file(context.es_file_entity)
+    # 文件内容已更新，失效问答阶段缓存
+    stage_cache.invalidate([context.params.uuid], [personal_library(context.params.user_id)])
 
     # None和True表示成功，False|err表示失败
     if not insert_file_bool or [thread_ret for thread_ret in thread_rets if thread_ret not in [None, True]]:
         logger.error(f"Doc Process Failed, trace_id: {context.trace_id}, exception: backend threads exception occurred: {thread_rets}")
-        callback(context.params.callback_url, context.params.uuid, FileProcessStatus.file_process_error.value, context.file_meta, params=context.params)
+        if context.job is None:
+            callback(context.params.callback_url, context.params.uuid, FileProcessStatus.file_process_error.value, context.file_meta, params=context.params)
+        raise FileProcessException(message=f"backend threads exception occurred: {thread_rets}")
     else:
         # 回调文件处理状态：切片成功
         callback(context.params.callback_url, context.params.uuid, FileProcessStatus.file_cut_success.value, context.file_meta, context.params)
+        # 问答侧缓存预热（片段树 / 原文段 / 文件向量 / 探测问题 embedding），失败不影响处理结果
+        cache_warmer.warm(context.params.uuid, user_id=context.params.user_id, file_meta=context.file_meta)
         # 清空后台线程
         context.threads = []
 
@@ -116,24 +138,52 @@ def process(params: Params) -> Context:
         # 如果文件是系统文件库中, 且修改的库非源库修改
         context = report_process_result(context, "exists", file_entity=file_entities[0])
     else:
-        # download file
-        context = download_file(context)
-        # TODO: 使用消息队列
-        if global_file_thread_pool._work_queue.qsize() >= config["threadpool"]["doc_process_queue_size"]:
+        if doc_queue.full():
             raise FileProcessException(message="当前文档处理队列已满，请稍后重试")
 
         # 存在相同文件
+        file_meta = {}
         if file_entities:
             same_file_meta = file_entities[0]
-            context.file_meta.page_number = same_file_meta.page_number
-            context.file_meta.first_image_id = same_file_meta.first_image_id
+            file_meta = dict(page_number=same_file_meta.page_number, first_image_id=same_file_meta.first_image_id)
 
-        global_file_thread_pool.submit(thread_process, context)
+        trace_carrier = {}
+        propagate.inject(trace_carrier)
+        doc_queue.enqueue(DocJob(job_id=doc_queue.job_id(params.uuid, params.user_id), kind="personal", params=params.model_dump(mode="json"),
+                                 file_meta=file_meta, trace_id=context.trace_id, trace_carrier=trace_carrier))
         context = report_process_result(context, "processing")
 
     return context
 
 
+def run_job(job: DocJob) -> Context:
+    '''
+    description: 文档处理队列任务，由 DocWorker 调用
+    return {*}
+    '''
+    context = Context(params=Params(**job.params), job=job)
+    context.trace_id = job.trace_id
+    context.span_ctx = propagate.extract(job.trace_carrier)
+    for key, value in job.file_meta.items():
+        setattr(context.file_meta, key, value)
+    return thread_process(context)
+
+
+def report_job_failed(job: DocJob):
+    '''
+    description: 队列任务最终失败（重试次数用完或超时回收）时回调失败状态
+    '''
+    params = Params(**job.params)
+    callback(params.callback_url, params.uuid, FileProcessStatus.file_process_error.value, params=params)
+
+
+def process_status(user_id: str, uuid: str) -> Optional[dict]:
+    '''
+    description: 文档处理任务状态（status / stage / attempts / error），任务不存在或已过期时返回 None
+    '''
+    return doc_queue.summary(doc_queue.job_id(uuid, user_id))
+
+
 def process_sync(params: Params) -> Context:
 
     context = Context(params=params)
@@ -145,8 +195,6 @@ def process_sync(params: Params) -> Context:
     if file_entities and context.params.knowledge_id != file_entities[0].kownledge_id:
         context = report_process_result(context, "exists")
     else:
-        # download file
-        context = download_file(context)
         context = thread_process(context)
         context = report_process_result(context, status="processing")
 
@@ -2,7 +2,7 @@
 Author: longsion<xianglong_chen@intsig.net>
 Date: 2024-07-04 22:09:38
 LastEditors: longsion
-LastEditTime: 2024-10-17 16:58:28
+LastEditTime: 2026-10-18 19:05:12
 '''
 
 import pypeln as pl
@@ -26,7 +26,7 @@ def upload_paragragh_fragment(context: Context) -> Context:
     段落切片数据上报
     row_texts: 段落切片逻辑
     """
-    from pkg.vdb import delete_personal_vdb
+    from pkg.vdb import delete_personal_vdb, get_vector_db_model
 
     file_uuid = context.params.uuid
 
@@ -37,6 +37,9 @@ def upload_paragragh_fragment(context: Context) -> Context:
     # 删除老向量
     delete_vbd_t = ThreadWithReturnValue(target=delete_personal_vdb, args=(context.params.user_id, [file_uuid]))
     delete_vbd_t.start()
+    if get_vector_db_model() == "local":
+        # 本地向量库按文件整段写入，需等删除完成再写入，避免删除晚于写入
+        delete_vbd_t.join()
 
     # multi_embedding and upload to es
     embedding_zilliz_t = ThreadWithReturnValue(target=embedding_and_upload, args=(context.doc_fragments, file_uuid, context.params.user_id))
@@ -64,6 +67,13 @@ def _delete_and_insert_es_fragments(file_uuid, doc_fragments: list[Fragment], us
 
 @ register_span_func()
 def embedding_and_upload(doc_fragments: list[Fragment], file_uuid: str, user_id: str):
+    from pkg.vdb import get_vector_db_model
+    if get_vector_db_model() == "local":
+        from pkg.vdb.local import embedding_and_insert
+        keys = PDocFragmentES().keys
+        payloads = [PDocFragmentModel(**item.model_dump(), file_uuid=file_uuid, user_id=user_id).model_dump(include=set(keys)) for item in doc_fragments]
+        return embedding_and_insert(file_uuid, payloads, user_id=user_id)
+
     vector_params = [
         dict(
             file_uuid=file_uuid,
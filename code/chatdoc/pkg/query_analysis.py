@@ -1,4 +1,4 @@
-import requests
+from pkg.clients.http_client import get_http_client
 
 
 def query_extract_uie(url, query):
@@ -20,9 +20,9 @@ def query_extract_uie(url, query):
         "input": query
     }
     headers_json = {'Content-Type': 'application/json'}
-    completion = requests.post(url=url,
-                               headers=headers_json,
-                               json=json_text)
+    completion = get_http_client("query_extract").post(url=url,
+                                                       headers=headers_json,
+                                                       json=json_text)
     completion.raise_for_status()
     query_analysis_res = completion.json()
     res["years"] = query_analysis_res["years"]
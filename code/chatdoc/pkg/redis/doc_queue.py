@@ -0,0 +1,332 @@
+'''
+Author: longsion<xianglong_chen@intsig.net>
+Date: 2026-10-18 23:12:40
+LastEditors: longsion
+LastEditTime: 2026-10-18 23:31:08
+'''
+
+# 文档处理队列（Redis）：替代进程内的文档处理线程池，任务在重启后不丢失，worker 可部署在多个节点（pkg/doc_worker.py）
+# - 任务 {prefix}:job:{job_id} 保存 DocJob json，job_id 为文件 uuid，个人库为 {user_id}-{uuid}；同一文件排队 / 处理中时不重复入队
+# - 就绪队列 {prefix}:ready（zset，score = 优先级 * 1e13 + 入队毫秒时间）：按 config priority 区分系统库 / 个人库，同优先级先进先出
+# - 处理中 {prefix}:inflight（zset，score 为可见性超时时间），worker 处理期间定时续期；进程退出 / 节点宕机后超时的任务被回收，计为当前阶段的一次失败
+# - 失败按阶段计数（max_attempts 可按阶段配置），未超过次数时进入延迟队列 {prefix}:delayed，指数退避后回到就绪队列
+# - 集合之间的移动都在 Lua 脚本中完成，任务不会丢失；完成 / 重试以移出 inflight 为准，租约已被回收的 worker 的结果会被丢弃
+# - 回收时在脚本内确认可见性超时仍未续期；worker 进入每个阶段前续期一次，租约已被回收时中止处理（LeaseLostError），避免与新 worker 同时写入
+# - 最终失败（含超时回收）时调用 on_failed 回调失败状态
+# - 背压按队列深度（就绪 + 延迟）判断；任务状态（status / stage / attempts / error）由 status 查询，结束后保留 job_expiration 秒
+
+import time
+from enum import Enum
+from typing import Callable, Optional
+
+from pydantic import BaseModel
+
+from pkg.config import config
+from pkg.utils.logger import logger
+from pkg.utils.metrics import global_metrics
+
+
+doc_queue_jobs = global_metrics.counter("doc_queue_jobs_total", "Document processing queue jobs by kind and outcome")
+doc_queue_depth = global_metrics.gauge("doc_queue_depth", "Document processing queue depth by state")
+
+PRIORITY_SCALE = 10 ** 13
+
+# KEYS: job, ready  ARGV: job json, job_id, score；返回排队 / 处理中的已有任务
+ENQUEUE_SCRIPT = """
+local current = redis.call('GET', KEYS[1])
+if current then
+  local status = cjson.decode(current)['status']
+  if status == 'queued' or status == 'running' or status == 'retrying' then
+    return current
+  end
+end
+redis.call('SET', KEYS[1], ARGV[1])
+redis.call('ZADD', KEYS[2], ARGV[3], ARGV[2])
+return false
+"""
+
+# KEYS: ready, inflight  ARGV: 可见性超时时间
+CLAIM_SCRIPT = """
+local popped = redis.call('ZPOPMIN', KEYS[1])
+if #popped == 0 then
+  return false
+end
+redis.call('ZADD', KEYS[2], ARGV[1], popped[1])
+return popped[1]
+"""
+
+# KEYS: inflight, job, delayed（重试时）  ARGV: job_id, job json, 过期时间（完成时）| 可重试时间（重试时）, 回收时间（回收时）
+FINISH_SCRIPT = """
+if ARGV[4] then
+  local score = redis.call('ZSCORE', KEYS[1], ARGV[1])
+  if not score or tonumber(score) >= tonumber(ARGV[4]) then
+    return 0
+  end
+end
+if redis.call('ZREM', KEYS[1], ARGV[1]) == 0 then
+  return 0
+end
+if KEYS[3] then
+  redis.call('SET', KEYS[2], ARGV[2])
+  redis.call('ZADD', KEYS[3], ARGV[3], ARGV[1])
+else
+  redis.call('SET', KEYS[2], ARGV[2], 'EX', ARGV[3])
+end
+return 1
+"""
+
+# KEYS: delayed, ready  ARGV: 当前时间, 当前毫秒时间, job key 前缀
+PROMOTE_SCRIPT = """
+local job_ids = redis.call('ZRANGEBYSCORE', KEYS[1], '-inf', ARGV[1], 'LIMIT', 0, 100)
+for _, job_id in ipairs(job_ids) do
+  redis.call('ZREM', KEYS[1], job_id)
+  local priority = 0
+  local data = redis.call('GET', ARGV[3] .. job_id)
+  if data then
+    priority = cjson.decode(data)['priority'] or 0
+  end
+  redis.call('ZADD', KEYS[2], string.format('%.0f', priority * """ + str(PRIORITY_SCALE) + """ + tonumber(ARGV[2])), job_id)
+end
+return #job_ids
+"""
+
+
+class LeaseLostError(Exception):
+    '''
+    任务租约已被回收（可见性超时），当前 worker 应中止处理
+    '''
+
+
+class JobStatus(str, Enum):
+    queued = "queued"
+    running = "running"
+    retrying = "retrying"
+    success = "success"
+    failed = "failed"
+
+
+class DocJob(BaseModel):
+
+    job_id: str
+    # analyst | personal，对应 doc_worker 中的处理函数
+    kind: str
+    priority: int = 0
+    # 处理参数 Params，及沿用已有文件的 file_meta 字段
+    params: dict
+    file_meta: dict = {}
+    trace_id: Optional[str] = None
+    # opentelemetry 上下文，worker 中继续同一条 trace
+    trace_carrier: dict = {}
+
+    status: str = JobStatus.queued.value
+    # 当前 / 最后所在的处理阶段，未开始处理为 pending
+    stage: str = "pending"
+    # 各阶段失败次数
+    attempts: dict[str, int] = {}
+    error: Optional[str] = None
+    worker: Optional[str] = None
+    enqueue_time: Optional[float] = None
+    start_time: Optional[float] = None
+    finish_time: Optional[float] = None
+
+
+class DocQueue:
+
+    def __init__(self, redis_client, prefix: str = "docq", max_depth: int = 40, visibility_timeout: int = 300,
+                 max_attempts: Optional[dict] = None, retry_backoff: float = 10, job_expiration: int = 86400 * 7,
+                 priorities: Optional[dict] = None):
+        self._redis = redis_client
+        self._prefix = prefix
+        self.max_depth = max_depth
+        self.visibility_timeout = visibility_timeout
+        self._max_attempts = max_attempts or {}
+        self._retry_backoff = retry_backoff
+        self._job_expiration = job_expiration
+        self._priorities = priorities or {}
+        self._ready_key = f"{prefix}:ready"
+        self._delayed_key = f"{prefix}:delayed"
+        self._inflight_key = f"{prefix}:inflight"
+        self._enqueue = redis_client.register_script(ENQUEUE_SCRIPT)
+        self._claim = redis_client.register_script(CLAIM_SCRIPT)
+        self._finish = redis_client.register_script(FINISH_SCRIPT)
+        self._promote = redis_client.register_script(PROMOTE_SCRIPT)
+
+    @staticmethod
+    def job_id(uuid: str, user_id: Optional[str] = None) -> str:
+        return f"{user_id}-{uuid}" if user_id else uuid
+
+    def _job_key(self, job_id: str) -> str:
+        return f"{self._prefix}:job:{job_id}"
+
+    def max_attempts(self, stage: Optional[str]) -> int:
+        return int(self._max_attempts.get(stage) or self._max_attempts.get("default") or 1)
+
+    def depth(self) -> dict[str, int]:
+        pipe = self._redis.pipeline(transaction=False)
+        for key in [self._ready_key, self._delayed_key, self._inflight_key]:
+            pipe.zcard(key)
+        ready, delayed, inflight = pipe.execute()
+        return dict(ready=ready, delayed=delayed, inflight=inflight)
+
+    def full(self) -> bool:
+        depth = self.depth()
+        return depth["ready"] + depth["delayed"] >= self.max_depth
+
+    def enqueue(self, job: DocJob) -> tuple[DocJob, bool]:
+        '''
+        返回 (任务, 是否新入队)；同一文件已在排队 / 处理中时返回已有任务
+        '''
+        now = time.time()
+        job.priority = int(self._priorities.get(job.kind, job.priority))
+        job.status, job.enqueue_time = JobStatus.queued.value, now
+        current = self._enqueue(keys=[self._job_key(job.job_id), self._ready_key],
+                                args=[job.model_dump_json(), job.job_id, job.priority * PRIORITY_SCALE + int(now * 1000)])
+        if current:
+            doc_queue_jobs.inc(kind=job.kind, outcome="duplicate")
+            return DocJob.model_validate_json(current), False
+        doc_queue_jobs.inc(kind=job.kind, outcome="enqueued")
+        return job, True
+
+    def claim(self, worker: str) -> Optional[DocJob]:
+        job_id = self._claim(keys=[self._ready_key, self._inflight_key], args=[time.time() + self.visibility_timeout])
+        if not job_id:
+            return None
+        job_id = job_id.decode() if isinstance(job_id, bytes) else job_id
+
+        job = self.status(job_id)
+        if job is None:
+            # 任务数据已丢失，直接移出
+            self._redis.zrem(self._inflight_key, job_id)
+            logger.warning(f"DocQueue job {job_id} not found")
+            return None
+        job.status, job.worker, job.start_time, job.error = JobStatus.running.value, worker, time.time(), None
+        self._save(job)
+        return job
+
+    def _save(self, job: DocJob):
+        self._redis.set(self._job_key(job.job_id), job.model_dump_json(), xx=True)
+
+    def heartbeat(self, job: DocJob) -> bool:
+        '''
+        续期可见性超时，租约已被回收时返回 False
+        '''
+        return bool(self._redis.zadd(self._inflight_key, {job.job_id: time.time() + self.visibility_timeout}, xx=True, ch=True))
+
+    def enter_stage(self, context, stage: str):
+        '''
+        记录当前处理阶段（失败时按阶段计重试次数），队列任务同时更新任务状态
+        '''
+        context.stage = stage
+        job = context.job
+        if job is None:
+            return
+        job.stage = stage
+        try:
+            alive = self.heartbeat(job)
+            if alive:
+                self._save(job)
+        except Exception as e:
+            logger.warning(f"DocQueue save job {job.job_id} stage {stage} failed: {e}")
+            return
+        if not alive:
+            raise LeaseLostError(f"DocQueue job {job.job_id} lease lost before stage {stage}")
+
+    def will_retry(self, job: Optional[DocJob]) -> bool:
+        '''
+        当前阶段失败后是否还会重试，处理流程据此决定是否回调失败
+        '''
+        if job is None:
+            return False
+        return job.attempts.get(job.stage, 0) + 1 < self.max_attempts(job.stage)
+
+    def complete(self, job: DocJob) -> bool:
+        job.status, job.finish_time = JobStatus.success.value, time.time()
+        finished = self._finish(keys=[self._inflight_key, self._job_key(job.job_id)], args=[job.job_id, job.model_dump_json(), self._job_expiration])
+        if not finished:
+            logger.warning(f"DocQueue job {job.job_id} lease lost before complete")
+            return False
+        doc_queue_jobs.inc(kind=job.kind, outcome="success")
+        return True
+
+    def fail(self, job: DocJob, error: str, on_failed: Optional[Callable[[DocJob], None]] = None,
+             expired_before: Optional[float] = None) -> bool:
+        '''
+        当前阶段失败次数 +1，未超过 max_attempts 时延迟重试，否则调用 on_failed；返回是否重试
+        expired_before: 回收超时任务时传入，可见性超时已续期到该时间之后时不处理
+        '''
+        retry = self.will_retry(job)
+        job.attempts[job.stage] = job.attempts.get(job.stage, 0) + 1
+        job.error = error
+        if retry:
+            job.status = JobStatus.retrying.value
+            due = time.time() + self._retry_backoff * 2 ** (job.attempts[job.stage] - 1)
+            keys, args = [self._inflight_key, self._job_key(job.job_id), self._delayed_key], [job.job_id, job.model_dump_json(), due]
+        else:
+            job.status, job.finish_time = JobStatus.failed.value, time.time()
+            keys, args = [self._inflight_key, self._job_key(job.job_id)], [job.job_id, job.model_dump_json(), self._job_expiration]
+        if expired_before is not None:
+            args.append(expired_before)
+
+        if not self._finish(keys=keys, args=args):
+            if expired_before is None:
+                logger.warning(f"DocQueue job {job.job_id} lease lost before fail")
+            return False
+        if expired_before is not None:
+            doc_queue_jobs.inc(kind=job.kind, outcome="expired")
+        doc_queue_jobs.inc(kind=job.kind, outcome="retry" if retry else "failed")
+        logger.warning(f"DocQueue job {job.job_id} failed at stage {job.stage}, attempts: {job.attempts}, retry: {retry}, error: {error}")
+        if not retry and on_failed is not None:
+            try:
+                on_failed(job)
+            except Exception as e:
+                logger.error(f"DocQueue job {job.job_id} failure callback failed: {e}")
+        return retry
+
+    def summary(self, job_id: str) -> Optional[dict]:
+        '''
+        status 接口返回的任务状态
+        '''
+        job = self.status(job_id)
+        return job.model_dump(exclude={"params", "trace_carrier"}) if job else None
+
+    def status(self, job_id: str) -> Optional[DocJob]:
+        data = self._redis.get(self._job_key(job_id))
+        return DocJob.model_validate_json(data) if data else None
+
+    def maintain(self, on_failed: Optional[Callable[[DocJob], None]] = None):
+        '''
+        延迟队列到期的任务回到就绪队列；回收可见性超时的任务（worker 退出或宕机），按当前阶段失败处理
+        '''
+        now = time.time()
+        self._promote(keys=[self._delayed_key, self._ready_key], args=[now, int(now * 1000), f"{self._prefix}:job:"])
+
+        for job_id in self._redis.zrangebyscore(self._inflight_key, "-inf", now, start=0, num=100):
+            job_id = job_id.decode() if isinstance(job_id, bytes) else job_id
+            job = self.status(job_id)
+            if job is None:
+                self._redis.zrem(self._inflight_key, job_id)
+                continue
+            # 读取后 worker 可能已续期，是否回收以脚本内的判断为准
+            self.fail(job, f"visibility timeout, worker: {job.worker}", on_failed=on_failed, expired_before=now)
+
+        depth = self.depth()
+        for state, value in depth.items():
+            doc_queue_depth.set(value, state=state)
+        return depth
+
+
+def _build_doc_queue():
+    from pkg.redis.redis import redis_store
+
+    queue_config = config.get("doc_queue") or {}
+    return DocQueue(redis_store,
+                    prefix=queue_config.get("prefix", "docq"),
+                    max_depth=int(queue_config.get("max_depth", 40)),
+                    visibility_timeout=int(queue_config.get("visibility_timeout", 300)),
+                    max_attempts=queue_config.get("max_attempts"),
+                    retry_backoff=float(queue_config.get("retry_backoff", 10)),
+                    job_expiration=int(queue_config.get("job_expiration", 86400 * 7)),
+                    priorities=queue_config.get("priority"))
+
+
+doc_queue = _build_doc_queue()
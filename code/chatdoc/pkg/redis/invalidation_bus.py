@@ -0,0 +1,228 @@
+'''
+Author: longsion<xianglong_chen@intsig.net>
+Date: 2026-10-18 22:31:05
+LastEditors: longsion
+LastEditTime: 2026-10-18 22:50:26
+'''
+
+# 跨 worker 的缓存失效总线（Redis pub/sub）
+# - 文件重新解析 / 删除时 stage_cache.invalidate 发布失效消息 {namespace, keys}，namespace: file（文件 uuid）/ library（文件库）
+# - 每个进程一个订阅线程：收到消息后本地版本号 +1，并回调该 namespace 的订阅者（按文件 uuid 淘汰进程内缓存）
+# - 文件级进程缓存（片段树 / 原文段 / 文件向量）用本地版本号组成缓存 key，不再每次查询 Redis 版本号，可以使用很长的 TTL
+# - 版本戳兜底：每次发布 INCR 全局序号，订阅线程每 check_interval 秒比对已收到的消息数，
+#   连续两次检查都落后（漏收消息）或订阅断开重连时换代（generation +1），全部本地版本号失效并通知订阅者清空
+# - 订阅未建立（Redis 不可用 / 未启用）时 versions 返回 None，调用方回退到 Redis 中的版本号
+
+import json
+import os
+import threading
+import time
+from typing import Callable, Optional
+
+from pkg.config import config
+from pkg.utils.logger import logger
+from pkg.utils.metrics import global_metrics
+
+
+invalidation_messages = global_metrics.counter("cache_invalidation_messages_total", "Cache invalidation bus messages by namespace and direction")
+invalidation_resets = global_metrics.counter("cache_invalidation_resets_total", "Cache invalidation bus generation resets by reason")
+
+FILE_NAMESPACE = "file"
+LIBRARY_NAMESPACE = "library"
+
+
+class InvalidationBus:
+
+    def __init__(self, redis_client=None, channel: str = "cache-invalidation", check_interval: float = 5.0):
+        self._redis = redis_client
+        self._channel = channel
+        self._epoch_key = f"{channel}:epoch"
+        self._check_interval = check_interval
+        self._lock = threading.Lock()
+        self._subscribers: dict[str, list[Callable[[Optional[list[str]]], None]]] = {}
+        self._versions: dict[tuple[str, str], int] = {}
+        self._generation = 0
+        self._active = False
+        self._thread = None
+        self._pid = None
+
+    @property
+    def active(self) -> bool:
+        return self._active and self._pid == os.getpid()
+
+    def start(self):
+        if self._redis is None:
+            return
+        if self._pid != os.getpid():
+            # fork 后子进程没有订阅线程，重新订阅；未订阅前 versions 返回 None
+            self._active = False
+            self._thread = None
+            self._lock = threading.Lock()
+        if self._thread is not None:
+            return
+        with self._lock:
+            if self._thread is None:
+                self._pid = os.getpid()
+                self._thread = threading.Thread(target=self._run, name="invalidation-bus", daemon=True)
+                self._thread.start()
+
+    def subscribe(self, namespace: str, callback: Callable[[Optional[list[str]]], None]):
+        '''
+        callback(keys)：keys 为失效的 key 列表，None 表示可能漏收消息，需要清空全部
+        '''
+        with self._lock:
+            self._subscribers.setdefault(namespace, []).append(callback)
+        self.start()
+
+    def versions(self, namespace: str, keys: list[str]) -> Optional[list[str]]:
+        '''
+        本地版本号，订阅未建立时返回 None
+        '''
+        self.start()
+        if not self.active:
+            return None
+        with self._lock:
+            return [f"g{self._generation}.{self._versions.get((namespace, key), 0)}" for key in keys]
+
+    def publish(self, namespace: str, keys: list[str], local: bool = True):
+        '''
+        local=False 时本进程不立即生效，与其他 worker 一样由订阅线程按消息顺序处理
+        '''
+        keys = list(dict.fromkeys(keys or []))
+        if not keys:
+            return
+        # 本进程立即生效，订阅线程收到自己的消息后再 +1 不影响正确性
+        if local:
+            self._apply(namespace, keys)
+        if self._redis is None:
+            return
+        try:
+            epoch = self._redis.incr(self._epoch_key)
+            self._redis.publish(self._channel, json.dumps(dict(namespace=namespace, keys=keys, epoch=epoch)))
+            invalidation_messages.inc(namespace=namespace, direction="publish")
+        except Exception as e:
+            logger.error(f"InvalidationBus publish failed: {e}, namespace: {namespace}, keys: {keys}")
+
+    def _apply(self, namespace: str, keys: list[str]):
+        with self._lock:
+            for key in keys:
+                self._versions[(namespace, key)] = self._versions.get((namespace, key), 0) + 1
+            callbacks = list(self._subscribers.get(namespace, []))
+        self._notify(callbacks, keys)
+
+    def _reset(self, reason: str):
+        with self._lock:
+            self._generation += 1
+            self._versions.clear()
+            callbacks = [callback for callbacks in self._subscribers.values() for callback in callbacks]
+        invalidation_resets.inc(reason=reason)
+        self._notify(callbacks, None)
+
+    @staticmethod
+    def _notify(callbacks, keys: Optional[list[str]]):
+        for callback in callbacks:
+            try:
+                callback(keys)
+            except Exception as e:
+                logger.warning(f"InvalidationBus callback failed: {e}")
+
+    def _remote_epoch(self) -> int:
+        return int(self._redis.get(self._epoch_key) or 0)
+
+    def _run(self):
+        while True:
+            pubsub = None
+            try:
+                # 先读序号再订阅：两者之间发布的消息会被判定为漏收，只会多清空一次
+                base, received, pending = self._remote_epoch(), 0, None
+                pubsub = self._redis.pubsub(ignore_subscribe_messages=True)
+                pubsub.subscribe(self._channel)
+                # 订阅建立前（或断开期间）的消息都已错过
+                self._reset("subscribe")
+                self._active = True
+                next_check = time.time() + self._check_interval
+
+                while True:
+                    message = pubsub.get_message(timeout=self._check_interval)
+                    if message and message.get("type") == "message":
+                        received += 1
+                        self._on_message(message["data"])
+
+                    if time.time() >= next_check:
+                        remote = self._remote_epoch()
+                        if pending is not None and base + received < pending:
+                            logger.warning(f"InvalidationBus missed messages, expected epoch: {pending}, received: {base + received}")
+                            self._reset("missed")
+                            base, received = remote, 0
+                        pending = remote if remote > base + received else None
+                        next_check = time.time() + self._check_interval
+            except Exception as e:
+                if self._active:
+                    logger.warning(f"InvalidationBus subscription lost: {e}")
+                self._active = False
+                time.sleep(self._check_interval)
+            finally:
+                if pubsub is not None:
+                    try:
+                        pubsub.close()
+                    except Exception:
+                        pass
+
+    def _on_message(self, data):
+        try:
+            message = json.loads(data)
+            namespace, keys = message["namespace"], message["keys"]
+        except Exception as e:
+            logger.warning(f"InvalidationBus invalid message: {e}")
+            return
+        invalidation_messages.inc(namespace=namespace, direction="receive")
+        self._apply(namespace, keys)
+
+
+class FileKeyIndex:
+    '''
+    文件级进程缓存的 文件 uuid -> 缓存 key 索引，收到失效消息时立即从缓存删除（释放内存 / mmap），不必等 TTL
+    索引超过 max_files 时清空索引，只影响提前释放，缓存 key 中的版本号仍保证正确性
+    '''
+
+    def __init__(self, cache, bus: "InvalidationBus", max_files: int = 100000):
+        self._cache = cache
+        self._max_files = max_files
+        self._lock = threading.Lock()
+        self._keys: dict[str, set] = {}
+        bus.subscribe(FILE_NAMESPACE, self._on_invalidate)
+
+    def add(self, file_uuid: str, key: str):
+        with self._lock:
+            if len(self._keys) >= self._max_files and file_uuid not in self._keys:
+                self._keys.clear()
+            self._keys.setdefault(file_uuid, set()).add(key)
+
+    def _on_invalidate(self, file_uuids: Optional[list[str]]):
+        if file_uuids is None:
+            with self._lock:
+                self._keys.clear()
+            self._cache.clear()
+            return
+
+        with self._lock:
+            keys = [key for file_uuid in file_uuids for key in self._keys.pop(file_uuid, ())]
+        for key in keys:
+            try:
+                del self._cache[key]
+            except KeyError:
+                pass
+
+
+def _build_invalidation_bus():
+    bus_config = config.get("invalidation_bus") or {}
+    redis_client = None
+    if bus_config.get("enable", True):
+        from pkg.redis.redis import redis_store
+        redis_client = redis_store
+    return InvalidationBus(redis_client,
+                           channel=bus_config.get("channel", "cache-invalidation"),
+                           check_interval=float(bus_config.get("check_interval", 5)))
+
+
+invalidation_bus = _build_invalidation_bus()
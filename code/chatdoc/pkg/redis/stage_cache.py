@@ -0,0 +1,210 @@
+'''
+Author: longsion<xianglong_chen@intsig.net>
+Date: 2026-10-18 17:32:40
+LastEditors: longsion
+LastEditTime: 2026-10-18 23:34:20
+'''
+
+# 问答阶段结果缓存（进程内 L1 + Redis L2）
+# - key: 阶段名 + 归一化问题(replace_query 之后) + 排序后的文件 uuid + 索引版本
+# - 索引版本 = config stage_cache.index_version + 每个文件/文件库的版本号；文件重新解析或删除时版本号 +1，旧缓存自然失效
+# - value 为 pickle 后的字段快照，每次读取都反序列化出新对象，后续阶段修改不会污染缓存
+# - 文件对象的片段来源（doc_fragments_json / 片段 blob，MB 级）不写入缓存，命中后由片段树缓存按 uuid 加载
+# - Redis 异常时不读写缓存，直接走完整链路
+# - invalidate 同时通过失效总线通知其他 worker；文件级进程缓存用 file_versions（订阅建立时为本地版本号，不访问 Redis）
+
+import hashlib
+import pickle
+import threading
+from collections.abc import ValuesView
+from typing import Optional
+
+from pkg.config import config
+from pkg.redis.invalidation_bus import FILE_NAMESPACE, LIBRARY_NAMESPACE, invalidation_bus
+from pkg.utils.logger import logger
+from pkg.utils.lru_cache import ShardedLRUCacheDict
+from pkg.utils.metrics import global_metrics
+
+
+stage_cache_requests = global_metrics.counter("stage_cache_requests_total", "Stage result cache lookups by stage and outcome")
+
+
+ANALYST_LIBRARY = "analyst"
+
+
+def personal_library(user_id: str) -> str:
+    return f"personal:{user_id}"
+
+
+class StageCache:
+
+    def __init__(self, redis_client=None, prefix: str = "stage", index_version: str = "1",
+                 l1_max_size: int = 2000, l1_max_bytes: int = None, expiration: int = 3600, enable: bool = True):
+        self.enable = enable
+        self._redis = redis_client
+        self._prefix = prefix
+        self._index_version = str(index_version)
+        self._expiration = expiration
+        self._l1 = ShardedLRUCacheDict(max_size=l1_max_size, expiration=expiration, max_bytes=l1_max_bytes)
+        # 未启用 Redis 时的进程内版本号，仅单进程部署可用
+        self._local_versions = {}
+        self._lock = threading.Lock()
+
+    def _version_key(self, name: str) -> str:
+        return f"{self._prefix}:ver:{name}"
+
+    def versions(self, names: list[str]) -> Optional[list[str]]:
+        '''
+        文件/文件库当前的版本号，Redis 异常时返回 None
+        '''
+        if self._redis is None:
+            with self._lock:
+                return [str(self._local_versions.get(name, 0)) for name in names]
+        try:
+            return [(v or b"0").decode() for v in self._redis.mget([self._version_key(name) for name in names])]
+        except Exception as e:
+            logger.warning(f"StageCache get versions failed: {e}")
+            return None
+
+    def file_versions(self, file_uuids: list[str]) -> Optional[list[str]]:
+        '''
+        进程内文件级缓存使用的版本号：失效总线订阅正常时为本地版本号，否则为 Redis 中的版本号
+        '''
+        versions = invalidation_bus.versions(FILE_NAMESPACE, file_uuids)
+        return versions if versions is not None else self.versions(file_uuids)
+
+    def scope(self, question: str, document_uuids: list[str], libraries: list[str]) -> Optional[str]:
+        '''
+        一次问答的缓存范围，同一次问答的各阶段共用，返回 None 表示本次不走缓存
+        document_uuids 为空时为全库问答，使用文件库版本号
+        '''
+        question = " ".join((question or "").split())
+        if not self.enable or not question:
+            return None
+
+        uuids = sorted(set(document_uuids or []))
+        versions = self.versions(uuids or libraries)
+        if versions is None:
+            return None
+
+        raw = "|".join([self._index_version, question, ",".join(uuids), ",".join(libraries), ",".join(versions)])
+        return hashlib.md5(raw.encode("utf-8")).hexdigest()
+
+    def _key(self, scope: str, stage: str) -> str:
+        return f"{self._prefix}:{stage}:{scope}"
+
+    def get(self, scope: Optional[str], stage: str) -> Optional[dict]:
+        if scope is None:
+            return None
+
+        key = self._key(scope, stage)
+        blob = self._l1.get(key)
+        if blob is None and self._redis is not None:
+            try:
+                blob = self._redis.get(key)
+            except Exception as e:
+                logger.warning(f"StageCache get failed: {e}")
+            if blob is not None:
+                self._l1[key] = blob
+
+        stage_cache_requests.inc(stage=stage, outcome="miss" if blob is None else "hit")
+        if blob is None:
+            return None
+        try:
+            return pickle.loads(blob)
+        except Exception as e:
+            logger.warning(f"StageCache loads failed: {e}")
+            return None
+
+    def set(self, scope: Optional[str], stage: str, value: dict):
+        if scope is None:
+            return
+
+        key = self._key(scope, stage)
+        try:
+            blob = pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL)
+        except Exception as e:
+            logger.warning(f"StageCache dumps failed: {e}")
+            return
+
+        self._l1[key] = blob
+        if self._redis is not None:
+            try:
+                self._redis.set(key, blob, ex=self._expiration)
+            except Exception as e:
+                logger.warning(f"StageCache set failed: {e}")
+
+    def invalidate(self, uuids: list[str], libraries: list[str]):
+        '''
+        文件重新解析或删除后调用：文件与所属文件库的版本号 +1
+        '''
+        names = list(set(uuids or [])) + libraries
+        if self._redis is None:
+            with self._lock:
+                for name in names:
+                    self._local_versions[name] = self._local_versions.get(name, 0) + 1
+        else:
+            try:
+                pipe = self._redis.pipeline(transaction=False)
+                for name in names:
+                    pipe.incr(self._version_key(name))
+                pipe.execute()
+            except Exception as e:
+                logger.error(f"StageCache invalidate failed: {e}, uuids: {uuids}, libraries: {libraries}")
+
+        # 先更新 Redis 版本号再广播，收到消息的 worker 回退读取 Redis 版本号时也是新的
+        invalidation_bus.publish(FILE_NAMESPACE, uuids)
+        invalidation_bus.publish(LIBRARY_NAMESPACE, libraries)
+
+    def load(self, context, scope: Optional[str], stage: str) -> bool:
+        '''
+        命中时把缓存的字段写回 context
+        '''
+        value = self.get(scope, stage)
+        if value is None:
+            return False
+        for name, field_value in value.items():
+            setattr(context, name, field_value)
+        return True
+
+    def save(self, context, scope: Optional[str], stage: str, fields: list[str]):
+        value = {}
+        for name in fields:
+            field_value = getattr(context, name)
+            # preprocess_question 去重后 files 是 dict_values，无法 pickle
+            if isinstance(field_value, ValuesView):
+                field_value = list(field_value)
+            if isinstance(field_value, list):
+                field_value = [_without_fragments_source(item) for item in field_value]
+            value[name] = field_value
+        self.set(scope, stage, value)
+
+
+def _without_fragments_source(item):
+    # ESFileObject / PESFileObject 去掉片段来源的副本，不修改本次问答使用的对象
+    if not hasattr(item, "fragments_source") or not item.fragments_source:
+        return item
+    item = item.model_copy(update=dict(doc_fragments_json=""))
+    item._fragments_blob = None
+    return item
+
+
+def _build_stage_cache():
+    cache_config = config.get("stage_cache") or {}
+    enable = cache_config.get("enable", True)
+
+    redis_client = None
+    if enable and cache_config.get("redis_enable", True):
+        from pkg.redis.redis import redis_store
+        redis_client = redis_store
+
+    return StageCache(redis_client,
+                      prefix=cache_config.get("redis_prefix", "stage"),
+                      index_version=cache_config.get("index_version", "1"),
+                      l1_max_size=cache_config.get("l1_max_size", 2000),
+                      l1_max_bytes=cache_config.get("l1_max_bytes"),
+                      expiration=cache_config.get("expiration", 3600),
+                      enable=enable)
+
+
+stage_cache = _build_stage_cache()
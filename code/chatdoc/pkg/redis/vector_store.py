@@ -0,0 +1,58 @@
+'''
+Author: longsion<xianglong_chen@intsig.net>
+Date: 2026-10-18 11:31:02
+LastEditors: longsion
+LastEditTime: 2026-10-18 11:31:02
+'''
+
+import hashlib
+
+import numpy as np
+
+from pkg.utils.logger import logger
+
+
+class RedisVectorStore:
+    '''
+    embedding 的 Redis 二级缓存，作为 TieredCacheDict 的 L2 使用
+    - key 为 md5(cache_key)，value 为 float16/float32 的二进制 blob
+    - 批量读写使用 MGET / pipeline SET，一次网络往返
+    - Redis 异常只打印告警并视为未命中，不影响主流程
+    '''
+
+    def __init__(self, redis_client, prefix: str = "emb", dtype: str = "float16", expiration: int = None):
+        self._redis = redis_client
+        self._prefix = prefix
+        self._dtype = np.dtype(dtype)
+        self._expiration = expiration
+
+    def _redis_key(self, key: str) -> str:
+        return f"{self._prefix}:{self._dtype.name}:{hashlib.md5(key.encode('utf-8')).hexdigest()}"
+
+    def _encode(self, vector) -> bytes:
+        return np.asarray(vector, dtype=self._dtype).tobytes()
+
+    def _decode(self, blob: bytes) -> list[float]:
+        return np.frombuffer(blob, dtype=self._dtype).astype(np.float32).tolist()
+
+    def get_many(self, keys: list[str]) -> list:
+        if not keys:
+            return []
+        try:
+            blobs = self._redis.mget([self._redis_key(key) for key in keys])
+        except Exception as e:
+            logger.warning(f"RedisVectorStore mget failed: {e}")
+            return [None] * len(keys)
+
+        return [self._decode(blob) if blob else None for blob in blobs]
+
+    def set_many(self, mapping: dict):
+        if not mapping:
+            return
+        try:
+            pipe = self._redis.pipeline(transaction=False)
+            for key, vector in mapping.items():
+                pipe.set(self._redis_key(key), self._encode(vector), ex=self._expiration)
+            pipe.execute()
+        except Exception as e:
+            logger.warning(f"RedisVectorStore set failed: {e}")
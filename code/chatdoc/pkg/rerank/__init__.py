@@ -2,17 +2,18 @@
 Author: longsion<xianglong_chen@intsig.net>
 Date: 2024-04-25 15:55:17
 LastEditors: longsion
-LastEditTime: 2025-03-09 08:13:37
+LastEditTime: 2026-10-19 09:34:52
 '''
-from pkg.utils import retry_exponential_backoff
 from pkg.config import config
-from pkg.utils.lru_cache import LRUCacheDict
-import requests
+from pkg.utils.lru_cache import ShardedLRUCacheDict
+from pkg.utils.single_flight import SingleFlight
+from pkg.clients.http_client import get_http_client
 
-rerank_lru_cache = LRUCacheDict(max_size=20000, expiration=60 * 60)
+rerank_lru_cache = ShardedLRUCacheDict(max_size=20000, expiration=60 * 60)
+# 并发请求同一 (问题, 文本) 对时只请求一次
+rerank_single_flight = SingleFlight("rerank")
 
 
-@retry_exponential_backoff()
 def rerank_api(pairs, headers=None, url='http://xxxx/rerank', if_softmax=0):
     json_text = {
         "input": pairs,
@@ -25,34 +26,53 @@ def rerank_api(pairs, headers=None, url='http://xxxx/rerank', if_softmax=0):
         "x-ti-secret-code": config["textin"]["app_secret"],
     })
 
-    completion = requests.post(url=url or config["textin"]["rerank_url"],
-                               headers=headers or None,
-                               json=json_text)
+    completion = get_http_client("rerank").post(url=url or config["textin"]["rerank_url"],
+                                                headers=headers or None,
+                                                json=json_text)
     completion.raise_for_status()
     return completion.json()["rerank_score"]
 
 
+def rerank_cache_key(text1: str, text2: str) -> str:
+    return text1 + '##' + text2
+
+
 def rerank_api_by_cache(pairs, headers=None, url='http://xxxx/rerank', if_softmax=0):
     text1_list, text2_list = pairs[0], pairs[1]
 
     result = []
-    to_request_text2_list = []
     request_indices = []
     for i, text_2 in enumerate(text2_list):
-        cache_key = text1_list[0] + '##' + text_2
+        cache_key = rerank_cache_key(text1_list[0], text_2)
         try:
             result.append(rerank_lru_cache[cache_key])
 
         except KeyError:
-            to_request_text2_list.append(text_2)
             request_indices.append(i)
             result.append(None)  # 占位符
 
-    if to_request_text2_list:
-        rerank_scores = rerank_api([text1_list, to_request_text2_list], headers=headers, url=url, if_softmax=if_softmax)
+    def _request(cache_keys):
+        # cache_key 与 text_2 一一对应，只请求既未缓存、也不在其他线程请求中的文本
+        # 取得请求权后再查一次缓存：未命中到取得请求权之间，上一个请求可能刚写入
+        scores = {}
+        for cache_key in cache_keys:
+            try:
+                scores[cache_key] = rerank_lru_cache[cache_key]
+            except KeyError:
+                pass
+        missing = [cache_key for cache_key in cache_keys if cache_key not in scores]
+        if missing:
+            to_request_text2_list = [request_texts[cache_key] for cache_key in missing]
+            rerank_scores = rerank_api([text1_list, to_request_text2_list], headers=headers, url=url, if_softmax=if_softmax)
+            for cache_key, rerank_score in zip(missing, rerank_scores):
+                rerank_lru_cache[cache_key] = rerank_score
+                scores[cache_key] = rerank_score
+        return [scores[cache_key] for cache_key in cache_keys]
+
+    if request_indices:
+        request_texts = {rerank_cache_key(text1_list[0], text2_list[idx]): text2_list[idx] for idx in request_indices}
+        rerank_scores = rerank_single_flight.do_many([rerank_cache_key(text1_list[0], text2_list[idx]) for idx in request_indices], _request)
         for idx, rerank_score in zip(request_indices, rerank_scores):
-            cache_key = text1_list[0] + '##' + text2_list[idx]
-            rerank_lru_cache[cache_key] = rerank_score
             result[idx] = rerank_score
 
     return result
@@ -0,0 +1,157 @@
+'''
+Author: longsion<xianglong_chen@intsig.net>
+Date: 2026-10-18 14:05:18
+LastEditors: longsion
+LastEditTime: 2026-10-19 09:48:05
+'''
+
+# 进程级 rerank 微批调度
+# 所有请求的 (query, passage) 按 (url, headers, query) 聚合，不同服务地址 / 鉴权的请求不会合入同一批，凑满 batch_size 或等待超过 max_wait_ms 后统一下发，
+# 在有界线程池中调用 rerank 服务，通过 Future 返回给调用方
+# 调用方最多等待 result_timeout 秒；服务返回的分数个数不一致或调度异常时，对应的 Future 以异常结束，不会一直挂起
+
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
+
+from pkg.config import config
+from pkg.rerank import rerank_api, rerank_cache_key, rerank_lru_cache
+from pkg.utils.logger import logger
+from pkg.utils.metrics import global_metrics
+
+
+rerank_batch_size_histogram = global_metrics.histogram("rerank_batch_size", "Rerank dispatched batch size", buckets=(1, 2, 4, 8, 12, 16, 24, 32, 64))
+rerank_queue_wait_histogram = global_metrics.histogram("rerank_queue_wait_seconds", "Rerank pair wait time before dispatch")
+
+
+class _PendingQuery:
+    __slots__ = ("query", "url", "headers", "first_ts", "passages")
+
+    def __init__(self, query: str, url: str, headers: dict = None):
+        self.query = query
+        self.url = url
+        self.headers = headers
+        self.first_ts = time.monotonic()
+        # passage -> [Future]，同一 query 下重复的 passage 只请求一次
+        self.passages = OrderedDict()
+
+
+class RerankBatcher:
+
+    def __init__(self, batch_size: int = 16, max_wait_ms: float = 5, max_concurrency: int = 16, url: str = None,
+                 result_timeout: float = 30):
+        self.batch_size = batch_size
+        self.max_wait = max_wait_ms / 1000
+        self.result_timeout = result_timeout
+        self.url = url
+
+        # (url, headers, query) -> _PendingQuery
+        self._pending = OrderedDict()
+        self._cond = threading.Condition()
+        self._executor = ThreadPoolExecutor(max_workers=max_concurrency, thread_name_prefix="rerank-batcher")
+        self._dispatcher = threading.Thread(target=self._run, name="rerank-batcher-dispatcher", daemon=True)
+        self._dispatcher.start()
+
+    def submit(self, query: str, passage: str, headers: dict = None, url: str = None) -> Future:
+        future = Future()
+        cached = rerank_lru_cache.get(rerank_cache_key(query, passage))
+        if cached is not None:
+            future.set_result(cached)
+            return future
+
+        url = url or self.url or config["textin"]["rerank_url"]
+        key = (url, tuple(sorted(headers.items())) if headers else None, query)
+        with self._cond:
+            pending = self._pending.get(key)
+            if pending is None:
+                pending = self._pending[key] = _PendingQuery(query, url, dict(headers) if headers else None)
+                # 新的 query 需要调度线程重新计算等待时间
+                self._cond.notify()
+            pending.passages.setdefault(passage, []).append(future)
+            if len(pending.passages) >= self.batch_size:
+                self._cond.notify()
+        return future
+
+    def score(self, query: str, passages: list[str], headers: dict = None, url: str = None) -> list[float]:
+        '''
+        与 rerank_api_by_cache([[query], passages], headers=headers, url=url) 返回一致
+        '''
+        futures = [self.submit(query, passage, headers=headers, url=url) for passage in passages]
+        deadline = time.monotonic() + self.result_timeout
+        return [future.result(timeout=max(0, deadline - time.monotonic())) for future in futures]
+
+    def _take_batches(self, now):
+        # 凑满 batch_size 的立即下发；不满的等到最早一条超过 max_wait 再下发
+        batches = []
+        next_deadline = None
+        for key in list(self._pending.keys()):
+            pending = self._pending[key]
+            deadline = pending.first_ts + self.max_wait
+            while len(pending.passages) >= self.batch_size or (pending.passages and now >= deadline):
+                items = [pending.passages.popitem(last=False) for _ in range(min(self.batch_size, len(pending.passages)))]
+                batches.append((pending, items))
+            if pending.passages:
+                next_deadline = deadline if next_deadline is None else min(next_deadline, deadline)
+            else:
+                del self._pending[key]
+        return batches, next_deadline
+
+    def _run(self):
+        while True:
+            batches = []
+            try:
+                with self._cond:
+                    batches, next_deadline = self._take_batches(time.monotonic())
+                    if not batches:
+                        timeout = None if next_deadline is None else max(0, next_deadline - time.monotonic())
+                        self._cond.wait(timeout)
+                        continue
+
+                while batches:
+                    pending, items = batches[0]
+                    rerank_queue_wait_histogram.observe(time.monotonic() - pending.first_ts)
+                    rerank_batch_size_histogram.observe(len(items))
+                    self._executor.submit(self._dispatch, pending, items)
+                    batches.pop(0)
+            except Exception as e:
+                # 调度线程不退出，本轮已取出但未下发的请求直接失败
+                logger.error(f"rerank batcher dispatch failed: {e}")
+                for _, items in batches:
+                    _fail(items, e)
+
+    def _dispatch(self, pending: _PendingQuery, items: list):
+        query = pending.query
+        passages = [passage for passage, _ in items]
+        try:
+            # rerank_api 会往 headers 写入鉴权，每批使用副本
+            scores = rerank_api([[query], passages], headers=dict(pending.headers) if pending.headers else None,
+                                url=pending.url, if_softmax=0)
+            if len(scores) != len(passages):
+                raise ValueError(f"rerank returned {len(scores)} scores for {len(passages)} passages")
+        except Exception as e:
+            logger.warning(f"rerank batch failed, size: {len(passages)}, error: {e}")
+            _fail(items, e)
+            return
+
+        for (passage, futures), score in zip(items, scores):
+            rerank_lru_cache[rerank_cache_key(query, passage)] = score
+            for future in futures:
+                future.set_result(score)
+
+
+def _fail(items: list, error: Exception):
+    for _, futures in items:
+        for future in futures:
+            future.set_exception(error)
+
+
+def _build_rerank_batcher():
+    rerank_config = config.get("rerank") or {}
+    return RerankBatcher(batch_size=int(rerank_config.get("batch_size", 16)),
+                         max_wait_ms=float(rerank_config.get("max_wait_ms", 5)),
+                         max_concurrency=int(rerank_config.get("max_concurrency", 16)),
+                         result_timeout=float(rerank_config.get("result_timeout", 30)))
+
+
+rerank_batcher = _build_rerank_batcher()
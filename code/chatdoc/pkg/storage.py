@@ -2,7 +2,7 @@
 Author: longsion<xianglong_chen@intsig.net>
 Date: 2024-08-06 14:42:29
 LastEditors: longsion
-LastEditTime: 2025-03-07 15:36:14
+LastEditTime: 2026-10-18 21:41:37
 '''
 import os
 
@@ -49,3 +49,18 @@ class Storage:
 
         with open(filepath, "rb") as f:
             return f.read(), None
+
+    @staticmethod
+    def local_path(filename):
+        # 本地存储可直接 mmap
+        filedir = config["location"]["base_file_path"].format(BASE_DIR=BASE_DIR)
+        return os.path.join(filedir, filename)
+
+    @staticmethod
+    def download_range(filename, start, length, url=None):
+        try:
+            with open(Storage.local_path(filename), "rb") as f:
+                f.seek(start)
+                return f.read(length), None
+        except Exception as e:
+            return None, e
@@ -2,7 +2,7 @@
 Author: longsion<xianglong_chen@intsig.net>
 Date: 2024-08-06 14:42:29
 LastEditors: longsion
-LastEditTime: 2024-10-16 14:33:45
+LastEditTime: 2026-10-18 21:41:37
 '''
 import requests
 
@@ -63,3 +63,22 @@ class Storage:
         save_file(download_path, ret.content)
 
         return ret.content, None
+
+    @staticmethod
+    def local_path(filename):
+        # 远程存储不能 mmap，按 Range 读取
+        return None
+
+    @staticmethod
+    def download_range(filename, start, length, url=None):
+        try:
+            ret = requests.get((url or config["storage"]["download_address"]) + filename,
+                               headers={"Range": f"bytes={start}-{start + length - 1}"}, timeout=60)
+            ret.raise_for_status()
+        except Exception as e:
+            return None, e
+
+        # 不支持 Range 的存储返回 200 与完整内容
+        if ret.status_code == 200:
+            return ret.content[start:start + length], None
+        return ret.content, None
@@ -2,12 +2,13 @@
 Author: longsion<xianglong_chen@intsig.net>
 Date: 2024-04-24 15:37:47
 LastEditors: longsion
-LastEditTime: 2025-03-09 08:13:43
+LastEditTime: 2026-10-19 00:08:14
 '''
 from pkg.config import config
 from pkg.utils.jaeger import TracedThreadPoolExecutor
 from pkg.utils.logger import logger
 import requests
+import asyncio
 from functools import wraps
 import time
 import re
@@ -28,7 +29,6 @@ def md5(content):
 
 
 global_thread_pool = TracedThreadPoolExecutor(max_workers=config["threadpool"]["global_worker"])
-global_file_thread_pool = TracedThreadPoolExecutor(max_workers=config["threadpool"]["doc_process_worker"])
 
 
 def print_run_time(func):
@@ -50,9 +50,16 @@ def print_run_time(func):
 
 def save_file(path, content):
     if not os.path.exists(os.path.dirname(path)):
-        os.makedirs(os.path.dirname(path))
-    with open(path, "wb") as f:
-        f.write(content)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+    # 先写临时文件再原子替换：读取方可能正 mmap 旧文件（原文段），原地截断会导致 SIGBUS
+    tmp_path = f"{path}.{os.getpid()}.{time.time_ns()}.tmp"
+    try:
+        with open(tmp_path, "wb") as f:
+            f.write(content)
+        os.replace(tmp_path, path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
 
 
 def top_p(retrieval_infos, top_p_score):
@@ -66,8 +73,35 @@ def top_p(retrieval_infos, top_p_score):
     return results
 
 
+try:
+    import httpx
+    # 异步请求（httpx）的连接 / 读取错误同样重试
+    RETRY_EXCEPTIONS = (requests.exceptions.RequestException, httpx.TransportError)
+except ImportError:  # pragma: no cover
+    RETRY_EXCEPTIONS = (requests.exceptions.RequestException,)
+
+
 def retry_exponential_backoff(max_retries=3, base_delay=1):
     def decorator(func):
+        if asyncio.iscoroutinefunction(func):
+            @wraps(func)
+            async def async_wrapper(*args, **kwargs):
+                retries = 0
+                func_name = func.__name__
+                while retries < max_retries:
+                    try:
+                        return await func(*args, **kwargs)
+                    except RETRY_EXCEPTIONS as e:
+                        wait_time = base_delay * (2 ** retries)
+                        logger.warning(f"{func_name}请求失败，{wait_time}秒后重试...{e}")
+                        logger.warning(f"{func_name}正在尝试第{retries + 1}次请求")
+                        await asyncio.sleep(wait_time)
+                        retries += 1
+                logger.error(f'{func_name}达到最大重试次数，请求失败')
+                raise Exception(f"{func_name}达到最大重试次数，请求失败")
+
+            return async_wrapper
+
         @wraps(func)
         def wrapper(*args, **kwargs):
             retries = 0
@@ -89,8 +123,9 @@ def retry_exponential_backoff(max_retries=3, base_delay=1):
     return decorator
 
 
-@retry_exponential_backoff()
 def embedding_multi(origin_text, headers=None, url=None):
+    from pkg.clients.http_client import get_http_client
+
     json_text = {
         "input": origin_text
     }
@@ -101,9 +136,9 @@ def embedding_multi(origin_text, headers=None, url=None):
         "x-ti-secret-code": config["textin"]["app_secret"],
     })
 
-    completion = requests.post(url=url or config["textin"]["embedding_url"],
-                               headers=headers or None,
-                               json=json_text)
+    completion = get_http_client("embedding").post(url=url or config["textin"]["embedding_url"],
+                                                   headers=headers or None,
+                                                   json=json_text)
     completion.raise_for_status()
     return completion.json()["result"]["embedding"]
 
@@ -247,28 +282,52 @@ def decompress(gzipped_data):
     return decompressed_data.decode('utf-8', errors='ignore')
 
 
+def _edit_distance_peq(pattern):
+    # 字符 -> 在 pattern 中出现位置的 bitmask
+    peq = {}
+    for i, c in enumerate(pattern):
+        peq[c] = peq.get(c, 0) | (1 << i)
+    return peq
+
+
+def _edit_distance_bit_parallel(peq, m, text):
+    """
+    Myers/Hyyrö bit-parallel Levenshtein，O(⌈m/w⌉·n)，用 python int 表示任意长度的位向量
+    """
+    if m == 0:
+        return len(text)
+
+    mask = (1 << m) - 1
+    high_bit = 1 << (m - 1)
+    pv, mv, score = mask, 0, m
+    for c in text:
+        eq = peq.get(c, 0)
+        xv = eq | mv
+        xh = (((eq & pv) + pv) ^ pv) | eq
+        ph = mv | (~(xh | pv) & mask)
+        mh = pv & xh
+        if ph & high_bit:
+            score += 1
+        elif mh & high_bit:
+            score -= 1
+        ph = ((ph << 1) | 1) & mask
+        mh = (mh << 1) & mask
+        pv = mh | (~(xv | ph) & mask)
+        mv = ph & xv
+    return score
+
+
 def edit_distance(str1, str2):
-    m, n = len(str1), len(str2)
-    # 创建一个矩阵来存储子问题的解
-    dp = [[0] * (n + 1) for _ in range(m + 1)]
-
-    # 填充矩阵的第一行和第一列
-    for i in range(m + 1):
-        dp[i][0] = i
-    for j in range(n + 1):
-        dp[0][j] = j
-
-    # 通过比较字符并考虑插入、删除和替换操作来填充dp矩阵
-    for i in range(1, m + 1):
-        for j in range(1, n + 1):
-            if str1[i - 1] == str2[j - 1]:
-                dp[i][j] = dp[i - 1][j - 1]
-            else:
-                dp[i][j] = 1 + min(dp[i - 1][j],    # 删除
-                                   dp[i][j - 1],    # 插入
-                                   dp[i - 1][j - 1])  # 替换
-
-    return dp[m][n]
+    """
+    >>> edit_distance("kitten", "sitting")
+    3
+    >>> edit_distance("", "abc")
+    3
+    """
+    # 较短的串作为 pattern，位向量更短
+    if len(str1) > len(str2):
+        str1, str2 = str2, str1
+    return _edit_distance_bit_parallel(_edit_distance_peq(str1), len(str1), str2)
 
 
 def group_by_func(entities: list[object], keyfunc: callable) -> list[tuple]:
@@ -0,0 +1,85 @@
+'''
+Author: longsion<xianglong_chen@intsig.net>
+Date: 2026-10-18 16:20:37
+LastEditors: longsion
+LastEditTime: 2026-10-18 23:47:15
+'''
+
+# asyncio 模式下的公共工具
+# - run_sync: 同步阶段提交到有界的请求线程池执行（threadpool.request_worker，与问答子任务的 global_task_pool 分开），传递 trace 与请求级 ThreadContext
+# - aiter_sync: 同步迭代器转异步迭代器，每次 next 在线程池执行
+# - get_async_http_client: 事件循环内共享的 httpx.AsyncClient（需安装 httpx）
+
+import asyncio
+import contextvars
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+
+from opentelemetry import context as otel_context
+
+from pkg.config import config
+from pkg.utils.jaeger import TracedThreadPoolExecutor
+from pkg.utils.thread_with_return_value import ThreadContext
+
+try:
+    import httpx
+except ImportError:  # pragma: no cover
+    httpx = None
+
+
+# 同时执行的同步阶段数即请求并发上限，超出的请求在线程池中排队；子任务仍提交到 global_task_pool，不会被请求本身占满
+request_pool = TracedThreadPoolExecutor(max_workers=int(config["threadpool"].get("request_worker") or 32),
+                                        thread_name_prefix="request")
+
+# 事件循环线程被所有请求共享，请求级 ThreadContext 改用 contextvars 保存
+_request_thread_context = contextvars.ContextVar("request_thread_context", default=None)
+
+
+def set_request_thread_context(context: ThreadContext):
+    _request_thread_context.set(context)
+
+
+def get_request_thread_context() -> ThreadContext:
+    return _request_thread_context.get() or ThreadContext()
+
+
+async def run_sync(fn, *args, **kwargs):
+    func = partial(fn, *args, **kwargs)
+    # 绕过 TracedThreadPoolExecutor.submit 读取当前线程的 ThreadContext，显式传入请求级上下文
+    future = ThreadPoolExecutor.submit(request_pool, request_pool.with_otel_context,
+                                       get_request_thread_context(), otel_context.get_current(), func, getattr(fn, "__name__", "run_sync"))
+    return await asyncio.wrap_future(future)
+
+
+async def aiter_sync(iterator):
+    sentinel = object()
+    while True:
+        item = await run_sync(next, iterator, sentinel)
+        if item is sentinel:
+            break
+        yield item
+
+
+_async_http_clients = {}
+
+
+def get_async_http_client():
+    if httpx is None:
+        raise ImportError("httpx is required for the asyncio infer mode")
+
+    loop = asyncio.get_running_loop()
+    client = _async_http_clients.get(loop)
+    if client is None:
+        pool_maxsize = int((config.get("http") or {}).get("pool_maxsize") or config["threadpool"]["global_worker"])
+        client = _async_http_clients[loop] = httpx.AsyncClient(
+            timeout=httpx.Timeout(600, connect=5),
+            limits=httpx.Limits(max_connections=pool_maxsize, max_keepalive_connections=pool_maxsize),
+            verify=False,
+        )
+    return client
+
+
+async def close_async_http_client():
+    client = _async_http_clients.pop(asyncio.get_running_loop(), None)
+    if client is not None:
+        await client.aclose()
@@ -2,15 +2,18 @@
 Author: longsion<xianglong_chen@intsig.net>
 Date: 2024-04-17 10:42:33
 LastEditors: longsion
-LastEditTime: 2024-04-26 10:59:48
+LastEditTime: 2026-10-19 00:14:02
 '''
 
 from collections import OrderedDict
+import sys
 import time
 import threading
 import weakref
 from concurrent.futures import ThreadPoolExecutor
 
+from pkg.utils.single_flight import SingleFlight
+
 
 def lru_cache_function(max_size=1024, expiration=15 * 60, **kwargs):
     """
@@ -218,6 +221,292 @@ class LRUCacheDict(object):
             return None
 
 
+def estimate_nbytes(value):
+    """
+    粗略估算缓存值占用的内存字节数，用于按字节淘汰.
+    同构列表(如 embedding 向量、向量列表)按首元素采样估算，保证 O(1)
+
+    >>> estimate_nbytes(b"abc")
+    3
+    >>> estimate_nbytes([0.1] * 1024) > 1024 * 8
+    True
+    """
+    nbytes = getattr(value, "nbytes", None)
+    if isinstance(nbytes, int):
+        # numpy.ndarray
+        return nbytes
+    if isinstance(value, (bytes, bytearray, memoryview)):
+        return len(value)
+    if isinstance(value, (list, tuple)):
+        size = sys.getsizeof(value)
+        if value:
+            size += len(value) * estimate_nbytes(value[0])
+        return size
+    if isinstance(value, dict):
+        return sys.getsizeof(value) + sum(estimate_nbytes(k) + estimate_nbytes(v) for k, v in value.items())
+    return sys.getsizeof(value)
+
+
+class _CacheShard(object):
+    __slots__ = ("lock", "entries", "wheel", "wheel_cursor", "nbytes")
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        # key -> [value, expire_tick, nbytes]，按访问顺序排列，头部为最久未访问
+        self.entries = OrderedDict()
+        # 时间轮: expire_tick -> 该tick过期的key集合
+        self.wheel = {}
+        self.wheel_cursor = None
+        self.nbytes = 0
+
+
+class ShardedLRUCacheDict(object):
+    """ 分片的 LRU/TTL 缓存，可直接替换 LRUCacheDict.
+
+    - key 按 hash 分配到各个分片，每个分片一把锁，get/set 均为 O(1)
+    - 过期采用时间轮惰性清理：每次访问只推进当前分片的时间轮，不再全量遍历
+    - 同时支持按条目数(max_size)与按字节数(max_bytes)淘汰
+
+    >>> d = ShardedLRUCacheDict(max_size=3, expiration=3, shards=1)
+    >>> d['foo'] = 'bar'
+    >>> d['foo']
+    'bar'
+    >>> import time
+    >>> time.sleep(4) # 4 seconds > 3 second cache expiry of d
+    >>> d['foo']
+    Traceback (most recent call last):
+        ...
+    KeyError: 'foo'
+    >>> d['a'] = 'A'
+    >>> d['b'] = 'B'
+    >>> d['c'] = 'C'
+    >>> d['a']
+    'A'
+    >>> d['d'] = 'D'
+    >>> d['b'] # Should return value error, since b is the least recently used
+    Traceback (most recent call last):
+        ...
+    KeyError: 'b'
+    >>> d.size()
+    3
+
+    max_bytes 是所有分片的总字节上限，超过时从最久未访问的条目开始淘汰
+
+    >>> d = ShardedLRUCacheDict(max_size=100, max_bytes=10, shards=1)
+    >>> d['a'] = b'12345'
+    >>> d['b'] = b'12345'
+    >>> d['c'] = b'12345'
+    >>> 'a' in d, 'b' in d, 'c' in d
+    (False, True, True)
+    >>> d.nbytes()
+    10
+    """
+
+    def __init__(self, max_size=1024, expiration=15 * 60, max_bytes=None, shards=16, tick=1.0, sizeof=estimate_nbytes):
+        self.max_size = max_size
+        self.expiration = expiration
+        self.max_bytes = max_bytes
+
+        self._tick = tick
+        self._expire_ticks = None if expiration is None else max(1, int(-(-expiration // tick)))
+        self._sizeof = sizeof
+        self._shards = [_CacheShard() for _ in range(max(1, shards))]
+        self._shard_max_size = max(1, -(-max_size // len(self._shards)))
+        self._shard_max_bytes = -(-max_bytes // len(self._shards)) if max_bytes else None
+
+    def _get_shard(self, key) -> _CacheShard:
+        return self._shards[hash(key) % len(self._shards)]
+
+    def _now_tick(self):
+        return int(time.monotonic() / self._tick)
+
+    @staticmethod
+    def _remove(shard: _CacheShard, key):
+        entry = shard.entries.pop(key)
+        shard.nbytes -= entry[2]
+        bucket = shard.wheel.get(entry[1])
+        if bucket is not None:
+            bucket.discard(key)
+            if not bucket:
+                del shard.wheel[entry[1]]
+        return entry
+
+    def _advance_wheel(self, shard: _CacheShard, now_tick):
+        cursor = shard.wheel_cursor
+        shard.wheel_cursor = now_tick
+        if cursor is None or now_tick <= cursor or not shard.wheel:
+            return
+
+        if now_tick - cursor > len(shard.wheel):
+            # 长时间未访问，直接按桶遍历，避免逐tick空转
+            due_ticks = sorted(t for t in shard.wheel if t <= now_tick)
+        else:
+            due_ticks = range(cursor + 1, now_tick + 1)
+
+        for t in due_ticks:
+            for key in shard.wheel.pop(t, ()):
+                entry = shard.entries.get(key)
+                if entry is not None and entry[1] == t:
+                    shard.entries.pop(key)
+                    shard.nbytes -= entry[2]
+
+    def _evict(self, shard: _CacheShard):
+        entries = shard.entries
+        while entries and (len(entries) > self._shard_max_size
+                           or (self._shard_max_bytes and shard.nbytes > self._shard_max_bytes)):
+            self._remove(shard, next(iter(entries)))
+
+    def size(self):
+        return sum(len(shard.entries) for shard in self._shards)
+
+    def nbytes(self):
+        return sum(shard.nbytes for shard in self._shards)
+
+    def clear(self):
+        for shard in self._shards:
+            with shard.lock:
+                shard.entries.clear()
+                shard.wheel.clear()
+                shard.nbytes = 0
+
+    def __len__(self):
+        return self.size()
+
+    def __contains__(self, key):
+        return self.has_key(key)
+
+    def has_key(self, key):
+        shard = self._get_shard(key)
+        now_tick = self._now_tick()
+        with shard.lock:
+            self._advance_wheel(shard, now_tick)
+            return key in shard.entries
+
+    def __setitem__(self, key, value):
+        nbytes = self._sizeof(value)
+        shard = self._get_shard(key)
+        now_tick = self._now_tick()
+        expire_tick = None if self._expire_ticks is None else now_tick + self._expire_ticks
+
+        with shard.lock:
+            self._advance_wheel(shard, now_tick)
+            if key in shard.entries:
+                self._remove(shard, key)
+
+            shard.entries[key] = [value, expire_tick, nbytes]
+            shard.nbytes += nbytes
+            if expire_tick is not None:
+                bucket = shard.wheel.get(expire_tick)
+                if bucket is None:
+                    bucket = shard.wheel[expire_tick] = set()
+                bucket.add(key)
+
+            self._evict(shard)
+
+    def __getitem__(self, key):
+        shard = self._get_shard(key)
+        now_tick = self._now_tick()
+        with shard.lock:
+            self._advance_wheel(shard, now_tick)
+            entry = shard.entries[key]
+            shard.entries.move_to_end(key)
+            return entry[0]
+
+    def __delitem__(self, key):
+        shard = self._get_shard(key)
+        with shard.lock:
+            if key in shard.entries:
+                self._remove(shard, key)
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def cleanup(self):
+        now_tick = self._now_tick()
+        for shard in self._shards:
+            with shard.lock:
+                self._advance_wheel(shard, now_tick)
+        return None
+
+
+class TieredCacheDict(object):
+    """ 两级缓存：L1 为进程内缓存，L2 为跨进程共享缓存(如 Redis).
+
+    l2 需实现 get_many(keys) -> list(缺失为 None) 与 set_many(dict)，L2 异常由 l2 自行处理。
+    L2 命中时回填 L1，写入时同时写两级
+
+    >>> class DictL2(dict):
+    ...     def get_many(self, keys):
+    ...         return [self.get(k) for k in keys]
+    ...     def set_many(self, mapping):
+    ...         self.update(mapping)
+    >>> l2 = DictL2()
+    >>> d = TieredCacheDict(ShardedLRUCacheDict(max_size=3, expiration=3), l2)
+    >>> d['foo'] = 'bar'
+    >>> l2['foo']
+    'bar'
+    >>> d.l1.clear()
+    >>> d['foo']
+    'bar'
+    >>> 'foo' in d.l1
+    True
+    >>> d.get_many(['foo', 'miss'])
+    ['bar', None]
+    >>> d['miss']
+    Traceback (most recent call last):
+        ...
+    KeyError: 'miss'
+    """
+
+    def __init__(self, l1, l2=None):
+        self.l1 = l1
+        self.l2 = l2
+
+    def __getitem__(self, key):
+        value = self.get_many([key])[0]
+        if value is None:
+            raise KeyError(key)
+        return value
+
+    def __setitem__(self, key, value):
+        self.set_many({key: value})
+
+    def __delitem__(self, key):
+        del self.l1[key]
+
+    def __contains__(self, key):
+        return self.get(key) is not None
+
+    def has_key(self, key):
+        return key in self
+
+    def get(self, key, default=None):
+        value = self.get_many([key])[0]
+        return default if value is None else value
+
+    def size(self):
+        return self.l1.size()
+
+    def get_many(self, keys):
+        result = [self.l1.get(key) for key in keys]
+        missing = [i for i, value in enumerate(result) if value is None]
+        if missing and self.l2 is not None:
+            for i, value in zip(missing, self.l2.get_many([keys[i] for i in missing])):
+                if value is not None:
+                    self.l1[keys[i]] = value
+                    result[i] = value
+        return result
+
+    def set_many(self, mapping: dict):
+        for key, value in mapping.items():
+            self.l1[key] = value
+        if self.l2 is not None and mapping:
+            self.l2.set_many(mapping)
+
+
 class LRUCachedFunction(object):
     """
     A memoized function, backed by an LRU cache.
@@ -253,60 +542,94 @@ class LRUCachedFunction(object):
 
     """
 
-    def __init__(self, function, cache=None, cache_key_suffix: str = None):
+    def __init__(self, function, cache=None, cache_key_suffix: str = None, key_func=None, single_flight: SingleFlight = None):
         if cache:
             self.cache = cache
         else:
             self.cache = LRUCacheDict()
         self.function = function
         self._cache_key_suffix = cache_key_suffix or self.function.__name__
+        # key_func(*args, **kwargs) -> str，与 BatchCacheManager 共用同一个 key_func 时两者可共享缓存
+        self._key_func = key_func
+        # 并发未命中同一个 key 时只请求一次，共享缓存时 BatchCacheManager 传入同一个 single_flight
+        self._single_flight = single_flight or SingleFlight(self._cache_key_suffix)
 
     def __call__(self, *args, **kwargs):
-        key = repr((args, kwargs)) + "#" + self._cache_key_suffix  # In principle a python repr(...) should not return any # characters.
+        if self._key_func:
+            key = self._key_func(*args, **kwargs)
+        else:
+            key = repr((args, kwargs)) + "#" + self._cache_key_suffix  # In principle a python repr(...) should not return any # characters.
+        try:
+            return self.cache[key]
+        except KeyError:
+            return self._single_flight.do(key, lambda: self._load(key, args, kwargs))
+
+    def _load(self, key, args, kwargs):
+        # 取得请求权后再查一次缓存：未命中到取得请求权之间，上一个请求可能刚写入
         try:
             return self.cache[key]
         except KeyError:
-            value = self.function(*args, **kwargs)
-            self.cache[key] = value
-            return value
+            pass
+        value = self.function(*args, **kwargs)
+        self.cache[key] = value
+        return value
 
 
 class BatchCacheManager:
-    def __init__(self, function, cache, batch_size: int = None, cache_key_suffix: str = None, thread_pool: ThreadPoolExecutor = None):
+    def __init__(self, function, cache, batch_size: int = None, cache_key_suffix: str = None, thread_pool: ThreadPoolExecutor = None, key_func=None,
+                 single_flight: SingleFlight = None):
         self.function = function
         self.cache = cache or LRUCacheDict()
         self.batch_size = batch_size
         self._cache_key_suffix = cache_key_suffix or self.function.__name__
         self._thread_pool = thread_pool
+        self._key_func = key_func
+        self._single_flight = single_flight or SingleFlight(self._cache_key_suffix)
 
     def __call__(self, inputs, *args, **kwargs):
-        result = []
-        to_request = []
-        request_indices = []
-
-        # 检查每个输入是否在缓存中
-        for i, input in enumerate(inputs):
-            cache_key = self._generate_cache_key(input, *args, **kwargs)
-            try:
-                # 从缓存获取结果
-                result.append(self.cache[cache_key])
-            except KeyError:
-                # 需要请求的加入列表
-                to_request.append(input)
-                request_indices.append(i)
-                result.append(None)  # 占位符
-
-        # 如果有未缓存的项，进行批处理请求
-        if to_request:
-            batched_results = self._process_batches(to_request, *args, **kwargs)
+        cache_keys = [self._generate_cache_key(input, *args, **kwargs) for input in inputs]
+
+        # 检查每个输入是否在缓存中, 支持批量读取的缓存(如 TieredCacheDict)一次性读取
+        if hasattr(self.cache, "get_many"):
+            result = self.cache.get_many(cache_keys)
+        else:
+            result = [self._get_from_cache(cache_key) for cache_key in cache_keys]
+
+        # 需要请求的加入列表
+        request_indices = [i for i, res in enumerate(result) if res is None]
+        request_inputs = {cache_keys[i]: inputs[i] for i in request_indices}
+
+        def _request(keys):
+            # 取得请求权后再查一次缓存：未命中到取得请求权之间，上一个请求可能刚写入
+            cached = self.cache.get_many(keys) if hasattr(self.cache, "get_many") else [self._get_from_cache(key) for key in keys]
+            missing = [key for key, res in zip(keys, cached) if res is None]
+            if not missing:
+                return cached
+
+            batched_results = self._process_batches([request_inputs[key] for key in missing], *args, **kwargs)
+            to_cache = dict(zip(missing, batched_results))
+            if hasattr(self.cache, "set_many"):
+                self.cache.set_many(to_cache)
+            else:
+                for cache_key, res in to_cache.items():
+                    self.cache[cache_key] = res
+            return [to_cache[key] if res is None else res for key, res in zip(keys, cached)]
+
+        # 如果有未缓存的项，只请求既不在请求中、也不重复的 key，其余等待进行中的请求
+        if request_indices:
+            values = self._single_flight.do_many([cache_keys[i] for i in request_indices], _request)
             # 填充结果到正确的位置
-            for idx, res in zip(request_indices, batched_results):
-                cache_key = self._generate_cache_key(inputs[idx], *args, **kwargs)
-                self.cache[cache_key] = res
+            for idx, res in zip(request_indices, values):
                 result[idx] = res
 
         return result
 
+    def _get_from_cache(self, cache_key):
+        try:
+            return self.cache[cache_key]
+        except KeyError:
+            return None
+
     def _process_batches(self, inputs, *args, **kwargs):
         if self.batch_size:
             groups = [inputs[i:i + self.batch_size] for i in range(0, len(inputs), self.batch_size)]
@@ -321,11 +644,13 @@ class BatchCacheManager:
                     results.extend(self.function(group, *args, **kwargs))
 
         else:
-            results = self.function(group, *args, **kwargs)
+            results = self.function(inputs, *args, **kwargs)
 
         return results
 
     def _generate_cache_key(self, input, *args, **kwargs):
+        if self._key_func:
+            return self._key_func(input, *args, **kwargs)
         return repr((input, args, kwargs)) + "#" + self._cache_key_suffix
 
 
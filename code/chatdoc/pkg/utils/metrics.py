@@ -0,0 +1,134 @@
+'''
+Author: longsion<xianglong_chen@intsig.net>
+Date: 2026-10-18 13:02:11
+LastEditors: longsion
+LastEditTime: 2026-10-18 13:02:11
+'''
+
+# 进程内的简易指标（Counter / Gauge / Histogram），以 Prometheus 文本格式导出
+
+import bisect
+import threading
+
+
+def _label_key(labels: dict) -> tuple:
+    return tuple(sorted((labels or {}).items()))
+
+
+def _format_labels(label_key: tuple, extra: dict = None) -> str:
+    items = list(label_key) + list((extra or {}).items())
+    if not items:
+        return ""
+    return "{" + ",".join(f'{k}="{v}"' for k, v in items) + "}"
+
+
+class _Metric:
+    kind = ""
+
+    def __init__(self, name: str, doc: str = ""):
+        self.name = name
+        self.doc = doc
+        self._lock = threading.Lock()
+        self._values = {}
+
+    def render(self) -> list[str]:
+        lines = [f"# HELP {self.name} {self.doc}", f"# TYPE {self.name} {self.kind}"]
+        with self._lock:
+            for label_key, value in self._values.items():
+                lines.append(f"{self.name}{_format_labels(label_key)} {value}")
+        return lines
+
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def inc(self, value=1, **labels):
+        key = _label_key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + value
+
+
+class Gauge(_Metric):
+    kind = "gauge"
+
+    def set(self, value, **labels):
+        with self._lock:
+            self._values[_label_key(labels)] = value
+
+    def inc(self, value=1, **labels):
+        key = _label_key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + value
+
+    def dec(self, value=1, **labels):
+        self.inc(-value, **labels)
+
+    def get(self, **labels):
+        return self._values.get(_label_key(labels), 0)
+
+
+class Histogram(_Metric):
+    kind = "histogram"
+    default_buckets = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+    def __init__(self, name: str, doc: str = "", buckets=None):
+        super().__init__(name, doc)
+        self.buckets = tuple(buckets or self.default_buckets)
+
+    def observe(self, value, **labels):
+        key = _label_key(labels)
+        with self._lock:
+            state = self._values.get(key)
+            if state is None:
+                state = self._values[key] = [[0] * len(self.buckets), 0, 0.0]
+            index = bisect.bisect_left(self.buckets, value)
+            if index < len(self.buckets):
+                state[0][index] += 1
+            state[1] += 1
+            state[2] += value
+
+    def render(self) -> list[str]:
+        lines = [f"# HELP {self.name} {self.doc}", f"# TYPE {self.name} {self.kind}"]
+        with self._lock:
+            for label_key, (bucket_counts, count, total) in self._values.items():
+                cumulative = 0
+                for bound, bucket_count in zip(self.buckets, bucket_counts):
+                    cumulative += bucket_count
+                    lines.append(f"{self.name}_bucket{_format_labels(label_key, dict(le=bound))} {cumulative}")
+                lines.append(f"{self.name}_bucket{_format_labels(label_key, dict(le='+Inf'))} {count}")
+                lines.append(f"{self.name}_count{_format_labels(label_key)} {count}")
+                lines.append(f"{self.name}_sum{_format_labels(label_key)} {total}")
+        return lines
+
+
+class MetricsRegistry:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._metrics = {}
+
+    def _get_or_create(self, cls, name, doc, **kwargs):
+        with self._lock:
+            metric = self._metrics.get(name)
+            if metric is None:
+                metric = self._metrics[name] = cls(name, doc, **kwargs)
+            return metric
+
+    def counter(self, name, doc="") -> Counter:
+        return self._get_or_create(Counter, name, doc)
+
+    def gauge(self, name, doc="") -> Gauge:
+        return self._get_or_create(Gauge, name, doc)
+
+    def histogram(self, name, doc="", buckets=None) -> Histogram:
+        return self._get_or_create(Histogram, name, doc, buckets=buckets)
+
+    def render(self) -> str:
+        with self._lock:
+            metrics = list(self._metrics.values())
+        lines = []
+        for metric in metrics:
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+global_metrics = MetricsRegistry()
@@ -0,0 +1,116 @@
+'''
+Author: longsion<xianglong_chen@intsig.net>
+Date: 2026-10-18 22:12:30
+LastEditors: longsion
+LastEditTime: 2026-10-18 22:12:30
+'''
+
+# 进程内的请求合并（single flight）：同一个 key 同时只有一个线程请求远端，其余线程等待该请求的结果
+# - do(key, fn)：单个 key，首个未命中的线程执行 fn，并发的同 key 调用等待同一个 Future
+# - do_many(keys, fn)：批量 key，只请求既不在请求中、也不是重复的 key（fn(keys) -> 同序结果），其余等待已有请求
+# - 先完成自己负责的 key 再等待他人的 key，不会互相等待；等待超时（config single_flight.wait_timeout）后自行请求，避免线程池耗尽时卡死
+# - 请求失败时等待者收到同一个异常；结果不做缓存，缓存由调用方在 fn 中写入
+
+import threading
+from concurrent.futures import Future, TimeoutError as FutureTimeoutError
+
+from pkg.config import config
+from pkg.utils.logger import logger
+from pkg.utils.metrics import global_metrics
+
+
+single_flight_requests = global_metrics.counter("single_flight_requests_total", "Single flight keys by outcome, shared keys waited on an in-flight request")
+
+
+def _wait_timeout() -> float:
+    return float((config.get("single_flight") or {}).get("wait_timeout", 30))
+
+
+class SingleFlight:
+
+    def __init__(self, name: str):
+        self.name = name
+        self._lock = threading.Lock()
+        self._calls: dict[str, Future] = {}
+
+    def _claim(self, keys: list) -> tuple[dict, dict]:
+        '''
+        返回 (本线程负责的 {key: Future}, 其他线程请求中的 {key: Future})
+        '''
+        owned, shared = {}, {}
+        with self._lock:
+            for key in keys:
+                if key in owned or key in shared:
+                    continue
+                future = self._calls.get(key)
+                if future is None:
+                    future = owned[key] = Future()
+                    self._calls[key] = future
+                else:
+                    shared[key] = future
+        return owned, shared
+
+    def _release(self, owned: dict):
+        with self._lock:
+            for key, future in owned.items():
+                if self._calls.get(key) is future:
+                    del self._calls[key]
+
+    def _wait(self, key, future: Future, fallback):
+        try:
+            return future.result(timeout=_wait_timeout())
+        except FutureTimeoutError:
+            logger.warning(f"SingleFlight {self.name} wait timeout, key: {key}")
+            single_flight_requests.inc(name=self.name, outcome="timeout")
+            return fallback()
+
+    def do(self, key, fn):
+        '''
+        fn() 为未命中时的请求
+        '''
+        owned, shared = self._claim([key])
+        if shared:
+            single_flight_requests.inc(name=self.name, outcome="shared")
+            return self._wait(key, shared[key], fn)
+
+        single_flight_requests.inc(name=self.name, outcome="leader")
+        future = owned[key]
+        try:
+            value = fn()
+        except BaseException as e:
+            future.set_exception(e)
+            raise
+        finally:
+            self._release(owned)
+        future.set_result(value)
+        return value
+
+    def do_many(self, keys: list, fn) -> list:
+        '''
+        fn(keys) -> 与 keys 同序的结果列表；返回与 keys 同序的结果（重复 key 取同一个结果）
+        '''
+        owned, shared = self._claim(keys)
+        single_flight_requests.inc(len(owned), name=self.name, outcome="leader")
+        single_flight_requests.inc(len(shared), name=self.name, outcome="shared")
+
+        values = {}
+        if owned:
+            owned_keys = list(owned)
+            try:
+                results = list(fn(owned_keys))
+                if len(results) != len(owned_keys):
+                    raise ValueError(f"SingleFlight {self.name} expects {len(owned_keys)} results, got {len(results)}")
+            except BaseException as e:
+                for future in owned.values():
+                    future.set_exception(e)
+                self._release(owned)
+                raise
+            self._release(owned)
+            for key, value in zip(owned_keys, results):
+                owned[key].set_result(value)
+                values[key] = value
+
+        for key, future in shared.items():
+            values[key] = self._wait(key, future, lambda key=key: fn([key])[0])
+
+        return [values[key] for key in keys]
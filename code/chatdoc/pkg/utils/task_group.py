@@ -0,0 +1,200 @@
+'''
+Author: longsion<xianglong_chen@intsig.net>
+Date: 2026-10-18 15:41:05
+LastEditors: longsion
+LastEditTime: 2026-10-18 23:41:52
+'''
+
+# 问答链路的结构化并发
+# - 子任务提交到有界的共享线程池，不再为每个子步骤新建线程；trace 与 ThreadContext 由 TracedThreadPoolExecutor 传递
+# - result() 与 ThreadWithReturnValue.join() 语义一致：返回结果或抛出子任务异常
+# - 等待时不限时的任务若仍在排队，则取消排队并在当前线程直接执行，嵌套任务组不会因线程池耗尽而死锁
+# - 每个阶段可设置超时（config.yaml threadpool.stage_timeout），超时后取消/放弃该任务，返回 default 或抛出 StageTimeoutError
+# - 阶段超时从任务开始执行算起，不计入共享线程池的排队时间；等待时限时任务仍在排队，则改到独立的 overflow 线程池执行
+# - 返回 default 的阶段记录到任务组 context 的 degraded_stages，降级结果不写入阶段缓存
+# - 任务组退出时等待所有未取结果的任务；组内出现异常时取消其余排队中的任务
+
+import threading
+import time
+from concurrent.futures import CancelledError, TimeoutError as FutureTimeoutError
+
+from pkg.config import config
+from pkg.exceptions import StageTimeoutError
+from pkg.utils.jaeger import TracedThreadPoolExecutor
+from pkg.utils.logger import logger
+from pkg.utils.metrics import global_metrics
+
+
+task_stage_seconds = global_metrics.histogram("task_stage_seconds", "Task group stage wait latency")
+task_stage_timeouts = global_metrics.counter("task_stage_timeouts_total", "Task group stage timeouts")
+task_inline_runs = global_metrics.counter("task_inline_runs_total", "Task group tasks executed inline by the waiting thread")
+task_overflow_runs = global_metrics.counter("task_overflow_runs_total", "Task group timed tasks moved to the overflow pool while queued")
+
+_NO_DEFAULT = object()
+
+global_task_pool = TracedThreadPoolExecutor(max_workers=int(config["threadpool"].get("task_worker") or config["threadpool"]["global_worker"]),
+                                            thread_name_prefix="task-group")
+# 共享线程池排满时，限时任务在此执行（父子任务共用 global_task_pool，嵌套阶段可能一直排队）
+overflow_task_pool = TracedThreadPoolExecutor(max_workers=int(config["threadpool"].get("task_overflow_worker") or 32),
+                                              thread_name_prefix="task-overflow")
+
+
+def stage_timeout(stage: str):
+    '''
+    config.yaml threadpool.stage_timeout 中配置的阶段超时（秒），未配置或 0 表示不限
+    '''
+    stage_timeouts = config["threadpool"].get("stage_timeout") or {}
+    timeout = stage_timeouts.get(stage, stage_timeouts.get("default"))
+    return float(timeout) if timeout else None
+
+
+class Task:
+
+    def __init__(self, group: "TaskGroup", stage: str, fn, args, kwargs, timeout, default):
+        self.group = group
+        self.stage = stage
+        self._fn = fn
+        self._args = args
+        self._kwargs = kwargs
+        self._default = default
+        self._timeout = timeout
+        self._started = threading.Event()
+        self._start_time = None
+        self._cancelled = False
+
+        self._future = group.executor.submit(self._run)
+        self._collected = False
+        self._value = None
+        self._error = None
+
+    @property
+    def done(self):
+        return self._collected or self._future.done()
+
+    def cancel(self) -> bool:
+        self._cancelled = self._future.cancel() or self._cancelled
+        return self._cancelled
+
+    def _run(self):
+        self._start_time = time.monotonic()
+        self._started.set()
+        return self._fn(*self._args, **self._kwargs)
+
+    @property
+    def deadline(self):
+        '''
+        任务组截止时间与阶段超时（开始执行后才确定）中较早的一个
+        '''
+        deadlines = [self.group.deadline]
+        if self._timeout and self._start_time is not None:
+            deadlines.append(self._start_time + self._timeout)
+        deadlines = [d for d in deadlines if d is not None]
+        return min(deadlines) if deadlines else None
+
+    def _remaining(self):
+        deadline = self.deadline
+        return None if deadline is None else max(0, deadline - time.monotonic())
+
+    def _wait(self):
+        timed = self._timeout or self.group.deadline is not None
+        if not self._cancelled and self._future.cancel():
+            if not timed:
+                # 不限时的任务仍在排队：直接在当前线程执行
+                task_inline_runs.inc(stage=self.stage)
+                return self._fn(*self._args, **self._kwargs)
+            # 限时任务需要保证超时生效：改到 overflow 线程池，不再等待共享线程池
+            task_overflow_runs.inc(stage=self.stage)
+            self._future = overflow_task_pool.submit(self._run)
+
+        try:
+            if timed and not self._future.cancelled() and not self._started.wait(self._remaining()):
+                raise FutureTimeoutError()
+            return self._future.result(timeout=self._remaining())
+        except FutureTimeoutError:
+            self._future.cancel()
+            task_stage_timeouts.inc(stage=self.stage)
+            if self._default is not _NO_DEFAULT:
+                logger.warning(f"TaskGroup {self.group.name}: stage {self.stage} timeout, fallback to default")
+                self.group.degrade(self.stage)
+                return self._default
+            raise StageTimeoutError(f"TaskGroup {self.group.name}: stage {self.stage} timeout")
+        except CancelledError:
+            if self._default is not _NO_DEFAULT:
+                self.group.degrade(self.stage)
+                return self._default
+            raise StageTimeoutError(f"TaskGroup {self.group.name}: stage {self.stage} cancelled")
+
+    def result(self):
+        if not self._collected:
+            st = time.time()
+            try:
+                self._value = self._wait()
+            except Exception as e:
+                self._error = e
+            finally:
+                self._collected = True
+                task_stage_seconds.observe(time.time() - st, stage=self.stage)
+
+        if self._error is not None:
+            raise self._error
+        return self._value
+
+    # 兼容 ThreadWithReturnValue 的写法
+    join = result
+
+
+class TaskGroup:
+    '''
+    with TaskGroup("retrieve_small", context=context) as tg:
+        table_t = tg.spawn(retrieve_by_table, context, document_uuids, default=[])
+        paragraph_t = tg.spawn(retrieve_by_paragraph, context, document_uuids, default=[])
+        tables, fragments = table_t.result(), paragraph_t.result()
+    '''
+
+    def __init__(self, name: str, timeout: float = None, executor=None, context=None):
+        '''
+        context: 问答 context，阶段超时降级时记录到 context.degraded_stages
+        '''
+        self.name = name
+        self.context = context
+        self.executor = executor or global_task_pool
+        self.deadline = time.monotonic() + timeout if timeout else None
+        self.tasks: list[Task] = []
+
+    def spawn(self, fn, *args, stage: str = None, timeout: float = None, default=_NO_DEFAULT, **kwargs) -> Task:
+        '''
+        stage: 阶段名，用于超时配置与指标，默认取函数名
+        timeout: 阶段超时（秒），默认读取 threadpool.stage_timeout[stage]
+        default: 超时后返回的降级结果，不传则抛出 StageTimeoutError
+        '''
+        stage = stage or getattr(fn, "__name__", "task")
+        if timeout is None:
+            timeout = stage_timeout(stage)
+        task = Task(self, stage, fn, args, kwargs, timeout, default)
+        self.tasks.append(task)
+        return task
+
+    def degrade(self, stage: str):
+        if self.context is not None:
+            self.context.degraded_stages.append(stage)
+
+    def cancel(self):
+        for task in self.tasks:
+            task.cancel()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is not None:
+            self.cancel()
+            return False
+
+        for index, task in enumerate(self.tasks):
+            try:
+                task.result()
+            except Exception:
+                for pending in self.tasks[index + 1:]:
+                    pending.cancel()
+                raise
+        return False
@@ -0,0 +1,472 @@
+'''
+Author: longsion<xianglong_chen@intsig.net>
+Date: 2026-10-18 19:05:12
+LastEditors: longsion
+LastEditTime: 2026-10-18 19:05:12
+'''
+
+# 本地向量库（vector.model: local），单机部署无需外部向量服务
+# - 按文件分段：每个文件一个 segment 文件，系统库 {path}/analyst/{file_uuid[:2]}/{file_uuid}.seg，个人库 {path}/personal/{user_id}/{file_uuid}.seg
+# - segment 写入临时文件后 os.replace 原子替换，读取通过 np.memmap 映射，多个 worker 进程共享 page cache
+# - segment 内同时保存召回需要的切片字段（payload），检索结果直接返回，不再回 ES 补全数据
+# - 指定文件检索时只精确计算这些文件；全库检索在训练过 IVF 质心（scripts/vdb/construct_local_vdb.py --train）后只扫描最近的 nprobe 个簇
+# - 集合目录下的 VERSION 在每次写入/删除后 +1，读取方据此刷新文件目录
+
+import fcntl
+import json
+import os
+import struct
+import threading
+import time
+import uuid as uuid_lib
+from typing import Optional
+
+import numpy as np
+
+from pkg.config import config
+from pkg.utils.logger import logger
+from pkg.utils.lru_cache import ShardedLRUCacheDict
+from pkg.utils.metrics import global_metrics
+
+
+local_vdb_search_seconds = global_metrics.histogram("local_vdb_search_seconds", "Local vector db search latency by collection and mode")
+
+ANALYST = "analyst"
+PERSONAL = "personal"
+
+MAGIC = b"CDVSEG01"
+# 文件头固定 4096 字节（magic + 头长度 + json 头），向量数据从 4096 开始，按页对齐
+HEADER_SIZE = 4096
+SEGMENT_SUFFIX = ".seg"
+
+
+def _write_segment(path: str, vectors: np.ndarray, list_ids: Optional[np.ndarray], uuids: list[str], payloads: list[dict]):
+    vectors = np.ascontiguousarray(vectors, dtype=np.float32)
+    payload_bytes = json.dumps(dict(uuids=uuids, payloads=payloads), ensure_ascii=False).encode("utf-8")
+    count, dimension = vectors.shape
+
+    list_offset = HEADER_SIZE + vectors.nbytes
+    payload_offset = list_offset + (count * 4 if list_ids is not None else 0)
+    header = json.dumps(dict(count=count, dimension=dimension, ivf=list_ids is not None,
+                             list_offset=list_offset, payload_offset=payload_offset, payload_length=len(payload_bytes))).encode("utf-8")
+    head = MAGIC + struct.pack("<I", len(header)) + header
+    if len(head) > HEADER_SIZE:
+        raise ValueError(f"segment header too large: {len(head)}")
+
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = f"{path}.{uuid_lib.uuid4().hex}.tmp"
+    try:
+        with open(tmp_path, "wb") as f:
+            f.write(head.ljust(HEADER_SIZE, b" "))
+            f.write(vectors.tobytes())
+            if list_ids is not None:
+                f.write(np.ascontiguousarray(list_ids, dtype=np.int32).tobytes())
+            f.write(payload_bytes)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+
+class LocalSegment:
+    '''
+    单个文件的向量段，只读；文件被替换后通过 (inode, mtime) 识别并重新加载
+    '''
+
+    def __init__(self, path: str, stat: os.stat_result):
+        self.path = path
+        self.file_uuid = os.path.basename(path)[:-len(SEGMENT_SUFFIX)]
+        self.stamp = (stat.st_ino, stat.st_mtime_ns, stat.st_size)
+
+        with open(path, "rb") as f:
+            head = f.read(HEADER_SIZE)
+        if head[:len(MAGIC)] != MAGIC:
+            raise ValueError(f"invalid segment: {path}")
+        header_length = struct.unpack("<I", head[len(MAGIC):len(MAGIC) + 4])[0]
+        header = json.loads(head[len(MAGIC) + 4:len(MAGIC) + 4 + header_length])
+
+        self.count = header["count"]
+        self.dimension = header["dimension"]
+        self._payload_offset = header["payload_offset"]
+        self._payload_length = header["payload_length"]
+
+        if self.count:
+            # 转为普通 ndarray 视图（仍由 mmap 支撑），避免 np.memmap 切片的额外开销
+            self.vectors = np.memmap(path, dtype=np.float32, mode="r", offset=HEADER_SIZE, shape=(self.count, self.dimension)).view(np.ndarray)
+        else:
+            self.vectors = np.zeros((0, self.dimension), dtype=np.float32)
+
+        # IVF：每行所属簇 id，写入时行已按簇 id 排序，同簇的行连续存放
+        self.list_ids = None
+        if header["ivf"] and self.count:
+            self.list_ids = np.fromfile(path, dtype=np.int32, count=self.count, offset=header["list_offset"])
+
+    def load_payload(self) -> dict:
+        with open(self.path, "rb") as f:
+            f.seek(self._payload_offset)
+            return json.loads(f.read(self._payload_length))
+
+    def top_k(self, query: np.ndarray, size: int, probe_mask: Optional[np.ndarray] = None):
+        '''
+        返回 (行号, 得分)，probe_mask 为各簇是否需要扫描，不为空时只计算这些簇内的行
+        '''
+        rows = None
+        if probe_mask is not None and self.list_ids is not None and self.list_ids[-1] < len(probe_mask):
+            rows = np.flatnonzero(probe_mask[self.list_ids])
+            if not len(rows):
+                return rows, np.zeros(0, dtype=np.float32)
+            scores = self.vectors[rows] @ query
+        else:
+            scores = self.vectors @ query
+
+        if len(scores) > size:
+            top = np.argpartition(-scores, size)[:size]
+        else:
+            top = np.arange(len(scores))
+        return (top if rows is None else rows[top]), scores[top]
+
+
+class LocalVectorCollection:
+    '''
+    一个向量集合（系统库 / 个人库），partition 为集合下的一级目录
+    '''
+
+    def __init__(self, root: str, name: str, nprobe: int = 16, segment_cache_size: int = 20000, payload_cache_size: int = 2000):
+        self.name = name
+        self.dir = os.path.join(root, name)
+        self.nprobe = nprobe
+        os.makedirs(self.dir, exist_ok=True)
+
+        self._segments = ShardedLRUCacheDict(max_size=segment_cache_size, expiration=24 * 60 * 60)
+        self._payloads = ShardedLRUCacheDict(max_size=payload_cache_size, expiration=24 * 60 * 60)
+        self._lock = threading.Lock()
+        self._catalog_version = None
+        self._catalog = {}
+        self._centroids_version = None
+        self._centroids = None
+
+    # ---------------- 版本与目录 ----------------
+
+    @property
+    def _version_path(self):
+        return os.path.join(self.dir, "VERSION")
+
+    @property
+    def _centroids_path(self):
+        return os.path.join(self.dir, "centroids.npy")
+
+    def version(self) -> str:
+        try:
+            with open(self._version_path, "r") as f:
+                return f.read().strip()
+        except FileNotFoundError:
+            return "0"
+
+    def _bump_version(self):
+        # 多进程写入时用文件锁保证版本号递增
+        with open(os.path.join(self.dir, ".lock"), "w") as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            version = int(self.version() or 0) + 1
+            tmp_path = f"{self._version_path}.{uuid_lib.uuid4().hex}.tmp"
+            with open(tmp_path, "w") as f:
+                f.write(str(version))
+            os.replace(tmp_path, self._version_path)
+
+    def catalog(self) -> dict[str, dict[str, str]]:
+        '''
+        partition -> {file_uuid: segment 路径}
+        '''
+        version = self.version()
+        if version == self._catalog_version:
+            return self._catalog
+
+        catalog = {}
+        for partition in os.scandir(self.dir):
+            if not partition.is_dir():
+                continue
+            catalog[partition.name] = {
+                entry.name[:-len(SEGMENT_SUFFIX)]: entry.path
+                for entry in os.scandir(partition.path) if entry.name.endswith(SEGMENT_SUFFIX)
+            }
+        with self._lock:
+            self._catalog, self._catalog_version = catalog, version
+        return catalog
+
+    def segment_path(self, partition: str, file_uuid: str) -> str:
+        return os.path.join(self.dir, partition, f"{file_uuid}{SEGMENT_SUFFIX}")
+
+    def centroids(self) -> Optional[np.ndarray]:
+        version = self.version()
+        if version != self._centroids_version:
+            centroids = np.load(self._centroids_path) if os.path.exists(self._centroids_path) else None
+            with self._lock:
+                self._centroids, self._centroids_version = centroids, version
+        return self._centroids
+
+    # ---------------- 读取 ----------------
+
+    def get_segment(self, path: str) -> Optional[LocalSegment]:
+        try:
+            stat = os.stat(path)
+        except FileNotFoundError:
+            return None
+
+        segment = self._segments.get(path)
+        if segment is None or segment.stamp != (stat.st_ino, stat.st_mtime_ns, stat.st_size):
+            segment = LocalSegment(path, stat)
+            self._segments[path] = segment
+        return segment
+
+    def get_payload(self, segment: LocalSegment) -> dict:
+        key = (segment.path, segment.stamp)
+        payload = self._payloads.get(key)
+        if payload is None:
+            payload = segment.load_payload()
+            self._payloads[key] = payload
+        return payload
+
+    def search(self, question_embedding: list[float], size: int, paths: list[str], use_ivf: bool = False) -> list[dict]:
+        '''
+        在给定 segment 中检索 top size，得分与 ES script_score 一致：max(dotProduct, 0)
+        '''
+        start_time = time.time()
+        query = np.asarray(question_embedding, dtype=np.float32)
+
+        probe_mask = None
+        centroids = self.centroids() if use_ivf else None
+        if centroids is not None and len(centroids) > self.nprobe:
+            probe_mask = np.zeros(len(centroids), dtype=bool)
+            probe_mask[np.argpartition(-(centroids @ query), self.nprobe)[:self.nprobe]] = True
+
+        segments, segment_ids, rows, scores = [], [], [], []
+        for path in paths:
+            segment = self.get_segment(path)
+            if segment is None or not segment.count:
+                continue
+            _rows, _scores = segment.top_k(query, size, probe_mask)
+            segment_ids.append(np.full(len(_rows), len(segments)))
+            segments.append(segment)
+            rows.append(_rows)
+            scores.append(_scores)
+
+        results = []
+        if segments:
+            segment_ids, rows, scores = np.concatenate(segment_ids), np.concatenate(rows), np.concatenate(scores)
+            top = np.argsort(-scores)[:size]
+            for i in top:
+                segment, row = segments[segment_ids[i]], int(rows[i])
+                payload = self.get_payload(segment)
+                results.append(dict(uuid=payload["uuids"][row], file_uuid=segment.file_uuid, score=max(float(scores[i]), 0.0), payload=payload["payloads"][row]))
+
+        mode = "ivf" if probe_mask is not None else "flat"
+        local_vdb_search_seconds.observe(time.time() - start_time, collection=self.name, mode=mode)
+        logger.info(f"LocalVDB {self.name} search {mode}, segments: {len(paths)}, size: {size}, cost: {1000*(time.time() - start_time):.1f}ms")
+        return results
+
+    # ---------------- 写入 ----------------
+
+    def _assign(self, vectors: np.ndarray, centroids: Optional[np.ndarray]) -> Optional[np.ndarray]:
+        if centroids is None or not len(vectors):
+            return None
+        return np.argmax(vectors @ centroids.T, axis=1).astype(np.int32)
+
+    def insert(self, partition: str, file_uuid: str, uuids: list[str], vectors, payloads: list[dict]):
+        '''
+        写入一个文件的全部向量，已存在时整段覆盖
+        '''
+        if not uuids:
+            return self.delete(partition, [file_uuid])
+
+        vectors = np.asarray(vectors, dtype=np.float32).reshape(len(uuids), -1)
+        list_ids = self._assign(vectors, self.centroids())
+        if list_ids is not None:
+            order = np.argsort(list_ids, kind="stable")
+            vectors, list_ids = vectors[order], list_ids[order]
+            uuids, payloads = [uuids[i] for i in order], [payloads[i] for i in order]
+
+        _write_segment(self.segment_path(partition, file_uuid), vectors, list_ids, uuids, payloads)
+        self._bump_version()
+
+    def delete(self, partition: str, file_uuids: list[str]):
+        for file_uuid in file_uuids:
+            try:
+                os.remove(self.segment_path(partition, file_uuid))
+            except FileNotFoundError:
+                pass
+        self._bump_version()
+
+    def delete_by_file_uuids(self, file_uuids: list[str]):
+        '''
+        不知道 partition 时，按目录查找后删除
+        '''
+        file_uuids = set(file_uuids)
+        for partition, segments in self.catalog().items():
+            for file_uuid in file_uuids & set(segments):
+                try:
+                    os.remove(segments[file_uuid])
+                except FileNotFoundError:
+                    pass
+        self._bump_version()
+
+    def train(self, n_lists: int, sample_size: int = 200000, iterations: int = 10, seed: int = 0):
+        '''
+        训练 IVF 质心（球面 k-means），并按新质心重写所有 segment
+        '''
+        paths = [path for segments in self.catalog().values() for path in segments.values()]
+        rng = np.random.default_rng(seed)
+        rng.shuffle(paths)
+
+        samples, count = [], 0
+        for path in paths:
+            segment = self.get_segment(path)
+            if segment is None or not segment.count:
+                continue
+            samples.append(np.array(segment.vectors))
+            count += segment.count
+            if count >= sample_size:
+                break
+        if count < n_lists:
+            raise ValueError(f"not enough vectors to train {n_lists} lists: {count}")
+
+        data = np.concatenate(samples)[:sample_size]
+        centroids = data[rng.choice(len(data), n_lists, replace=False)]
+        for _ in range(iterations):
+            assign = np.argmax(data @ centroids.T, axis=1)
+            sums = np.zeros_like(centroids)
+            np.add.at(sums, assign, data)
+            empty = np.bincount(assign, minlength=n_lists) == 0
+            sums[empty] = data[rng.choice(len(data), int(empty.sum()), replace=False)]
+            centroids = sums / np.maximum(np.linalg.norm(sums, axis=1, keepdims=True), 1e-12)
+
+        tmp_path = f"{self._centroids_path}.{uuid_lib.uuid4().hex}.tmp.npy"
+        np.save(tmp_path, centroids.astype(np.float32))
+        os.replace(tmp_path, self._centroids_path)
+        self._bump_version()
+
+        for partition, segments in self.catalog().items():
+            for file_uuid, path in segments.items():
+                segment = self.get_segment(path)
+                if segment is None:
+                    continue
+                payload = segment.load_payload()
+                self.insert(partition, file_uuid, payload["uuids"], np.array(segment.vectors), payload["payloads"])
+        logger.info(f"LocalVDB {self.name} trained {n_lists} lists on {len(data)} vectors")
+
+
+def analyst_partition(file_uuid: str) -> str:
+    # 系统库按 file_uuid 前两位分目录，避免单目录文件过多
+    return file_uuid[:2] or "_"
+
+
+_collections = {}
+_collections_lock = threading.Lock()
+
+
+def get_local_collection(name: str) -> LocalVectorCollection:
+    if name not in _collections:
+        with _collections_lock:
+            if name not in _collections:
+                local_config = config.get("local_vdb") or {}
+                _collections[name] = LocalVectorCollection(local_config.get("path", "/data/local_vdb"), name,
+                                                           nprobe=local_config.get("nprobe", 16),
+                                                           segment_cache_size=local_config.get("segment_cache_size", 20000),
+                                                           payload_cache_size=local_config.get("payload_cache_size", 2000))
+    return _collections[name]
+
+
+def insert_entities(file_uuid, uuids: list[str], vectors, payloads: list[dict]):
+    try:
+        t0 = time.time()
+        get_local_collection(ANALYST).insert(analyst_partition(file_uuid), file_uuid, uuids, vectors, payloads)
+        logger.info(f"LocalVDB insert file_uuid: {file_uuid}, count: {len(uuids)}, rt: {1000*(time.time() - t0):.1f}ms")
+        return True
+    except Exception as e:
+        logger.error(f"LocalVDB insert error, file_uuid: {file_uuid} {e}")
+        import traceback
+        traceback.print_exc()
+        return False
+
+
+def insert_personal_entities(user_id, file_uuid, uuids: list[str], vectors, payloads: list[dict]):
+    try:
+        t0 = time.time()
+        get_local_collection(PERSONAL).insert(user_id, file_uuid, uuids, vectors, payloads)
+        logger.info(f"LocalVDB insert user_id: {user_id}, file_uuid: {file_uuid}, count: {len(uuids)}, rt: {1000*(time.time() - t0):.1f}ms")
+        return True
+    except Exception as e:
+        logger.error(f"LocalVDB insert error, user_id: {user_id}, file_uuid: {file_uuid} {e}")
+        import traceback
+        traceback.print_exc()
+        return False
+
+
+def delete_entities(file_uuid):
+    return delete_entities_by_uuids([file_uuid])
+
+
+def delete_entities_by_uuids(file_uuids):
+    try:
+        collection = get_local_collection(ANALYST)
+        for file_uuid in file_uuids:
+            collection.delete(analyst_partition(file_uuid), [file_uuid])
+        logger.info(f"LocalVDB delete file_uuids: {file_uuids}")
+        return True
+    except Exception as e:
+        logger.error(f"LocalVDB delete error, file_uuids: {file_uuids} {e}")
+        return False
+
+
+def delete_personal_entities(user_id, file_uuids):
+    try:
+        get_local_collection(PERSONAL).delete(user_id, file_uuids)
+        logger.info(f"LocalVDB delete user_id: {user_id}, file_uuids: {file_uuids}")
+        return True
+    except Exception as e:
+        logger.error(f"LocalVDB delete error, user_id: {user_id}, file_uuids: {file_uuids}, {e}")
+        return False
+
+
+def search_analyst(size: int, file_uuids: list[str], question_embedding: list[float]) -> list[dict]:
+    collection = get_local_collection(ANALYST)
+    if file_uuids:
+        paths = [collection.segment_path(analyst_partition(file_uuid), file_uuid) for file_uuid in file_uuids]
+        return collection.search(question_embedding, size, paths)
+
+    paths = [path for segments in collection.catalog().values() for path in segments.values()]
+    return collection.search(question_embedding, size, paths, use_ivf=True)
+
+
+def search_personal(size: int, file_uuids: list[str], question_embedding: list[float], user_id=None) -> list[dict]:
+    collection = get_local_collection(PERSONAL)
+    if user_id and file_uuids:
+        paths = [collection.segment_path(user_id, file_uuid) for file_uuid in file_uuids]
+        return collection.search(question_embedding, size, paths)
+
+    catalog = collection.catalog()
+    if user_id:
+        paths = list(catalog.get(user_id, {}).values())
+    else:
+        file_uuids = set(file_uuids or [])
+        paths = [path for segments in catalog.values() for file_uuid, path in segments.items() if not file_uuids or file_uuid in file_uuids]
+    return collection.search(question_embedding, size, paths, use_ivf=not file_uuids)
+
+
+def embedding_and_insert(file_uuid: str, payloads: list[dict], user_id: str = None):
+    '''
+    vector.model=local 时由文档解析直接计算 embedding 写入本地向量库（不经过 chatdoc-proxy）
+    payloads 为切片字段，需包含 uuid 与 ebed_text
+    '''
+    from pkg.embedding.acge_embedding import acge_embedding_multi
+    from pkg.utils import global_thread_pool
+    from pkg.utils.generator import batch_generator
+
+    batch_size = (config.get("local_vdb") or {}).get("embedding_batch_size", 64)
+    texts = [payload["ebed_text"] for payload in payloads]
+    vectors = [vector for batch in global_thread_pool.map(acge_embedding_multi, batch_generator(texts, batch_size)) for vector in batch]
+
+    uuids = [payload["uuid"] for payload in payloads]
+    if user_id:
+        return insert_personal_entities(user_id, file_uuid, uuids, vectors, payloads)
+    return insert_entities(file_uuid, uuids, vectors, payloads)
@@ -2,9 +2,20 @@
 Author: longsion<xianglong_chen@intsig.net>
 Date: 2024-07-03 21:01:12
 LastEditors: longsion
-LastEditTime: 2024-09-13 14:59:02
+LastEditTime: 2026-10-19 09:20:11
 '''
 
 import pkg.es.es_retrieval
 import pkg.analyst.objects
 import pkg.personal.objects
+from pkg.utils import global_thread_pool
+from pkg.embedding.keyword_matrix import three_table_key_matrix
+from pkg.cache_warmup import cache_warmer
+
+# 启动时后台预热固定表关键词 embedding 矩阵
+global_thread_pool.submit(three_table_key_matrix.warmup)
+
+# 订阅入库后的缓存预热消息（只在提供问答的进程中预建）
+cache_warmer.subscribe()
+
+# 进程内的文档处理 worker 不在导入时启动，见 gunicorn.conf.py post_worker_init
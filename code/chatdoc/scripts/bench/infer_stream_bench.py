@@ -0,0 +1,142 @@
+'''
+Author: longsion<xianglong_chen@intsig.net>
+Date: 2026-10-18 16:20:37
+LastEditors: longsion
+LastEditTime: 2026-10-18 16:20:37
+'''
+
+# 流式问答并发对比：线程模式（Flask / gunicorn sync worker）与 asyncio 模式（asgi.py）
+# 1. 本地模拟（默认）：启动一个逐 token 输出的模拟 LLM SSE 服务，
+#    分别用「每路流占用一个线程 + requests + result_generator」和「事件循环 + httpx + async_result_generator」消费，
+#    统计给定并发下的吞吐、首 token 延迟以及每秒 CPU 时间可支撑的并发流数（streams per core）
+# 2. 压测已部署服务：--url 指向 /api/v1/*/infer，分别对 main:app 与 asgi:app 各跑一次对比
+# 用法（chatdoc 根目录下执行，需安装 httpx）:
+#   python -m scripts.bench.infer_stream_bench --concurrency 200 --tokens 200 --token-interval 0.02
+#   python -m scripts.bench.infer_stream_bench --concurrency 200 --threads 4   # 对照当前 gunicorn -w 4 同步 worker
+#   python -m scripts.bench.infer_stream_bench --url http://127.0.0.1:5000/api/v1/global/infer --body params.json --concurrency 100
+
+import argparse
+import asyncio
+import json
+import multiprocessing
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import httpx
+import requests
+
+from pkg.llm.util import async_result_generator, result_generator
+
+
+def start_fake_llm(port, tokens, token_interval):
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def log_message(self, *args):
+            pass
+
+        def do_POST(self):
+            self.rfile.read(int(self.headers.get("Content-Length") or 0))
+            self.send_response(200)
+            self.send_header("Content-Type", "text/event-stream")
+            self.send_header("Transfer-Encoding", "chunked")
+            self.end_headers()
+            for i in range(tokens + 1):
+                chunk = {"choices": [{"delta": {"content": f"t{i}"}, "finish_reason": "stop" if i == tokens else None}]}
+                data = f"data: {json.dumps(chunk)}\n\n".encode()
+                self.wfile.write(f"{len(data):x}\r\n".encode() + data + b"\r\n")
+                self.wfile.flush()
+                time.sleep(token_interval)
+            self.wfile.write(b"0\r\n\r\n")
+
+    ThreadingHTTPServer.daemon_threads = True
+    ThreadingHTTPServer.request_queue_size = 1024
+    ThreadingHTTPServer(("127.0.0.1", port), Handler).serve_forever()
+
+
+def summarize(name, durations, ttfts, wall, cpu, threads):
+    # streams per core: 客户端每占满一个核可以同时维持的流数 = 并发数 * wall / cpu
+    durations.sort()
+    ttfts.sort()
+    n = len(durations)
+    print(f"{name:<10} streams: {n}, wall: {wall:.2f}s, throughput: {n / wall:.1f} streams/s, "
+          f"ttft p50: {1000 * ttfts[n // 2]:.1f}ms, p99: {1000 * ttfts[int(n * 0.99) - 1]:.1f}ms, "
+          f"cpu: {cpu:.2f}s, streams per core: {n * wall / max(cpu, 1e-6):.0f}, peak threads: {threads}")
+
+
+def bench_threaded(url, body, concurrency, threads):
+    durations, ttfts = [], []
+    session = requests.Session()
+    session.mount("http://", requests.adapters.HTTPAdapter(pool_maxsize=concurrency))
+
+    def one(st):
+        # st 为提交时间，包含排队等待线程的耗时
+        resp = session.post(url, json=body, stream=True)
+        first = None
+        for _ in result_generator(st, resp.iter_content(chunk_size=None)):
+            first = first or time.time()
+        ttfts.append(first - st)
+        durations.append(time.time() - st)
+
+    st, cpu_st = time.time(), time.process_time()
+    with ThreadPoolExecutor(max_workers=threads) as pool:
+        futures = [pool.submit(one, time.time()) for _ in range(concurrency)]
+        peak_threads = threading.active_count()
+        for f in futures:
+            f.result()
+    return durations, ttfts, time.time() - st, time.process_time() - cpu_st, peak_threads
+
+
+async def _bench_async(url, body, concurrency, raw_sse):
+    durations, ttfts = [], []
+    limits = httpx.Limits(max_connections=concurrency, max_keepalive_connections=concurrency)
+    async with httpx.AsyncClient(timeout=None, limits=limits) as client:
+        async def one():
+            st = time.time()
+            async with client.stream("POST", url, json=body) as resp:
+                first = None
+                chunks = async_result_generator(st, resp.aiter_bytes()) if raw_sse else resp.aiter_lines()
+                async for _ in chunks:
+                    first = first or time.time()
+            ttfts.append(first - st)
+            durations.append(time.time() - st)
+
+        st, cpu_st = time.time(), time.process_time()
+        await asyncio.gather(*[one() for _ in range(concurrency)])
+        return durations, ttfts, time.time() - st, time.process_time() - cpu_st, threading.active_count()
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--concurrency", type=int, default=200)
+    parser.add_argument("--tokens", type=int, default=200)
+    parser.add_argument("--token-interval", type=float, default=0.02)
+    parser.add_argument("--threads", type=int, default=0, help="线程模式的处理线程数，模拟 gunicorn -w N 同步 worker，0 表示不限（每路流一个线程）")
+    parser.add_argument("--port", type=int, default=18080)
+    parser.add_argument("--url", default=None, help="压测已部署的 infer 接口")
+    parser.add_argument("--body", default=None, help="infer 请求体 json 文件")
+    args = parser.parse_args()
+
+    if args.url:
+        with open(args.body, "r", encoding="utf-8") as f:
+            body = json.load(f)
+        body["stream"] = True
+        summarize("service", *asyncio.run(_bench_async(args.url, body, args.concurrency, raw_sse=False)))
+        return
+
+    # 模拟服务放在子进程，CPU 统计只包含客户端
+    server = multiprocessing.Process(target=start_fake_llm, args=(args.port, args.tokens, args.token_interval), daemon=True)
+    server.start()
+    time.sleep(0.5)
+    url = f"http://127.0.0.1:{args.port}/v1/chat/completions"
+    body = {"stream": True}
+    print(f"concurrency: {args.concurrency}, tokens: {args.tokens}, token interval: {1000 * args.token_interval:.0f}ms")
+    summarize("threaded", *bench_threaded(url, body, args.concurrency, args.threads or args.concurrency))
+    summarize("asyncio", *asyncio.run(_bench_async(url, body, args.concurrency, raw_sse=True)))
+    server.terminate()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,149 @@
+'''
+Author: longsion<xianglong_chen@intsig.net>
+Date: 2026-10-18 19:05:12
+LastEditors: longsion
+LastEditTime: 2026-10-18 19:05:12
+'''
+
+# 本地向量库（pkg/vdb/local.py）与 ES script_score 向量召回的耗时 / recall@k 对比
+# 1. 模拟（--synthetic）：在临时目录生成 files 个文件的随机向量，统计指定文件检索（1~5 个文件）与全库检索（flat / IVF）的耗时和 recall@k
+# 2. 线上（--index）：随机抽取片段向量作为查询，对比 ES script_score 与本地向量库（需先执行 scripts/vdb/construct_local_vdb.py 导入），
+#    分别统计限定在查询片段所在文件内和全库的耗时与 recall@k（以 script_score 结果为准）
+# 用法（chatdoc 根目录下执行）:
+#   python -m scripts.bench.local_vdb_bench --synthetic --files 2000 --per-file 300 --lists 1024
+#   python -m scripts.bench.local_vdb_bench --index doc_fragment --queries 200 --k 25
+
+import argparse
+import tempfile
+import time
+
+import numpy as np
+
+from pkg.vdb.local import LocalVectorCollection
+
+
+def recall(truth: list, got: list, k: int) -> float:
+    return len(set(truth[:k]) & set(got[:k])) / max(1, min(k, len(truth)))
+
+
+def percentile(values, p):
+    values = sorted(values)
+    return 1000 * values[min(len(values) - 1, int(len(values) * p))]
+
+
+def report(name, latencies, recalls=None, k=0):
+    line = f"{name:<24} p50: {percentile(latencies, 0.5):.2f}ms, p99: {percentile(latencies, 0.99):.2f}ms"
+    if recalls:
+        line += f", recall@{k}: {np.mean(recalls):.4f}"
+    print(line)
+
+
+def bench_synthetic(files, per_file, dims, lists, nprobe, queries, k):
+    rng = np.random.default_rng(0)
+    root = tempfile.mkdtemp(prefix="local_vdb_bench_")
+    collection = LocalVectorCollection(root, "bench", nprobe=nprobe)
+
+    centers = rng.standard_normal((max(16, files // 4), dims)).astype(np.float32)
+    st = time.time()
+    for i in range(files):
+        vectors = centers[rng.integers(0, len(centers), per_file)] + 0.8 * rng.standard_normal((per_file, dims)).astype(np.float32)
+        vectors /= np.linalg.norm(vectors, axis=1, keepdims=True)
+        uuids = [f"{i}-{j}" for j in range(per_file)]
+        collection.insert(f"{i:04d}"[:2], f"file{i}", uuids, vectors, [dict(uuid=uuid, ebed_text="") for uuid in uuids])
+    print(f"insert {files} files x {per_file} vectors: {time.time() - st:.1f}s, dir: {root}")
+
+    paths = {file_uuid: path for segments in collection.catalog().values() for file_uuid, path in segments.items()}
+    all_paths = list(paths.values())
+    query_vectors = [collection.get_segment(paths[f"file{rng.integers(files)}"]).vectors[rng.integers(per_file)] for _ in range(queries)]
+
+    for n_files in [1, 5]:
+        latencies = []
+        for q in query_vectors:
+            scoped = [paths[f"file{i}"] for i in rng.choice(files, n_files, replace=False)]
+            st = time.perf_counter()
+            collection.search(q, k, scoped)
+            latencies.append(time.perf_counter() - st)
+        report(f"scoped {n_files} file(s)", latencies)
+
+    flat_latencies, truths = [], []
+    for q in query_vectors:
+        st = time.perf_counter()
+        truths.append([hit["uuid"] for hit in collection.search(q, k, all_paths)])
+        flat_latencies.append(time.perf_counter() - st)
+    report("global flat", flat_latencies)
+
+    if lists:
+        collection.train(lists)
+        all_paths = [path for segments in collection.catalog().values() for path in segments.values()]
+        ivf_latencies, recalls = [], []
+        for q, truth in zip(query_vectors, truths):
+            st = time.perf_counter()
+            got = [hit["uuid"] for hit in collection.search(q, k, all_paths, use_ivf=True)]
+            ivf_latencies.append(time.perf_counter() - st)
+            recalls.append(recall(truth, got, k))
+        report(f"global ivf nprobe={nprobe}", ivf_latencies, recalls, k)
+
+
+def bench_index(target, queries, k):
+    from pkg.es import global_es
+    from pkg.es.es_doc_fragment import DocFragmentES
+    from pkg.es.es_p_doc_fragment import PDocFragmentES
+    from pkg.es.es_retrieval import build_embedding_search_body
+    from pkg.vdb.local import search_analyst, search_personal
+
+    personal = target == "p_doc_fragment"
+    index = (PDocFragmentES() if personal else DocFragmentES()).index_name
+    docs = global_es.search(index, {
+        "_source": ["uuid", "file_uuid", "user_id", "acge_embedding"],
+        "size": queries,
+        "query": {"function_score": {"query": {"exists": {"field": "acge_embedding"}}, "random_score": {"seed": 1, "field": "_seq_no"}}},
+    })
+
+    latencies = {name: [] for name in ["es scoped", "local scoped", "es global", "local global"]}
+    recalls = {"local scoped": [], "local global": []}
+    for doc in docs:
+        source = doc["_source"]
+        q = source["acge_embedding"]
+        user_id = source.get("user_id") if personal else None
+        for scope, file_uuids in [("scoped", [source["file_uuid"]]), ("global", [])]:
+            must_conditions = [dict(terms=dict(file_uuid=file_uuids))] if file_uuids else []
+            if user_id:
+                must_conditions.append(dict(term=dict(user_id=user_id)))
+
+            st = time.time()
+            truth = [hit["_source"]["uuid"] for hit in global_es.search(index, build_embedding_search_body("acge_embedding", q, k, ["uuid"], must_conditions))]
+            latencies[f"es {scope}"].append(time.time() - st)
+
+            st = time.time()
+            if personal:
+                hits = search_personal(k, file_uuids, q, user_id=user_id)
+            else:
+                hits = search_analyst(k, file_uuids, q)
+            latencies[f"local {scope}"].append(time.time() - st)
+            recalls[f"local {scope}"].append(recall(truth, [hit["uuid"] for hit in hits], k))
+
+    for name, values in latencies.items():
+        report(name, values, recalls.get(name), k)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--synthetic", action="store_true")
+    parser.add_argument("--index", default=None, choices=["doc_fragment", "p_doc_fragment"])
+    parser.add_argument("--files", type=int, default=2000)
+    parser.add_argument("--per-file", type=int, default=300)
+    parser.add_argument("--dims", type=int, default=1024)
+    parser.add_argument("--lists", type=int, default=1024, help="模拟模式训练的 IVF 簇数，0 不训练")
+    parser.add_argument("--nprobe", type=int, default=16)
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("--k", type=int, default=25)
+    args = parser.parse_args()
+
+    if args.index:
+        bench_index(args.index, args.queries, args.k)
+    else:
+        bench_synthetic(args.files, args.per_file, args.dims, args.lists, args.nprobe, args.queries, args.k)
+
+
+if __name__ == '__main__':
+    main()
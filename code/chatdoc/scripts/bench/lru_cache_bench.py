@@ -0,0 +1,77 @@
+'''
+Author: longsion<xianglong_chen@intsig.net>
+Date: 2026-10-18 10:40:31
+LastEditors: longsion
+LastEditTime: 2026-10-18 10:40:31
+'''
+
+# LRUCacheDict 与 ShardedLRUCacheDict 并发读写对比
+# 用法（chatdoc 根目录下执行）:
+#   python -m scripts.bench.lru_cache_bench --threads 80 --ops 20000 --max-size 20000
+
+import argparse
+import random
+import threading
+import time
+
+from pkg.utils.lru_cache import LRUCacheDict, ShardedLRUCacheDict
+
+
+def run(cache, threads, ops, key_space, write_ratio, value):
+    keys = [f"question-{i}##fragment-text-{i}" for i in range(key_space)]
+    for k in keys[:key_space // 2]:
+        cache[k] = value
+
+    barrier = threading.Barrier(threads + 1)
+    hits = [0] * threads
+
+    def worker(idx):
+        rnd = random.Random(idx)
+        barrier.wait()
+        for _ in range(ops):
+            k = keys[rnd.randrange(key_space)]
+            if rnd.random() < write_ratio:
+                cache[k] = value
+            else:
+                try:
+                    cache[k]
+                    hits[idx] += 1
+                except KeyError:
+                    pass
+
+    ts = [threading.Thread(target=worker, args=(i,)) for i in range(threads)]
+    for t in ts:
+        t.start()
+    barrier.wait()
+    start = time.perf_counter()
+    for t in ts:
+        t.join()
+    cost = time.perf_counter() - start
+    total = threads * ops
+    return cost, total / cost, sum(hits) / max(1, total)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--threads", type=int, default=80)
+    parser.add_argument("--ops", type=int, default=20000)
+    parser.add_argument("--max-size", type=int, default=20000)
+    parser.add_argument("--key-space", type=int, default=40000)
+    parser.add_argument("--write-ratio", type=float, default=0.2)
+    parser.add_argument("--shards", type=int, default=16)
+    args = parser.parse_args()
+
+    # 模拟 1024 维 embedding
+    value = [0.1] * 1024
+
+    caches = [
+        ("LRUCacheDict", LRUCacheDict(max_size=args.max_size, expiration=60 * 60, concurrent=True)),
+        ("ShardedLRUCacheDict", ShardedLRUCacheDict(max_size=args.max_size, expiration=60 * 60, shards=args.shards)),
+    ]
+    for name, cache in caches:
+        cost, qps, hit_rate = run(cache, args.threads, args.ops, args.key_space, args.write_ratio, value)
+        print(f"{name:<22} threads={args.threads} cost={cost:.2f}s ops/s={qps:,.0f} hit_rate={hit_rate:.2%} size={cache.size()}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,176 @@
+'''
+Author: longsion<xianglong_chen@intsig.net>
+Date: 2026-10-18 18:40:26
+LastEditors: longsion
+LastEditTime: 2026-10-18 18:40:26
+'''
+
+# 两阶段向量召回的 recall@k 与耗时评估，基准为当前 script_score 全量 dotProduct 的 top-k
+# 1. 线上索引（--index）：随机抽取片段，用其 acge_embedding 作为查询向量（结果中去掉自身），
+#    对比 script_score / knn / two_stage 三种查询体的 recall@k 与耗时
+# 2. 离线（--npy 或 --synthetic）：numpy 模拟粗排 + rescore，对比 float 截断 / int8 / binary 粗排的 recall@k 与每条向量的字节数
+#    --dump 可从索引导出向量到 npy，之后离线反复调参
+# 用法（chatdoc 根目录下执行）:
+#   python -m scripts.bench.two_stage_recall_bench --index doc_fragment --queries 200 --k 25
+#   python -m scripts.bench.two_stage_recall_bench --index doc_fragment --dump /tmp/acge.npy --dump-size 200000
+#   python -m scripts.bench.two_stage_recall_bench --npy /tmp/acge.npy --k 25 --oversample 4
+#   python -m scripts.bench.two_stage_recall_bench --synthetic 100000
+
+import argparse
+import time
+
+import numpy as np
+
+
+def recall(truth: list, got: list, k: int) -> float:
+    return len(set(truth[:k]) & set(got[:k])) / max(1, min(k, len(truth)))
+
+
+def normalize(x):
+    return x / np.maximum(np.linalg.norm(x, axis=-1, keepdims=True), 1e-12)
+
+
+# ---------------- 离线评估 ----------------
+
+def int8_quantize(x, lo, hi):
+    # 与 ES int8_hnsw 类似的标量量化：按分位数截断后线性映射到 [0, 127]
+    scale = 127.0 / np.maximum(hi - lo, 1e-12)
+    return np.clip(np.round((x - lo) * scale), 0, 127).astype(np.int8), scale
+
+
+def synthetic(n, dims=1024, seed=0):
+    # 方差随维度衰减，模拟 Matryoshka 表征前几维信息量更大的特点
+    rng = np.random.default_rng(seed)
+    centers = rng.standard_normal((max(16, n // 200), dims)) * np.linspace(3, 0.3, dims)
+    x = centers[rng.integers(0, len(centers), n)] + rng.standard_normal((n, dims)) * np.linspace(1, 0.5, dims)
+    return normalize(x.astype(np.float32))
+
+
+def bench_offline(vectors, queries, k, oversample, coarse_dims):
+    vectors = normalize(vectors.astype(np.float32))
+    rng = np.random.default_rng(1)
+    query_ids = rng.choice(len(vectors), size=min(queries, len(vectors)), replace=False)
+    window = k * oversample
+
+    coarse = normalize(vectors[:, :coarse_dims])
+    lo, hi = np.quantile(coarse, 0.001), np.quantile(coarse, 0.999)
+    coarse_int8, _ = int8_quantize(coarse, lo, hi)
+    coarse_int8 = coarse_int8.astype(np.float32)
+    coarse_bits = np.packbits(coarse > 0, axis=1)
+
+    methods = {
+        f"float{coarse_dims}": (coarse_dims * 4, lambda q: coarse @ normalize(q[:coarse_dims])),
+        f"int8_{coarse_dims}": (coarse_dims, lambda q: coarse_int8 @ normalize(q[:coarse_dims])),
+        f"binary{coarse_dims}": (coarse_dims // 8, lambda q: -np.unpackbits(coarse_bits ^ np.packbits(q[:coarse_dims] > 0), axis=1).sum(axis=1, dtype=np.int32)),
+    }
+
+    print(f"vectors: {len(vectors)}, queries: {len(query_ids)}, k: {k}, oversample: {oversample}, full: {vectors.shape[1] * 4} bytes/vector")
+    for name, (nbytes, coarse_scores) in methods.items():
+        recalls_coarse, recalls_rescore, cost = [], [], 0.0
+        for qid in query_ids:
+            q = vectors[qid]
+            exact = np.dot(vectors, q)
+            exact[qid] = -np.inf
+            truth = list(np.argsort(-exact)[:k])
+
+            st = time.perf_counter()
+            scores = coarse_scores(q).astype(np.float32)
+            scores[qid] = -np.inf
+            candidates = np.argpartition(-scores, window)[:window]
+            rescored = candidates[np.argsort(-(vectors[candidates] @ q))]
+            cost += time.perf_counter() - st
+
+            recalls_coarse.append(recall(truth, list(candidates[np.argsort(-scores[candidates])]), k))
+            recalls_rescore.append(recall(truth, list(rescored), k))
+
+        print(f"{name:<12} bytes/vector: {nbytes:<5} ({vectors.shape[1] * 4 / nbytes:.0f}x smaller), "
+              f"recall@{k} coarse only: {np.mean(recalls_coarse):.4f}, two stage: {np.mean(recalls_rescore):.4f}, "
+              f"numpy cost: {1000 * cost / len(query_ids):.2f}ms/query")
+
+
+# ---------------- 线上索引评估 ----------------
+
+def sample_docs(index, size):
+    from pkg.es import global_es
+    return global_es.search(index, {
+        "_source": ["uuid", "acge_embedding"],
+        "size": size,
+        "query": {"function_score": {"query": {"exists": {"field": "acge_embedding"}}, "random_score": {"seed": 1, "field": "_seq_no"}}},
+    })
+
+
+def dump(index, path, size):
+    from elasticsearch import helpers
+    from pkg.es import global_es
+    vectors, batch = [], min(size, 5000)
+    for hit in helpers.scan(global_es.conn, index=index, size=batch, _source=["acge_embedding"],
+                            query={"query": {"exists": {"field": "acge_embedding"}}}):
+        vectors.append(hit["_source"]["acge_embedding"])
+        if len(vectors) >= size:
+            break
+    np.save(path, np.asarray(vectors, dtype=np.float32))
+    print(f"dump {len(vectors)} vectors to {path}")
+
+
+def bench_index(index, queries, k):
+    from pkg.es import global_es
+    from pkg.es.es_retrieval import build_embedding_search_body, build_knn_search_body, build_two_stage_search_body
+
+    builders = {
+        "knn": lambda q: build_knn_search_body("acge_embedding", q, k + 1, op_fields=["uuid"]),
+        "two_stage": lambda q: build_two_stage_search_body("acge_embedding", q, k + 1, op_fields=["uuid"]),
+    }
+    latencies = {name: [] for name in ["script_score", *builders]}
+    recalls = {name: [] for name in builders}
+
+    for doc in sample_docs(index, queries):
+        self_uuid, q = doc["_source"]["uuid"], doc["_source"]["acge_embedding"]
+
+        st = time.time()
+        truth = [hit["_source"]["uuid"] for hit in global_es.search(index, build_embedding_search_body("acge_embedding", q, k + 1, ["uuid"]))]
+        latencies["script_score"].append(time.time() - st)
+        truth = [uuid for uuid in truth if uuid != self_uuid]
+
+        for name, builder in builders.items():
+            st = time.time()
+            got = [hit["_source"]["uuid"] for hit in global_es.search(index, builder(q))]
+            latencies[name].append(time.time() - st)
+            recalls[name].append(recall(truth, [uuid for uuid in got if uuid != self_uuid], k))
+
+    for name, values in latencies.items():
+        values.sort()
+        line = f"{name:<12} p50: {1000 * values[len(values) // 2]:.1f}ms, p99: {1000 * values[int(len(values) * 0.99) - 1]:.1f}ms"
+        if name in recalls:
+            line += f", recall@{k}: {np.mean(recalls[name]):.4f}"
+        print(line)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--index", default=None, choices=["doc_fragment", "p_doc_fragment"])
+    parser.add_argument("--npy", default=None)
+    parser.add_argument("--synthetic", type=int, default=0, help="生成 N 条模拟向量做离线评估")
+    parser.add_argument("--dump", default=None, help="从 --index 导出向量到 npy")
+    parser.add_argument("--dump-size", type=int, default=100000)
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("--k", type=int, default=25)
+    parser.add_argument("--oversample", type=int, default=4)
+    parser.add_argument("--coarse-dims", type=int, default=256)
+    args = parser.parse_args()
+
+    if args.index:
+        from pkg.es.es_doc_fragment import DocFragmentES
+        from pkg.es.es_p_doc_fragment import PDocFragmentES
+        index = (DocFragmentES() if args.index == "doc_fragment" else PDocFragmentES()).index_name
+        if args.dump:
+            dump(index, args.dump, args.dump_size)
+        else:
+            bench_index(index, args.queries, args.k)
+        return
+
+    vectors = np.load(args.npy) if args.npy else synthetic(args.synthetic or 50000)
+    bench_offline(vectors, args.queries, args.k, args.oversample, args.coarse_dims)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,36 @@
+'''
+Author: longsion<xianglong_chen@intsig.net>
+Date: 2026-10-18 23:12:40
+LastEditors: longsion
+LastEditTime: 2026-10-18 23:12:40
+'''
+
+# 独立的文档处理 worker 进程，可在多个节点上运行，从 Redis 文档处理队列（pkg/redis/doc_queue.py）领取任务
+# Web 节点只负责入队时，把 config.yaml doc_queue.local_workers 设为 0
+# 用法（chatdoc 根目录下执行）:
+#   python -m scripts.doc_worker --workers 4
+
+import argparse
+import signal
+
+from pkg.config import config
+from pkg.doc_worker import DocWorker
+from pkg.redis.doc_queue import doc_queue
+
+
+def main():
+    queue_config = config.get("doc_queue") or {}
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--workers", type=int, default=int(queue_config.get("local_workers") or 4), help="处理线程数")
+    args = parser.parse_args()
+
+    worker = DocWorker(doc_queue, workers=args.workers, poll_interval=float(queue_config.get("poll_interval", 1)))
+    # 收到退出信号后不再领取新任务，处理中的任务完成后退出；强制退出时未完成的任务超时后由其他 worker 重新处理
+    signal.signal(signal.SIGTERM, lambda *_: worker.stop())
+    signal.signal(signal.SIGINT, lambda *_: worker.stop())
+    worker.start()
+    worker.join()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,83 @@
+'''
+Author: longsion<xianglong_chen@intsig.net>
+Date: 2026-10-18 21:06:12
+LastEditors: longsion
+LastEditTime: 2026-10-18 21:06:12
+'''
+
+# 原文索引表格 markdown 回填：问答链路不再解析 html，content 仍为表格 html 的历史数据需执行一次
+# 1. 给原文索引增加 content_html 映射（只存储不检索）
+# 2. scan 出 type=table 且 content 为 html 的原文，按批转换为 markdown（与入库 html_list_2_markdown 相同，超过 20 个走 proxy 并发）
+# 3. 批量 update：content 改为 markdown，原 html 移到 content_html；已转换的跳过，可重复执行
+# 用法（chatdoc 根目录下执行）:
+#   python -m scripts.es.backfill_doc_item_markdown --target doc_item --target p_doc_item
+
+import argparse
+
+from elasticsearch import helpers
+
+from pkg.doc.preprocess_doctree import html_list_2_markdown
+from pkg.es import global_es
+from pkg.es.es_doc_item import DocItemES
+from pkg.es.es_p_doc_item import PDocItemES
+from pkg.utils.logger import logger
+
+
+TARGETS = {
+    "doc_item": DocItemES,
+    "p_doc_item": PDocItemES,
+}
+
+
+def flush(index, batch):
+    markdowns = html_list_2_markdown([html for _, html in batch])
+    actions = [
+        {
+            "_op_type": "update",
+            "_index": index,
+            "_id": doc_id,
+            "doc": {"content": markdown, "content_html": html},
+        }
+        for (doc_id, html), markdown in zip(batch, markdowns)
+    ]
+    success, errors = helpers.bulk(global_es.conn, actions, raise_on_error=False)
+    if errors:
+        logger.error(f"{index}: {len(errors)} updates failed, first: {errors[0]}")
+    return success
+
+
+def backfill(target, batch_size):
+    es_obj = TARGETS[target]()
+    index = es_obj.index_name
+    global_es.conn.indices.put_mapping(index=index, properties={"content_html": es_obj.properties["content_html"]})
+
+    batch, scanned, updated = [], 0, 0
+    query = {"query": {"bool": {"filter": [dict(term=dict(type="table"))]}}}
+    for hit in helpers.scan(global_es.conn, index=index, _source=["content"], query=query):
+        scanned += 1
+        content = hit["_source"].get("content") or ""
+        if not content.startswith("<table border="):
+            continue
+        batch.append((hit["_id"], content))
+        if len(batch) >= batch_size:
+            updated += flush(index, batch)
+            batch = []
+            logger.info(f"{target}: {scanned} tables scanned, {updated} converted")
+
+    if batch:
+        updated += flush(index, batch)
+    logger.info(f"{target} done: {scanned} tables scanned, {updated} converted")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--target", action="append", choices=list(TARGETS), help="需要回填的原文索引，可重复指定")
+    parser.add_argument("--batch-size", type=int, default=200, help="每批转换并更新的表格数")
+    args = parser.parse_args()
+
+    for target in args.target or list(TARGETS):
+        backfill(target, args.batch_size)
+
+
+if __name__ == '__main__':
+    main()
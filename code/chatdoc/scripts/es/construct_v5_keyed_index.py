@@ -0,0 +1,98 @@
+'''
+Author: longsion<xianglong_chen@intsig.net>
+Date: 2026-10-18 21:24:05
+LastEditors: longsion
+LastEditTime: 2026-10-18 23:55:48
+'''
+
+# 历史数据迁移为确定性 _id（原文: {file_uuid}|{ori_id}，片段: 片段 uuid，表格行: {file_uuid}|{ori_id}|{row_id}，个人库前加 {user_id}|）
+# 原地迁移：scan 出 _id 不是确定性 _id 的文档，按确定性 _id 重新写入（原文按每个 ori_id 各写一份）后删除原文档；已迁移的跳过，可重复执行
+# 每批先 bulk 写入，只删除全部写入成功的原文档；写入失败的原文档保留，重新执行时再次迁移
+# 迁移期间请暂停文档解析与删除；全部完成后 config.yaml es.keyed_lookup_fallback 可设置为 false
+# 用法（chatdoc 根目录下执行）:
+#   python -m scripts.es.construct_v5_keyed_index --target doc_item --target doc_fragment --target doc_table
+
+import argparse
+
+from elasticsearch import helpers
+
+from pkg.es import global_es
+from pkg.es.es_doc_fragment import DocFragmentES
+from pkg.es.es_doc_item import DocItemES
+from pkg.es.es_doc_table import DocTableES
+from pkg.es.es_p_doc_fragment import PDocFragmentES
+from pkg.es.es_p_doc_item import PDocItemES
+from pkg.es.es_p_doc_table import PDocTableES
+from pkg.utils.logger import logger
+
+
+TARGETS = {
+    "doc_item": DocItemES,
+    "p_doc_item": PDocItemES,
+    "doc_fragment": DocFragmentES,
+    "p_doc_fragment": PDocFragmentES,
+    "doc_table": DocTableES,
+    "p_doc_table": PDocTableES,
+}
+
+
+def flush(index, pending):
+    '''
+    pending: [(原文档 _id, 确定性 _id 列表, _source)]，返回删除的原文档数
+    '''
+    actions = [{"_op_type": "index", "_index": index, "_id": doc_id, "_source": source} for _, doc_ids, source in pending for doc_id in doc_ids]
+    indexed, errors = set(), []
+    for ok, item in helpers.streaming_bulk(global_es.conn, actions, chunk_size=len(actions), raise_on_error=False, raise_on_exception=False):
+        if ok:
+            indexed.add(item["index"]["_id"])
+        else:
+            errors.append(item)
+    if errors:
+        logger.error(f"{index}: {len(errors)} index actions failed, first: {errors[0]}")
+
+    deletes = [{"_op_type": "delete", "_index": index, "_id": old_id} for old_id, doc_ids, _ in pending if all(doc_id in indexed for doc_id in doc_ids)]
+    if not deletes:
+        return 0
+    success, errors = helpers.bulk(global_es.conn, deletes, raise_on_error=False)
+    if errors:
+        # 未删除的原文档与新文档重复，重新执行时删除
+        logger.error(f"{index}: {len(errors)} delete actions failed, first: {errors[0]}")
+    return success
+
+
+def migrate(target, batch_size):
+    es_obj = TARGETS[target]()
+    index = es_obj.index_name
+
+    pending, pending_actions, scanned, migrated = [], 0, 0, 0
+    for hit in helpers.scan(global_es.conn, index=index, query={"query": {"match_all": {}}}):
+        scanned += 1
+        source = hit["_source"]
+        doc_ids = es_obj.doc_ids(source)
+        if not doc_ids or hit["_id"] in doc_ids:
+            continue
+
+        pending.append((hit["_id"], doc_ids, source))
+        pending_actions += len(doc_ids)
+        if pending_actions >= batch_size:
+            migrated += flush(index, pending)
+            pending, pending_actions = [], 0
+            logger.info(f"{target}: {scanned} scanned, {migrated} migrated")
+
+    if pending:
+        migrated += flush(index, pending)
+    logger.info(f"{target} done: {scanned} scanned, {migrated} migrated")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--target", action="append", choices=list(TARGETS), help="需要迁移的索引，可重复指定")
+    parser.add_argument("--batch-size", type=int, default=500, help="每批 bulk 写入的文档数")
+    args = parser.parse_args()
+
+    for target in args.target or list(TARGETS):
+        migrate(target, args.batch_size)
+
+
+if __name__ == '__main__':
+    main()
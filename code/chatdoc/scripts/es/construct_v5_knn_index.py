@@ -0,0 +1,106 @@
+'''
+Author: longsion<xianglong_chen@intsig.net>
+Date: 2026-10-18 18:02:15
+LastEditors: longsion
+LastEditTime: 2026-10-18 18:02:15
+'''
+
+# 片段索引 acge_embedding 迁移为 HNSW dense_vector，迁移完成后 config.yaml es.vector_search 设置为 knn
+# 1. 以新 mapping（DocFragmentES / PDocFragmentES.properties）创建目标索引 {源索引}{suffix}
+# 2. _reindex 异步拷贝数据并轮询进度，完成后恢复 refresh/副本设置并校验文档数
+# 3. --swap: 删除源索引，并创建与源索引同名的 alias 指向新索引，无需修改 config.yaml；
+#    不加 --swap 时需手动将 config.yaml 中 es.index_doc_fragment / es.index_p_doc_fragment 改为新索引
+# 迁移期间请暂停文档解析与删除；重复执行只补充目标索引中缺失的文档（op_type=create）
+# ES 8.11+ 创建的索引 dense_vector 默认即为 HNSW，脚本检测到后直接跳过（--force 强制迁移）
+# 用法（chatdoc 根目录下执行）:
+#   python -m scripts.es.construct_v5_knn_index --target doc_fragment --target p_doc_fragment
+#   python -m scripts.es.construct_v5_knn_index --target doc_fragment --swap
+
+import argparse
+import time
+
+from pkg.es import global_es
+from pkg.es.es_doc_fragment import DocFragmentES
+from pkg.es.es_p_doc_fragment import PDocFragmentES
+from pkg.utils.logger import logger
+
+
+TARGETS = {
+    "doc_fragment": DocFragmentES,
+    "p_doc_fragment": PDocFragmentES,
+}
+
+
+def is_hnsw_indexed(index, field="acge_embedding") -> bool:
+    mappings = global_es.conn.indices.get_mapping(index=index)
+    for mapping in mappings.values():
+        field_mapping = mapping["mappings"]["properties"].get(field) or {}
+        if field_mapping.get("index") and (field_mapping.get("index_options") or {}).get("type", "").endswith("hnsw"):
+            return True
+    return False
+
+
+def wait_task(task_id, interval=10):
+    while True:
+        resp = global_es.conn.tasks.get(task_id=task_id)
+        status = resp["task"]["status"]
+        logger.info(f"reindex {task_id}: {status['created'] + status['updated']}/{status['total']}")
+        if resp["completed"]:
+            return resp
+        time.sleep(interval)
+
+
+def migrate(es_obj, suffix, swap, slices, force):
+    source = es_obj.index_name
+    dest = f"{source}{suffix}"
+    conn = global_es.conn
+
+    if not force and is_hnsw_indexed(source):
+        logger.info(f"{source}: acge_embedding already HNSW indexed, skip")
+        return
+
+    if not conn.indices.exists(index=dest):
+        global_es.create_index(dest, dict(settings=es_obj.settings, mappings=dict(properties=es_obj.properties)))
+
+    # 拷贝期间关闭 refresh 与副本，加快 HNSW 构建
+    conn.indices.put_settings(index=dest, settings={"index": {"refresh_interval": "-1", "number_of_replicas": 0}})
+    task = conn.reindex(source={"index": source}, dest={"index": dest, "op_type": "create"}, conflicts="proceed",
+                        slices=slices, wait_for_completion=False)
+    resp = wait_task(task["task"])
+    failures = (resp.get("response") or {}).get("failures")
+    if failures:
+        raise Exception(f"reindex {source} -> {dest} failed: {failures[:3]}")
+
+    index_settings = es_obj.settings["index"]
+    conn.indices.put_settings(index=dest, settings={"index": {"refresh_interval": index_settings["refresh_interval"],
+                                                              "number_of_replicas": index_settings["number_of_replicas"]}})
+    conn.indices.refresh(index=dest)
+
+    source_count, dest_count = conn.count(index=source)["count"], conn.count(index=dest)["count"]
+    logger.info(f"reindex {source} -> {dest} done, docs: {source_count} -> {dest_count}")
+    if source_count != dest_count:
+        raise Exception(f"doc count mismatch: {source}={source_count}, {dest}={dest_count}")
+
+    if swap:
+        conn.indices.delete(index=source)
+        conn.indices.put_alias(index=dest, name=source)
+        logger.info(f"alias {source} -> {dest}")
+    else:
+        logger.info(f"please update config.yaml: {source} -> {dest}")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--target", action="append", choices=list(TARGETS), help="需要迁移的索引，可重复指定")
+    parser.add_argument("--suffix", default="_hnsw")
+    parser.add_argument("--swap", action="store_true", help="迁移后删除源索引，并创建同名 alias 指向新索引")
+    parser.add_argument("--slices", default="auto")
+    parser.add_argument("--force", action="store_true")
+    args = parser.parse_args()
+
+    for target in args.target or list(TARGETS):
+        migrate(TARGETS[target](), args.suffix, args.swap, args.slices, args.force)
+
+
+if __name__ == '__main__':
+    main()
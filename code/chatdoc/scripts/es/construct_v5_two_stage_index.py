@@ -0,0 +1,131 @@
+'''
+Author: longsion<xianglong_chen@intsig.net>
+Date: 2026-10-18 18:40:26
+LastEditors: longsion
+LastEditTime: 2026-10-18 18:40:26
+'''
+
+# 两阶段召回（es.vector_search=two_stage）的索引迁移
+# 默认（原地）：给片段索引增加 acge_embedding_{dims} 字段（int8 HNSW），并用 _update_by_query 从 acge_embedding 截断归一化回填
+# --reindex：新建 {源索引}{suffix}，acge_embedding 设置为 index: false 只保留原始向量用于 rescore，
+#            HNSW 只建在粗排向量上（1024 维 float -> 256 维 int8，向量索引内存约降为 1/16），reindex 时同时生成粗排向量
+#            --swap 与 construct_v5_knn_index.py 相同：删除源索引并创建同名 alias
+# 迁移期间请暂停文档解析与删除
+# 用法（chatdoc 根目录下执行）:
+#   python -m scripts.es.construct_v5_two_stage_index --target doc_fragment --target p_doc_fragment
+#   python -m scripts.es.construct_v5_two_stage_index --target doc_fragment --reindex --swap
+
+import argparse
+
+from pkg.config import config
+from pkg.es import global_es
+from pkg.utils.logger import logger
+from scripts.es.construct_v5_knn_index import TARGETS, wait_task
+
+
+# 与 pkg.embedding.matryoshka_truncate 一致：取前 dims 维并重新归一化
+COARSE_SCRIPT = """
+def v = ctx._source.acge_embedding;
+if (v == null || v.size() < params.dims) { return; }
+double norm = 0;
+List coarse = new ArrayList();
+for (int i = 0; i < params.dims; i++) {
+    double x = v.get(i);
+    coarse.add(x);
+    norm += x * x;
+}
+norm = Math.sqrt(norm);
+if (norm > 0) {
+    for (int i = 0; i < params.dims; i++) {
+        coarse.set(i, coarse.get(i) / norm);
+    }
+}
+ctx._source[params.field] = coarse;
+"""
+
+
+def coarse_properties(es_obj, dims):
+    properties = dict(es_obj.properties)
+    field = f"acge_embedding_{dims}"
+    properties[field] = dict(properties["acge_embedding_256"], dims=dims)
+    if dims != 256:
+        properties.pop("acge_embedding_256")
+    return field, properties
+
+
+def check_result(resp, name):
+    failures = (resp.get("response") or {}).get("failures")
+    if failures:
+        raise Exception(f"{name} failed: {failures[:3]}")
+
+
+def backfill(es_obj, dims, slices):
+    index = es_obj.index_name
+    field, properties = coarse_properties(es_obj, dims)
+    global_es.conn.indices.put_mapping(index=index, properties={field: properties[field]})
+
+    # 只回填缺少粗排向量的文档，可重复执行
+    task = global_es.conn.update_by_query(index=index,
+                                          query={"bool": {"must": [{"exists": {"field": "acge_embedding"}}],
+                                                          "must_not": [{"exists": {"field": field}}]}},
+                                          script={"source": COARSE_SCRIPT, "params": {"dims": dims, "field": field}},
+                                          conflicts="proceed", slices=slices, wait_for_completion=False)
+    check_result(wait_task(task["task"]), f"update_by_query {index}")
+    logger.info(f"{index}: {field} backfilled")
+
+
+def reindex(es_obj, dims, suffix, swap, slices):
+    conn = global_es.conn
+    source = es_obj.index_name
+    dest = f"{source}{suffix}"
+    field, properties = coarse_properties(es_obj, dims)
+    # 原始向量不建 HNSW，只作为 rescore 的 doc values
+    properties["acge_embedding"] = {"type": "dense_vector", "dims": 1024, "index": False}
+
+    if not conn.indices.exists(index=dest):
+        global_es.create_index(dest, dict(settings=es_obj.settings, mappings=dict(properties=properties)))
+
+    conn.indices.put_settings(index=dest, settings={"index": {"refresh_interval": "-1", "number_of_replicas": 0}})
+    task = conn.reindex(source={"index": source}, dest={"index": dest, "op_type": "create"}, conflicts="proceed",
+                        script={"source": COARSE_SCRIPT, "params": {"dims": dims, "field": field}},
+                        slices=slices, wait_for_completion=False)
+    check_result(wait_task(task["task"]), f"reindex {source} -> {dest}")
+
+    index_settings = es_obj.settings["index"]
+    conn.indices.put_settings(index=dest, settings={"index": {"refresh_interval": index_settings["refresh_interval"],
+                                                              "number_of_replicas": index_settings["number_of_replicas"]}})
+    conn.indices.refresh(index=dest)
+
+    source_count, dest_count = conn.count(index=source)["count"], conn.count(index=dest)["count"]
+    logger.info(f"reindex {source} -> {dest} done, docs: {source_count} -> {dest_count}")
+    if source_count != dest_count:
+        raise Exception(f"doc count mismatch: {source}={source_count}, {dest}={dest_count}")
+
+    if swap:
+        conn.indices.delete(index=source)
+        conn.indices.put_alias(index=dest, name=source)
+        logger.info(f"alias {source} -> {dest}")
+    else:
+        logger.info(f"please update config.yaml: {source} -> {dest}")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--target", action="append", choices=list(TARGETS), help="需要迁移的索引，可重复指定")
+    parser.add_argument("--dims", type=int, default=int(config["es"].get("coarse_embedding_dims") or 256))
+    parser.add_argument("--reindex", action="store_true", help="新建索引：原始向量不建 HNSW，只在粗排向量上建 int8 HNSW")
+    parser.add_argument("--suffix", default="_2stage")
+    parser.add_argument("--swap", action="store_true", help="--reindex 后删除源索引，并创建同名 alias 指向新索引")
+    parser.add_argument("--slices", default="auto")
+    args = parser.parse_args()
+
+    for target in args.target or list(TARGETS):
+        es_obj = TARGETS[target]()
+        if args.reindex:
+            reindex(es_obj, args.dims, args.suffix, args.swap, args.slices)
+        else:
+            backfill(es_obj, args.dims, args.slices)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,36 @@
+'''
+Author: longsion<xianglong_chen@intsig.net>
+Date: 2026-10-18 20:58:40
+LastEditors: longsion
+LastEditTime: 2026-10-18 20:58:40
+'''
+
+# 给已有片段索引增加入库时物化的子树字段（tree_ori_ids / tree_text / tree_all_texts，只存储不检索）
+# 未加映射时新字段会被动态映射为 text + keyword 并建倒排；历史切片没有这些字段，问答时回退到递归拼接，重新解析后生效
+# 用法（chatdoc 根目录下执行）:
+#   python -m scripts.es.put_fragment_tree_mapping --target doc_fragment --target p_doc_fragment
+
+import argparse
+
+from pkg.es import global_es
+from pkg.utils.logger import logger
+from scripts.es.construct_v5_knn_index import TARGETS
+
+
+TREE_FIELDS = ["tree_ori_ids", "tree_text", "tree_all_texts"]
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--target", action="append", choices=list(TARGETS), help="需要更新映射的索引，可重复指定")
+    args = parser.parse_args()
+
+    for target in args.target or list(TARGETS):
+        es_obj = TARGETS[target]()
+        properties = {field: es_obj.properties[field] for field in TREE_FIELDS}
+        global_es.conn.indices.put_mapping(index=es_obj.index_name, properties=properties)
+        logger.info(f"{target}: put mapping {TREE_FIELDS} to {es_obj.index_name}")
+
+
+if __name__ == '__main__':
+    main()
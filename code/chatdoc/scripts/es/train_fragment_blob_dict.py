@@ -0,0 +1,58 @@
+'''
+Author: longsion<xianglong_chen@intsig.net>
+Date: 2026-10-18 21:58:12
+LastEditors: longsion
+LastEditTime: 2026-10-18 21:58:12
+'''
+
+# 训练片段 blob 的 zstd 字典：从文件索引 scan 出 doc_fragments_json，编码为未压缩的 blob body 作为样本
+# 训练完成后把字典路径写入 config.yaml fragment_blob.zstd_dict_path 并发布到所有节点；
+# 更换字典后旧字典压缩的 Redis / Storage 缓存无法解码，会回退到片段索引加载，可同时清理 fragment-* 缓存
+# 用法（chatdoc 根目录下执行，需要安装 zstandard）:
+#   python -m scripts.es.train_fragment_blob_dict --output data/fragment_blob.dict --samples 2000
+
+import argparse
+
+import zstandard
+from elasticsearch import helpers
+
+from pkg.es import global_es
+from pkg.es.es_file import FileES
+from pkg.es.es_p_file import PFileES
+from pkg.es.fragment_blob import encode_fragments_body
+from pkg.utils import xjson
+from pkg.utils.logger import logger
+
+
+def collect_samples(max_samples):
+    samples = []
+    for es_obj in [FileES(), PFileES()]:
+        for hit in helpers.scan(global_es.conn, index=es_obj.index_name, _source=["doc_fragments_json"], query={"query": {"match_all": {}}}):
+            doc_fragments_json = hit["_source"].get("doc_fragments_json")
+            if not doc_fragments_json:
+                continue
+            fragments = xjson.loads(doc_fragments_json)
+            if isinstance(fragments, list) and fragments:
+                samples.append(encode_fragments_body(fragments))
+            if len(samples) >= max_samples:
+                return samples
+    return samples
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--output", required=True, help="字典输出路径")
+    parser.add_argument("--samples", type=int, default=2000, help="样本文件数")
+    parser.add_argument("--dict-size", type=int, default=112640, help="字典大小（字节）")
+    args = parser.parse_args()
+
+    samples = collect_samples(args.samples)
+    logger.info(f"collected {len(samples)} samples, {sum(len(sample) for sample in samples)} bytes")
+    zstd_dict = zstandard.train_dictionary(args.dict_size, samples)
+    with open(args.output, "wb") as f:
+        f.write(zstd_dict.as_bytes())
+    logger.info(f"zstd dict {zstd_dict.dict_id()} saved to {args.output}")
+
+
+if __name__ == '__main__':
+    main()
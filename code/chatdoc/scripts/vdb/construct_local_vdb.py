@@ -0,0 +1,116 @@
+'''
+Author: longsion<xianglong_chen@intsig.net>
+Date: 2026-10-18 19:05:12
+LastEditors: longsion
+LastEditTime: 2026-10-18 19:05:12
+'''
+
+# 从 ES 片段索引导入本地向量库（vector.model: local），导入后可训练 IVF 质心
+# 1. composite 聚合分页列出全部 file_uuid（个人库为 user_id + file_uuid）
+# 2. 逐个文件 scan 出 acge_embedding 与切片字段，整段写入本地向量库（可重复执行，已存在的文件跳过，--overwrite 覆盖）
+# 3. --train N: 采样训练 N 个簇的质心并按簇重写所有 segment，全库检索只扫描 local_vdb.nprobe 个簇
+#    经验值 N ≈ 4 * sqrt(向量总数)
+# 用法（chatdoc 根目录下执行）:
+#   python -m scripts.vdb.construct_local_vdb --target doc_fragment --target p_doc_fragment
+#   python -m scripts.vdb.construct_local_vdb --target doc_fragment --train 4096
+
+import argparse
+
+from elasticsearch import helpers
+
+from pkg.es import global_es
+from pkg.es.es_doc_fragment import DocFragmentES
+from pkg.es.es_p_doc_fragment import PDocFragmentES
+from pkg.utils.logger import logger
+from pkg.vdb.local import ANALYST, PERSONAL, analyst_partition, get_local_collection, insert_entities, insert_personal_entities
+
+
+TARGETS = {
+    "doc_fragment": (DocFragmentES, ANALYST),
+    "p_doc_fragment": (PDocFragmentES, PERSONAL),
+}
+
+
+def iter_files(index, personal):
+    sources = [{"file_uuid": {"terms": {"field": "file_uuid"}}}]
+    if personal:
+        sources.insert(0, {"user_id": {"terms": {"field": "user_id"}}})
+
+    after = None
+    while True:
+        composite = {"size": 1000, "sources": sources}
+        if after:
+            composite["after"] = after
+        resp = global_es.conn.search(index=index, size=0, aggs={"files": {"composite": composite}})
+        buckets = resp["aggregations"]["files"]["buckets"]
+        for bucket in buckets:
+            yield bucket["key"].get("user_id"), bucket["key"]["file_uuid"]
+        after = resp["aggregations"]["files"].get("after_key")
+        if not buckets or not after:
+            return
+
+
+def load_file(index, keys, file_uuid, user_id=None):
+    filters = [dict(term=dict(file_uuid=file_uuid))]
+    if user_id:
+        filters.append(dict(term=dict(user_id=user_id)))
+
+    uuids, vectors, payloads = [], [], []
+    for hit in helpers.scan(global_es.conn, index=index, _source=keys + ["acge_embedding"], query={"query": {"bool": {"filter": filters}}}):
+        source = hit["_source"]
+        vector = source.pop("acge_embedding", None)
+        if not vector:
+            continue
+        uuids.append(source["uuid"])
+        vectors.append(vector)
+        payloads.append(source)
+    return uuids, vectors, payloads
+
+
+def construct(target, overwrite):
+    es_cls, collection_name = TARGETS[target]
+    es_obj = es_cls()
+    personal = collection_name == PERSONAL
+    keys = es_obj.keys if personal else es_obj.keys_without_embedding
+    keys = [key for key in keys if key not in ("acge_embedding", "peg_embedding")]
+    collection = get_local_collection(collection_name)
+
+    file_count = vector_count = 0
+    for user_id, file_uuid in iter_files(es_obj.index_name, personal):
+        partition = user_id if personal else analyst_partition(file_uuid)
+        if not overwrite and collection.get_segment(collection.segment_path(partition, file_uuid)) is not None:
+            continue
+
+        uuids, vectors, payloads = load_file(es_obj.index_name, keys, file_uuid, user_id)
+        if not uuids:
+            continue
+        if personal:
+            insert_personal_entities(user_id, file_uuid, uuids, vectors, payloads)
+        else:
+            insert_entities(file_uuid, uuids, vectors, payloads)
+        file_count += 1
+        vector_count += len(uuids)
+        if file_count % 100 == 0:
+            logger.info(f"{target}: {file_count} files, {vector_count} vectors imported")
+
+    logger.info(f"{target} done: {file_count} files, {vector_count} vectors imported")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--target", action="append", choices=list(TARGETS), help="需要导入的索引，可重复指定")
+    parser.add_argument("--overwrite", action="store_true", help="覆盖本地已存在的文件")
+    parser.add_argument("--skip-import", action="store_true", help="只训练质心，不从 ES 导入")
+    parser.add_argument("--train", type=int, default=0, help="训练 IVF 质心的簇数，0 不训练")
+    parser.add_argument("--sample-size", type=int, default=200000)
+    args = parser.parse_args()
+
+    for target in args.target or list(TARGETS):
+        if not args.skip_import:
+            construct(target, args.overwrite)
+        if args.train:
+            get_local_collection(TARGETS[target][1]).train(args.train, sample_size=args.sample_size)
+
+
+if __name__ == '__main__':
+    main()